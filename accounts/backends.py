@@ -0,0 +1,93 @@
+"""
+Backend de autenticación con el usuario en caché.
+
+Con el ModelBackend normal, cada petición de alguien logueado hace un
+SELECT a auth_user para rellenar request.user (AuthenticationMiddleware
+llama a get_user con el id que hay en la sesión). Es la misma fila
+siempre, así que la guardo en la caché shared (settings.CACHES)
+USER_TIMEOUT segundos.
+
+OJO: tiene que ser una caché que vean todos los procesos. Con la de
+memoria de cada uno, forget() solo borraría el usuario del proceso que
+atiende el cambio, y los demás seguirían con el de antes (con la
+contraseña vieja, así que las otras sesiones no se cerrarían). Si la
+shared es LocMem (alguien la ha cambiado en settings.py) no lo guardo.
+
+Se borra de la caché cuando el usuario se guarda o se borra (ver
+signals.py): cambiar la contraseña, el login (last_login), desactivarlo
+en el admin... Así al cambiar la contraseña las otras sesiones se cierran
+igual que antes (get_user compara el hash de la contraseña con el de la
+sesión, y el usuario ya no es el de la caché).
+
+OJO: User.objects.filter(...).update(...) no lanza señales. Si se cambia
+un usuario así, la caché tarda como mucho USER_TIMEOUT en enterarse
+(o forget() a mano).
+
+Los permisos no se guardan: ModelBackend los sigue consultando (solo en
+las páginas que los miran, como el admin).
+"""
+
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import PermissionDenied
+
+
+# La caché donde guardo los usuarios (la misma para todos los procesos)
+USER_CACHE = 'shared'
+
+# Cuánto guardo cada usuario (segundos)
+USER_TIMEOUT = 5 * 60
+
+
+def _key(user_id):
+    return f'accounts:user:{user_id}'
+
+
+def _cache():
+    """La caché de los usuarios, o None si es la de cada proceso (ver arriba)"""
+    users = caches[USER_CACHE]
+    return None if isinstance(users, LocMemCache) else users
+
+
+def forget(user_id):
+    """Quita al usuario de la caché (la siguiente petición lo lee de la BD)"""
+    users = _cache()
+    if users is not None:
+        users.delete(_key(user_id))
+
+
+class CachedModelBackend(ModelBackend):
+    """ModelBackend con get_user (y aget_user) a través de la caché"""
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        user = super().authenticate(request, username, password, **kwargs)
+        if user is None and password is not None:
+            # ModelBackend va detrás (para las sesiones viejas, ver settings.py)
+            # y volvería a comprobar la contraseña: otro hash, que es lento
+            # a propósito. PermissionDenied corta ahí
+            raise PermissionDenied
+        return user
+
+    def get_user(self, user_id):
+        users = _cache()
+        if users is None:
+            return super().get_user(user_id)
+        user = users.get(_key(user_id))
+        if user is None:
+            user = super().get_user(user_id)
+            if user is not None:
+                users.set(_key(user_id), user, USER_TIMEOUT)
+        return user
+
+    async def aget_user(self, user_id):
+        # La shared puede ser de ficheros o Redis (bloquean): aget/aset
+        users = _cache()
+        if users is None:
+            return await super().aget_user(user_id)
+        user = await users.aget(_key(user_id))
+        if user is None:
+            user = await super().aget_user(user_id)
+            if user is not None:
+                await users.aset(_key(user_id), user, USER_TIMEOUT)
+        return user
@@ -0,0 +1,21 @@
+"""
+Señales de accounts.
+
+Se conectan al arrancar la app (ver AccountsConfig.ready en apps.py).
+"""
+
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import backends
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_cached_user(sender, instance, **kwargs):
+    """
+    El usuario ha cambiado (contraseña, last_login, is_active...): fuera
+    de la caché de CachedModelBackend
+    """
+    backends.forget(instance.pk)
@@ -5,11 +5,103 @@ Registro los modelos Tema y Cita para poder gestionarlos desde /admin/
 """
 
 from django.contrib import admin
+from django.http import QueryDict
 from .models import Tema, Cita
+from . import search, sharding
+
+
+class ShardFilter(admin.SimpleListFilter):
+    """
+    Filtro lateral "Shard" (solo con CITAS_SHARDS): en qué BD mirar.
+    
+    No filtra nada: el parámetro lo lee ShardedAdmin, que manda toda la
+    vista a esa BD.
+    """
+    
+    title = 'shard'
+    parameter_name = 'shard'
+    
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in sharding.databases()]
+    
+    def queryset(self, request, queryset):
+        return queryset
+    
+    def choices(self, changelist):
+        # Sin la opción "Todos": se mira un shard cada vez. Marco en el que
+        # se está mirando (sin ?shard= es el del admin)
+        current = sharding.db()
+        for alias, title in self.lookup_choices:
+            yield {
+                'selected': alias == current,
+                # Al cambiar de shard quito el filtro por usuario (mandaría él)
+                'query_string': changelist.get_query_string({self.parameter_name: alias}, ['owner__']),
+                'display': title,
+            }
+
+
+class ShardedAdmin(admin.ModelAdmin):
+    """
+    Admin de un modelo repartido por shards (ver sharding.py).
+    
+    Sin esto el admin solo veía lo del shard del admin (el que pone
+    ShardMiddleware). Ahora cada vista va al shard que dice la URL:
+    - filtrando por usuario (?owner__id__exact=5): el de ese usuario
+    - con el filtro Shard (?shard=shard_1): ese
+    - si no, el del admin, como antes
+    
+    En la ficha de un objeto (editar, borrar, historial) Django trae los
+    filtros de la lista en _changelist_filters para volver a ella
+    después, así que el shard viene con ellos.
+    
+    OJO: los enlaces que no vienen de la lista (las "acciones recientes"
+    de la portada del admin) no llevan filtros: abren el objeto con ese
+    id del shard del admin, que puede ser otro.
+    """
+    
+    def get_list_filter(self, request):
+        list_filter = super().get_list_filter(request)
+        if sharding.enabled():
+            return [ShardFilter, 'owner', *list_filter]
+        return list_filter
+    
+    def _shard(self, request):
+        """El shard que pide la URL, o None (el del admin)"""
+        for params in (request.GET, QueryDict(request.GET.get('_changelist_filters', ''))):
+            owner_id = params.get('owner__id__exact', '')
+            if owner_id.isdigit():
+                return sharding.db_for_owner(int(owner_id))
+            if params.get('shard') in sharding.databases():
+                return params['shard']
+        return None
+    
+    def _in_shard(self, view, request, *args, **kwargs):
+        alias = self._shard(request) if sharding.enabled() else None
+        if alias is None:
+            return view(request, *args, **kwargs)
+        with sharding.using(alias):
+            response = view(request, *args, **kwargs)
+            # OJO: las plantillas del admin también consultan (los <select>
+            # de la ficha, los filtros...): hay que renderizar aquí dentro
+            if hasattr(response, 'render'):
+                response.render()
+            return response
+    
+    def changelist_view(self, request, extra_context=None):
+        return self._in_shard(super().changelist_view, request, extra_context)
+    
+    def changeform_view(self, request, object_id=None, form_url='', extra_context=None):
+        return self._in_shard(super().changeform_view, request, object_id, form_url, extra_context)
+    
+    def delete_view(self, request, object_id, extra_context=None):
+        return self._in_shard(super().delete_view, request, object_id, extra_context)
+    
+    def history_view(self, request, object_id, extra_context=None):
+        return self._in_shard(super().history_view, request, object_id, extra_context)
 
 
 @admin.register(Tema)
-class TemaAdmin(admin.ModelAdmin):
+class TemaAdmin(ShardedAdmin):
     """
     Configuración del admin para Tema.
     
@@ -24,10 +116,25 @@ class TemaAdmin(admin.ModelAdmin):
     
     # Filtros laterales
     list_filter = ['created_at']
+    
+    
+    def get_search_fields(self, request):
+        # Con CITAS_SHARDS auth_user está en otra BD: no se puede buscar
+        # por owner__username (sería un JOIN). Ver sharding.py
+        if sharding.enabled():
+            return ['name']
+        return super().get_search_fields(request)
+    
+    
+    def get_list_select_related(self, request):
+        # Lo mismo: sin JOIN con auth_user (el owner se carga de default)
+        if sharding.enabled():
+            return ()
+        return super().get_list_select_related(request)
 
 
 @admin.register(Cita)
-class CitaAdmin(admin.ModelAdmin):
+class CitaAdmin(ShardedAdmin):
     """
     Configuración del admin para Cita.
     
@@ -40,7 +147,9 @@ class CitaAdmin(admin.ModelAdmin):
     list_display = ['id', 'get_preview', 'source', 'tag', 'is_favorite', 'owner', 'created_at']
     
     # Campos por los que se puede buscar
-    search_fields = ['text', 'source', 'owner__username']
+    # text y source NO van aquí: los busco con el índice FTS5
+    # en get_search_results() (ver search.py)
+    search_fields = ['owner__username']
     
     # Filtros laterales
     list_filter = ['is_favorite', 'tag', 'created_at']
@@ -49,6 +158,19 @@ class CitaAdmin(admin.ModelAdmin):
     readonly_fields = ['created_at', 'updated_at']
     
     
+    def get_search_fields(self, request):
+        # Con CITAS_SHARDS no se busca por usuario (ver TemaAdmin)
+        if sharding.enabled():
+            return []
+        return super().get_search_fields(request)
+    
+    
+    def get_list_select_related(self, request):
+        if sharding.enabled():
+            return ['tag']
+        return super().get_list_select_related(request)
+    
+    
     def get_preview(self, obj):
         """
         Método personalizado para mostrar un preview del texto.
@@ -67,4 +189,60 @@ class CitaAdmin(admin.ModelAdmin):
         return '[Vacía]'
     
     # short_description es el título de la columna en el admin
-    get_preview.short_description = 'Preview'
\ No newline at end of file
+    get_preview.short_description = 'Preview'
+    
+    
+    def get_queryset(self, request):
+        """
+        Si se está buscando, añado search_rank (relevancia del índice FTS5)
+        para poder ordenar por él en get_ordering().
+        
+        Es lo mismo que el get_queryset() del admin, pero anotando ANTES
+        de ordenar (si no, order_by('search_rank') no encuentra el campo).
+        """
+        queryset = self.model._default_manager.get_queryset()
+        search_term = request.GET.get('q')
+        
+        if search_term:
+            queryset = search.annotate_rank(queryset, search_term)
+        
+        ordering = self.get_ordering(request)
+        if ordering:
+            queryset = queryset.order_by(*ordering)
+        
+        return queryset
+    
+    
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Búsqueda del admin.
+        
+        - Por usuario: lo normal de Django (search_fields)
+        - Por texto y fuente: con el índice de texto completo
+        
+        Junto las dos cosas con OR.
+        """
+        by_owner, may_have_duplicates = super().get_search_results(
+            request, queryset, search_term
+        )
+        
+        if not search_term:
+            return by_owner, may_have_duplicates
+        
+        by_text = search.filter_queryset(queryset, search_term)
+        
+        if not self.get_search_fields(request):
+            # Sin search_fields (con CITAS_SHARDS) by_owner son todas
+            return by_text, may_have_duplicates
+        
+        return by_owner | by_text, may_have_duplicates
+    
+    
+    def get_ordering(self, request):
+        """
+        Si se está buscando, las más relevantes primero.
+        (Si haces clic en una columna, manda el orden de esa columna)
+        """
+        if request.GET.get('q'):
+            return ['search_rank', '-created_at']
+        return super().get_ordering(request)
@@ -1,5 +1,36 @@
 from django.apps import AppConfig
+from django.core import checks
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
+
+
+def install_search_index(sender, using, **kwargs):
+    """
+    Después de cada migrate me aseguro de que el índice FTS5 exista.
+
+    (Ver search.py para saber por qué no va en una migración normal)
+    """
+    from django.db import connections
+    from . import search
+
+    search.install(connections[using])
 
 
 class CitasConfig(AppConfig):
     name = 'citas'
+    
+    def ready(self):
+        # Importo las señales para que se registren los @receiver
+        from . import signals  # noqa: F401
+        
+        # sender=self: solo cuando se migra esta app, no por cada app
+        post_migrate.connect(install_search_index, sender=self)
+        
+        # Cada conexión a la BD mide sus consultas (ver timing.py)
+        from . import timing
+        connection_created.connect(timing.install_wrapper)
+        
+        # Aviso si hay varios workers: los cambios en directo no se
+        # reparten entre procesos (ver events.py)
+        from . import events
+        checks.register(events.check_single_process)
@@ -0,0 +1,242 @@
+"""
+Vistas async de las páginas que más se visitan.
+
+Con ASGI (asgi.py pone CITAS_ASYNC_VIEWS=1, ver settings.py) urls.py usa
+estas en vez de las de views.py para:
+- la lista de citas (quote_list)
+- el inbox (quote_inbox)
+- la cita aleatoria (quote_random)
+- marcar/desmarcar favorita sin JS (quote_toggle_favorite)
+
+Y aquí está la única que solo tiene sentido con ASGI: quote_events, los
+cambios en directo para las otras pestañas (ver events.py).
+
+Hacen exactamente lo mismo que las de views.py (reutilizo sus funciones
+y las mismas plantillas), pero con el ORM async (aget, afirst, aupdate,
+async for...). Así, bajo ASGI, Django no tiene que pasar cada petición
+a un hilo aparte para ejecutar una vista normal: mientras una espera a
+la BD el bucle de eventos atiende otras.
+
+OJO: el ORM async de Django por dentro sigue siendo síncrono
+(sync_to_async con thread_sensitive=True): todas las consultas van por
+el mismo hilo, una detrás de otra. Lo que se gana es lo que no es BD
+(caché, renderizar). Para medirlo: python manage.py bench_views.
+
+Lo que solo existe síncrono (validar el formulario de filtros, que
+consulta el tema; la búsqueda FTS5; el clasificador; las parecidas) lo
+llamo con sync_to_async.
+
+Mientras se renderiza no se puede consultar la BD (salta
+SynchronousOnlyOperation), así que antes de render() dejo cargado todo
+lo que usa la plantilla: el usuario (request.user), los contadores de la
+barra (request.contador_citas, ver context_processors.py) y el nombre
+del tema elegido en el filtro (TemaAutocomplete.label).
+
+@login_required funciona igual con vistas async (Django 5.1+).
+"""
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.auth.decorators import login_required
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.shortcuts import aget_object_or_404, redirect, render
+
+from . import caching, counters, events, random_draw, related, views
+from .forms import BulkActionForm, QuoteFilterForm
+from .models import Cita, Tema
+from .pagination import ORDERING, akeyset_page
+
+
+async def _load_user(request):
+    """
+    El usuario de la sesión y sus contadores, cargados antes de renderizar.
+
+    Dejo el usuario en request.user para que el context processor de auth
+    no lo tenga que buscar (sería una consulta síncrona).
+    """
+    user = await request.auser()
+    request.user = user
+    request.contador_citas = await counters.afor_owner(user.pk)
+    return user
+
+
+def _filter(citas, form):
+    """
+    views.filter_citas y el nombre del tema elegido para el widget.
+
+    Es síncrona (validar el tema y la búsqueda consultan la BD): se llama
+    con sync_to_async.
+    """
+    citas = views.filter_citas(citas, form)
+    if form.is_bound:
+        tag = form.cleaned_data.get('tag') if form.is_valid() else None
+        form.fields['tag'].widget.label = tag.name if tag else ''
+    return citas
+
+
+async def _page_ids(request, user_cache, citas):
+    """Lo mismo que views._page_ids con akeyset_page"""
+    key = user_cache.key('page', caching.digest(sorted(request.GET.lists())))
+    cached = cache.get(key)
+    if cached is not None:
+        ids, next_cursor = cached
+        return ids, next_cursor, None
+
+    page, next_cursor = await akeyset_page(citas, request.GET.get('cursor'))
+    ids = [cita.pk for cita in page]
+    cache.set(key, (ids, next_cursor), caching.IDS_TIMEOUT)
+    return ids, next_cursor, {cita.pk: cita for cita in page}
+
+
+async def _cached_count(request, user_cache, citas, form):
+    """
+    Lo mismo que views._cached_count. Sin filtros el total ya lo tengo
+    (request.contador_citas); si no, la de views.py con sync_to_async.
+    """
+    if not getattr(settings, 'CITAS_SHOW_COUNT', True):
+        return None
+    if not form.is_bound:
+        return request.contador_citas.total
+    return await sync_to_async(views._cached_count)(request, user_cache, citas, form)
+
+
+@login_required
+async def quote_list(request):
+    """Lista de citas con filtros (ver views.quote_list)"""
+    user = await _load_user(request)
+    citas = Cita.objects.filter(owner=user).select_related('tag')
+
+    form = QuoteFilterForm(request.GET or None, user=user)
+    citas = await sync_to_async(_filter)(citas, form)
+
+    user_cache = caching.UserCache(user.pk)
+    ids, next_cursor, page = await _page_ids(request, user_cache, citas)
+    cards = await caching.arender_cards(request, user_cache, ids, views.CARD_TEMPLATE, page, csrf=True)
+    next_url, next_fragment_url = views._next_page_urls(request, next_cursor)
+
+    return render(request, 'citas/quote_list.html', {
+        'cards': cards,
+        'total': await _cached_count(request, user_cache, citas, form),
+        'form': form,
+        'bulk_form': BulkActionForm(user=user),
+        'next_url': next_url,
+        'next_fragment_url': next_fragment_url,
+    })
+
+
+@login_required
+async def quote_inbox(request):
+    """Citas sin tema, con los temas sugeridos (ver views.quote_inbox)"""
+    user = await _load_user(request)
+    citas = Cita.objects.filter(owner=user, tag__isnull=True)
+
+    user_cache = caching.UserCache(user.pk)
+    key = user_cache.key('inbox')
+    ids = cache.get(key)
+    if ids is None:
+        ids = [pk async for pk in citas.order_by(*ORDERING).values_list('pk', flat=True)]
+        cache.set(key, ids, caching.IDS_TIMEOUT)
+
+    cards = await caching.arender_cards(
+        request, user_cache, ids, views.INBOX_TEMPLATE,
+        csrf=True, context=sync_to_async(views._suggested_temas(user.pk)),
+    )
+
+    return render(request, 'citas/quote_inbox.html', {
+        'cards': cards,
+        'bulk_form': BulkActionForm(user=user),
+    })
+
+
+@login_required
+async def quote_random(request):
+    """Una cita aleatoria y sus parecidas (ver views.quote_random)"""
+    user = await _load_user(request)
+    scope = views._random_scope(request)
+    deck = request.GET.get('mazo') == '1'
+
+    user_cache = caching.UserCache(user.pk)
+    template = views.RANDOM_TEMPLATE
+    cita_id = await random_draw.adraw_id(user.pk, scope, deck=deck)
+    cards = await caching.arender_cards(request, user_cache, [cita_id], template) if cita_id else []
+
+    if cita_id and not cards:
+        # La cita se acaba de borrar: adraw() lo vuelve a intentar
+        cita = await random_draw.adraw(user.pk, scope, deck=deck)
+        cita_id = cita.pk if cita else None
+        cards = await caching.arender_cards(request, user_cache, [cita_id], template, {cita_id: cita}) if cita else []
+
+    return render(request, 'citas/quote_random.html', {
+        'cita_id': cita_id,
+        'card': cards[0] if cards else None,
+        'related': await sync_to_async(related.similar)(user.pk, cita_id) if cards else [],
+        # Una lista, no el queryset: la plantilla no puede consultar la BD
+        'temas': [tema async for tema in Tema.objects.filter(owner=user)],
+        'ambito': request.GET.get('ambito', ''),
+        'tema_actual': int(scope[5:]) if scope.startswith('tema:') else None,
+        'mazo': deck,
+        'query': request.GET.urlencode(),
+    })
+
+
+async def set_favorite(user, pk, favorite):
+    """Lo mismo que views.set_favorite con el ORM async"""
+    changed = await (Cita.objects.filter(pk=pk, owner=user)
+                     .exclude(is_favorite=favorite)
+                     .aupdate(is_favorite=favorite))
+
+    if changed:
+        await counters.aadd_to_favorites(user.pk, 1 if favorite else -1)
+        caching.bump(user.pk)
+        # aupdate() ya está confirmado (no hay transacción): sin on_commit
+        events.hub.publish(user.pk, events.TOGGLED, id=pk, is_favorite=favorite)
+    elif not await Cita.objects.filter(pk=pk, owner=user).aexists():
+        raise Http404('Cita no encontrada')
+
+    return bool(changed)
+
+
+@login_required
+async def quote_toggle_favorite(request, pk):
+    """Marcar/desmarcar favorita sin JS (ver views.quote_toggle_favorite)"""
+    if request.method == 'POST':
+        user = await request.auser()
+        favorite = views._favorite_from_post(request)
+        if favorite is None:
+            cita = await aget_object_or_404(Cita.objects.only('is_favorite'), pk=pk, owner=user)
+            favorite = not cita.is_favorite
+
+        await set_favorite(user, pk, favorite)
+
+        if favorite:
+            messages.success(request, 'Cita marcada como favorita ⭐')
+        else:
+            messages.info(request, 'Cita desmarcada de favoritas')
+
+    return redirect(request.META.get('HTTP_REFERER', 'citas:quote_list'))
+
+
+@login_required
+async def quote_events(request):
+    """
+    Los cambios de mis citas en directo (Server-Sent Events, ver events.py).
+
+    main.js abre un EventSource aquí y la respuesta no termina nunca: cada
+    cambio es un trozo más. Con WSGI cada conexión abierta ocuparía un
+    hilo para siempre, así que ahí contesto 204 (el navegador deja de
+    intentarlo) y las pestañas funcionan como antes.
+    """
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+
+    user = await request.auser()
+    subscriber = events.hub.subscribe(user.pk, request.headers.get('Last-Event-ID'))
+
+    response = StreamingHttpResponse(events.stream(subscriber), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # nginx: que no guarde los eventos en su buffer
+    response['X-Accel-Buffering'] = 'no'
+    return response
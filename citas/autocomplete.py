@@ -0,0 +1,161 @@
+"""
+Autocompletar la fuente de las citas y los temas.
+
+La fuente ("Autor, libro, película...") es texto libre, así que el mismo
+autor acaba escrito de tres formas. Y el selector de temas mandaba en
+cada página un <option> por tema. Ahora los dos campos son un input que
+pide sugerencias a /citas/api/autocomplete/ mientras escribes.
+
+Cada usuario tiene un índice en memoria del proceso (PrefixIndex) por
+campo: una lista ORDENADA de claves normalizadas (minúsculas, sin tildes)
+y, con bisect, las que empiezan por lo escrito son un trozo seguido de la
+lista: dos búsquedas binarias, sin recorrerla entera (solo ese trozo,
+para quedarme con las que más citas tienen). Cada valor entra
+una vez por palabra ("friedrich nietzsche" y "nietzsche"), así "nietz"
+también encuentra "Friedrich Nietzsche". Salen primero las que más citas
+tienen.
+
+Las fuentes que solo se diferencian en mayúsculas o tildes cuentan como
+una sola, y se sugiere la forma más usada.
+
+Los índices se guardan con la versión de la caché del usuario (ver
+caching.py): cualquier cambio en sus citas o temas hace que se vuelva a
+construir la próxima vez (una consulta). Solo guardo los MAX_INDEXES
+últimos usados: los de los usuarios que no escriben se van tirando (LRU).
+"""
+
+import heapq
+import threading
+import unicodedata
+from bisect import bisect_left
+from collections import Counter, OrderedDict, defaultdict
+
+from django.db.models import Count
+
+from . import caching, counters
+from .models import Cita, Tema
+
+
+SOURCE = 'source'
+TEMA = 'tema'
+FIELDS = (SOURCE, TEMA)
+
+# Sugerencias por petición (por defecto y como mucho)
+LIMIT = 8
+MAX_LIMIT = 20
+
+# Índices (usuario, campo) que guarda cada proceso
+MAX_INDEXES = 128
+
+
+def _normalize(value):
+    """'  Friedrich NIETZSCHE ' -> 'friedrich nietzsche' (sin tildes)"""
+    value = unicodedata.normalize('NFKD', (value or '').lower())
+    value = ''.join(char for char in value if not unicodedata.combining(char))
+    return ' '.join(value.split())
+
+
+class PrefixIndex:
+    """
+    Búsqueda por prefijo en una lista ordenada.
+
+    entries: lista de (valor, número de citas, id o None).
+    """
+
+    def __init__(self, entries):
+        self.entries = list(entries)
+        keys = []
+        for position, (value, _, _) in enumerate(self.entries):
+            words = _normalize(value).split()
+            keys.extend((' '.join(words[start:]), position) for start in range(len(words)))
+        keys.sort()
+
+        # Los valores ordenados de más a menos citas: en vez de la posición
+        # de cada valor guardo su puesto en esta lista, así quedarse con
+        # los mejores es quedarse con los números más pequeños
+        self.top = sorted(range(len(self.entries)), key=lambda i: (-self.entries[i][1], self.entries[i][0]))
+        rank = {position: number for number, position in enumerate(self.top)}
+
+        self.keys = [key for key, _ in keys]
+        self.ranks = [rank[position] for _, position in keys]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def search(self, prefix, limit=LIMIT):
+        """
+        Los valores que tienen una palabra que empieza por prefix: [(valor, citas, id)]
+
+        Encontrar el trozo de claves que empiezan por prefix son dos
+        búsquedas binarias, pero elegir los mejores recorre ese trozo
+        entero (O(claves que coinciden)). OJO: con una o dos letras
+        puede ser buena parte de la lista; con más se queda en nada.
+        """
+        prefix = _normalize(prefix)
+        if not prefix:
+            return [self.entries[i] for i in self.top[:limit]]
+
+        start = bisect_left(self.keys, prefix)
+        # '\U0010ffff' es el carácter más alto: todo lo que empieza por prefix va antes
+        end = bisect_left(self.keys, prefix + '\U0010ffff', start)
+        best = heapq.nsmallest(limit, set(self.ranks[start:end]))
+        return [self.entries[self.top[number]] for number in best]
+
+
+def _source_entries(owner_id):
+    """Las fuentes del usuario, juntando las que se escriben distinto"""
+    rows = (Cita.objects.filter(owner_id=owner_id).exclude(source='')
+            .values_list('source').annotate(count=Count('pk')).order_by())
+    spellings = defaultdict(Counter)
+    for source, count in rows:
+        spellings[_normalize(source)][source.strip()] += count
+    return [
+        (written.most_common(1)[0][0], sum(written.values()), None)
+        for key, written in spellings.items() if key
+    ]
+
+
+def _tema_entries(owner_id):
+    """Los temas del usuario con su número de citas (de ContadorTema, sin COUNT)"""
+    counts = counters.tema_counts(owner_id)
+    return [
+        (name, counts.get(pk) or 0, pk)
+        for pk, name in Tema.objects.filter(owner_id=owner_id).values_list('pk', 'name')
+    ]
+
+
+_indexes = OrderedDict()
+_lock = threading.Lock()
+
+
+def load(owner_id, field):
+    """El índice de un campo del usuario (lo construyo si no está o es viejo)"""
+    version = caching.get_version(owner_id)
+    key = (owner_id, field)
+    with _lock:
+        entry = _indexes.get(key)
+        if entry and entry[0] == version:
+            _indexes.move_to_end(key)
+            return entry[1]
+
+    entries = _source_entries(owner_id) if field == SOURCE else _tema_entries(owner_id)
+    index = PrefixIndex(entries)
+    with _lock:
+        _indexes[key] = (version, index)
+        _indexes.move_to_end(key)
+        while len(_indexes) > MAX_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+
+def suggest(owner_id, field, prefix, limit=LIMIT):
+    """Las sugerencias para lo escrito: [{'value', 'count'(, 'id')}]"""
+    results = []
+    # Entre 1 y MAX_LIMIT (con un límite negativo top[:limit] las daría casi todas)
+    limit = max(1, min(limit, MAX_LIMIT))
+    for value, count, pk in load(owner_id, field).search(prefix, limit):
+        result = {'value': value, 'count': count}
+        if pk is not None:
+            result['id'] = pk
+        results.append(result)
+    return results
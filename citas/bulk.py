@@ -0,0 +1,200 @@
+"""
+Acciones en bloque sobre muchas citas a la vez (clasificar, favoritas, borrar).
+
+Clasificar el inbox era abrir quote_edit por cada cita: un GET, un POST y
+una redirección por cita. Con esto se marcan varias en la lista o en el
+inbox y se cambian todas con una sola petición.
+
+Cada acción son unas pocas consultas, no unas pocas POR CITA:
+
+    SELECT id, tag_id, is_favorite, image, text, source FROM citas_cita
+        WHERE id IN (...) AND owner_id = 1           -- lo que cambia
+    UPDATE citas_cita SET tag_id = 3
+        WHERE id IN (...) AND owner_id = 1           -- (o DELETE)
+
+todo dentro de una transacción (en la BD del usuario, ver sharding.py).
+Como update() y el borrado directo no
+mandan señales, lo que hacían las señales por cada cita lo hago aquí una
+vez para todas:
+- contadores: sumo las diferencias y hago un UPDATE por usuario/tema
+  (counters.apply_changes)
+- imágenes: una referencia menos por cada cita borrada
+  (image_refs.release_many)
+- caché: subo la versión del usuario (caching.bump)
+- sugerencias de tema: el clasificador aprende los cambios de tema
+  (suggestions.record_changes)
+- las otras pestañas del usuario: un evento por cita (events.publish_many)
+
+El índice de búsqueda (FTS5) se mantiene solo con sus triggers.
+"""
+
+from collections import Counter
+
+from django.db import transaction
+
+from . import caching, counters, events, image_refs, related, sharding, suggestions
+from .models import Cita, CubetaImagen, CubetaLSH
+
+
+# Acciones que se pueden hacer (valor del <select>, texto)
+CLASSIFY = 'classify'
+FAVORITE = 'favorite'
+UNFAVORITE = 'unfavorite'
+DELETE = 'delete'
+
+ACTIONS = [
+    (CLASSIFY, 'Mover al tema...'),
+    (FAVORITE, 'Marcar como favoritas'),
+    (UNFAVORITE, 'Quitar de favoritas'),
+    (DELETE, 'Borrar'),
+]
+
+# Ids por consulta. SQLite antiguo no deja más de 999 parámetros en una
+# consulta, así que con muchísimas citas seleccionadas voy por trozos
+# (siguen siendo pocas consultas y todo en la misma transacción)
+BATCH_SIZE = 900
+
+
+def _batches(ids):
+    ids = sorted(set(ids))
+    for start in range(0, len(ids), BATCH_SIZE):
+        yield ids[start:start + BATCH_SIZE]
+
+
+def _state(owner_id, row):
+    """El snapshot de counters.py a partir de una fila de _rows()"""
+    _, tag_id, is_favorite, image, _, _ = row
+    return (owner_id, tag_id, bool(is_favorite), bool(image))
+
+
+def _document(row):
+    """El snapshot de suggestions.py a partir de una fila de _rows()"""
+    _, tag_id, _, _, text, source = row
+    return (tag_id, text, source)
+
+
+def _rows(owner_id, ids, exclude=None):
+    """
+    (id, tag_id, is_favorite, image, text, source) de las citas ids del usuario.
+
+    exclude: las que ya están como se quiere dejarlas (no cambian nada,
+    así no cuentan en el número de afectadas).
+    """
+    citas = Cita.objects.filter(owner_id=owner_id, pk__in=ids)
+    if exclude:
+        citas = citas.exclude(**exclude)
+    # select_for_update: en PostgreSQL bloquea las filas hasta el UPDATE
+    # para que los contadores no se desajusten (en SQLite no hace nada)
+    return list(citas.select_for_update()
+                .values_list('pk', 'tag_id', 'is_favorite', 'image', 'text', 'source'))
+
+
+def classify(owner_id, ids, tema):
+    """Pone el tema a las citas (tema=None las manda al inbox)"""
+    exclude = {'tag__isnull': True} if tema is None else {'tag': tema}
+    tag_id = tema.pk if tema else None
+
+    def moved(state):
+        owner, _, is_favorite, has_image = state
+        return (owner, tag_id, is_favorite, has_image)
+
+    return _update(owner_id, ids, exclude, {'tag_id': tag_id}, moved, learn=True,
+                   event=(events.UPDATED, {'tag': tag_id}))
+
+
+def set_favorite(owner_id, ids, favorite):
+    """Marca (favorite=True) o desmarca como favoritas"""
+    def marked(state):
+        owner, tag_id, _, has_image = state
+        return (owner, tag_id, favorite, has_image)
+
+    return _update(owner_id, ids, {'is_favorite': favorite}, {'is_favorite': favorite}, marked,
+                   event=(events.TOGGLED, {'is_favorite': favorite}))
+
+
+def _update(owner_id, ids, exclude, values, new_state, learn=False, event=None):
+    """
+    Un UPDATE por trozo de ids, solo de las citas que cambian de verdad.
+
+    new_state(old) dice cómo queda cada cita, para los contadores.
+    learn=True si cambia el tema (el clasificador de temas lo aprende).
+    event = (tipo, datos) que se manda por cada cita (ver events.py).
+    Devuelve cuántas citas han cambiado.
+    """
+    changed = []
+    alias = sharding.db_for_owner(owner_id)
+    with transaction.atomic(using=alias):
+        for batch in _batches(ids):
+            rows = _rows(owner_id, batch, exclude)
+            if not rows:
+                continue
+
+            Cita.objects.filter(owner_id=owner_id, pk__in=[row[0] for row in rows]).update(**values)
+
+            states = [_state(owner_id, row) for row in rows]
+            counters.apply_changes([(state, new_state(state)) for state in states])
+            if learn:
+                suggestions.record_changes(owner_id, [
+                    (_document(row), (values['tag_id'], row[4], row[5])) for row in rows
+                ])
+            changed.extend(row[0] for row in rows)
+
+        if changed:
+            caching.bump(owner_id, using=alias)
+            if event:
+                kind, data = event
+                events.publish_many(owner_id, kind, changed, **data)
+    return len(changed)
+
+
+def delete(owner_id, ids):
+    """
+    Borra las citas con un DELETE por trozo de ids.
+
+    OJO: Cita.objects.filter(...).delete() NO hace un solo DELETE: como
+    hay señales de post_delete (signals.py), Django carga las citas y
+    manda la señal una por una. Uso _raw_delete (el DELETE directo que
+    usa Django cuando no hay señales) y hago aquí lo de las señales.
+    Lo único que tiene una ForeignKey a Cita son sus cubetas (LSH del
+    texto, ver duplicates.py, y las de la imagen, ver perceptual.py), y
+    esas las borro antes a mano (sin señales tampoco).
+    """
+    deleted = []
+    # Las referencias de las imágenes (Imagen) están siempre en default:
+    # una transacción en cada BD (si es la misma, la de dentro no hace nada)
+    alias = sharding.db_for_owner(owner_id)
+    with transaction.atomic(), transaction.atomic(using=alias):
+        for batch in _batches(ids):
+            rows = _rows(owner_id, batch)
+            if not rows:
+                continue
+
+            pks = [row[0] for row in rows]
+            CubetaLSH.objects.filter(cita_id__in=pks).delete()
+            CubetaImagen.objects.filter(cita_id__in=pks).delete()
+            citas = Cita.objects.filter(owner_id=owner_id, pk__in=pks)
+            citas._raw_delete(citas.db)
+
+            counters.apply_changes([(_state(owner_id, row), None) for row in rows])
+            image_refs.release_many(Counter(row[3] for row in rows if row[3]))
+            suggestions.record_changes(owner_id, [(_document(row), None) for row in rows])
+            related.forget(owner_id, pks)
+            deleted.extend(pks)
+
+        if deleted:
+            caching.bump(owner_id, using=alias)
+            events.publish_many(owner_id, events.DELETED, deleted)
+    return len(deleted)
+
+
+def run(owner_id, action, ids, tema=None):
+    """Hace la acción y devuelve el número de citas afectadas"""
+    if action == CLASSIFY:
+        return classify(owner_id, ids, tema)
+    if action == FAVORITE:
+        return set_favorite(owner_id, ids, True)
+    if action == UNFAVORITE:
+        return set_favorite(owner_id, ids, False)
+    if action == DELETE:
+        return delete(owner_id, ids)
+    raise ValueError(f'Acción desconocida: {action}')
@@ -0,0 +1,205 @@
+"""
+Backends de caché con límite de memoria (LRU) y estadísticas.
+
+Los de Django limitan el NÚMERO de entradas (MAX_ENTRIES), pero no lo que
+ocupan: 300 tarjetas pequeñas no son lo mismo que 300 listas de ids
+enormes. Estos dos añaden:
+
+- MAX_BYTES en OPTIONS: cuando la caché pasa de ese tamaño se tiran las
+  entradas usadas hace más tiempo (LRU = least recently used).
+- stats(): aciertos (hits), fallos (misses), entradas tiradas (evictions),
+  número de entradas y bytes. Son de este proceso: con varios workers
+  cada uno lleva sus números.
+
+Se configuran en CACHES (settings.py):
+
+    'BACKEND': 'citas.cache_backends.LRULocMemCache',
+    'OPTIONS': {'MAX_ENTRIES': 50000, 'MAX_BYTES': 64 * 1024 * 1024},
+"""
+
+import os
+from collections import Counter
+
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+
+
+# Estadísticas por nombre de caché (igual que LocMemCache guarda sus datos:
+# así todas las instancias de la misma caché comparten los números)
+_stats = {}
+_sizes = {}
+
+# Valor para distinguir "no está" de "está y vale None"
+_MISSING = object()
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class StatsMixin:
+    """Cuenta aciertos y fallos de get() (get_many usa get por debajo)"""
+
+    def _init_stats(self, name, params):
+        self._stats = _stats.setdefault(name, Counter())
+        options = params.get('OPTIONS', {})
+        self._max_bytes = options.get('MAX_BYTES', DEFAULT_MAX_BYTES)
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, _MISSING, version=version)
+        if value is _MISSING:
+            self._stats['misses'] += 1
+            return default
+        self._stats['hits'] += 1
+        return value
+
+    def stats(self):
+        """Números de la caché: hits, misses, hit_rate, evictions, entries, bytes"""
+        hits, misses = self._stats['hits'], self._stats['misses']
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+            'evictions': self._stats['evictions'],
+            'max_bytes': self._max_bytes,
+            **self._usage(),
+        }
+
+    def reset_stats(self):
+        # bytes no: es lo que ocupa la caché, no una estadística
+        for name in ('hits', 'misses', 'evictions'):
+            self._stats[name] = 0
+
+
+class LRULocMemCache(StatsMixin, LocMemCache):
+    """
+    LocMemCache con límite de bytes.
+
+    LocMemCache ya guarda las claves en orden de uso (un OrderedDict: cada
+    get() mueve la clave al principio), así que para hacerlo LRU por tamaño
+    solo tengo que apuntar lo que ocupa cada valor (ya está en pickle) e ir
+    quitando del final mientras me pase de MAX_BYTES.
+    """
+
+    def __init__(self, name, params):
+        super().__init__(name, params)
+        self._init_stats(name, params)
+        self._sizes = _sizes.setdefault(name, {})
+
+    def _set(self, key, value, timeout=None):
+        self._forget_size(key)
+        while self._cache and self._stats['bytes'] + len(value) > self._max_bytes:
+            self._evict_oldest()
+        super()._set(key, value, timeout)
+        self._sizes[key] = len(value)
+        self._stats['bytes'] += len(value)
+
+    def _evict_oldest(self):
+        key, _ = self._cache.popitem()
+        self._expire_info.pop(key, None)
+        self._forget_size(key)
+        self._stats['evictions'] += 1
+
+    def _forget_size(self, key):
+        self._stats['bytes'] -= self._sizes.pop(key, 0)
+
+    def _cull(self):
+        # El de Django (por número de entradas) pero sin perder la cuenta de bytes
+        if self._cull_frequency == 0:
+            self._clear()
+            return
+        for _ in range(len(self._cache) // self._cull_frequency):
+            self._evict_oldest()
+
+    def _delete(self, key):
+        deleted = super()._delete(key)
+        if deleted:
+            self._forget_size(key)
+        return deleted
+
+    def incr(self, key, delta=1, version=None):
+        value = super().incr(key, delta, version=version)
+        # El nuevo valor puede ocupar algo distinto
+        key = self.make_and_validate_key(key, version=version)
+        with self._lock:
+            if key in self._cache:
+                self._forget_size(key)
+                self._sizes[key] = len(self._cache[key])
+                self._stats['bytes'] += self._sizes[key]
+        return value
+
+    def _clear(self):
+        self._cache.clear()
+        self._expire_info.clear()
+        self._sizes.clear()
+        self._stats['bytes'] = 0
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def _usage(self):
+        return {'entries': len(self._cache), 'bytes': self._stats['bytes']}
+
+
+class LRUFileBasedCache(StatsMixin, FileBasedCache):
+    """
+    FileBasedCache con límite de bytes y LRU de verdad.
+
+    El de Django, cuando hay demasiados ficheros, borra unos cuantos AL
+    AZAR. Este usa la fecha de modificación de cada fichero como "último
+    uso" (la actualizo en cada acierto) y borra los más antiguos hasta
+    bajar del 90% de MAX_BYTES y de MAX_ENTRIES.
+    """
+
+    def __init__(self, dir, params):
+        super().__init__(dir, params)
+        self._init_stats(dir, params)
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, _MISSING, version=version)
+        if value is _MISSING:
+            return default
+        # Marco el fichero como usado ahora
+        try:
+            os.utime(self._key_to_file(key, version))
+        except FileNotFoundError:
+            pass
+        return value
+
+    def _file_info(self):
+        """[(último uso, tamaño, ruta)] de todos los ficheros de la caché"""
+        info = []
+        for fname in self._list_cache_files():
+            try:
+                stat = os.stat(fname)
+            except FileNotFoundError:
+                continue
+            info.append((stat.st_mtime, stat.st_size, fname))
+        return info
+
+    def _cull(self):
+        info = self._file_info()
+        total = sum(size for _, size, _ in info)
+        if len(info) < self._max_entries and total < self._max_bytes:
+            return
+
+        if self._cull_frequency == 0:
+            self.clear()
+            return
+
+        # Dejo algo de margen para no tener que limpiar en cada set()
+        max_entries = self._max_entries - self._max_entries // self._cull_frequency
+        max_bytes = self._max_bytes * 0.9
+
+        info.sort()
+        count = len(info)
+        for _, size, fname in info:
+            if count <= max_entries and total <= max_bytes:
+                break
+            if self._delete(fname):
+                self._stats['evictions'] += 1
+            count -= 1
+            total -= size
+
+    def _usage(self):
+        info = self._file_info()
+        return {'entries': len(info), 'bytes': sum(size for _, size, _ in info)}
@@ -0,0 +1,230 @@
+"""
+Caché por usuario: tarjetas ya renderizadas y listas de ids.
+
+Antes, cada visita a la lista, al inbox o a la aleatoria consultaba la BD
+y renderizaba otra vez todas las tarjetas del bucle del template. Ahora
+guardo en caché:
+
+- Las listas de ids de cada página (según filtros y cursor) y del inbox.
+- El HTML de cada tarjeta, por cita.
+
+Con las dos cosas en caché, una página de la lista no toca la tabla de
+citas: saco los ids, y con un solo get_many todas las tarjetas.
+
+Versiones en vez de borrar claves: cada usuario tiene un número de
+versión que va dentro de todas sus claves
+
+    citas:<usuario>:v<versión>:card:cita_card:42
+
+Cualquier cambio en sus citas o temas sube la versión (ver signals.py), así
+que todas sus claves antiguas dejan de usarse de golpe, sin tener que
+buscarlas. Las viejas las va tirando la caché (LRU, ver cache_backends.py).
+
+OJO: las versiones van en la caché 'shared' (settings.py), no en la de
+cada proceso. Con varios workers, si la versión solo sube en el que ha
+guardado la cita, los otros siguen enseñando las tarjetas de antes (hasta
+CARD_TIMEOUT) y las listas de antes (hasta IDS_TIMEOUT). Las tarjetas y
+las listas sí van en la de cada proceso: con la versión en la clave no
+hay nada que borrar.
+
+Y la versión no empieza en 1 sino en la hora en nanosegundos, y cada
+bump() pone un número nuevo, más alto (como related.get_version). Si la
+caché pierde la versión (se llena, se reinicia...), empezar otra vez en 1
+podía coincidir con claves "v1" que seguían en la caché de algún proceso,
+con lo de antes.
+
+OJO: lo que cambie citas con update() o bulk_create() (sin señales) tiene
+que llamar a bump() o enviar citas_bulk_changed.
+
+OJO con el CSRF: la tarjeta de la lista lleva un formulario con el token
+CSRF dentro. El token cambia en cada petición, pero todos valen mientras
+el "secreto" de la cookie sea el mismo. Por eso esas tarjetas llevan en la
+clave un hash del secreto: cada navegador tiene las suyas.
+"""
+
+import hashlib
+import time
+
+from django.core.cache import cache, caches
+from django.db import transaction
+from django.middleware.csrf import get_token
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+
+from .models import Cita
+
+
+# Cuánto duran las listas de ids y las tarjetas (segundos). Con las
+# versiones no hace falta que caduquen pronto: al cambiar algo ya no se usan
+IDS_TIMEOUT = 60 * 60
+CARD_TIMEOUT = 60 * 60 * 24
+
+
+# La caché de las versiones (la misma para todos los procesos)
+VERSIONS_CACHE = 'shared'
+
+
+def _version_key(owner_id):
+    return f'citas:version:{owner_id}'
+
+
+def get_version(owner_id):
+    """Versión actual de la caché de un usuario (ver arriba)"""
+    versions = caches[VERSIONS_CACHE]
+    version = versions.get(_version_key(owner_id))
+    if version is None:
+        # add() no pisa el valor si otro proceso lo creó a la vez
+        new = time.time_ns()
+        versions.add(_version_key(owner_id), new, None)
+        version = versions.get(_version_key(owner_id), new)
+    return version
+
+
+def bump(owner_id, using=None):
+    """
+    Sube la versión del usuario: todo lo que tenía en caché deja de valer.
+
+    Lo llaman las señales cada vez que se guarda o borra una cita o tema.
+
+    Se llama DESPUÉS de cambiar las cosas (contadores...). Si el cambio va
+    dentro de una transacción de la BD using, la vuelvo a subir al
+    confirmarla: hasta entonces las otras conexiones todavía leen lo de
+    antes, y lo que guarden en caché con la versión nueva estaría mal.
+    """
+    _new_version(owner_id)
+    if using is not None and transaction.get_connection(using).in_atomic_block:
+        transaction.on_commit(lambda: _new_version(owner_id), using=using)
+
+
+def _new_version(owner_id):
+    """
+    Una versión que no ha salido nunca: la hora, o la de antes + 1 si el
+    reloj va por detrás. Con set() y no incr(): si la clave no está (la
+    caché la ha perdido) también cambia, y no hace falta que incr() sea
+    atómico en el backend (en el de ficheros no lo es)
+    """
+    versions = caches[VERSIONS_CACHE]
+    current = versions.get(_version_key(owner_id)) or 0
+    versions.set(_version_key(owner_id), max(time.time_ns(), current + 1), None)
+
+
+def digest(value):
+    """Hash corto para meter cosas largas (filtros, secretos) en una clave"""
+    return hashlib.md5(repr(value).encode()).hexdigest()[:16]
+
+
+class UserCache:
+    """
+    Las claves de un usuario con la versión actual.
+
+    Leo la versión una vez al crearla y la uso para todas las claves de
+    la petición.
+    """
+
+    def __init__(self, owner_id):
+        self.owner_id = owner_id
+        self.version = get_version(owner_id)
+
+    def key(self, *parts):
+        return ':'.join(['citas', str(self.owner_id), f'v{self.version}', *map(str, parts)])
+
+    def get_or_set(self, parts, default, timeout=IDS_TIMEOUT):
+        """cache.get_or_set con una clave de este usuario"""
+        return cache.get_or_set(self.key(*parts), default, timeout)
+
+
+def render_cards(request, user_cache, ids, template_name, citas=None, csrf=False, context=None):
+    """
+    Devuelve el HTML de las tarjetas de las citas ids (en ese orden).
+
+    - Las que están en caché salen de un solo get_many.
+    - Las que no, las renderizo con template_name y las guardo. Si me pasan
+      citas ({id: Cita}) las uso; si no, las cargo de una vez con in_bulk.
+    - csrf=True si la plantilla lleva {% csrf_token %}.
+    - context: función que recibe la lista de citas que hay que renderizar
+      y devuelve {id: variables extra} (por ejemplo las sugerencias de
+      tema del inbox). Así se calcula todo de una vez y solo para las que
+      no estaban en caché.
+
+    Renderizo sin request (solo con 'cita' y el token CSRF), así no se
+    ejecutan los context processors por cada tarjeta.
+
+    Las citas que ya no existen se saltan.
+    """
+    template, keys, extra = _card_keys(request, user_cache, ids, template_name, csrf)
+    found = cache.get_many(list(keys.values()))
+
+    missing = [pk for pk in ids if keys[pk] not in found]
+    if missing:
+        citas = dict(citas or {})
+        to_load = [pk for pk in missing if pk not in citas]
+        if to_load:
+            citas.update(_cards_queryset(user_cache).in_bulk(to_load))
+
+        missing = [pk for pk in missing if pk in citas]
+        per_cita = context([citas[pk] for pk in missing]) if context and missing else {}
+        found.update(_render_missing(template, keys, extra, citas, missing, per_cita))
+
+    return [mark_safe(found[keys[pk]]) for pk in ids if keys[pk] in found]
+
+
+async def arender_cards(request, user_cache, ids, template_name, citas=None, csrf=False, context=None):
+    """
+    Lo mismo que render_cards para las vistas async (async_views.py): las
+    citas que faltan se cargan con el ORM async y context, si lo hay, es
+    una función async.
+
+    La caché es de memoria (cache_backends.py), así que get_many/set_many
+    no esperan a nada y los llamo directamente.
+    """
+    template, keys, extra = _card_keys(request, user_cache, ids, template_name, csrf)
+    found = cache.get_many(list(keys.values()))
+
+    missing = [pk for pk in ids if keys[pk] not in found]
+    if missing:
+        citas = dict(citas or {})
+        to_load = [pk for pk in missing if pk not in citas]
+        if to_load:
+            citas.update(await _cards_queryset(user_cache).ain_bulk(to_load))
+
+        missing = [pk for pk in missing if pk in citas]
+        per_cita = await context([citas[pk] for pk in missing]) if context and missing else {}
+        found.update(_render_missing(template, keys, extra, citas, missing, per_cita))
+
+    return [mark_safe(found[keys[pk]]) for pk in ids if keys[pk] in found]
+
+
+def _card_keys(request, user_cache, ids, template_name, csrf):
+    """La plantilla, la clave de caché de cada tarjeta y las variables comunes"""
+    template = get_template(template_name)
+    name = template_name.rsplit('/', 1)[-1].split('.')[0]
+
+    parts = ['card', name]
+    extra = {}
+    if csrf:
+        extra['csrf_token'] = get_token(request)
+        parts.append(digest(request.META['CSRF_COOKIE']))
+
+    keys = {pk: user_cache.key(*parts, pk) for pk in ids}
+    return template, keys, extra
+
+
+def _cards_queryset(user_cache):
+    return Cita.objects.filter(owner_id=user_cache.owner_id).select_related('tag')
+
+
+def _render_missing(template, keys, extra, citas, missing, per_cita):
+    """Renderiza las tarjetas que no estaban y las guarda en la caché"""
+    rendered = {
+        keys[pk]: template.render({'cita': citas[pk], **extra, **per_cita.get(pk, {})})
+        for pk in missing
+    }
+    cache.set_many(rendered, CARD_TIMEOUT)
+    return rendered
+
+
+def stats():
+    """Estadísticas del backend de caché (si es uno de cache_backends.py)"""
+    if hasattr(cache, 'stats'):
+        return cache.stats()
+    return None
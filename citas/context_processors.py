@@ -0,0 +1,32 @@
+"""
+Context processors de la app citas.
+
+Añaden variables a TODOS los templates (ver TEMPLATES en settings.py).
+"""
+
+from django.utils.functional import SimpleLazyObject
+
+from . import counters
+
+
+def contadores(request):
+    """
+    contador_citas: los contadores del usuario (total, inbox, favorites,
+    with_image) para los números de la barra de navegación.
+
+    Es "lazy": solo se consulta la BD si el template lo usa de verdad.
+    Para los usuarios no logueados vale None.
+
+    Las vistas async (async_views.py) no pueden consultar la BD mientras
+    renderizan: los cargan antes y los dejan en request.contador_citas.
+    """
+    if hasattr(request, 'contador_citas'):
+        return {'contador_citas': request.contador_citas}
+
+    def get_contador():
+        user = getattr(request, 'user', None)
+        if user is None or not user.is_authenticated:
+            return None
+        return counters.for_owner(user.pk)
+
+    return {'contador_citas': SimpleLazyObject(get_contador)}
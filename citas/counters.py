@@ -0,0 +1,195 @@
+"""
+Contadores de citas sin COUNT(*).
+
+Para los números de la barra de navegación (cuántas citas, cuántas en el
+inbox) y del selector de temas ("Filosofía (12)") antes habría que hacer
+un COUNT sobre citas_cita en cada página. Ahora los guardo en dos tablas
+(ContadorUsuario y ContadorTema, ver models.py) y los actualizo poco a
+poco, con las señales de signals.py:
+
+- Al cargar una cita apunto lo que "cuenta": (owner, tema, favorita, imagen).
+- Al guardarla comparo con lo nuevo y sumo/resto la diferencia.
+  Por ejemplo, ponerle tema a una cita del inbox: inbox - 1, tema + 1.
+- Al borrarla resto lo que contaba.
+
+Las sumas se hacen en la BD con F() (UPDATE ... SET inbox = inbox - 1)
+para que dos peticiones a la vez no se pisen.
+
+Si falta la fila de un usuario o tema (usuarios de antes de esto,
+bulk_create...) se calcula la primera vez que se lee. Y si algo se
+desincroniza: python manage.py recount
+"""
+
+from collections import Counter, defaultdict
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db.models import Count, F, Q, Value
+from django.db.models.functions import Greatest
+
+from . import caching
+from .models import Cita, ContadorTema, ContadorUsuario, Tema
+
+
+FIELDS = ('total', 'inbox', 'favorites', 'with_image')
+
+
+def snapshot(cita):
+    """
+    Lo que cuenta una cita: (owner_id, tag_id, is_favorite, tiene imagen).
+
+    Devuelve None si alguno de esos campos no está cargado (.only(...)),
+    para no provocar una consulta por cada cita.
+    """
+    values = cita.__dict__
+    if not all(field in values for field in ('owner_id', 'tag_id', 'is_favorite', 'image')):
+        return None
+
+    image = values['image']
+    return (
+        values['owner_id'],
+        values['tag_id'],
+        bool(values['is_favorite']),
+        bool(getattr(image, 'name', image)),
+    )
+
+
+def apply_change(old, new):
+    """
+    Actualiza los contadores cuando una cita pasa de old a new.
+
+    old y new son snapshots; None quiere decir que la cita no existía
+    (al crearla) o que ya no existe (al borrarla).
+    """
+    apply_changes([(old, new)])
+
+
+def apply_changes(changes):
+    """
+    Lo mismo para muchas citas de golpe: changes es una lista de (old, new).
+
+    Primero sumo todas las diferencias en Python y luego hago un UPDATE
+    por usuario y otro por tema, no uno por cita (ver bulk.py).
+    """
+    owners = defaultdict(Counter)
+    temas = Counter()
+
+    for old, new in changes:
+        for state, sign in ((old, -1), (new, 1)):
+            if state is None:
+                continue
+            owner_id, tag_id, is_favorite, has_image = state
+
+            owners[owner_id]['total'] += sign
+            owners[owner_id]['inbox'] += sign * (tag_id is None)
+            owners[owner_id]['favorites'] += sign * is_favorite
+            owners[owner_id]['with_image'] += sign * has_image
+            if tag_id is not None:
+                temas[tag_id] += sign
+
+    for owner_id, deltas in owners.items():
+        updates = {field: _add(field, delta) for field, delta in deltas.items() if delta}
+        if updates:
+            ContadorUsuario.objects.filter(owner_id=owner_id).update(**updates)
+
+    for tema_id, delta in temas.items():
+        if delta:
+            ContadorTema.objects.filter(tema_id=tema_id).update(total=_add('total', delta))
+
+
+def _add(field, delta):
+    """
+    field + delta, sin bajar de 0.
+
+    Si el contador estaba mal (más bajo de lo real) prefiero que se quede
+    en 0 a que el UPDATE falle y no se pueda guardar la cita.
+    """
+    return Greatest(F(field) + delta, Value(0))
+
+
+def add_to_inbox(owner_id, delta):
+    """Para cuando las citas cambian de tema sin save() (borrar un tema)"""
+    if delta:
+        ContadorUsuario.objects.filter(owner_id=owner_id).update(inbox=_add('inbox', delta))
+
+
+def add_to_favorites(owner_id, delta):
+    """Para cuando se marca/desmarca favorita con update() (ver views.py)"""
+    if delta:
+        ContadorUsuario.objects.filter(owner_id=owner_id).update(favorites=_add('favorites', delta))
+
+
+async def aadd_to_favorites(owner_id, delta):
+    """Lo mismo con el ORM async (ver async_views.py)"""
+    if delta:
+        await ContadorUsuario.objects.filter(owner_id=owner_id).aupdate(favorites=_add('favorites', delta))
+
+
+def recount_owner(owner_id):
+    """Recalcula los contadores de un usuario con un solo aggregate"""
+    counts = Cita.objects.filter(owner_id=owner_id).aggregate(
+        total=Count('pk'),
+        inbox=Count('pk', filter=Q(tag__isnull=True)),
+        favorites=Count('pk', filter=Q(is_favorite=True)),
+        with_image=Count('pk', filter=~Q(image='') & Q(image__isnull=False)),
+    )
+    contador, _ = ContadorUsuario.objects.update_or_create(owner_id=owner_id, defaults=counts)
+    return contador
+
+
+def recount_temas(owner_id):
+    """Recalcula los contadores de todos los temas de un usuario"""
+    totals = (Tema.objects.filter(owner_id=owner_id)
+              .annotate(n=Count('citas')).values_list('pk', 'n'))
+    ContadorTema.objects.bulk_create(
+        [ContadorTema(tema_id=pk, total=n) for pk, n in totals],
+        update_conflicts=True,
+        unique_fields=['tema'],
+        update_fields=['total'],
+    )
+
+
+def recount(owner_id):
+    recount_owner(owner_id)
+    recount_temas(owner_id)
+    # Los contadores en caché (for_owner) ya no valen
+    caching.bump(owner_id)
+
+
+def for_owner(owner_id):
+    """
+    El ContadorUsuario de un usuario (lo calcula si todavía no existe).
+
+    Se lee en cada página (la barra de navegación), así que lo guardo en
+    la caché del usuario (caching.UserCache): todo lo que cambia los
+    contadores sube su versión (las señales, set_favorite, recount...).
+    """
+    user_cache = caching.UserCache(owner_id)
+    contador = cache.get(user_cache.key('contador'))
+    if contador is None:
+        contador = ContadorUsuario.objects.filter(owner_id=owner_id).first() or recount_owner(owner_id)
+        cache.set(user_cache.key('contador'), contador, caching.IDS_TIMEOUT)
+    return contador
+
+
+async def afor_owner(owner_id):
+    """Lo mismo que for_owner con el ORM async (para async_views.py)"""
+    user_cache = caching.UserCache(owner_id)
+    contador = cache.get(user_cache.key('contador'))
+    if contador is None:
+        contador = (await ContadorUsuario.objects.filter(owner_id=owner_id).afirst()
+                    or await sync_to_async(recount_owner)(owner_id))
+        cache.set(user_cache.key('contador'), contador, caching.IDS_TIMEOUT)
+    return contador
+
+
+def tema_counts(owner_id):
+    """{id del tema: número de citas} de todos los temas de un usuario"""
+    counts = dict(Tema.objects.filter(owner_id=owner_id).values_list('pk', 'contador__total'))
+
+    # Algún tema sin contador: los recalculo todos
+    if None in counts.values():
+        recount_temas(owner_id)
+        counts = dict(Tema.objects.filter(owner_id=owner_id).values_list('pk', 'contador__total'))
+
+    return counts
@@ -0,0 +1,314 @@
+"""
+Citas casi repetidas: MinHash + LSH.
+
+Mucha gente pega la misma cita dos veces con cambios pequeños (una coma,
+mayúsculas, "—Autor" al final...). Comparar el texto nuevo con TODAS las
+citas del usuario sería leer toda la tabla en cada alta, así que:
+
+1. MinHash: cada texto se resume en una huella de 64 números. Parto el
+   texto (sin tildes, en minúsculas) en trozos de 5 letras ("shingles") y,
+   para 64 funciones hash distintas, me quedo con el hash más pequeño.
+   La fracción de números iguales entre dos huellas es una estimación de
+   cuánto se parecen los textos (similitud de Jaccard de sus trozos).
+   Guardo solo los 16 bits de abajo de cada número: 128 bytes por cita
+   (Cita.text_minhash).
+
+2. LSH: parto la huella en 16 bandas de 4 números y cada banda va a una
+   cubeta (CubetaLSH). Dos textos parecidos al 70% coinciden en alguna
+   banda con un 99% de probabilidad; dos textos distintos casi nunca.
+   Para un texto nuevo miro solo sus 16 cubetas y compruebo las huellas
+   de las pocas citas que salgan.
+
+Las huellas las calculan las señales al guardar una cita, y las que faltan
+(import_citas, citas de antes) con: python manage.py find_duplicates --index
+"""
+
+import re
+import unicodedata
+import zlib
+
+import numpy as np
+from django.db import connections, transaction
+
+from . import sharding
+from .models import Cita, CubetaLSH
+
+
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE = 5
+
+# Parecido mínimo (estimado) para avisar de que una cita está repetida
+THRESHOLD = 0.7
+
+# Las 64 funciones hash: h(x) = (a*x + b) >> 32, con aritmética de 64 bits
+# (multiply-shift). Semilla fija: las huellas tienen que salir siempre igual
+_rng = np.random.default_rng(20261017)
+_A = _rng.integers(1, 2 ** 63, size=NUM_PERM, dtype=np.uint64) | np.uint64(1)
+_B = _rng.integers(0, 2 ** 63, size=NUM_PERM, dtype=np.uint64)
+
+# Una constante distinta por banda para que la misma banda de valores en
+# dos posiciones distintas no caiga en la misma cubeta
+_BAND_SALT = _rng.integers(1, 2 ** 63, size=BANDS, dtype=np.uint64)
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Textos por tanda al calcular huellas en bloque
+BATCH_SIZE = 2000
+
+
+def _normalize(text):
+    """Minúsculas, sin tildes y sin signos: 'El  Corazón, ¡ay!' -> 'el corazon ay'"""
+    text = unicodedata.normalize('NFKD', (text or '').lower())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(WORD_RE.findall(text))
+
+
+def _shingle_hashes(text):
+    """Los hashes (CRC32) de los trozos de 5 letras del texto, sin repetir"""
+    text = _normalize(text)
+    if not text:
+        return np.empty(0, dtype=np.uint64)
+    if len(text) <= SHINGLE:
+        shingles = {text}
+    else:
+        shingles = {text[i:i + SHINGLE] for i in range(len(text) - SHINGLE + 1)}
+    return np.fromiter((zlib.crc32(s.encode()) for s in shingles), dtype=np.uint64, count=len(shingles))
+
+
+def signatures(texts):
+    """
+    Las huellas de muchos textos a la vez: array (len(texts), 64) de uint16.
+
+    Todos los trozos van en un solo array y para cada función hash saco el
+    mínimo de cada texto con np.minimum.reduceat: 64 operaciones de NumPy
+    para toda la tanda, no 64 por texto.
+
+    Los textos sin letras tienen la fila a 0 y valid=False.
+    Devuelve (huellas, valid).
+    """
+    hashes = [_shingle_hashes(text) for text in texts]
+    lengths = np.array([len(h) for h in hashes], dtype=np.int64)
+    valid = lengths > 0
+    result = np.zeros((len(texts), NUM_PERM), dtype=np.uint16)
+    if not valid.any():
+        return result, valid
+
+    shingles = np.concatenate([h for h in hashes if len(h)])
+    starts = np.concatenate([[0], np.cumsum(lengths[valid])[:-1]])
+    for perm in range(NUM_PERM):
+        values = (_A[perm] * shingles + _B[perm]) >> np.uint64(32)
+        result[valid, perm] = np.minimum.reduceat(values, starts) & np.uint64(0xFFFF)
+    return result, valid
+
+
+def signature(text):
+    """La huella de un texto (128 bytes), o None si no tiene letras"""
+    result, valid = signatures([text])
+    return result[0].tobytes() if valid[0] else None
+
+
+def from_bytes(data):
+    return np.frombuffer(bytes(data), dtype=np.uint16)
+
+
+def band_keys(sigs):
+    """
+    Las 16 cubetas de cada huella: array (n, 16) de int64.
+
+    Los 4 números de 16 bits de cada banda caben justos en 64 bits; los
+    mezclo con la constante de la banda.
+    """
+    sigs = np.asarray(sigs, dtype=np.uint64).reshape(len(sigs), BANDS, ROWS)
+    packed = np.zeros(sigs.shape[:2], dtype=np.uint64)
+    for row in range(ROWS):
+        packed |= sigs[:, :, row] << np.uint64(16 * row)
+    return (packed ^ _BAND_SALT).view(np.int64)
+
+
+def similarity(a, b):
+    """Parecido estimado entre dos huellas (0 a 1)"""
+    return float(np.mean(from_bytes(a) == from_bytes(b)))
+
+
+# --- Índice en la BD ---
+
+def index_citas(owner_id, rows):
+    """
+    Guarda huellas y cubetas de citas de un usuario: rows = [(id, texto)].
+
+    Borra las cubetas que tuvieran antes. Las citas sin letras se quedan
+    con la huella vacía (b''): así index_missing sabe que ya están vistas.
+
+    Uso executemany y no bulk_update/bulk_create: son 16 cubetas por cita
+    y crear todos esos objetos de Django era lo que más tardaba (25 s para
+    10.000 citas, así unos 2).
+    """
+    if not rows:
+        return
+    ids = [pk for pk, _ in rows]
+    sigs, valid = signatures([text for _, text in rows])
+    keys = band_keys(sigs)
+
+    # SQL directo: con la conexión de la BD del usuario (ver sharding.py)
+    db = sharding.db_for_owner(owner_id)
+    connection = connections[db]
+    with transaction.atomic(using=db):
+        CubetaLSH.objects.using(db).filter(cita_id__in=ids).delete()
+        quote = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'UPDATE {quote(Cita._meta.db_table)} SET text_minhash = %s WHERE id = %s',
+                [(sigs[i].tobytes() if valid[i] else b'', pk) for i, pk in enumerate(ids)],
+            )
+            cursor.executemany(
+                f'INSERT INTO {quote(CubetaLSH._meta.db_table)} (owner_id, cita_id, {quote("key")}) '
+                f'VALUES (%s, %s, %s)',
+                [(owner_id, ids[i], key) for i in np.flatnonzero(valid) for key in keys[i].tolist()],
+            )
+
+
+def index_cita(cita):
+    """Huella y cubetas de una cita recién guardada (ver signals.py)"""
+    index_citas(cita.owner_id, [(cita.pk, cita.text)])
+
+
+def index_missing(owner_ids=None):
+    """
+    Calcula las huellas que faltan (citas con texto y sin huella), por
+    tandas y shard por shard. Devuelve cuántas ha calculado.
+    """
+    done = 0
+    for shard_owner_ids in sharding.by_shard(owner_ids):
+        citas = Cita.objects.filter(text_minhash__isnull=True).exclude(text='')
+        if shard_owner_ids is not None:
+            citas = citas.filter(owner_id__in=shard_owner_ids)
+
+        while True:
+            batch = list(citas.order_by('pk').values_list('pk', 'owner_id', 'text')[:BATCH_SIZE])
+            if not batch:
+                break
+            by_owner = {}
+            for pk, owner_id, text in batch:
+                by_owner.setdefault(owner_id, []).append((pk, text))
+            for owner_id, rows in by_owner.items():
+                index_citas(owner_id, rows)
+            done += len(batch)
+    return done
+
+
+def find_similar(owner_id, text, exclude_pk=None, threshold=THRESHOLD, limit=5):
+    """
+    Las citas del usuario con el texto casi igual a text:
+    [(Cita, parecido)] de más a menos parecida.
+
+    Dos consultas: las cubetas del texto (por índice) y las huellas de las
+    citas candidatas.
+    """
+    sig = signature(text)
+    if sig is None:
+        return []
+
+    keys = [int(key) for key in band_keys([from_bytes(sig)])[0]]
+    candidates = (CubetaLSH.objects.filter(owner_id=owner_id, key__in=keys)
+                  .values_list('cita_id', flat=True).distinct())
+    citas = Cita.objects.filter(owner_id=owner_id, pk__in=candidates)
+    if exclude_pk:
+        citas = citas.exclude(pk=exclude_pk)
+
+    found = []
+    for cita in citas.only('text', 'source', 'text_minhash'):
+        score = similarity(sig, cita.text_minhash)
+        if score >= threshold:
+            found.append((cita, score))
+    found.sort(key=lambda item: -item[1])
+    return found[:limit]
+
+
+# --- Grupos de repetidas en bloque (find_duplicates) ---
+
+def clusters(ids, sigs, threshold=THRESHOLD):
+    """
+    Agrupa citas casi iguales: ids (n,) y sus huellas (n, 64).
+
+    Devuelve una lista de grupos (listas de ids), solo los de 2 o más.
+    """
+    sigs = np.asarray(sigs)
+    return bucket_clusters(
+        ids, band_keys(sigs) if len(sigs) else np.empty((0, BANDS), dtype=np.int64),
+        lambda a, b: (sigs[a] == sigs[b]).mean(axis=1) >= threshold,
+    )
+
+
+def bucket_clusters(ids, keys, matches, window=0):
+    """
+    Agrupa por cubetas: keys es un array (n, columnas) con la cubeta de
+    cada elemento en cada columna (las bandas de LSH, los trozos del hash
+    de las imágenes...).
+
+    Para cada columna ordeno las cubetas (np.argsort) y, dentro de cada
+    cubeta, comparo cada elemento con el primero: matches(a, b) recibe dos
+    arrays de posiciones y dice cuáles se parecen de verdad. Las parejas
+    que se parecen se juntan con union-find. Nunca comparo todos con todos
+    (el precio: dos que solo se parecen entre ellos, y no al primero de su
+    cubeta, no se juntan por esa cubeta).
+
+    Con window > 0 además comparo cada uno con los window anteriores de su
+    cubeta: en las cubetas pequeñas eso ya es todos con todos. Hace falta
+    cuando en las cubetas caen muchos que no se parecen (los trozos de 16
+    bits de las imágenes: con 200.000 hashes, unos 3 por cubeta).
+
+    Devuelve una lista de grupos (listas de ids), solo los de 2 o más.
+    """
+    n = len(ids)
+    if n < 2:
+        return []
+    ids = np.asarray(ids)
+    parent = np.arange(n)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def join(a, b):
+        same = matches(a, b)
+        for i, j in zip(a[same], b[same]):
+            root_i, root_j = find(i), find(j)
+            if root_i != root_j:
+                parent[root_j] = root_i
+
+    for column in range(keys.shape[1]):
+        order = np.argsort(keys[:, column], kind='stable')
+        sorted_keys = keys[order, column]
+        # Posición del primer elemento de la cubeta de cada uno
+        new_bucket = np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]])
+        start = np.maximum.accumulate(np.where(new_bucket, np.arange(n), 0))
+        first = order[start]
+        pairs = first != order
+        if not pairs.any():
+            continue
+        join(first[pairs], order[pairs])
+
+        # Los anteriores de la misma cubeta (el primero ya está comparado)
+        for offset in range(1, window + 1):
+            position = np.arange(offset, n)
+            pairs = position - offset > start[position]
+            if not pairs.any():
+                break
+            join(order[position[pairs] - offset], order[position[pairs]])
+
+    # Cada elemento apuntando directamente a la raíz de su grupo
+    while True:
+        roots = parent[parent]
+        if (roots == parent).all():
+            break
+        parent = roots
+
+    # Los grupos de más de uno: ordeno por raíz y corto donde cambia
+    members = np.flatnonzero(np.bincount(roots, minlength=n)[roots] > 1)
+    members = members[np.argsort(roots[members], kind='stable')]
+    splits = np.flatnonzero(np.diff(roots[members])) + 1
+    return [ids[group].tolist() for group in np.split(members, splits)] if len(members) else []
@@ -0,0 +1,254 @@
+"""
+Cambios en directo entre pestañas (Server-Sent Events).
+
+Si cambias una cita en una pestaña, las otras (lista, inbox, aleatoria)
+se quedaban con lo de antes hasta recargar. Ahora cada página abre un
+EventSource a /citas/api/events/ (async_views.quote_events) y el servidor
+le manda los cambios de SUS citas:
+
+    created  {"id": 5, "tag": 2}                    -> cita nueva
+    updated  {"id": 5, "tag": 2}                    -> cita cambiada
+    toggled  {"id": 5, "is_favorite": true}         -> marcada/desmarcada
+    deleted  {"id": 5}                              -> cita borrada
+    resync   {}                                     -> demasiados cambios: recargar
+
+main.js cambia solo la tarjeta afectada (ver "Cambios en directo" allí).
+
+Los publican las señales (signals.py) y set_favorite, cuando se confirma
+la transacción (transaction.on_commit): si se deshace, no se publica.
+
+El reparto (Hub) es en memoria del proceso, con asyncio:
+- Cada conexión abierta es un Subscriber con una cola asyncio.Queue de
+  QUEUE_SIZE eventos como mucho. Mientras no pasa nada solo es una
+  corrutina esperando en su cola (sin hilos, y sin más tareas que las
+  que Django ya crea por petición), así que un proceso ASGI aguanta
+  miles de pestañas abiertas.
+- publish() se puede llamar desde cualquier hilo (las vistas normales
+  corren en hilos, ver async_views.py): mete el evento en el bucle de
+  cada suscriptor con call_soon_threadsafe.
+- Si una pestaña no lee (cola llena), tiro sus eventos pendientes y le
+  mando resync: mejor recargar que ir guardando memoria sin límite.
+- Guardo los últimos HISTORY eventos de cada usuario: al reconectar el
+  navegador manda Last-Event-ID y le reenvío los que se ha perdido. Si
+  son demasiados (o el id es de otro proceso), resync.
+
+OJO: con varios procesos cada uno tiene su Hub, y una pestaña solo se
+entera de los cambios hechos en el mismo proceso. Para eso haría falta
+algo compartido (Redis pub/sub...), que este proyecto no tiene. Si
+WEB_CONCURRENCY (lo que leen gunicorn y uvicorn para el número de
+workers) dice más de uno, python manage.py check avisa (citas.W001,
+ver check_single_process).
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict, deque
+
+from django.core import checks
+from django.db import transaction
+
+from . import sharding
+
+
+CREATED = 'created'
+UPDATED = 'updated'
+TOGGLED = 'toggled'
+DELETED = 'deleted'
+RESYNC = 'resync'
+
+# Eventos pendientes por conexión antes de mandarle resync
+QUEUE_SIZE = 64
+
+# Últimos eventos que guardo por usuario (para Last-Event-ID)
+HISTORY = 100
+
+# Usuarios de los que guardo historial (los que más tiempo llevan sin
+# cambios se tiran)
+MAX_HISTORIES = 1024
+
+# Cada cuánto mando un comentario para que los proxys no corten la conexión
+HEARTBEAT = 25
+
+
+class Event:
+    """Un cambio: id ('<proceso>-<n>'), tipo y datos"""
+
+    __slots__ = ('id', 'kind', 'data')
+
+    def __init__(self, id, kind, data):
+        self.id = id
+        self.kind = kind
+        self.data = data
+
+    def encode(self):
+        """El evento en formato text/event-stream"""
+        return f'id: {self.id}\nevent: {self.kind}\ndata: {json.dumps(self.data)}\n\n'
+
+
+class Subscriber:
+    """Una conexión abierta: su cola y el bucle de eventos donde vive"""
+
+    def __init__(self, owner_id, loop, queue_size):
+        self.owner_id = owner_id
+        self.loop = loop
+        self.queue = asyncio.Queue(queue_size)
+
+    def deliver(self, event):
+        """Mete el evento en la cola (siempre desde su propio bucle)"""
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # No lee: lo que tenía ya no sirve, que recargue
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(Event(event.id, RESYNC, {}))
+
+
+class Hub:
+    """Reparte los eventos de cada usuario entre sus conexiones abiertas"""
+
+    def __init__(self, queue_size=QUEUE_SIZE, history=HISTORY, max_histories=MAX_HISTORIES):
+        self.queue_size = queue_size
+        self.history = history
+        self.max_histories = max_histories
+        # Los ids llevan delante este prefijo: así sé si un Last-Event-ID
+        # es de este proceso (y de esta vez que ha arrancado)
+        self.prefix = uuid.uuid4().hex[:8]
+        self._numbers = itertools.count(1)
+        self._subscribers = {}
+        self._histories = OrderedDict()
+        self._lock = threading.Lock()
+
+    def subscribe(self, owner_id, last_event_id=None):
+        """
+        Nueva conexión del usuario (desde el bucle de eventos de la vista).
+
+        Si viene last_event_id, la cola empieza con los eventos que se ha
+        perdido (o con resync si no los tengo todos).
+        """
+        subscriber = Subscriber(owner_id, asyncio.get_running_loop(), self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(owner_id, set()).add(subscriber)
+            missed = self._missed(owner_id, last_event_id) if last_event_id else []
+        for event in missed:
+            subscriber.deliver(event)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.owner_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[subscriber.owner_id]
+
+    def connections(self):
+        """Conexiones abiertas en este proceso"""
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def publish(self, owner_id, kind, **data):
+        """Manda un evento a todas las conexiones del usuario (desde cualquier hilo)"""
+        with self._lock:
+            number = next(self._numbers)
+            event = Event(f'{self.prefix}-{number}', kind, data)
+            # [número desde el que lo tengo todo, últimos eventos]
+            history = self._histories.pop(owner_id, None) or [number - 1, deque(maxlen=self.history)]
+            if len(history[1]) == self.history:
+                history[0] = _number(history[1][0])
+            history[1].append(event)
+            self._histories[owner_id] = history
+            while len(self._histories) > self.max_histories:
+                self._histories.popitem(last=False)
+            subscribers = list(self._subscribers.get(owner_id, ()))
+
+        for subscriber in subscribers:
+            try:
+                subscriber.loop.call_soon_threadsafe(subscriber.deliver, event)
+            except RuntimeError:
+                # Su bucle ya está cerrado (el proceso se está parando)
+                self.unsubscribe(subscriber)
+        return event
+
+    def _missed(self, owner_id, last_event_id):
+        """Los eventos de después de last_event_id, o [resync] si no los tengo todos"""
+        prefix, _, number = last_event_id.rpartition('-')
+        since, history = self._histories.get(owner_id, (None, ()))
+        if prefix != self.prefix or not number.isdigit() or since is None or int(number) < since:
+            return [Event(last_event_id, RESYNC, {})]
+        return [event for event in history if _number(event) > int(number)]
+
+
+def _number(event):
+    """El contador de un evento: 'a1b2c3d4-17' -> 17"""
+    return int(event.id.rpartition('-')[2])
+
+
+hub = Hub()
+
+
+def check_single_process(app_configs=None, **kwargs):
+    """
+    System check (registrado en apps.py): aviso si WEB_CONCURRENCY pide
+    varios workers, porque el Hub es de cada proceso (ver arriba).
+    """
+    workers = os.environ.get('WEB_CONCURRENCY', '')
+    if not workers.isdigit() or int(workers) <= 1:
+        return []
+    return [checks.Warning(
+        f'WEB_CONCURRENCY={workers}: los cambios en directo (citas/events.py) '
+        'solo llegan a las pestañas conectadas al mismo proceso',
+        hint='Arranca el servidor ASGI con un solo worker '
+             '(las vistas async atienden muchas conexiones con uno)',
+        id='citas.W001',
+    )]
+
+
+def publish(owner_id, kind, **data):
+    """
+    hub.publish cuando se confirme la transacción (o ya, si no hay
+    ninguna) de la BD con las citas del usuario (ver sharding.py)
+    """
+    transaction.on_commit(lambda: hub.publish(owner_id, kind, **data),
+                          using=sharding.db_for_owner(owner_id))
+
+
+def publish_many(owner_id, kind, ids, **data):
+    """
+    El mismo cambio en muchas citas (acciones en bloque, ver bulk.py).
+
+    Si son muchas mando un solo resync: ir tarjeta por tarjeta sería más
+    lento que recargar (y llenaría las colas igualmente).
+    """
+    if len(ids) > QUEUE_SIZE // 2:
+        publish(owner_id, RESYNC)
+        return
+    for pk in ids:
+        publish(owner_id, kind, id=pk, **data)
+
+
+async def stream(subscriber):
+    """
+    El cuerpo de la respuesta de quote_events: los eventos del suscriptor
+    en formato text/event-stream, y un comentario cada HEARTBEAT segundos.
+
+    Cuando el navegador se va, Django cancela la respuesta y el finally
+    quita la conexión del Hub.
+    """
+    try:
+        # Si se corta, que el navegador espere 5 segundos antes de reconectar
+        yield 'retry: 5000\n\n'
+        while True:
+            try:
+                async with asyncio.timeout(HEARTBEAT):
+                    event = await subscriber.queue.get()
+            except TimeoutError:
+                yield ': ping\n\n'
+                continue
+            yield event.encode()
+    finally:
+        hub.unsubscribe(subscriber)
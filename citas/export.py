@@ -0,0 +1,190 @@
+"""
+Exportar el cuaderno de un usuario (JSONL, CSV o ZIP con las imágenes).
+
+Con 100.000 citas no puedo montar el fichero entero en memoria y luego
+mandarlo. Aquí todo son generadores que van soltando trozos, y la vista
+los manda con StreamingHttpResponse según se generan:
+
+- Las citas se leen con .iterator(chunk_size=...): Django no guarda la
+  caché del queryset, así que en memoria solo hay un trozo cada vez.
+- Las imágenes del ZIP se copian del storage por trozos de 64 KB.
+- zipfile sabe escribir en un "fichero" en el que no se puede hacer seek
+  (pone los tamaños detrás de cada fichero, en un data descriptor), así
+  que el ZIP se va generando y mandando a la vez.
+
+El JSONL tiene los mismos campos que lee import_citas, así que un
+cuaderno exportado se puede importar en otra cuenta.
+"""
+
+import csv
+import json
+import logging
+import posixpath
+import time
+import zipfile
+
+from .models import Cita
+
+
+logger = logging.getLogger(__name__)
+
+# Citas que se leen de la BD en cada consulta
+CHUNK_SIZE = 2000
+
+# Trozo de imagen que se lee/escribe cada vez
+FILE_CHUNK_SIZE = 64 * 1024
+
+# Formato -> (content type, extensión)
+FORMATS = {
+    'jsonl': ('application/x-ndjson; charset=utf-8', 'jsonl'),
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'zip': ('application/zip', 'zip'),
+}
+
+CSV_COLUMNS = ['text', 'source', 'tema', 'is_favorite', 'created_at', 'image']
+
+
+def export_queryset(citas):
+    """
+    Solo las columnas que se exportan (sin placeholders ni variantes, que
+    ocupan bastante) y el tema en la misma consulta.
+    """
+    return (citas
+            .select_related('tag')
+            .only('text', 'source', 'is_favorite', 'created_at', 'image', 'tag__name')
+            .order_by('created_at', 'pk'))
+
+
+def _image_path(name):
+    """
+    Ruta de la imagen dentro del ZIP: images/<nombre en el storage>
+
+    Con el nombre entero (quotes/ab/cd/<hash>.jpg) y no solo el del
+    fichero: las imágenes antiguas (sin hash) pueden llamarse igual en
+    carpetas distintas y se pisarían dentro del ZIP.
+    """
+    if not name:
+        return ''
+    # Sin '..' ni '/' al principio: que no se salga de images/ al descomprimir
+    parts = [part for part in posixpath.normpath(name).split('/') if part not in ('', '.', '..')]
+    return posixpath.join('images', *parts)
+
+
+def cita_to_dict(cita):
+    return {
+        'text': cita.text,
+        'source': cita.source,
+        'tema': cita.tag.name if cita.tag else '',
+        'is_favorite': cita.is_favorite,
+        'created_at': cita.created_at.isoformat(),
+        'image': _image_path(cita.image.name),
+    }
+
+
+def jsonl_lines(citas):
+    """Una línea JSON por cita"""
+    for cita in export_queryset(citas).iterator(chunk_size=CHUNK_SIZE):
+        yield json.dumps(cita_to_dict(cita), ensure_ascii=False) + '\n'
+
+
+class _Echo:
+    """
+    "Fichero" que devuelve lo que le escriben en vez de guardarlo.
+
+    Es el truco de la documentación de Django para usar csv.writer en
+    streaming: writerow() devuelve la línea ya formateada.
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(citas):
+    """Cabecera + una fila por cita"""
+    writer = csv.writer(_Echo())
+    # BOM para que Excel abra bien las tildes
+    yield '\ufeff' + writer.writerow(CSV_COLUMNS)
+    for cita in export_queryset(citas).iterator(chunk_size=CHUNK_SIZE):
+        row = cita_to_dict(cita)
+        row['is_favorite'] = 'sí' if row['is_favorite'] else ''
+        yield writer.writerow([row[column] for column in CSV_COLUMNS])
+
+
+class _ZipStream:
+    """
+    "Fichero" donde escribe zipfile. Va acumulando los bytes y pop()
+    devuelve lo que haya (y lo vacía) para mandarlo al navegador.
+
+    No tiene seek() ni tell(): zipfile se da cuenta y lleva la cuenta él.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def zip_chunks(citas):
+    """
+    ZIP con citas.jsonl y la carpeta images/.
+
+    Las imágenes se guardan por su hash (storage.py), así que si dos citas
+    usan la misma imagen va una sola vez. Las saco con DISTINCT en una
+    segunda consulta en vez de apuntar en un set las que ya he metido.
+    """
+    stream = _ZipStream()
+    # Sin fecha, ZipInfo pone 1980
+    now = time.localtime()[:6]
+
+    with zipfile.ZipFile(stream, 'w') as archive:
+        # El texto se comprime bien
+        info = zipfile.ZipInfo('citas.jsonl', now)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        with archive.open(info, 'w', force_zip64=True) as target:
+            for line in jsonl_lines(citas):
+                target.write(line.encode('utf-8'))
+                # DEFLATE va guardando: no siempre hay bytes que mandar
+                data = stream.pop()
+                if data:
+                    yield data
+
+        names = (citas.exclude(image='').exclude(image__isnull=True)
+                 .order_by('image').values_list('image', flat=True).distinct())
+        storage = Cita._meta.get_field('image').storage
+
+        for name in names.iterator(chunk_size=CHUNK_SIZE):
+            try:
+                source = storage.open(name, 'rb')
+            except OSError:
+                logger.warning('Exportación: no existe la imagen %s', name)
+                continue
+
+            # Las imágenes ya vienen comprimidas (JPEG, PNG, WebP...): ZIP_STORED
+            info = zipfile.ZipInfo(_image_path(name), now)
+            info.compress_type = zipfile.ZIP_STORED
+            with source, archive.open(info, 'w', force_zip64=True) as target:
+                for chunk in source.chunks(FILE_CHUNK_SIZE):
+                    target.write(chunk)
+                    yield stream.pop()
+
+    # El índice del ZIP (central directory) se escribe al cerrar
+    yield stream.pop()
+
+
+def generate(citas, fmt):
+    """Generador de trozos para StreamingHttpResponse"""
+    if fmt == 'csv':
+        return csv_lines(citas)
+    if fmt == 'zip':
+        return zip_chunks(citas)
+    return jsonl_lines(citas)
@@ -1,17 +1,85 @@
 """
 Formularios de la app citas.
 
-Tengo dos formularios:
+Tengo tres formularios:
 1. QuoteFilterForm: para filtrar la lista (Form normal)
 2. QuoteForm: para crear/editar citas (ModelForm)
+3. BulkActionForm: acciones sobre varias citas marcadas (Form normal)
 
 La diferencia:
 - Form: formulario genérico, no guarda nada en BD
 - ModelForm: basado en un modelo, guarda en BD
+
+Y dos widgets con sugerencias mientras escribes (ver autocomplete.py):
+AutocompleteInput (la fuente) y TemaAutocomplete (el tema).
 """
 
 from django import forms
+from django.core.files.uploadedfile import UploadedFile
+from django.urls import reverse
 from .models import Cita, Tema
+from .pagination import MAX_ID, MIN_ID
+from .placeholders import image_metadata
+from . import bulk, duplicates, perceptual
+
+
+class AutocompleteInput(forms.TextInput):
+    """
+    Input de texto con sugerencias mientras escribes (ver autocomplete.py).
+    
+    Lleva un <datalist> vacío: main.js lo rellena con lo que devuelve la
+    API. Sin JavaScript es un input normal.
+    """
+    template_name = 'citas/widgets/autocomplete.html'
+    
+    def __init__(self, field, attrs=None):
+        super().__init__(attrs)
+        self.field = field
+    
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        widget_attrs = context['widget']['attrs']
+        widget_attrs['list'] = f'{widget_attrs["id"]}_list'
+        widget_attrs['autocomplete'] = 'off'
+        widget_attrs['data-autocomplete'] = self.field
+        widget_attrs['data-autocomplete-url'] = reverse('citas:quote_autocomplete')
+        return context
+
+
+class TemaAutocomplete(forms.Widget):
+    """
+    El tema se elige escribiendo su nombre, en vez de con un <select> con
+    todos los temas (que se mandaba entero en cada página).
+    
+    Se pinta un input de texto (el nombre) y uno oculto con el id, que es
+    el que se envía; main.js pide los temas que empiezan por lo escrito y
+    pone el id del elegido en el oculto. Para enseñar el nombre del tema
+    que ya está elegido hago una consulta (solo de ese tema).
+    
+    queryset lo pone el formulario (los temas del usuario).
+    """
+    template_name = 'citas/widgets/tema_autocomplete.html'
+    
+    def __init__(self, empty_label='', attrs=None):
+        super().__init__(attrs)
+        self.empty_label = empty_label
+        self.queryset = Tema.objects.none()
+        # Si ya se sabe el nombre no lo busco (las vistas async no pueden
+        # consultar la BD mientras renderizan, ver async_views.py)
+        self.label = None
+    
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        pk = context['widget']['value']
+        label = self.label or ''
+        if pk and str(pk).isdigit() and self.label is None:
+            label = self.queryset.filter(pk=pk).values_list('name', flat=True).first() or ''
+        context['widget'].update({
+            'label': label,
+            'empty_label': self.empty_label,
+            'url': reverse('citas:quote_autocomplete'),
+        })
+        return context
 
 
 class QuoteFilterForm(forms.Form):
@@ -53,15 +121,15 @@ class QuoteFilterForm(forms.Form):
         label='Solo con imagen'
     )
     
-    # Select de temas
-    # ModelChoiceField = select con opciones de un modelo
+    # Tema (se elige escribiendo, ver TemaAutocomplete)
+    # ModelChoiceField = un objeto de un modelo (llega su id)
     # queryset lo relleno en __init__ porque depende del usuario
     tag = forms.ModelChoiceField(
         queryset=Tema.objects.none(),  # De momento vacío
         required=False,
         empty_label='Todos los temas',
         label='Tema',
-        widget=forms.Select(attrs={'class': 'form-select'})
+        widget=TemaAutocomplete(empty_label='Todos los temas')
     )
     
     
@@ -86,6 +154,10 @@ class QuoteFilterForm(forms.Form):
             # Filtro los temas solo del usuario actual
             # Sobrescribo el queryset del campo 'tag'
             self.fields['tag'].queryset = Tema.objects.filter(owner=user)
+            self.fields['tag'].widget.queryset = self.fields['tag'].queryset
+            
+            # (Cuántas citas tiene cada tema sale ahora en las sugerencias,
+            # ver autocomplete.py)
 
 
 class QuoteForm(forms.ModelForm):
@@ -102,8 +174,18 @@ class QuoteForm(forms.ModelForm):
     - Validación extra en clean()
     - Filtrado de temas por usuario
     - Widgets personalizados
+    - Aviso si ya tienes una cita casi igual (al crear), por el texto o
+      por la imagen
     """
     
+    # No es del modelo: "sí, ya sé que está repetida, guárdala".
+    # Va oculto y solo se enseña cuando hay repetidas (ver check_duplicates)
+    confirm_duplicate = forms.BooleanField(
+        required=False,
+        label='Guardar igualmente',
+        widget=forms.HiddenInput()
+    )
+    
     class Meta:
         # Modelo asociado
         model = Cita
@@ -122,11 +204,15 @@ class QuoteForm(forms.ModelForm):
                 'class': 'form-control'
             }),
             
-            # source: input con placeholder
-            'source': forms.TextInput(attrs={
+            # source: input con placeholder y sugerencias de las fuentes
+            # que ya has usado (así no escribes el mismo autor de tres formas)
+            'source': AutocompleteInput('source', attrs={
                 'placeholder': 'Autor, libro, película...',
                 'class': 'form-control'
             }),
+            
+            # tag: se escribe el nombre (ver TemaAutocomplete)
+            'tag': TemaAutocomplete(empty_label='Sin clasificar (irá al Inbox)'),
         }
     
     
@@ -136,7 +222,7 @@ class QuoteForm(forms.ModelForm):
         
         Similar a QuoteFilterForm, necesito el usuario para:
         1. Filtrar los temas (solo los del usuario)
-        2. Cambiar el texto de la opción vacía del select
+        2. Buscar citas repetidas (check_duplicates)
         
         Uso: QuoteForm(user=request.user)
         """
@@ -146,14 +232,103 @@ class QuoteForm(forms.ModelForm):
         # Llamo al __init__ de ModelForm
         super().__init__(*args, **kwargs)
         
+        # Lo guardo para buscar citas repetidas en check_duplicates()
+        self.user = user
+        self.duplicates = []
+        self.duplicate_images = []
+        
         # Si hay usuario
         if user:
             # Solo muestro los temas del usuario actual
             self.fields['tag'].queryset = Tema.objects.filter(owner=user)
-            
-            # Cambio el texto de la opción vacía
-            # Por defecto sería "-------" que no es muy descriptivo
-            self.fields['tag'].empty_label = 'Sin clasificar (irá al Inbox)'
+            self.fields['tag'].widget.queryset = self.fields['tag'].queryset
+    
+    
+    def check_duplicates(self, text):
+        """
+        Al crear una cita, aviso si ya tienes una con el texto casi igual
+        o con la misma imagen (aunque esté recomprimida o reescalada).
+        
+        No miro todas tus citas: duplicates.find_similar busca solo en las
+        cubetas LSH del texto (ver duplicates.py) y perceptual.find_similar
+        en las 4 cubetas del hash de la imagen (ver perceptual.py), así que
+        da igual cuántas tengas. Si hay repetidas el formulario no se guarda
+        y aparece la casilla "Guardar igualmente"; marcándola se guarda.
+        """
+        # Solo al crear (al editar ya sabes que existe)
+        if not self.user or self.instance.pk:
+            return
+        if self.cleaned_data.get('confirm_duplicate'):
+            return
+        
+        if text:
+            self.duplicates = duplicates.find_similar(self.user.pk, text)
+        if self.duplicates:
+            repetidas = '; '.join(
+                f'«{cita.text[:80]}{"..." if len(cita.text) > 80 else ""}» ({score:.0%})'
+                for cita, score in self.duplicates[:3]
+            )
+            self.add_error('text', (
+                f'Ya tienes una cita casi igual: {repetidas}. '
+                f'Marca "Guardar igualmente" si quieres guardarla de todas formas.'
+            ))
+        
+        # getattr: si la imagen no era válida, clean_image no ha llegado a calcularlo
+        dhash = getattr(self, 'image_dhash', None)
+        if dhash is not None:
+            self.duplicate_images = perceptual.find_similar(self.user.pk, dhash)
+        if self.duplicate_images:
+            repetidas = ', '.join(
+                f'«{cita.text[:40]}»' if cita.text else f'#{cita.pk}'
+                for cita, _ in self.duplicate_images[:3]
+            )
+            self.add_error('image', (
+                f'Ya tienes una cita con esta imagen: {repetidas}. '
+                f'Si quieres guardarla de todas formas, vuelve a elegirla y marca "Guardar igualmente".'
+            ))
+        
+        if self.duplicates or self.duplicate_images:
+            self.fields['confirm_duplicate'].widget = forms.CheckboxInput()
+    
+    
+    def clean_image(self):
+        """
+        Si se ha subido una imagen nueva, saco su tamaño, el placeholder y
+        su hash perceptual (para buscar imágenes repetidas).
+        
+        Lo hago aquí (al validar) porque es el único momento en que ya
+        tengo el fichero abierto. Luego nunca más hay que abrirlo para
+        saber cuánto mide. Los valores se guardan en save().
+        """
+        image = self.cleaned_data.get('image')
+        
+        # UploadedFile = fichero nuevo
+        # (si no se cambia la imagen al editar, llega el FieldFile de antes)
+        if isinstance(image, UploadedFile):
+            self.image_metadata = image_metadata(image)
+            self.image_dhash = perceptual.dhash(image)
+        elif not image:
+            # Se ha quitado la imagen (o nunca la hubo)
+            self.image_metadata = (None, None, '')
+            self.image_dhash = None
+        
+        return image
+    
+    
+    def save(self, commit=True):
+        """
+        Guarda la cita con el tamaño, el placeholder y el hash de clean_image().
+        (Las cubetas del hash las guardan las señales, ver signals.py)
+        """
+        metadata = getattr(self, 'image_metadata', None)
+        
+        if metadata:
+            (self.instance.image_width,
+             self.instance.image_height,
+             self.instance.image_placeholder) = metadata
+            self.instance.image_dhash = self.image_dhash
+        
+        return super().save(commit)
     
     
     def clean(self):
@@ -181,6 +356,74 @@ class QuoteForm(forms.ModelForm):
                 'Debes añadir al menos texto o una imagen. La cita no puede estar vacía.'
             )
         
+        # ¿Ya la tenía? (ver check_duplicates)
+        self.check_duplicates(text)
+        
         # Devuelvo los datos limpios
         # Es importante devolverlos
-        return cleaned_data
\ No newline at end of file
+        return cleaned_data
+
+
+class IdListField(forms.Field):
+    """
+    Lista de ids de citas que llega como varios campos con el mismo nombre
+    (ids=3&ids=7&ids=12), uno por cada checkbox marcado.
+    """
+    widget = forms.MultipleHiddenInput
+    
+    def to_python(self, value):
+        if not value:
+            return []
+        try:
+            ids = [int(pk) for pk in value]
+        except (TypeError, ValueError):
+            raise forms.ValidationError('Selección de citas no válida.')
+        # OJO: un id que no cabe en un BigAutoField hace que la consulta
+        # falle (OverflowError, un 500), igual que en los cursores
+        if not all(MIN_ID <= pk <= MAX_ID for pk in ids):
+            raise forms.ValidationError('Selección de citas no válida.')
+        return ids
+
+
+class BulkActionForm(forms.Form):
+    """
+    Formulario de la barra de acciones en bloque (lista e inbox).
+    
+    Los checkboxes de las tarjetas están fuera del <form> (cada tarjeta
+    está en la caché y en su sitio del grid), pero llevan form="bulk-form"
+    y el navegador los envía con este formulario igualmente. Así funciona
+    sin JavaScript.
+    
+    Uso: BulkActionForm(request.POST, user=request.user)
+    """
+    
+    action = forms.ChoiceField(
+        choices=bulk.ACTIONS,
+        label='Acción',
+        widget=forms.Select(attrs={'class': 'form-select form-select-sm'})
+    )
+    
+    # Solo para "Mover al tema": vacío = mandarlas al inbox
+    # (se elige escribiendo el nombre, ver TemaAutocomplete)
+    tema = forms.ModelChoiceField(
+        queryset=Tema.objects.none(),
+        required=False,
+        empty_label='Inbox (sin tema)',
+        label='Tema',
+        widget=TemaAutocomplete(empty_label='Inbox (sin tema)', attrs={'class': 'form-control form-control-sm'})
+    )
+    
+    ids = IdListField(
+        label='Citas',
+        error_messages={'required': 'No has marcado ninguna cita.'}
+    )
+    
+    
+    def __init__(self, *args, **kwargs):
+        user = kwargs.pop('user', None)
+        super().__init__(*args, **kwargs)
+        
+        if user:
+            # Solo se puede mover a temas propios
+            self.fields['tema'].queryset = Tema.objects.filter(owner=user)
+            self.fields['tema'].widget.queryset = self.fields['tema'].queryset
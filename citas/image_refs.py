@@ -0,0 +1,149 @@
+"""
+Cuenta de referencias de los ficheros de imagen (modelo Imagen).
+
+Con el almacenamiento por contenido (storage.py) varias citas pueden
+compartir el mismo fichero, así que ya no se puede borrar el fichero al
+borrar una cita: hay que saber si alguna otra lo sigue usando.
+
+- acquire(name): una cita más usa el fichero
+- release(name): una cita menos; si llega a 0, se borran el fichero y
+  sus miniaturas (cuando termina la transacción, por si hay rollback)
+- release_many(names): lo mismo al borrar muchas citas a la vez
+- hold(name): la referencia de una cita que se está guardando, antes de
+  mirar si el fichero existe (lo usa storage.py)
+
+Lo llaman las señales de Cita (ver signals.py).
+
+OJO con las carreras: HashedImageStorage.save no escribe el fichero si ya
+existe, pero la referencia se sumaba después, en post_save. Entre medias
+otra petición podía quitar la última referencia y borrar el fichero (en
+su on_commit), y la cita nueva se quedaba apuntando a un fichero que no
+existe. Ahora:
+- save() toma la referencia (hold) ANTES de mirar si el fichero existe.
+  La señal de la cita, al llegar, se queda con esa referencia en vez de
+  sumar otra.
+- delete_files() vuelve a mirar, antes de borrar, si alguien ha tomado
+  el fichero entretanto.
+Las dos cosas van en una transacción de la BD de Imagen (_locked). Con el
+perfil de producción de SQLite (transaction_mode IMMEDIATE) la
+transacción pide el candado de escritura al empezar, así que nunca van a
+la vez; en otras BD select_for_update bloquea la fila.
+"""
+
+from contextvars import ContextVar
+
+from django.db import router, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+
+from .models import Cita, Imagen
+from .storage import is_hashed_name
+from . import thumbnails
+
+
+# Referencias que ha tomado hold() y que todavía no ha usado ninguna cita
+# (una tupla: el valor de un ContextVar no se puede cambiar por dentro).
+# Si la cita no llega a guardarse, su referencia se queda: sobra una y el
+# fichero no se borra (hasta que dedupe_images recalcula las cuentas),
+# pero nunca falta una de un fichero que se usa
+_held = ContextVar('citas_held_images', default=())
+
+
+def _locked():
+    """Transacción en la BD de Imagen (default) para contar y borrar a la vez"""
+    return transaction.atomic(using=router.db_for_write(Imagen))
+
+
+def _add_reference(name):
+    imagen, _ = Imagen.objects.select_for_update().get_or_create(name=name)
+    # F() hace la suma en la BD (UPDATE ... SET refcount = refcount + 1),
+    # así dos peticiones a la vez no se pisan
+    Imagen.objects.filter(pk=imagen.pk).update(refcount=F('refcount') + 1)
+
+
+def hold(name):
+    """
+    Toma la referencia de la cita que se va a guardar con el fichero name.
+
+    Desde aquí el fichero ya no se puede borrar, así que se puede mirar
+    si existe y no escribirlo otra vez. El acquire() de la cita (en
+    post_save) se queda con esta referencia.
+    """
+    if not name or not is_hashed_name(name):
+        return
+    
+    with _locked():
+        _add_reference(name)
+    _held.set(_held.get() + (name,))
+
+
+def _take_held(name):
+    """True si había una referencia de hold() para name (y ya no está)"""
+    held = _held.get()
+    if name not in held:
+        return False
+    index = held.index(name)
+    _held.set(held[:index] + held[index + 1:])
+    return True
+
+
+def acquire(name):
+    """Suma una referencia al fichero name (o usa la que tomó hold)"""
+    if not name or not is_hashed_name(name) or _take_held(name):
+        return
+    
+    with _locked():
+        _add_reference(name)
+
+
+def drop_hold(name):
+    """
+    La cita se ha guardado pero no estrena imagen (ya tenía esa): la
+    referencia de hold() sobra
+    """
+    if name and _take_held(name):
+        release(name)
+
+
+def release(name):
+    """Resta una referencia; si ya no la usa nadie, borra el fichero"""
+    if not name or not is_hashed_name(name):
+        return
+    
+    Imagen.objects.filter(name=name, refcount__gt=0).update(refcount=F('refcount') - 1)
+    
+    deleted, _ = Imagen.objects.filter(name=name, refcount=0).delete()
+    if deleted:
+        transaction.on_commit(lambda: delete_files(name))
+
+
+def release_many(names):
+    """
+    release() para muchas citas borradas de golpe (ver bulk.py).
+
+    names es un Counter {fichero: cuántas citas lo usaban}: un UPDATE por
+    fichero distinto en vez de uno por cita.
+    """
+    names = {name: n for name, n in names.items() if name and is_hashed_name(name)}
+    if not names:
+        return
+    
+    for name, n in names.items():
+        Imagen.objects.filter(name=name).update(refcount=Greatest(F('refcount') - n, Value(0)))
+    
+    unused = list(Imagen.objects.filter(name__in=names, refcount=0).values_list('name', flat=True))
+    if unused:
+        Imagen.objects.filter(name__in=unused).delete()
+        transaction.on_commit(lambda: [delete_files(name) for name in unused])
+
+
+def delete_files(name):
+    """
+    Borra el fichero original y todas sus miniaturas, si nadie lo ha
+    vuelto a tomar desde que llegó a 0 (ver arriba)
+    """
+    with _locked():
+        if Imagen.objects.select_for_update().filter(name=name).exists():
+            return
+        Cita._meta.get_field('image').storage.delete(name)
+        thumbnails.delete_all_variants(name)
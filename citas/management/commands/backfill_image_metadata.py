@@ -0,0 +1,79 @@
+"""
+Rellena el tamaño y el placeholder de las imágenes antiguas.
+
+Uso:
+    python manage.py backfill_image_metadata
+    python manage.py backfill_image_metadata --batch-size 1000
+
+Las citas nuevas ya los traen (se calculan en QuoteForm al subir la
+imagen), pero las que se subieron antes no. Voy por lotes ordenados por
+pk y guardo cada lote con un solo bulk_update.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from citas import caching, sharding
+from citas.models import Cita
+from citas.placeholders import image_metadata
+
+
+class Command(BaseCommand):
+    help = 'Calcula image_width, image_height e image_placeholder de las imágenes antiguas'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Citas por lote')
+    
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        self.done = self.failed = 0
+        self.start = time.perf_counter()
+        
+        # Shard por shard (ver citas/sharding.py): las pk de cada uno van aparte
+        for _ in sharding.each_shard():
+            self.backfill(batch_size)
+        
+        self.stdout.write(self.style.SUCCESS(
+            f'Terminado: {self.done} imágenes actualizadas, {self.failed} con error'
+        ))
+    
+    def backfill(self, batch_size):
+        pending = (Cita.objects
+                   .exclude(image='').exclude(image__isnull=True)
+                   .filter(image_width__isnull=True)
+                   .order_by('pk')
+                   .only('pk', 'image', 'owner_id'))
+        last_pk = 0
+        
+        while True:
+            batch = list(pending.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            
+            updated = []
+            for cita in batch:
+                try:
+                    with cita.image.open('rb') as fileobj:
+                        (cita.image_width,
+                         cita.image_height,
+                         cita.image_placeholder) = image_metadata(fileobj)
+                except Exception as error:
+                    self.failed += 1
+                    self.stderr.write(f'Cita {cita.pk} ({cita.image.name}): {error}')
+                    continue
+                updated.append(cita)
+            
+            Cita.objects.bulk_update(
+                updated, ['image_width', 'image_height', 'image_placeholder']
+            )
+            self.done += len(updated)
+            
+            # bulk_update no lanza señales: invalido a mano la caché de las tarjetas
+            for owner_id in {cita.owner_id for cita in updated}:
+                caching.bump(owner_id)
+            
+            elapsed = time.perf_counter() - self.start
+            self.stdout.write(f'{self.done} imágenes ({self.done / elapsed:.1f}/s)')
@@ -0,0 +1,130 @@
+"""
+Benchmark: vistas con la caché vacía (fría) y con la caché llena (caliente).
+
+Uso:
+    python manage.py bench_cache --rows 5000 --repeat 20
+
+Crea un usuario temporal con N citas de prueba, llama a las vistas de la
+lista, la segunda página, el inbox y la aleatoria, y mide:
+- fría: vaciando la caché antes de cada petición
+- caliente: con las tarjetas y las listas de ids ya en caché
+
+Al final enseña las estadísticas de la caché (aciertos, fallos...) y
+deshace todo (rollback), así que no deja nada en la base de datos.
+"""
+
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from citas import caching, sharding, views
+from citas.models import Cita, Tema
+from citas.pagination import PAGE_SIZE, encode_cursor
+
+
+WORDS = (
+    'vida amor tiempo camino corazón sueño libertad miedo esperanza '
+    'filosofía razón verdad mundo alma destino silencio música palabra'
+).split()
+
+
+class Command(BaseCommand):
+    help = 'Compara la latencia de las vistas con la caché fría y caliente'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=5000,
+                            help='Número de citas de prueba')
+        parser.add_argument('--repeat', type=int, default=20,
+                            help='Peticiones que mido de cada vista')
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        repeat = options['repeat']
+
+        with transaction.atomic():
+            user = User.objects.create_user('bench-cache-tmp')
+
+            # Las citas van al shard del usuario (ver citas/sharding.py)
+            with sharding.for_owner(user.pk) as alias, transaction.atomic(using=alias):
+                temas = [Tema.objects.create(owner=user, name=f'Tema {i}') for i in range(5)]
+
+                self.stdout.write(f'Creando {rows} citas de prueba...')
+                Cita.objects.bulk_create(
+                    (Cita(owner=user,
+                          text=' '.join(random.choices(WORDS, k=15)),
+                          source=random.choice(WORDS).title(),
+                          tag=random.choice(temas + [None]),
+                          is_favorite=random.random() < 0.2)
+                     for _ in range(rows)),
+                    batch_size=1000,
+                )
+                caching.bump(user.pk)
+
+                second_page = list(Cita.objects.filter(owner=user)
+                                   .order_by('-created_at', '-id')[PAGE_SIZE - 1:PAGE_SIZE])
+                cursor = encode_cursor(second_page[0]) if second_page else ''
+
+                # Un "navegador": siempre la misma cookie CSRF
+                self.factory = RequestFactory()
+                self.user = user
+                self.csrf_secret = 'a' * 32
+
+                cases = [
+                    ('lista', views.quote_list, {}),
+                    ('lista (página 2)', views.quote_list, {'cursor': cursor}),
+                    ('lista (favoritas)', views.quote_list, {'favorite_only': 'on'}),
+                    ('scroll infinito', views.quote_list_page, {'cursor': cursor}),
+                    ('inbox', views.quote_inbox, {}),
+                    ('aleatoria', views.quote_random, {}),
+                ]
+
+                if hasattr(cache, 'reset_stats'):
+                    cache.reset_stats()
+
+                self.stdout.write(f'{"vista":<22}{"fría":>10}{"caliente":>12}{"consultas":>14}')
+                for name, view, params in cases:
+                    cold, cold_queries = self._time(repeat, view, params, clear=True)
+                    self._request(view, params)  # la lleno
+                    warm, warm_queries = self._time(repeat, view, params, clear=False)
+                    self.stdout.write(
+                        f'{name:<22}{cold:>8.1f}ms{warm:>10.1f}ms'
+                        f'{cold_queries:>8} -> {warm_queries}'
+                    )
+
+                stats = caching.stats()
+                if stats:
+                    self.stdout.write(
+                        f'\nCaché: {stats["hits"]} aciertos, {stats["misses"]} fallos '
+                        f'({stats["hit_rate"]:.0%}), {stats["evictions"]} tiradas, '
+                        f'{stats["entries"]} entradas, {stats["bytes"] / 1024:.0f} KB'
+                    )
+
+                transaction.set_rollback(True, using=alias)
+
+            transaction.set_rollback(True)
+
+    def _request(self, view, params):
+        request = self.factory.get('/', params)
+        request.user = self.user
+        request.META['CSRF_COOKIE'] = self.csrf_secret
+        response = view(request)
+        assert response.status_code == 200, response.status_code
+
+    def _time(self, repeat, view, params, clear):
+        """Media en milisegundos y consultas SQL de la última petición"""
+        total = 0
+        for _ in range(repeat):
+            if clear:
+                cache.clear()
+            # Las consultas de las vistas van al shard (sin shards, a default)
+            with CaptureQueriesContext(connections[sharding.db()]) as queries:
+                start = time.perf_counter()
+                self._request(view, params)
+                total += time.perf_counter() - start
+        return total / repeat * 1000, len(queries)
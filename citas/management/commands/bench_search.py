@@ -0,0 +1,94 @@
+"""
+Benchmark: búsqueda con FTS5 vs. la búsqueda antigua con icontains.
+
+Uso:
+    python manage.py bench_search --rows 50000 --repeat 20
+
+Crea un usuario temporal con N citas de prueba, mide las dos búsquedas
+con varias palabras y al final deshace todo (rollback), así que no deja
+nada en la base de datos.
+"""
+
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+
+from citas import search, sharding
+from citas.models import Cita
+
+
+# Palabras para inventar citas más o menos realistas
+WORDS = (
+    'vida amor tiempo camino corazón sueño libertad miedo esperanza '
+    'filosofía razón verdad mundo alma destino silencio música palabra '
+    'éxito fracaso paciencia valentía amistad memoria futuro pasado'
+).split()
+
+# Más palabras inventadas con sílabas, para que el vocabulario no sea
+# ridículamente pequeño (en citas reales casi todas las palabras son raras)
+SYLLABLES = 'ba ce di fo gu la me ni po ru sa te vi zo al en or'.split()
+WORDS += [''.join(random.choices(SYLLABLES, k=3)) for _ in range(3000)]
+
+QUERIES = ['corazon', 'filos', 'libertad miedo', 'xyz']
+
+
+class Command(BaseCommand):
+    help = 'Compara la búsqueda FTS5 con la búsqueda icontains'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=20000,
+                            help='Número de citas de prueba')
+        parser.add_argument('--repeat', type=int, default=10,
+                            help='Veces que repito cada búsqueda')
+    
+    def handle(self, *args, **options):
+        if not search.is_available():
+            raise CommandError('No hay índice FTS5 (¿has hecho migrate?)')
+        
+        rows = options['rows']
+        repeat = options['repeat']
+        
+        # Todo dentro de una transacción que luego deshago
+        with transaction.atomic():
+            user = User.objects.create_user('bench-search-tmp')
+            
+            # Las citas van al shard del usuario (ver citas/sharding.py)
+            with sharding.for_owner(user.pk) as alias, transaction.atomic(using=alias):                
+                self.stdout.write(f'Creando {rows} citas de prueba...')
+                Cita.objects.bulk_create(
+                    (Cita(owner=user,
+                          text=' '.join(random.choices(WORDS, k=12)),
+                          source=random.choice(WORDS).title())
+                     for _ in range(rows)),
+                    batch_size=1000,
+                )
+                
+                base = Cita.objects.filter(owner=user)
+                
+                self.stdout.write(f'{"búsqueda":<20}{"icontains":>12}{"fts5":>12}{"filas":>8}')
+                for q in QUERIES:
+                    old = self._time(repeat, lambda: list(base.filter(
+                        Q(text__icontains=q) | Q(source__icontains=q)
+                    ).values_list('pk', flat=True)))
+                    
+                    found = []
+                    new = self._time(repeat, lambda: found.append(len(list(
+                        search.filter_queryset(base, q).values_list('pk', flat=True)
+                    ))))
+                    
+                    self.stdout.write(f'{q:<20}{old:>10.1f}ms{new:>10.1f}ms{found[-1]:>8}')
+                
+                transaction.set_rollback(True, using=alias)
+            
+            transaction.set_rollback(True)
+    
+    def _time(self, repeat, func):
+        """Ejecuta func repeat veces y devuelve la media en milisegundos"""
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        return (time.perf_counter() - start) / repeat * 1000
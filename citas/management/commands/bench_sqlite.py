@@ -0,0 +1,207 @@
+"""
+Benchmark: SQLite tal cual contra el perfil de producción (settings.py),
+con varios procesos leyendo y escribiendo a la vez.
+
+Uso:
+    python manage.py bench_sqlite --workers 4 --seconds 10 --citas 5000
+
+No toca tu base de datos: crea una en un directorio temporal (migrate +
+N citas de prueba repartidas entre --users usuarios) y hace una copia
+para cada perfil:
+- default: CITAS_DB_PROFILE=default (journal de siempre, DEFERRED, sin
+  PRAGMA, una conexión por petición)
+- production: CITAS_DB_PROFILE=production (WAL, busy_timeout,
+  synchronous=NORMAL, mmap, caché, IMMEDIATE, conexiones persistentes)
+
+Siempre sin shards (CITAS_SHARDS=0): lo que se mide es un fichero.
+
+Luego lanza --workers procesos a la vez contra esa copia (como gunicorn
+con varios workers). Cada uno hace lo mismo que las vistas:
+- 70% leer: una página de la lista (keyset_page) y los contadores
+- 10% crear una cita (Cita.objects.create, con todas sus señales)
+- 10% editar el texto de una cita (save)
+- 10% marcar/desmarcar favorita (views.set_favorite)
+
+y al final cierra la conexión si el perfil no las guarda (como hace
+Django al terminar cada petición).
+
+Enseña operaciones por segundo, latencias de lectura y escritura (p50 y
+p99) y cuántas veces salió "database is locked".
+"""
+
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, close_old_connections, connection
+
+from citas import counters, views
+from citas.models import Cita
+from citas.pagination import keyset_page
+
+
+WORDS = (
+    'vida amor tiempo camino corazón sueño libertad miedo esperanza '
+    'filosofía razón verdad mundo alma destino silencio música palabra'
+).split()
+
+PROFILES = ['default', 'production']
+
+# Reparto de las operaciones (el resto, hasta 1, leer)
+WRITES = [('crear', 0.1), ('editar', 0.1), ('favorita', 0.1)]
+
+
+def _text():
+    return ' '.join(random.choices(WORDS, k=random.randint(5, 25)))
+
+
+class Command(BaseCommand):
+    help = 'Compara SQLite por defecto y el perfil de producción con varios procesos a la vez'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Procesos a la vez')
+        parser.add_argument('--seconds', type=float, default=10, help='Segundos que dura cada prueba')
+        parser.add_argument('--citas', type=int, default=5000, help='Citas de prueba')
+        parser.add_argument('--users', type=int, default=4, help='Usuarios entre los que se reparten')
+        # Lo usan los procesos hijos, no hace falta ponerlo a mano
+        parser.add_argument('--seed', action='store_true', help='(interno)')
+        parser.add_argument('--worker', type=int, help='(interno)')
+        parser.add_argument('--start-at', type=float, help='(interno)')
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            return self.seed(options['citas'], options['users'])
+        if options['worker'] is not None:
+            return self.worker(options)
+
+        with tempfile.TemporaryDirectory(prefix='bench-sqlite-') as tmp:
+            base = os.path.join(tmp, 'base.sqlite3')
+            self.stdout.write(f'Creando la BD de prueba con {options["citas"]} citas...')
+            self.manage(base, 'default', 'migrate', '-v0')
+            self.manage(base, 'default', 'bench_sqlite', '--seed',
+                        '--citas', str(options['citas']), '--users', str(options['users']))
+
+            self.stdout.write(
+                f'{options["workers"]} procesos, {options["seconds"]:g} s cada perfil\n\n'
+                f'{"perfil":<12}{"ops/s":>8}{"lectura p50/p99":>20}{"escritura p50/p99":>22}{"locked":>8}'
+            )
+            for profile in PROFILES:
+                name = os.path.join(tmp, f'{profile}.sqlite3')
+                shutil.copy(base, name)
+                result = self.run_profile(name, profile, options)
+                self.stdout.write(
+                    f'{profile:<12}{result["ops"] / options["seconds"]:>8.0f}'
+                    f'{result["read_p50"]:>10.1f}/{result["read_p99"]:.1f}ms'
+                    f'{result["write_p50"]:>12.1f}/{result["write_p99"]:.1f}ms'
+                    f'{result["locked"]:>8}'
+                )
+
+    def manage(self, name, profile, *args, start=False):
+        """manage.py con la BD name y el perfil (Popen si start, si no espera)"""
+        # Sin shards (ver citas/sharding.py): aquí se compara un solo fichero
+        env = {**os.environ, 'CITAS_DB_NAME': name, 'CITAS_DB_PROFILE': profile, 'CITAS_SHARDS': '0'}
+        command = [sys.executable, str(settings.BASE_DIR / 'manage.py'), *args]
+        if start:
+            return subprocess.Popen(command, env=env, stdout=subprocess.PIPE, text=True)
+        subprocess.run(command, env=env, check=True)
+
+    def run_profile(self, name, profile, options):
+        """Lanza los procesos (empiezan todos a la vez) y junta lo que miden"""
+        start_at = time.time() + 3  # lo que tarda en arrancar Django
+        processes = [
+            self.manage(name, profile, 'bench_sqlite', '--worker', str(number),
+                        '--start-at', str(start_at), '--seconds', str(options['seconds']),
+                        start=True)
+            for number in range(options['workers'])
+        ]
+        reads, writes, locked = [], [], 0
+        for process in processes:
+            output, _ = process.communicate()
+            result = json.loads(output.strip().splitlines()[-1])
+            reads += result['reads']
+            writes += result['writes']
+            locked += result['locked']
+
+        def percentile(values, p):
+            values = sorted(values)
+            return values[min(len(values) - 1, int(len(values) * p))] * 1000 if values else 0
+
+        return {
+            'ops': len(reads) + len(writes),
+            'read_p50': percentile(reads, 0.50),
+            'read_p99': percentile(reads, 0.99),
+            'write_p50': percentile(writes, 0.50),
+            'write_p99': percentile(writes, 0.99),
+            'locked': locked,
+        }
+
+    # --- Procesos hijos ---
+
+    def seed(self, rows, users):
+        """Los usuarios y sus citas (bulk_create, sin señales)"""
+        owners = [User.objects.create_user(f'bench-sqlite-{i}') for i in range(users)]
+        Cita.objects.bulk_create(
+            (Cita(owner=random.choice(owners), text=_text(), is_favorite=random.random() < 0.2)
+             for _ in range(rows)),
+            batch_size=1000,
+        )
+        for owner in owners:
+            counters.recount_owner(owner.pk)
+
+    def worker(self, options):
+        """Operaciones hasta que se acaba el tiempo; devuelve sus latencias (JSON)"""
+        users = list(User.objects.order_by('pk'))
+        user = users[options['worker'] % len(users)]
+        ids = list(Cita.objects.filter(owner=user).values_list('pk', flat=True))
+        connection.close()
+
+        time.sleep(max(0, options['start_at'] - time.time()))
+        end = time.time() + options['seconds']
+        reads, writes, locked = [], [], 0
+
+        while time.time() < end:
+            operation = self.pick()
+            start = time.perf_counter()
+            try:
+                self.run(operation, user, ids)
+            except OperationalError as error:
+                if 'locked' not in str(error):
+                    raise
+                locked += 1
+                continue
+            finally:
+                # Fin de la "petición": Django cierra la conexión si CONN_MAX_AGE es 0
+                close_old_connections()
+            (reads if operation == 'leer' else writes).append(time.perf_counter() - start)
+
+        self.stdout.write(json.dumps({'reads': reads, 'writes': writes, 'locked': locked}))
+
+    def pick(self):
+        draw = random.random()
+        for name, weight in WRITES:
+            if draw < weight:
+                return name
+            draw -= weight
+        return 'leer'
+
+    def run(self, operation, user, ids):
+        if operation == 'leer':
+            keyset_page(Cita.objects.filter(owner=user).select_related('tag'))
+            counters.for_owner(user.pk)
+        elif operation == 'crear':
+            ids.append(Cita.objects.create(owner=user, text=_text()).pk)
+        elif operation == 'editar':
+            cita = Cita.objects.filter(pk=random.choice(ids)).first()
+            if cita:
+                cita.text = _text()
+                cita.save()
+        else:
+            views.set_favorite(user, random.choice(ids), random.random() < 0.5)
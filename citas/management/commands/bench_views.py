@@ -0,0 +1,256 @@
+"""
+Benchmark: las vistas normales con WSGI contra las async con ASGI.
+
+Uso:
+    python manage.py bench_views --citas 5000 --requests 2000 --concurrency 16
+
+Crea un usuario temporal con N citas y lanza el mismo reparto de
+peticiones (lista, inbox, aleatoria y un 10% de marcar favorita) contra
+la aplicación montada de tres formas, cada una en su propio proceso
+(las URLs eligen las vistas al arrancar, ver CITAS_ASYNC_VIEWS):
+
+- wsgi: vistas de views.py, un hilo por petición a la vez (como gunicorn
+  con --threads)
+- asgi-sync: las mismas vistas bajo ASGI (Django las pasa a un hilo)
+- asgi: las vistas async de async_views.py
+
+Para cada una enseña peticiones por segundo, latencias (p50, p95, p99 y
+la peor) y errores.
+
+No hace falta tener uvicorn ni gunicorn: las peticiones pasan por el
+handler WSGI o ASGI de Django (Client y AsyncClient de django.test) con
+todos los middlewares, solo sin la parte de red. Lo que se compara es
+Django, no el servidor.
+
+OJO: el ORM async sigue yendo por un solo hilo (ver async_views.py), así
+que con SQLite no hay que esperar milagros: lo que se gana es no cambiar
+de hilo en cada petición.
+
+Al final borra el usuario y sus citas. Usa la base de datos de verdad
+(los procesos hijos no verían una transacción sin confirmar).
+"""
+
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from citas import bulk, caching, counters, sharding
+from citas.models import Cita, Tema
+
+
+WORDS = (
+    'vida amor tiempo camino corazón sueño libertad miedo esperanza '
+    'filosofía razón verdad mundo alma destino silencio música palabra'
+).split()
+
+USERNAME = 'bench-views-tmp'
+
+MODES = {
+    # modo: (servidor, CITAS_ASYNC_VIEWS)
+    'wsgi': ('wsgi', '0'),
+    'asgi-sync': ('asgi', '0'),
+    'asgi': ('asgi', '1'),
+}
+
+# Reparto de las peticiones (el resto, hasta 1, marcar/desmarcar favorita)
+MIX = [('lista', 0.4), ('inbox', 0.2), ('aleatoria', 0.3)]
+
+
+class Command(BaseCommand):
+    help = 'Compara peticiones/s y latencias de las vistas con WSGI y con ASGI (async)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--citas', type=int, default=5000,
+                            help='Número de citas del usuario de prueba')
+        parser.add_argument('--requests', type=int, default=2000,
+                            help='Peticiones que mido en cada modo')
+        parser.add_argument('--concurrency', type=int, default=16,
+                            help='Peticiones a la vez (hilos con WSGI, tareas con ASGI)')
+        parser.add_argument('--mode', choices=list(MODES), action='append',
+                            help='Solo estos modos (se puede repetir)')
+        # Lo usan los procesos hijos, no hace falta ponerlo a mano
+        parser.add_argument('--child', choices=list(MODES), help='(interno)')
+        parser.add_argument('--user-id', type=int, help='(interno)')
+
+    def handle(self, *args, **options):
+        if options['child']:
+            return self.child(options)
+
+        if User.objects.filter(username=USERNAME).exists():
+            raise CommandError(f'Ya existe el usuario {USERNAME!r} (¿se cortó otra ejecución?). Bórralo antes.')
+
+        user = self.create_user(options['citas'])
+        try:
+            self.stdout.write(
+                f'{options["requests"]} peticiones, {options["concurrency"]} a la vez, '
+                f'{options["citas"]} citas\n'
+            )
+            self.stdout.write(f'{"modo":<11}{"req/s":>8}{"p50":>9}{"p95":>9}{"p99":>9}{"peor":>9}{"errores":>9}')
+            for mode in options['mode'] or MODES:
+                result = self.run_child(mode, user, options)
+                self.stdout.write(
+                    f'{mode:<11}{result["rps"]:>8.0f}'
+                    + ''.join(f'{result[name]:>7.1f}ms' for name in ('p50', 'p95', 'p99', 'max'))
+                    + f'{result["errors"]:>9}'
+                )
+        finally:
+            with sharding.for_owner(user.pk):
+                bulk.delete(user.pk, list(Cita.objects.filter(owner=user).values_list('pk', flat=True)))
+            user.delete()
+
+    def create_user(self, rows):
+        """El usuario temporal con rows citas (bulk_create, sin señales)"""
+        user = User.objects.create_user(USERNAME)
+        # Las citas van al shard del usuario (ver citas/sharding.py)
+        with sharding.for_owner(user.pk):
+            temas = [Tema.objects.create(owner=user, name=f'Tema {i}') for i in range(5)]
+
+            self.stdout.write(f'Creando {rows} citas de prueba...')
+            Cita.objects.bulk_create(
+                (Cita(owner=user,
+                      text=' '.join(random.choices(WORDS, k=15)),
+                      source=random.choice(WORDS).title(),
+                      tag=random.choice(temas + [None]),
+                      is_favorite=random.random() < 0.2)
+                 for _ in range(rows)),
+                batch_size=1000,
+            )
+            counters.recount_owner(user.pk)
+        caching.bump(user.pk)
+        return user
+
+    def run_child(self, mode, user, options):
+        """Lanza un proceso para un modo y devuelve lo que mide (JSON)"""
+        server, async_views = MODES[mode]
+        env = {**os.environ, 'CITAS_ASYNC_VIEWS': async_views}
+        command = [
+            sys.executable, str(settings.BASE_DIR / 'manage.py'), 'bench_views',
+            '--child', mode, '--user-id', str(user.pk),
+            '--requests', str(options['requests']),
+            '--concurrency', str(options['concurrency']),
+        ]
+        output = subprocess.run(command, env=env, check=True, capture_output=True, text=True).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+    # --- Procesos hijos ---
+
+    def child(self, options):
+        # Client y AsyncClient llaman al servidor "testserver"
+        settings.ALLOWED_HOSTS = [*settings.ALLOWED_HOSTS, 'testserver']
+
+        user = User.objects.get(pk=options['user_id'])
+        with sharding.for_owner(user.pk):
+            ids = list(Cita.objects.filter(owner=user).values_list('pk', flat=True))
+        total = options['requests']
+        concurrency = options['concurrency']
+
+        if MODES[options['child']][0] == 'wsgi':
+            latencies, errors, elapsed = self.run_wsgi(user, ids, total, concurrency)
+        else:
+            latencies, errors, elapsed = asyncio.run(self.run_asgi(user, ids, total, concurrency))
+
+        # total // concurrency por cliente: pueden ser unas pocas menos
+        latencies.sort()
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+        self.stdout.write(json.dumps({
+            'rps': len(latencies) / elapsed,
+            'p50': percentile(0.50),
+            'p95': percentile(0.95),
+            'p99': percentile(0.99),
+            'max': latencies[-1] * 1000,
+            'errors': errors,
+        }))
+
+    def plan(self, ids, total, seed):
+        """Las peticiones que hace cada cliente: [(método, url, datos)]"""
+        rng = random.Random(seed)
+        urls = {'lista': '/citas/', 'inbox': '/citas/inbox/', 'aleatoria': '/citas/random/'}
+        requests = []
+        for _ in range(total):
+            draw = rng.random()
+            for name, weight in MIX:
+                if draw < weight:
+                    requests.append(('get', urls[name], None))
+                    break
+                draw -= weight
+            else:
+                pk = rng.choice(ids)
+                requests.append(('post', f'/citas/toggle-favorite/{pk}/', {'favorite': rng.choice('01')}))
+        return requests
+
+    def run_wsgi(self, user, ids, total, concurrency):
+        """concurrency hilos, cada uno con su Client (su sesión y su conexión a la BD)"""
+        from django.db import connection
+        from django.test import Client
+
+        latencies = []
+        errors = []
+        start_line = threading.Barrier(concurrency + 1)
+
+        def worker(number):
+            client = Client()
+            client.force_login(user)
+            requests = self.plan(ids, total // concurrency, number)
+            for method, url, data in requests[:5]:  # calentar
+                getattr(client, method)(url, data)
+            start_line.wait()
+
+            mine = []
+            for method, url, data in requests:
+                start = time.perf_counter()
+                response = getattr(client, method)(url, data)
+                mine.append(time.perf_counter() - start)
+                if response.status_code >= 400:
+                    errors.append(response.status_code)
+            latencies.extend(mine)
+            connection.close()
+
+        threads = [threading.Thread(target=worker, args=(number,)) for number in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        start_line.wait()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        return latencies, len(errors), time.perf_counter() - start
+
+    async def run_asgi(self, user, ids, total, concurrency):
+        """concurrency tareas en el mismo bucle, cada una con su AsyncClient"""
+        from django.test import AsyncClient
+
+        latencies = []
+        errors = 0
+
+        async def login(number):
+            client = AsyncClient()
+            await client.aforce_login(user)
+            requests = self.plan(ids, total // concurrency, number)
+            for method, url, data in requests[:5]:  # calentar
+                await getattr(client, method)(url, data)
+            return client, requests
+
+        async def worker(client, requests):
+            nonlocal errors
+            for method, url, data in requests:
+                start = time.perf_counter()
+                response = await getattr(client, method)(url, data)
+                latencies.append(time.perf_counter() - start)
+                if response.status_code >= 400:
+                    errors += 1
+
+        clients = await asyncio.gather(*(login(number) for number in range(concurrency)))
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client, requests) for client, requests in clients))
+        return latencies, errors, time.perf_counter() - start
@@ -0,0 +1,54 @@
+"""
+Comprueba que las consultas de las vistas de citas usan índices.
+
+Uso:
+    python manage.py check_query_plans
+
+Para cada consulta (ver citas/query_plans.py) ejecuta EXPLAIN QUERY PLAN y
+falla si alguna recorre la tabla entera o necesita ordenar en una tabla
+temporal. Crea un usuario y un tema temporales y al final lo deshace todo.
+"""
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from citas import query_plans, sharding
+from citas.models import Tema
+
+
+class Command(BaseCommand):
+    help = 'Falla si alguna consulta de las vistas de citas no usa índices'
+    
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('Este comando solo entiende los planes de SQLite')
+        
+        failures = []
+        
+        with transaction.atomic():
+            user = User.objects.create_user('check-query-plans-tmp')
+            
+            # El tema y las consultas van al shard del usuario (ver citas/sharding.py)
+            with sharding.for_owner(user.pk) as alias, transaction.atomic(using=alias):
+                tema = Tema.objects.create(owner=user, name='tmp')
+                
+                for name, queryset in query_plans.view_querysets(user, tema):
+                    problems = query_plans.plan_problems(queryset)
+                    
+                    if problems:
+                        failures.append(name)
+                        self.stdout.write(self.style.ERROR(f'✗ {name}'))
+                        for line in problems:
+                            self.stdout.write(f'    {line}')
+                    else:
+                        self.stdout.write(f'✓ {name}')
+                
+                transaction.set_rollback(True, using=alias)
+            
+            transaction.set_rollback(True)
+        
+        if failures:
+            raise CommandError(f'{len(failures)} consulta(s) sin índice: {", ".join(failures)}')
+        
+        self.stdout.write(self.style.SUCCESS('Todas las consultas usan índices'))
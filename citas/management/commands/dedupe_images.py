@@ -0,0 +1,193 @@
+"""
+Pasa las imágenes antiguas al almacenamiento por contenido y quita duplicados.
+
+Uso:
+    python manage.py dedupe_images --dry-run          -> solo dice qué haría
+    python manage.py dedupe_images
+    python manage.py dedupe_images --delete-orphans   -> borra también los
+                                                         ficheros sin cita
+
+Pasos:
+1. Para cada imagen con nombre antiguo (quotes/foto_AbC123.jpg) calculo
+   su hash y la muevo a quotes/ab/cd/<hash>.jpg. Si ese fichero ya existe
+   (otra copia del mismo meme), borro la copia.
+2. Actualizo las citas para que apunten al nuevo nombre.
+3. Recalculo la cuenta de referencias (modelo Imagen) de todos los ficheros.
+4. Busco ficheros en media/quotes/ que no use ninguna cita.
+
+Después conviene ejecutar generate_thumbnails (las miniaturas de los nombres
+antiguos se borran).
+"""
+
+import os
+import posixpath
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from collections import Counter
+
+from citas import caching, image_refs, sharding, thumbnails
+from citas.models import Cita, Imagen
+from citas.storage import content_hash, hashed_name, is_hashed_name
+
+
+class Command(BaseCommand):
+    help = 'Deduplica media/quotes/ guardando cada imagen una sola vez por su hash'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='No cambia nada, solo informa')
+        parser.add_argument('--delete-orphans', action='store_true',
+                            help='Borra los ficheros que no usa ninguna cita')
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.storage = Cita._meta.get_field('image').storage
+
+        moved, duplicates, saved_bytes = self.migrate_names()
+        self.stdout.write(
+            f'{moved} fichero(s) movido(s), {duplicates} duplicado(s) eliminado(s), '
+            f'{saved_bytes / 1024 / 1024:.1f} MB liberados'
+        )
+
+        if not self.dry_run:
+            self.recount()
+
+        self.find_orphans(options['delete_orphans'])
+
+        if self.dry_run:
+            self.stdout.write(self.style.WARNING('--dry-run: no se ha cambiado nada'))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                'Hecho. Ejecuta generate_thumbnails para regenerar las miniaturas.'
+            ))
+
+    def _used_names(self):
+        """Los ficheros que usan las citas, en todos los shards (ver citas/sharding.py)"""
+        names = set()
+        for _ in sharding.each_shard():
+            names.update(
+                Cita.objects.exclude(image='').exclude(image__isnull=True)
+                .order_by().values_list('image', flat=True).distinct()
+            )
+        return names
+
+    def migrate_names(self):
+        """Paso 1 y 2: mueve/borra ficheros y actualiza las citas"""
+        moved = duplicates = saved_bytes = 0
+
+        for old in sorted(self._used_names()):
+            if is_hashed_name(old):
+                continue
+
+            if not self.storage.exists(old):
+                self.stderr.write(f'No existe el fichero {old}, lo dejo como está')
+                continue
+
+            with self.storage.open(old, 'rb') as content:
+                digest = content_hash(content)
+            new = hashed_name(posixpath.dirname(old), digest, old)
+
+            if self.storage.exists(new):
+                duplicates += 1
+                saved_bytes += self.storage.size(old)
+                action = 'duplicado de'
+            else:
+                moved += 1
+                action = '->'
+
+            self.stdout.write(f'{old} {action} {new}')
+            if self.dry_run:
+                continue
+
+            # La misma imagen puede estar en citas de varios shards
+            for alias in sharding.each_shard():
+                with transaction.atomic(using=alias):
+                    owner_ids = set(Cita.objects.filter(image=old).values_list('owner_id', flat=True))
+                    Cita.objects.filter(image=old).update(image=new, image_variants={})
+                    # update() no lanza señales: invalido a mano la caché de las tarjetas
+                    for owner_id in owner_ids:
+                        transaction.on_commit(lambda owner_id=owner_id: caching.bump(owner_id), using=alias)
+            self._move(old, new)
+
+        return moved, duplicates, saved_bytes
+
+    def _move(self, old, new):
+        """Mueve old a new (o lo borra si new ya existe) y quita sus miniaturas"""
+        if self.storage.exists(new):
+            self.storage.delete(old)
+        else:
+            target = self.storage.path(new)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(self.storage.path(old), target)
+
+        # Miniaturas del nombre antiguo (quotes/variants/foto_grid.webp...)
+        thumbnails.delete_all_variants(old)
+
+    def recount(self):
+        """
+        Paso 3: refcount = número real de citas que usan cada fichero.
+
+        Los ficheros que se quedan a 0 se borran (con sus miniaturas).
+        """
+        counts = Counter()
+        for _ in sharding.each_shard():
+            counts.update(dict(
+                Cita.objects.exclude(image='').exclude(image__isnull=True)
+                .order_by().values_list('image').annotate(n=Count('pk'))
+            ))
+
+        fixed = 0
+        with transaction.atomic():
+            known = set()
+            for imagen in Imagen.objects.select_for_update():
+                known.add(imagen.name)
+                refcount = counts.get(imagen.name, 0)
+                if imagen.refcount != refcount:
+                    imagen.refcount = refcount
+                    imagen.save(update_fields=['refcount'])
+                    fixed += 1
+
+            new = [
+                Imagen(name=name, refcount=n)
+                for name, n in counts.items()
+                if name not in known and is_hashed_name(name)
+            ]
+            Imagen.objects.bulk_create(new)
+
+            unused = list(Imagen.objects.filter(refcount=0).values_list('name', flat=True))
+            Imagen.objects.filter(name__in=unused).delete()
+            for name in unused:
+                transaction.on_commit(lambda name=name: image_refs.delete_files(name))
+
+        self.stdout.write(
+            f'Cuenta de referencias: {fixed} corregida(s), {len(new)} nueva(s), '
+            f'{len(unused)} sin uso borrada(s)'
+        )
+
+    def find_orphans(self, delete):
+        """Paso 4: ficheros de media/quotes/ que no usa ninguna cita"""
+        root = self.storage.path('quotes')
+        if not os.path.isdir(root):
+            return
+
+        used = self._used_names()
+
+        orphans = []
+        for directory, subdirectories, files in os.walk(root):
+            # Las miniaturas no son imágenes de citas
+            subdirectories[:] = [d for d in subdirectories if d != 'variants']
+            for filename in files:
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, self.storage.location).replace(os.sep, '/')
+                if name not in used:
+                    orphans.append(name)
+
+        for name in orphans:
+            self.stdout.write(f'Sin uso: {name}')
+            if delete and not self.dry_run:
+                image_refs.delete_files(name)
+
+        self.stdout.write(f'{len(orphans)} fichero(s) sin uso')
@@ -0,0 +1,89 @@
+"""
+Busca grupos de citas con la misma imagen (ver perceptual.py).
+
+Uso:
+    python manage.py find_duplicate_images                   -> todos los usuarios
+    python manage.py find_duplicate_images --user bea        -> solo uno
+    python manage.py find_duplicate_images --backfill        -> antes calcula los hashes que falten
+    python manage.py find_duplicate_images --backfill --workers 4
+    python manage.py find_duplicate_images --max-distance 1  -> solo las casi idénticas
+
+No borra nada: solo enseña los grupos (ids y el principio del texto) para
+que cada uno decida qué hacer con ellos.
+
+"La misma imagen" = los hashes se diferencian en --max-distance bits o
+menos (3 como mucho: con más, el índice de 4 trozos no garantiza
+encontrarlas). Para cada usuario carga todos sus hashes (8 bytes por
+cita) y los agrupa por trozos, sin comparar todos con todos (ver
+perceptual.clusters).
+"""
+
+import time
+
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from citas import perceptual, sharding
+from citas.models import Cita
+
+
+class Command(BaseCommand):
+    help = 'Busca grupos de citas con la imagen casi igual'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Solo este usuario (username)')
+        parser.add_argument('--backfill', action='store_true',
+                            help='Calcular antes los hashes que falten (en varios procesos)')
+        parser.add_argument('--workers', type=int,
+                            help='Procesos para --backfill (por defecto, uno por CPU)')
+        parser.add_argument('--max-distance', type=int, default=perceptual.MAX_DISTANCE,
+                            help=f'Bits distintos como máximo (0 a {perceptual.MAX_DISTANCE})')
+        parser.add_argument('--limit', type=int, default=20,
+                            help='Grupos que enseño por usuario')
+
+    def handle(self, *args, **options):
+        if not 0 <= options['max_distance'] <= perceptual.MAX_DISTANCE:
+            raise CommandError(f'--max-distance tiene que estar entre 0 y {perceptual.MAX_DISTANCE}')
+
+        users = User.objects.order_by('pk')
+        if options['user']:
+            users = users.filter(username=options['user'])
+            if not users.exists():
+                raise CommandError(f'El usuario {options["user"]!r} no existe')
+
+        if options['backfill']:
+            start = time.perf_counter()
+            done = perceptual.backfill(
+                list(users.values_list('pk', flat=True)),
+                workers=options['workers'],
+                stdout=self.stdout if options['verbosity'] > 1 else None,
+            )
+            self.stdout.write(f'{done} hashes calculados en {time.perf_counter() - start:.1f} s')
+
+        total = 0
+        for user in users.iterator():
+            # Las citas de cada usuario están en su shard (ver citas/sharding.py)
+            with sharding.for_owner(user.pk):
+                rows = (Cita.objects.filter(owner=user, image_dhash__isnull=False)
+                        .order_by('pk').values_list('pk', 'image_dhash'))
+                ids, hashes = zip(*rows) if rows else ((), ())
+                groups = perceptual.clusters(ids, np.array(hashes, dtype=np.int64), options['max_distance'])
+                groups.sort(key=len, reverse=True)
+                total += len(groups)
+
+                if groups:
+                    self.stdout.write(self.style.WARNING(
+                        f'{user.username}: {len(groups)} grupo(s) de imágenes repetidas '
+                        f'({sum(map(len, groups))} citas de {len(ids)} con imagen)'
+                    ))
+                    self._show(groups[:options['limit']])
+
+        self.stdout.write(self.style.SUCCESS(f'{total} grupo(s) de imágenes repetidas en total'))
+
+    def _show(self, groups):
+        citas = Cita.objects.only('text', 'image').in_bulk([pk for group in groups for pk in group])
+        for group in groups:
+            first = citas[group[0]]
+            label = first.text.replace('\n', ' ')[:50] if first.text else first.image.name
+            self.stdout.write(f'  {group}: «{label}»')
@@ -0,0 +1,141 @@
+"""
+Busca grupos de citas casi repetidas (ver duplicates.py).
+
+Uso:
+    python manage.py find_duplicates                  -> todos los usuarios
+    python manage.py find_duplicates --user bea       -> solo uno
+    python manage.py find_duplicates --index          -> antes calcula las huellas que falten
+    python manage.py find_duplicates --threshold 0.9  -> solo las muy parecidas
+    python manage.py find_duplicates --bench 1000000  -> benchmark con 1M huellas inventadas
+
+No borra nada: solo enseña los grupos (ids y el principio del texto) para
+que cada uno decida qué hacer con ellos.
+
+Para cada usuario carga todas sus huellas en un array de NumPy (128 bytes
+por cita) y las agrupa con las cubetas LSH, sin comparar todas con todas
+(ver duplicates.clusters).
+"""
+
+import random
+import time
+
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from citas import duplicates, sharding
+from citas.models import Cita
+
+
+WORDS = (
+    'vida amor tiempo camino corazón sueño libertad miedo esperanza '
+    'filosofía razón verdad mundo alma destino silencio música palabra'
+).split()
+
+
+class Command(BaseCommand):
+    help = 'Busca grupos de citas con el texto casi igual'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Solo este usuario (username)')
+        parser.add_argument('--index', action='store_true',
+                            help='Calcular antes las huellas que falten')
+        parser.add_argument('--threshold', type=float, default=duplicates.THRESHOLD,
+                            help='Parecido mínimo (0 a 1)')
+        parser.add_argument('--limit', type=int, default=20,
+                            help='Grupos que enseño por usuario')
+        parser.add_argument('--bench', type=int, metavar='N',
+                            help='No mira la BD: agrupa N huellas inventadas y mide el tiempo')
+
+    def handle(self, *args, **options):
+        if options['bench']:
+            return self.bench(options['bench'], options['threshold'])
+
+        users = User.objects.order_by('pk')
+        if options['user']:
+            users = users.filter(username=options['user'])
+            if not users.exists():
+                raise CommandError(f'El usuario {options["user"]!r} no existe')
+
+        if options['index']:
+            start = time.perf_counter()
+            done = duplicates.index_missing(list(users.values_list('pk', flat=True)))
+            self.stdout.write(f'{done} huellas calculadas en {time.perf_counter() - start:.1f} s')
+
+        total = 0
+        for user in users.iterator():
+            # Las citas de cada usuario están en su shard (ver citas/sharding.py)
+            with sharding.for_owner(user.pk):
+                ids, sigs = self._load(user.pk)
+                groups = duplicates.clusters(ids, sigs, options['threshold'])
+                groups.sort(key=len, reverse=True)
+                total += len(groups)
+
+                if groups:
+                    self.stdout.write(self.style.WARNING(
+                        f'{user.username}: {len(groups)} grupo(s) de repetidas '
+                        f'({sum(map(len, groups))} citas de {len(ids)})'
+                    ))
+                    self._show(groups[:options['limit']])
+
+        self.stdout.write(self.style.SUCCESS(f'{total} grupo(s) de citas repetidas en total'))
+
+    def _load(self, owner_id):
+        """Ids y huellas (n, 64) de las citas con huella de un usuario"""
+        rows = (Cita.objects.filter(owner_id=owner_id, text_minhash__isnull=False)
+                .values_list('pk', 'text_minhash').order_by('pk').iterator(chunk_size=5000))
+        ids, data = [], []
+        for pk, sig in rows:
+            if sig:
+                ids.append(pk)
+                data.append(bytes(sig))
+        sigs = np.frombuffer(b''.join(data), dtype=np.uint16).reshape(len(ids), duplicates.NUM_PERM)
+        return np.array(ids, dtype=np.int64), sigs
+
+    def _show(self, groups):
+        texts = Cita.objects.in_bulk([pk for group in groups for pk in group])
+        for group in groups:
+            first = texts[group[0]].text.replace('\n', ' ')
+            self.stdout.write(f'  {group}: «{first[:70]}»')
+
+    def bench(self, n, threshold):
+        """
+        Benchmark sin BD: n huellas al azar y un 1% de casi repetidas
+        (copias de otra con un 15% de los números cambiados).
+        """
+        rng = np.random.default_rng(1)
+        self.stdout.write(f'Generando {n} huellas ({n * duplicates.NUM_PERM * 2 / 2**20:.0f} MB)...')
+        sigs = rng.integers(0, 2 ** 16, size=(n, duplicates.NUM_PERM), dtype=np.uint16)
+
+        planted = n // 100
+        copies = rng.choice(n, size=planted, replace=False)
+        originals = (copies + 1 + rng.integers(0, n - 1, size=planted)) % n
+        sigs[copies] = sigs[originals]
+        changed = rng.random((planted, duplicates.NUM_PERM)) < 0.15
+        noise = rng.integers(0, 2 ** 16, size=(planted, duplicates.NUM_PERM), dtype=np.uint16)
+        sigs[copies] = np.where(changed, noise, sigs[copies])
+
+        start = time.perf_counter()
+        groups = duplicates.clusters(np.arange(n), sigs, threshold)
+        elapsed = time.perf_counter() - start
+
+        group_of = np.full(n, -1)
+        for number, group in enumerate(groups):
+            group_of[group] = number
+        found = np.mean((group_of[copies] >= 0) & (group_of[copies] == group_of[originals]))
+
+        self.stdout.write(
+            f'Agrupar {n} huellas: {elapsed:.2f} s, {len(groups)} grupos, '
+            f'{found:.1%} de las {planted} repetidas encontradas'
+        )
+
+        # Y lo que cuesta calcular las huellas de los textos
+        sample = 20000
+        texts = [' '.join(random.choices(WORDS, k=20)) for _ in range(sample)]
+        start = time.perf_counter()
+        duplicates.signatures(texts)
+        per_text = (time.perf_counter() - start) / sample
+        self.stdout.write(
+            f'Huellas de {sample} textos: {per_text * 1e6:.0f} µs por texto '
+            f'(~{per_text * n:.0f} s para {n})'
+        )
@@ -0,0 +1,103 @@
+"""
+Genera las miniaturas de las imágenes que ya existían.
+
+Uso:
+    python manage.py generate_thumbnails              -> solo las que faltan
+    python manage.py generate_thumbnails --all        -> todas otra vez
+    python manage.py generate_thumbnails --workers 8
+
+Redimensionar imágenes gasta CPU, así que lo reparto entre varios procesos
+(ProcessPoolExecutor). Los procesos solo leen y escriben ficheros: las
+rutas resultantes las guarda en la BD el proceso principal, por lotes.
+
+Como varias citas pueden compartir fichero (storage.py), cada fichero
+se procesa una sola vez por lote.
+"""
+
+from collections import defaultdict
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from citas import caching, sharding, thumbnails
+from citas.models import Cita, Imagen
+
+
+def _generate(name):
+    """Lo que ejecuta cada proceso: devuelve (name, variantes o error)"""
+    try:
+        return name, thumbnails.generate_variants(name), None
+    except Exception as error:
+        return name, None, str(error)
+
+
+class Command(BaseCommand):
+    help = 'Genera las miniaturas WebP/JPEG de las imágenes de las citas'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Regenera también las que ya tienen miniaturas')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Número de procesos')
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='Imágenes que mando a los procesos de cada vez')
+    
+    def handle(self, *args, **options):
+        citas = Cita.objects.exclude(image='').exclude(image__isnull=True)
+        if not options['all']:
+            citas = citas.filter(image_variants={})
+        
+        pending = citas.order_by('pk').values_list('pk', 'image', 'owner_id')
+        batch_size = options['batch_size']
+        
+        # Cierro las conexiones antes de crear los procesos: una conexión
+        # de SQLite no se puede compartir entre procesos
+        connections.close_all()
+        
+        done = failed = 0
+        start = time.perf_counter()
+        
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            # Shard por shard (ver citas/sharding.py): las pk de cada uno van aparte
+            for _ in sharding.each_shard():
+                last_pk = 0
+                while True:
+                    # Voy por lotes según la pk para no cargar todas las rutas
+                    batch = list(pending.filter(pk__gt=last_pk)[:batch_size])
+                    if not batch:
+                        break
+                    last_pk = batch[-1][0]
+                    
+                    # Fichero -> citas que lo usan
+                    by_name = defaultdict(list)
+                    for pk, name, _ in batch:
+                        by_name[name].append(pk)
+                    
+                    futures = [executor.submit(_generate, name) for name in by_name]
+                    for future in as_completed(futures):
+                        name, variants, error = future.result()
+                        pks = by_name[name]
+                        
+                        if error:
+                            failed += len(pks)
+                            self.stderr.write(f'{name} (citas {pks}): {error}')
+                            continue
+                        
+                        # Mismo truco que thumbnails.process_cita: solo si no cambió la imagen
+                        Imagen.objects.filter(name=name).update(variants=variants)
+                        done += Cita.objects.filter(pk__in=pks, image=name).update(image_variants=variants)
+                    
+                    # update() no lanza señales: invalido a mano la caché de las tarjetas
+                    for owner_id in {owner_id for _, _, owner_id in batch}:
+                        caching.bump(owner_id)
+                    
+                    elapsed = time.perf_counter() - start
+                    self.stdout.write(f'{done} imágenes ({done / elapsed:.1f}/s)')
+            
+        self.stdout.write(self.style.SUCCESS(
+            f'Terminado: {done} imágenes procesadas, {failed} con error'
+        ))
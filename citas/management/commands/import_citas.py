@@ -0,0 +1,376 @@
+"""
+Importa citas en bloque desde un fichero JSONL o CSV.
+
+Uso:
+    python manage.py import_citas citas.jsonl --owner bea
+    python manage.py import_citas export.csv --owner bea --batch-size 5000
+    python manage.py import_citas citas.jsonl --owner bea --resume   -> sigue donde se quedó
+    cat citas.jsonl | python manage.py import_citas - --format jsonl --owner bea
+
+Cada cita es una línea JSON (JSONL) o una fila del CSV (con cabecera):
+
+    {"text": "...", "source": "Séneca", "tema": "Filosofía",
+     "is_favorite": true, "created_at": "2024-01-31T10:00:00+01:00", "owner": "bea"}
+
+- text es obligatorio (las imágenes no se importan).
+- owner es opcional: si no viene, uso el usuario de --owner.
+- tema es el NOMBRE del tema: si el usuario no lo tiene, lo creo.
+- created_at es opcional: si no viene, la fecha de la importación.
+
+Cómo está hecho (para ficheros de millones de líneas):
+- El fichero se lee con generadores, línea a línea: en memoria solo hay
+  un lote (--batch-size) de citas a la vez, da igual lo grande que sea.
+- Los temas los busco en un diccionario (usuario, nombre) -> id que se
+  rellena la primera vez que aparece cada usuario. Los que faltan se
+  crean de una vez por lote.
+- Cada lote se guarda con un solo bulk_create dentro de una transacción
+  (uno por shard, si hay varios).
+- Después de cada lote apunto en <fichero>.progress cuántas citas llevo.
+  Si la importación se corta, --resume se salta esas y sigue.
+  OJO: si se corta justo entre el commit y la escritura del .progress,
+  ese último lote se importaría dos veces.
+
+Las filas con errores (JSON roto, sin texto, usuario que no existe...) se
+saltan y se avisa por stderr con su número.
+"""
+
+import csv
+import io
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from itertools import islice
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from citas import sharding
+from citas.models import Cita, Tema
+from citas.signals import citas_bulk_changed
+
+
+# Textos que cuentan como "sí" en la columna is_favorite del CSV
+TRUE_VALUES = {'1', 'true', 'si', 'sí', 'yes', 'x'}
+
+# Las citas largas no caben en el límite por defecto del módulo csv (128 KB)
+csv.field_size_limit(16 * 1024 * 1024)
+
+
+class RowError(Exception):
+    """Una fila que no se puede importar (se salta y se sigue)"""
+
+
+def read_records(fileobj, fmt):
+    """
+    Genera los registros del fichero sin procesar.
+
+    - jsonl: cada línea no vacía (todavía como texto, se parsea después,
+      así al reanudar no pierdo tiempo parseando lo que me salto)
+    - csv: cada fila como dict (la cabecera da los nombres)
+    """
+    if fmt == 'jsonl':
+        for line in fileobj:
+            if line.strip():
+                yield line
+    else:
+        yield from csv.DictReader(fileobj)
+
+
+def parse_record(record):
+    """Registro sin procesar -> dict con los campos"""
+    if isinstance(record, dict):
+        return record
+
+    try:
+        data = json.loads(record)
+    except ValueError as error:
+        raise RowError(f'JSON no válido ({error})')
+
+    if not isinstance(data, dict):
+        raise RowError('cada línea tiene que ser un objeto JSON')
+    return data
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value or '').strip().lower() in TRUE_VALUES
+
+
+def parse_date(value, default):
+    """Texto ISO 8601 -> datetime (con zona horaria). Vacío -> default"""
+    if not value:
+        return default
+
+    date = parse_datetime(str(value).strip())
+    if date is None:
+        raise RowError(f'fecha no válida: {value!r}')
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date)
+    return date
+
+
+def batched(iterable, size):
+    """Agrupa un iterable en listas de size elementos (la última, las que queden)"""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+@contextmanager
+def keep_created_at():
+    """
+    Deja que bulk_create guarde el created_at que traigo.
+
+    created_at tiene auto_now_add, y Django lo pisa con "ahora" al crear
+    (también en bulk_create). Para conservar las fechas originales lo
+    desactivo mientras dura la importación y relleno yo la fecha.
+    OJO: cambia el campo para todo el proceso, por eso solo lo uso en
+    este comando y lo dejo como estaba al terminar.
+    """
+    field = Cita._meta.get_field('created_at')
+    original = field.auto_now_add
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = original
+
+
+class Importer:
+    """
+    Convierte registros en citas y las guarda por lotes.
+
+    Guarda los diccionarios de usuarios y temas entre lotes.
+    """
+
+    def __init__(self, default_owner=None):
+        self.default_owner = default_owner
+        # username -> id
+        self.owners = {}
+        # owner_id -> {nombre del tema -> id}
+        self.temas = {}
+
+    def owner_id(self, username):
+        username = (username or '').strip()
+        if not username:
+            if self.default_owner is None:
+                raise RowError('no tiene owner y no se ha pasado --owner')
+            return self.default_owner.pk
+
+        if username not in self.owners:
+            pk = User.objects.filter(username=username).values_list('pk', flat=True).first()
+            if pk is None:
+                raise RowError(f'el usuario {username!r} no existe')
+            self.owners[username] = pk
+        return self.owners[username]
+
+    def build(self, data, now):
+        """dict de una fila -> Cita sin guardar (el tema se resuelve en save_batch)"""
+        text = str(data.get('text') or '').strip()
+        if not text:
+            raise RowError('la cita no tiene texto')
+
+        source = str(data.get('source') or '').strip()
+        if len(source) > Cita._meta.get_field('source').max_length:
+            raise RowError('la fuente es demasiado larga')
+
+        tema = str(data.get('tema') or '').strip()
+        if len(tema) > Tema._meta.get_field('name').max_length:
+            raise RowError(f'el nombre del tema es demasiado largo: {tema[:20]!r}...')
+
+        cita = Cita(
+            owner_id=self.owner_id(data.get('owner')),
+            text=text,
+            source=source,
+            is_favorite=parse_bool(data.get('is_favorite')),
+            created_at=parse_date(data.get('created_at'), now),
+        )
+        cita._tema_name = tema
+        return cita
+
+    def _load_temas(self, owner_id):
+        if owner_id not in self.temas:
+            self.temas[owner_id] = dict(
+                Tema.objects.filter(owner_id=owner_id).values_list('name', 'id')
+            )
+        return self.temas[owner_id]
+
+    def resolve_temas(self, citas):
+        """Pone tag_id a cada cita, creando de una vez los temas que falten"""
+        missing = set()
+        for cita in citas:
+            if cita._tema_name and cita._tema_name not in self._load_temas(cita.owner_id):
+                missing.add((cita.owner_id, cita._tema_name))
+
+        if missing:
+            # ignore_conflicts: si otro proceso lo ha creado a la vez, no pasa nada
+            Tema.objects.bulk_create(
+                [Tema(owner_id=owner_id, name=name) for owner_id, name in missing],
+                ignore_conflicts=True,
+            )
+            for owner_id in {owner_id for owner_id, _ in missing}:
+                names = [name for o, name in missing if o == owner_id]
+                self.temas[owner_id].update(
+                    Tema.objects.filter(owner_id=owner_id, name__in=names).values_list('name', 'id')
+                )
+
+        for cita in citas:
+            if cita._tema_name:
+                cita.tag_id = self.temas[cita.owner_id][cita._tema_name]
+
+    def save_batch(self, citas):
+        """
+        Guarda un lote en una transacción (una por shard si las citas son
+        de usuarios de shards distintos, ver citas/sharding.py).
+        Devuelve los owners afectados
+        """
+        by_shard = {}
+        for cita in citas:
+            by_shard.setdefault(sharding.db_for_owner(cita.owner_id), []).append(cita)
+
+        for alias, shard_citas in by_shard.items():
+            with sharding.using(alias), transaction.atomic(using=alias):
+                self.resolve_temas(shard_citas)
+                Cita.objects.bulk_create(shard_citas)
+        return {cita.owner_id for cita in citas}
+
+
+class Command(BaseCommand):
+    help = 'Importa citas en bloque desde un fichero JSONL o CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Fichero a importar (- para la entrada estándar)')
+        parser.add_argument('--format', choices=['jsonl', 'csv'],
+                            help='Formato (por defecto, según la extensión)')
+        parser.add_argument('--owner',
+                            help='Usuario para las filas que no traen owner')
+        parser.add_argument('--batch-size', type=int, default=2000,
+                            help='Citas por lote (y por transacción)')
+        parser.add_argument('--resume', action='store_true',
+                            help='Sigue desde donde se quedó la última vez')
+        parser.add_argument('--progress-file',
+                            help='Dónde guardar el progreso (por defecto <path>.progress)')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or self._guess_format(path)
+
+        default_owner = None
+        if options['owner']:
+            default_owner = User.objects.filter(username=options['owner']).first()
+            if default_owner is None:
+                raise CommandError(f'El usuario {options["owner"]!r} no existe')
+
+        progress_file = options['progress_file'] or (None if path == '-' else f'{path}.progress')
+        skip = self._read_progress(progress_file, options['resume'])
+
+        importer = Importer(default_owner)
+        batch_size = options['batch_size']
+        now = timezone.now()
+
+        done = skip
+        imported = failed = 0
+        start = time.perf_counter()
+
+        # Usuarios con citas nuevas: al final (aunque falle a mitad) aviso
+        # con citas_bulk_changed para que se recalculen sus contadores y se
+        # invalide la caché de las aleatorias. Una vez y no por lote,
+        # porque recalcular los contadores es un aggregate sobre todas sus citas.
+        touched = set()
+
+        try:
+            with self._open(path) as fileobj, keep_created_at():
+                records = islice(read_records(fileobj, fmt), skip, None)
+                if skip:
+                    self.stdout.write(f'Reanudando: me salto las {skip} primeras citas')
+
+                for batch in batched(records, batch_size):
+                    citas = []
+                    for number, record in enumerate(batch, start=done + 1):
+                        try:
+                            citas.append(importer.build(parse_record(record), now))
+                        except RowError as error:
+                            failed += 1
+                            self.stderr.write(f'Cita {number}: {error}')
+
+                    if citas:
+                        touched |= importer.save_batch(citas)
+                    done += len(batch)
+                    imported += len(citas)
+                    self._write_progress(progress_file, done)
+
+                    elapsed = time.perf_counter() - start
+                    self.stdout.write(f'{done} citas leídas, {imported} importadas '
+                                      f'({imported / elapsed:.0f} citas/s)')
+        finally:
+            if touched:
+                citas_bulk_changed.send(sender=Cita, owner_ids=touched)
+
+        # Terminado sin errores graves: el progreso ya no sirve
+        if progress_file and os.path.exists(progress_file):
+            os.remove(progress_file)
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Terminado: {imported} citas importadas, {failed} con error, '
+            f'en {elapsed:.1f} s ({imported / max(elapsed, 1e-9):.0f} citas/s)'
+        ))
+
+    def _guess_format(self, path):
+        extension = os.path.splitext(path)[1].lower()
+        if extension in ('.jsonl', '.ndjson'):
+            return 'jsonl'
+        if extension == '.csv':
+            return 'csv'
+        raise CommandError('No sé el formato del fichero: usa --format jsonl o --format csv')
+
+    @contextmanager
+    def _open(self, path):
+        """
+        Abre el fichero como texto UTF-8 (utf-8-sig quita el BOM que pone Excel).
+        newline='' es lo que pide el módulo csv (los saltos de línea dentro de
+        una celda entre comillas se respetan).
+        """
+        if path == '-':
+            yield io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8-sig', newline='')
+            return
+
+        try:
+            fileobj = open(path, encoding='utf-8-sig', newline='')
+        except OSError as error:
+            raise CommandError(f'No se puede abrir {path}: {error}')
+        with fileobj:
+            yield fileobj
+
+    def _read_progress(self, progress_file, resume):
+        """Cuántas citas me tengo que saltar (0 si empiezo de cero)"""
+        if not progress_file or not os.path.exists(progress_file):
+            return 0
+
+        if not resume:
+            raise CommandError(
+                f'Hay una importación a medias ({progress_file}). '
+                'Usa --resume para seguirla o borra ese fichero para empezar de cero.'
+            )
+
+        with open(progress_file) as fileobj:
+            return json.load(fileobj)['records']
+
+    def _write_progress(self, progress_file, done):
+        """
+        Guarda el progreso en un temporal y lo renombra: si el proceso
+        muere a mitad, el .progress anterior sigue entero.
+        """
+        if not progress_file:
+            return
+
+        temp = f'{progress_file}.tmp'
+        with open(temp, 'w') as fileobj:
+            json.dump({'records': done}, fileobj)
+        os.replace(temp, progress_file)
@@ -0,0 +1,106 @@
+"""
+Mueve usuarios de un shard a otro (ver citas/sharding.py).
+
+Uso:
+    python manage.py move_user --list                       -> usuarios y citas por shard
+    python manage.py move_user bea --to shard_2             -> mueve a bea a shard_2
+    python manage.py move_user --rebalance --from-shards 2  -> después de pasar de 2 shards a más
+
+Mover a alguien sirve para repartir la carga a mano: si un usuario tiene
+muchísimas citas (o escribe mucho), se le puede dejar en un shard él solo.
+Se apunta en ShardUsuario, así que ya no depende del hash.
+
+--rebalance es para cuando se cambia CITAS_SHARDS: con jump_hash solo
+cambian de shard unos pocos usuarios (al pasar de 2 a 3, más o menos uno
+de cada tres), y esto mueve sus datos adonde les toca ahora. Los que se
+movieron a mano se quedan donde están.
+
+OJO: las citas se quedan con su id si en el shard nuevo está libre; si
+no, cambian de id (ver sharding.move_owner) y se dice cuántas. Mejor
+hacerlo con la web parada, o por lo menos sin que el usuario esté
+guardando cosas mientras tanto.
+"""
+
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from citas import sharding
+from citas.models import Cita, ShardUsuario
+
+
+class Command(BaseCommand):
+    help = 'Mueve los datos de citas de un usuario a otro shard'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', nargs='?', help='El usuario a mover')
+        parser.add_argument('--to', help='El shard al que va (shard_0, shard_1...)')
+        parser.add_argument('--rebalance', action='store_true',
+                            help='Mueve a los usuarios que con el número de shards nuevo van a otro')
+        parser.add_argument('--from-shards', type=int,
+                            help='Con --rebalance: cuántos shards había antes')
+        parser.add_argument('--list', action='store_true', help='Usuarios y citas de cada shard')
+
+    def handle(self, *args, **options):
+        if not sharding.enabled():
+            raise CommandError('No hay shards: pon CITAS_SHARDS en el entorno (ver settings.py)')
+
+        if options['list']:
+            return self.show()
+        if options['rebalance']:
+            return self.rebalance(options['from_shards'])
+
+        if not options['username'] or not options['to']:
+            raise CommandError('Di qué usuario y adónde: move_user USUARIO --to shard_N')
+        if options['to'] not in sharding.databases():
+            raise CommandError(f'{options["to"]!r} no es un shard: {", ".join(sharding.databases())}')
+
+        user = User.objects.filter(username=options['username']).first()
+        if user is None:
+            raise CommandError(f'El usuario {options["username"]!r} no existe')
+
+        source = sharding.db_for_owner(user.pk)
+        if source == options['to']:
+            self.stdout.write(f'{user.username} ya está en {source}')
+            return
+        self.move(user, options['to'])
+
+    def move(self, user, target, source=None):
+        source = source or sharding.db_for_owner(user.pk)
+        start = time.perf_counter()
+        moved, renumbered = sharding.move_owner(user.pk, target, source=source)
+        self.stdout.write(
+            f'{user.username}: {source} -> {target}, {moved} citas '
+            f'({time.perf_counter() - start:.1f} s)'
+        )
+        if renumbered:
+            self.stdout.write(self.style.WARNING(
+                f'  {renumbered} cita(s) con id nuevo (el suyo ya estaba usado en {target}): '
+                'sus enlaces de antes ya no valen'
+            ))
+
+    def rebalance(self, old_shards):
+        if not old_shards or old_shards < 1:
+            raise CommandError('--rebalance necesita --from-shards (cuántos shards había antes)')
+
+        # Los movidos a mano (ShardUsuario) no dependen del hash
+        pinned = set(ShardUsuario.objects.values_list('owner_id', flat=True))
+        moved = 0
+        for user in User.objects.order_by('pk').iterator():
+            if user.pk in pinned:
+                continue
+            source = sharding.hashed_shard(user.pk, old_shards)
+            target = sharding.hashed_shard(user.pk)
+            if source != target:
+                self.move(user, target, source=source)
+                moved += 1
+
+        self.stdout.write(self.style.SUCCESS(f'{moved} usuario(s) movidos'))
+
+    def show(self):
+        """Cuántos usuarios y citas hay en cada shard"""
+        for alias in sharding.each_shard():
+            owners = Cita.objects.order_by().values('owner_id').distinct().count()
+            total = Cita.objects.count()
+            self.stdout.write(f'{alias}: {owners} usuario(s) con citas, {total} citas')
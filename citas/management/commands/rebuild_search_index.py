@@ -0,0 +1,34 @@
+"""
+Comando para reconstruir el índice de búsqueda (FTS5).
+
+Uso:
+    python manage.py rebuild_search_index
+
+Normalmente no hace falta porque los triggers mantienen el índice al día,
+pero si se ha tocado la base de datos a mano (o se restauró una copia
+antigua de citas_cita) esto lo deja otra vez igual que la tabla.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from citas import search, sharding
+
+
+class Command(BaseCommand):
+    help = 'Reconstruye el índice de texto completo de las citas'
+    
+    def handle(self, *args, **options):
+        # Cada shard tiene su índice (ver citas/sharding.py)
+        for alias in sharding.databases():
+            connection = connections[alias]
+            # install() crea la tabla y los triggers si faltan
+            if not search.install(connection):
+                raise CommandError(
+                    f'La base de datos {alias} no soporta FTS5. '
+                    'La búsqueda seguirá usando icontains.'
+                )
+            
+            search.rebuild(connection)
+        
+        self.stdout.write(self.style.SUCCESS('Índice de búsqueda reconstruido'))
@@ -0,0 +1,49 @@
+"""
+Recalcula los contadores de citas (ContadorUsuario y ContadorTema).
+
+Uso:
+    python manage.py recount              -> todos los usuarios
+    python manage.py recount --user bea   -> solo uno
+
+Las señales los mantienen al día, pero si se toca la BD a mano (o se
+usa bulk_create/update() sin enviar citas_bulk_changed) se pueden
+desincronizar. Esto los deja otra vez bien y dice cuántos estaban mal.
+"""
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from citas import counters, sharding
+from citas.models import ContadorTema, ContadorUsuario
+
+
+class Command(BaseCommand):
+    help = 'Recalcula los contadores de citas de los usuarios y sus temas'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Solo este usuario (username)')
+    
+    def handle(self, *args, **options):
+        users = User.objects.order_by('pk')
+        if options['user']:
+            users = users.filter(username=options['user'])
+            if not users.exists():
+                raise CommandError(f'El usuario {options["user"]!r} no existe')
+        
+        drifted = 0
+        for owner_id in users.values_list('pk', flat=True).iterator():
+            with sharding.for_owner(owner_id):
+                before = self._current(owner_id)
+                counters.recount(owner_id)
+                if self._current(owner_id) != before:
+                    drifted += 1
+        
+        self.stdout.write(self.style.SUCCESS(
+            f'Contadores recalculados: {users.count()} usuario(s), {drifted} estaban mal'
+        ))
+    
+    def _current(self, owner_id):
+        """Los valores guardados de un usuario y sus temas, para comparar"""
+        contador = ContadorUsuario.objects.filter(owner_id=owner_id).values(*counters.FIELDS).first()
+        temas = dict(ContadorTema.objects.filter(tema__owner_id=owner_id).values_list('tema_id', 'total'))
+        return contador, temas
@@ -0,0 +1,97 @@
+"""
+Vectores de "citas parecidas" (ver related.py).
+
+Uso:
+    python manage.py related_citas --index            -> calcula los vectores que falten
+    python manage.py related_citas --user bea         -> cuánto tarda en buscar para ese usuario
+    python manage.py related_citas --bench 100000     -> benchmark con 100.000 textos inventados
+
+Normalmente no hace falta: las señales calculan el vector de cada cita al
+guardarla. Sirve para las citas de antes y para medir.
+"""
+
+import random
+import time
+
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from citas import related, sharding
+
+
+WORDS = (
+    'vida amor tiempo camino corazón sueño libertad miedo esperanza '
+    'filosofía razón verdad mundo alma destino silencio música palabra'
+).split()
+
+
+class Command(BaseCommand):
+    help = 'Calcula los vectores de citas parecidas y mide cuánto se tarda en buscar'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Solo este usuario (username)')
+        parser.add_argument('--index', action='store_true',
+                            help='Calcular los vectores que falten')
+        parser.add_argument('--bench', type=int, metavar='N',
+                            help='No mira la BD: busca entre N textos inventados')
+
+    def handle(self, *args, **options):
+        if options['bench']:
+            return self.bench(options['bench'])
+
+        users = User.objects.order_by('pk')
+        if options['user']:
+            users = users.filter(username=options['user'])
+            if not users.exists():
+                raise CommandError(f'El usuario {options["user"]!r} no existe')
+
+        if options['index']:
+            start = time.perf_counter()
+            done = related.index_missing(list(users.values_list('pk', flat=True)))
+            self.stdout.write(f'{done} vectores calculados en {time.perf_counter() - start:.1f} s')
+
+        for user in users.iterator():
+            with sharding.for_owner(user.pk):
+                start = time.perf_counter()
+                index = related.build(user.pk)
+                loaded = time.perf_counter() - start
+                if not len(index):
+                    continue
+                self.stdout.write(
+                    f'{user.username}: {len(index)} vectores ({index.matrix.nbytes / 2**20:.1f} MB), '
+                    f'leídos en {loaded * 1000:.0f} ms; {self._time(index)}'
+                )
+
+    def _time(self, index, queries=100):
+        """Lo que tarda una búsqueda (exacta y, si la hay, aproximada)"""
+        rows = np.random.default_rng(0).integers(0, index.size, size=queries)
+        result = []
+        for exact in (True, False) if index.groups is not None else (True,):
+            start = time.perf_counter()
+            for row in rows:
+                index.search(index.matrix[row], exclude=int(index.ids[row]), exact=exact)
+            per_query = (time.perf_counter() - start) / queries
+            result.append(f'{"exacta" if exact else "aproximada"} {per_query * 1000:.2f} ms')
+        return ', '.join(result)
+
+    def bench(self, n):
+        """n textos al azar con un 1% de casi iguales (la misma con una palabra cambiada)"""
+        texts = [' '.join(random.choices(WORDS, k=random.randint(5, 25))) for _ in range(n)]
+        for i in range(0, n - 1, 100):
+            words = texts[i + 1].split()
+            words[0] = 'otra'
+            texts[i] = ' '.join(words)
+
+        start = time.perf_counter()
+        matrix = related.vectors(texts)
+        self.stdout.write(f'Vectores de {n} textos: {time.perf_counter() - start:.1f} s')
+
+        start = time.perf_counter()
+        index = related.VectorIndex(np.arange(n), matrix)
+        self.stdout.write(f'Índice: {time.perf_counter() - start:.2f} s; {self._time(index)}')
+
+        if index.groups is not None:
+            planted = range(0, n - 1, 100)
+            found = sum(i + 1 in [pk for pk, _ in index.search(matrix[i], exclude=i)] for i in planted)
+            self.stdout.write(f'La aproximada encuentra {found / len(planted):.1%} de las casi iguales')
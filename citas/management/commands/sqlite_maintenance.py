@@ -0,0 +1,129 @@
+"""
+Mantenimiento de la base de datos SQLite (para programarlo, por ejemplo
+cada noche).
+
+Uso:
+    python manage.py sqlite_maintenance                        -> lo normal (ver abajo)
+    python manage.py sqlite_maintenance --analyze              -> ANALYZE entero en vez de optimize
+    python manage.py sqlite_maintenance --check                -> además comprueba el fichero (quick_check)
+    python manage.py sqlite_maintenance --enable-incremental   -> una vez, en una BD de antes del perfil
+
+Con cron (todas las noches a las 4):
+    0 4 * * * cd /ruta/al/proyecto && python manage.py sqlite_maintenance
+
+Lo normal es:
+1. PRAGMA optimize: vuelve a calcular las estadísticas de los índices
+   (las que usa SQLite para elegir el plan) solo de las tablas que han
+   cambiado mucho. Con analysis_limit para que no lea tablas enteras.
+2. PRAGMA incremental_vacuum: devuelve al disco las páginas libres que
+   dejan las citas borradas (con auto_vacuum=INCREMENTAL, ver
+   SQLITE_PRAGMAS en settings.py). Sin bloquear la BD mucho rato como
+   VACUUM.
+3. PRAGMA wal_checkpoint(TRUNCATE): pasa lo que queda en el -wal al
+   fichero y lo deja a 0 bytes. SQLite ya lo hace solo, pero si siempre
+   hay alguien leyendo el -wal puede ir creciendo.
+
+Al terminar enseña el tamaño del fichero, las páginas libres y el -wal.
+
+Con shards (CITAS_SHARDS, ver citas/sharding.py) hace lo mismo en cada
+fichero: default y todos los shard_<i>.
+"""
+
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+
+# Filas que mira ANALYZE de cada índice con optimize (lo que recomienda SQLite)
+ANALYSIS_LIMIT = 400
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+class Command(BaseCommand):
+    help = 'ANALYZE/optimize, vacuum incremental y checkpoint del WAL de la BD SQLite'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--analyze', action='store_true',
+                            help='ANALYZE de todo (más lento que optimize)')
+        parser.add_argument('--check', action='store_true',
+                            help='PRAGMA quick_check antes de nada')
+        parser.add_argument('--enable-incremental', action='store_true',
+                            help='Activa auto_vacuum=INCREMENTAL (hace un VACUUM entero, una vez)')
+        parser.add_argument('--pages', type=int, default=0,
+                            help='Páginas libres a devolver como mucho (0 = todas)')
+
+    def handle(self, *args, **options):
+        for alias in connections:
+            connection = connections[alias]
+            if connection.vendor != 'sqlite':
+                raise CommandError('Este comando es solo para SQLite')
+            self.maintain(alias, connection, options)
+
+    def maintain(self, alias, connection, options):
+        before = self.sizes(connection)
+        with connection.cursor() as cursor:
+            if options['check']:
+                result = cursor.execute('PRAGMA quick_check').fetchone()[0]
+                if result != 'ok':
+                    raise CommandError(f'quick_check: {result}')
+                self.stdout.write('quick_check: ok')
+
+            if options['enable_incremental']:
+                self.enable_incremental(cursor)
+
+            if options['analyze']:
+                cursor.execute('ANALYZE')
+                self.stdout.write('ANALYZE hecho')
+            else:
+                cursor.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+                cursor.execute('PRAGMA optimize')
+                self.stdout.write('PRAGMA optimize hecho')
+
+            auto_vacuum = cursor.execute('PRAGMA auto_vacuum').fetchone()[0]
+            if auto_vacuum == AUTO_VACUUM_INCREMENTAL:
+                pages = f'({options["pages"]})' if options['pages'] else ''
+                # OJO: con cursor.execute() el módulo sqlite3 solo da un paso
+                # a la sentencia y incremental_vacuum devuelve UNA página por
+                # paso. executescript la ejecuta hasta el final
+                connection.connection.executescript(f'PRAGMA incremental_vacuum{pages};')
+            else:
+                self.stdout.write(self.style.WARNING(
+                    'auto_vacuum no es INCREMENTAL: las páginas libres no se devuelven '
+                    '(--enable-incremental lo activa)'
+                ))
+
+            busy, wal_pages, _ = cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+            if busy:
+                self.stdout.write(self.style.WARNING(
+                    f'Checkpoint incompleto: alguien estaba usando la BD ({wal_pages} páginas en el -wal)'
+                ))
+
+        after = self.sizes(connection)
+        self.stdout.write(
+            f'{alias}: fichero {before["file"] / 2**20:.1f} MB -> {after["file"] / 2**20:.1f} MB, '
+            f'páginas libres: {before["free"]} -> {after["free"]}, '
+            f'-wal: {before["wal"] / 2**20:.1f} MB -> {after["wal"] / 2**20:.1f} MB'
+        )
+
+    def enable_incremental(self, cursor):
+        """auto_vacuum solo cambia en una BD ya creada si después se hace un VACUUM"""
+        if cursor.execute('PRAGMA auto_vacuum').fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+            self.stdout.write('auto_vacuum ya era INCREMENTAL')
+            return
+        self.stdout.write('Activando auto_vacuum=INCREMENTAL (VACUUM, puede tardar)...')
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('VACUUM')
+
+    def sizes(self, connection):
+        """Tamaño del fichero y del -wal (bytes) y páginas libres"""
+        name = str(connection.settings_dict['NAME'])
+        with connection.cursor() as cursor:
+            free = cursor.execute('PRAGMA freelist_count').fetchone()[0]
+        wal = f'{name}-wal'
+        return {
+            'file': os.path.getsize(name) if os.path.exists(name) else 0,
+            'wal': os.path.getsize(wal) if os.path.exists(wal) else 0,
+            'free': free,
+        }
@@ -0,0 +1,54 @@
+"""
+Vuelve a entrenar los clasificadores de temas (ver suggestions.py).
+
+Uso:
+    python manage.py train_suggestions              -> todos los usuarios
+    python manage.py train_suggestions --user bea   -> solo uno
+
+Normalmente no hace falta: las señales los van actualizando al clasificar
+citas. Sirve si se han tocado las citas a mano en la BD, o para ver cuánto
+ocupa cada uno y cuánto se tarda en sugerir temas para todo su inbox.
+"""
+
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from citas import sharding, suggestions
+from citas.models import Cita
+
+
+class Command(BaseCommand):
+    help = 'Vuelve a entrenar el clasificador de temas de los usuarios'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Solo este usuario (username)')
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by('pk')
+        if options['user']:
+            users = users.filter(username=options['user'])
+            if not users.exists():
+                raise CommandError(f'El usuario {options["user"]!r} no existe')
+
+        for user in users.iterator():
+            with sharding.for_owner(user.pk):
+                start = time.perf_counter()
+                classifier = suggestions.retrain(user.pk)
+                trained = time.perf_counter() - start
+
+                # Lo que tarda en sugerir temas para todo el inbox
+                inbox = list(Cita.objects.filter(owner=user, tag__isnull=True).only('text', 'source'))
+                start = time.perf_counter()
+                classifier.suggest([(cita.text, cita.source) for cita in inbox])
+                scored = time.perf_counter() - start
+
+                self.stdout.write(
+                    f'{user.username}: {len(classifier)} citas clasificadas, '
+                    f'{len(classifier.terms)} palabras, {len(classifier.to_bytes()) / 1024:.1f} KB '
+                    f'(entrenado en {trained * 1000:.0f} ms; '
+                    f'{len(inbox)} del inbox puntuadas en {scored * 1000:.1f} ms)'
+                )
+
+        self.stdout.write(self.style.SUCCESS('Clasificadores entrenados'))
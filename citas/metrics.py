@@ -0,0 +1,373 @@
+"""
+Métricas para ver cuánto se usa la web y cuánto tarda, en el formato de
+texto de Prometheus, sin ningún servicio aparte.
+
+Qué se cuenta (lo apunta timing.ServerTimingMiddleware al terminar cada
+petición, ver observe_request):
+- citas_http_requests_total: peticiones por nombre de URL
+  ('citas:quote_list', 'accounts:login'...), método y código
+- citas_http_errors_total: las que acaban en 5xx, por URL
+- citas_http_request_duration_seconds: histograma de lo que tardan
+- citas_db_queries_per_request: histograma de consultas por petición
+- citas_db_duration_seconds_total: tiempo en la BD
+- citas_cache_hits_total / misses / evictions: de los backends de
+  cache_backends.py (sus stats() son de cada proceso: aquí se suman), y
+  citas_cache_hit_ratio, que se calcula al pedir las métricas
+
+Con varios procesos (gunicorn con varios workers) cada uno lleva sus
+números en memoria, y /metrics/ lo atiende uno cualquiera. Por eso cada
+proceso escribe en un fichero suyo (<pid>.bin en CITAS_METRICS_DIR)
+mapeado en memoria (mmap): sumar es cambiar 8 bytes, sin llamadas al
+sistema. Al pedir las métricas se leen todos los ficheros y se suman
+(como el modo multiproceso de prometheus_client).
+
+Formato de cada fichero:
+    [4 bytes: bytes usados][4 de relleno]
+    y por cada valor: [4 bytes: largo de la clave][clave, rellena hasta
+    múltiplo de 8][float64]
+La cabecera se escribe la última al añadir un valor: quien lee a la vez
+nunca ve uno a medias.
+
+OJO: los ficheros de procesos que ya no existen se siguen sumando (los
+contadores no bajan nunca, como en Prometheus). Al desplegar se puede
+vaciar el directorio.
+
+Los histogramas guardan cada observación solo en su cubeta (una
+escritura); al exportar se acumulan (le="0.1" incluye las de 0.05).
+"""
+
+import bisect
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+# Segundos (petición entera)
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Consultas por petición
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+INITIAL_SIZE = 64 * 1024
+
+_HEADER = 8
+
+
+# --- Los ficheros ---
+
+class MmapValues:
+    """El fichero de un proceso: clave (str) -> float64, para sumar"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a+b')
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._file.truncate(INITIAL_SIZE)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._used = struct.unpack_from('i', self._map, 0)[0]
+        if self._used == 0:
+            # Fichero nuevo
+            self._used = _HEADER
+            struct.pack_into('i', self._map, 0, self._used)
+        # Clave -> dónde está su valor
+        self._positions = {key: position for key, position, _ in _entries(self._map, self._used)}
+
+    def inc(self, key, amount=1.0):
+        with self._lock:
+            position = self._positions.get(key)
+            if position is None:
+                position = self._add(key)
+            value = struct.unpack_from('d', self._map, position)[0]
+            struct.pack_into('d', self._map, position, value + amount)
+
+    def _add(self, key):
+        encoded = key.encode()
+        padded = len(encoded) + (8 - (4 + len(encoded)) % 8) % 8
+        size = 4 + padded + 8
+        if self._used + size > len(self._map):
+            # No cabe: el doble (o lo que haga falta)
+            new_size = max(len(self._map) * 2, self._used + size)
+            self._map.close()
+            self._file.truncate(new_size)
+            self._map = mmap.mmap(self._file.fileno(), 0)
+
+        start = self._used
+        struct.pack_into(f'i{padded}sd', self._map, start, len(encoded), encoded, 0.0)
+        self._used += size
+        # La cabecera la última (ver arriba)
+        struct.pack_into('i', self._map, 0, self._used)
+        self._positions[key] = start + 4 + padded
+        return self._positions[key]
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def _entries(data, used):
+    """(clave, posición del valor, valor) de lo que hay en un fichero"""
+    position = _HEADER
+    while position < used:
+        length = struct.unpack_from('i', data, position)[0]
+        padded = length + (8 - (4 + length) % 8) % 8
+        key = bytes(data[position + 4:position + 4 + length]).decode()
+        value_at = position + 4 + padded
+        yield key, value_at, struct.unpack_from('d', data, value_at)[0]
+        position = value_at + 8
+
+
+def read_file(path):
+    """Los valores de un fichero (de este proceso o de otro)"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < _HEADER:
+        return []
+    used = min(struct.unpack_from('i', data, 0)[0], len(data))
+    return [(key, value) for key, _, value in _entries(data, used)]
+
+
+def directory():
+    return str(getattr(settings, 'CITAS_METRICS_DIR'))
+
+
+_values = None
+_values_pid = None
+_values_lock = threading.Lock()
+
+
+def _process_values():
+    """
+    El fichero de este proceso. Se abre al usarlo la primera vez, y otra
+    vez si el proceso es otro (gunicorn --preload crea los workers con
+    fork: no pueden escribir todos en el del padre)
+    """
+    global _values, _values_pid
+    if _values_pid != os.getpid():
+        with _values_lock:
+            if _values_pid != os.getpid():
+                os.makedirs(directory(), exist_ok=True)
+                _values = MmapValues(os.path.join(directory(), f'{os.getpid()}.bin'))
+                _values_pid = os.getpid()
+    return _values
+
+
+def enabled():
+    return getattr(settings, 'CITAS_METRICS', True)
+
+
+# --- Las métricas ---
+
+REGISTRY = {}
+
+
+def _format(value):
+    """Como lo escribe Prometheus: 3 y no 3.0"""
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def _key(sample, labels):
+    """La clave del fichero: nombre de la muestra y etiquetas en JSON"""
+    return json.dumps([sample, labels], separators=(',', ':'))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # (valores de las etiquetas, muestra) -> clave, para no hacer json.dumps cada vez
+        self._keys = {}
+        REGISTRY[name] = self
+
+    def _labels(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def key(self, values, sample=None, extra=()):
+        cache_key = (values, sample, extra)
+        key = self._keys.get(cache_key)
+        if key is None:
+            key = _key(sample or self.name, [*zip(self.labelnames, values), *extra])
+            self._keys[cache_key] = key
+        return key
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if enabled():
+            _process_values().inc(self.key(self._labels(labels)), amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        self._bounds = [_format(bound) for bound in self.buckets] + ['+Inf']
+
+    def observe(self, value, **labels):
+        if not enabled():
+            return
+        values = self._labels(labels)
+        bound = self._bounds[bisect.bisect_left(self.buckets, value)]
+        store = _process_values()
+        store.inc(self.key(values, f'{self.name}_bucket', (('le', bound),)))
+        store.inc(self.key(values, f'{self.name}_sum'), value)
+        store.inc(self.key(values, f'{self.name}_count'))
+
+
+requests_total = Counter(
+    'citas_http_requests_total', 'Peticiones por nombre de URL, método y código',
+    ['view', 'method', 'status'],
+)
+errors_total = Counter(
+    'citas_http_errors_total', 'Peticiones que acaban en 5xx, por nombre de URL', ['view'],
+)
+request_duration = Histogram(
+    'citas_http_request_duration_seconds', 'Lo que tarda cada petición (segundos)', ['view'],
+)
+db_queries = Histogram(
+    'citas_db_queries_per_request', 'Consultas a la BD por petición', ['view'], buckets=QUERY_BUCKETS,
+)
+db_duration_total = Counter(
+    'citas_db_duration_seconds_total', 'Tiempo en la BD (segundos)', ['view'],
+)
+cache_hits_total = Counter('citas_cache_hits_total', 'Aciertos de la caché', ['cache'])
+cache_misses_total = Counter('citas_cache_misses_total', 'Fallos de la caché', ['cache'])
+cache_evictions_total = Counter(
+    'citas_cache_evictions_total', 'Entradas tiradas de la caché por falta de sitio', ['cache'],
+)
+
+
+# Lo último que pasé de stats() de cada caché a los contadores (de este proceso)
+_cache_seen = defaultdict(dict)
+
+
+def observe_request(view_name, method, status, elapsed, queries, db_time):
+    """Apunta una petición (lo llama timing.ServerTimingMiddleware)"""
+    if not enabled():
+        return
+    view = view_name or 'sin_url'
+    requests_total.inc(view=view, method=method, status=status)
+    if status >= 500:
+        errors_total.inc(view=view)
+    request_duration.observe(elapsed, view=view)
+    db_queries.observe(queries, view=view)
+    if db_time:
+        db_duration_total.inc(db_time, view=view)
+    _sync_cache_stats()
+
+
+def _sync_cache_stats():
+    """
+    Suma a los contadores lo que han cambiado hits/misses/evictions de
+    cada caché desde la última petición (ver cache_backends.StatsMixin)
+    """
+    for alias in settings.CACHES:
+        stats = getattr(caches[alias], '_stats', None)
+        if stats is None:
+            continue
+        seen = _cache_seen[alias]
+        for name, counter in (('hits', cache_hits_total), ('misses', cache_misses_total),
+                              ('evictions', cache_evictions_total)):
+            # reset_stats() los pone a 0: entonces cuento desde ahí
+            delta = stats[name] - seen.get(name, 0)
+            if delta < 0:
+                delta = stats[name]
+            if delta:
+                counter.inc(delta, cache=alias)
+            seen[name] = stats[name]
+
+
+# --- Exportar ---
+
+def collect():
+    """{clave: valor} sumando los ficheros de todos los procesos"""
+    totals = defaultdict(float)
+    for path in glob.glob(os.path.join(directory(), '*.bin')):
+        try:
+            for key, value in read_file(path):
+                totals[key] += value
+        except (OSError, struct.error, UnicodeDecodeError, ValueError):
+            # Un fichero roto no puede dejar sin métricas a los demás
+            continue
+    return totals
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _sample(name, labels, value):
+    if labels:
+        inside = ','.join(f'{label}="{_escape(text)}"' for label, text in labels)
+        return f'{name}{{{inside}}} {_format(value)}'
+    return f'{name} {_format(value)}'
+
+
+def exposition():
+    """Todas las métricas en el formato de texto de Prometheus (0.0.4)"""
+    samples = defaultdict(list)
+    for key, value in collect().items():
+        sample, labels = json.loads(key)
+        samples[sample].append((tuple(map(tuple, labels)), value))
+
+    lines = []
+    for metric in REGISTRY.values():
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        if metric.kind == 'counter':
+            for labels, value in sorted(samples[metric.name]):
+                lines.append(_sample(metric.name, labels, value))
+        else:
+            lines += _histogram_lines(metric, samples)
+
+    lines += _hit_ratio_lines(samples)
+    return '\n'.join(lines) + '\n'
+
+
+def _histogram_lines(metric, samples):
+    """Las cubetas acumuladas (cada observación solo está en la suya)"""
+    buckets = defaultdict(dict)
+    for labels, value in samples[f'{metric.name}_bucket']:
+        *rest, (_, bound) = labels
+        buckets[tuple(rest)][bound] = value
+    sums = dict(samples[f'{metric.name}_sum'])
+    counts = dict(samples[f'{metric.name}_count'])
+
+    lines = []
+    for labels in sorted(counts):
+        total = 0.0
+        for bound in metric._bounds:
+            total += buckets[labels].get(bound, 0.0)
+            lines.append(_sample(f'{metric.name}_bucket', (*labels, ('le', bound)), total))
+        lines.append(_sample(f'{metric.name}_sum', labels, sums.get(labels, 0.0)))
+        lines.append(_sample(f'{metric.name}_count', labels, counts[labels]))
+    return lines
+
+
+def _hit_ratio_lines(samples):
+    hits = dict(samples[cache_hits_total.name])
+    misses = dict(samples[cache_misses_total.name])
+    lines = [
+        '# HELP citas_cache_hit_ratio Aciertos / (aciertos + fallos) de la caché, de todos los procesos',
+        '# TYPE citas_cache_hit_ratio gauge',
+    ]
+    for labels in sorted(set(hits) | set(misses)):
+        total = hits.get(labels, 0.0) + misses.get(labels, 0.0)
+        lines.append(_sample('citas_cache_hit_ratio', labels, hits.get(labels, 0.0) / total if total else 0.0))
+    return lines
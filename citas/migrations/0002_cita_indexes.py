@@ -0,0 +1,35 @@
+# Generated by Django 6.0.2 on 2026-10-17 01:45
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('citas', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cita',
+            index=models.Index(fields=['owner', '-created_at', '-id'], name='cita_owner_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cita',
+            index=models.Index(fields=['owner', 'tag', '-created_at', '-id'], name='cita_owner_tag_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cita',
+            index=models.Index(condition=models.Q(('tag__isnull', True)), fields=['owner', '-created_at', '-id'], name='cita_inbox_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cita',
+            index=models.Index(condition=models.Q(('is_favorite', True)), fields=['owner', '-created_at', '-id'], name='cita_favorite_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cita',
+            index=models.Index(condition=models.Q(('image', ''), _negated=True), fields=['owner', '-created_at', '-id'], name='cita_with_image_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-17 02:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('citas', '0002_cita_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cita',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 6.0.2 on 2026-10-17 03:05
+
+import citas.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('citas', '0004_cita_image_dimensions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Imagen',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('refcount', models.PositiveIntegerField(default=0)),
+                ('variants', models.JSONField(blank=True, default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Imagen',
+                'verbose_name_plural': 'Imágenes',
+            },
+        ),
+        migrations.AlterField(
+            model_name='cita',
+            name='image',
+            field=models.ImageField(blank=True, null=True, storage=citas.storage.get_image_storage, upload_to='quotes/', verbose_name='Imagen'),
+        ),
+    ]
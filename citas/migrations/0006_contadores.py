@@ -0,0 +1,41 @@
+# Generated by Django 6.0.2 on 2026-10-17 11:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('citas', '0005_imagen_hashed_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContadorTema',
+            fields=[
+                ('tema', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='contador', serialize=False, to='citas.tema')),
+                ('total', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Contador de tema',
+                'verbose_name_plural': 'Contadores de tema',
+            },
+        ),
+        migrations.CreateModel(
+            name='ContadorUsuario',
+            fields=[
+                ('owner', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='contador_citas', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('inbox', models.PositiveIntegerField(default=0)),
+                ('favorites', models.PositiveIntegerField(default=0)),
+                ('with_image', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Contador de usuario',
+                'verbose_name_plural': 'Contadores de usuario',
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 6.0.2 on 2026-10-17 12:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('citas', '0006_contadores'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClasificadorTemas',
+            fields=[
+                ('owner', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='clasificador_temas', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('data', models.BinaryField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Clasificador de temas',
+                'verbose_name_plural': 'Clasificadores de temas',
+            },
+        ),
+    ]
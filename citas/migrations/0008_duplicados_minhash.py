@@ -0,0 +1,35 @@
+# Generated by Django 6.0.2 on 2026-10-17 14:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('citas', '0007_clasificador_temas'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cita',
+            name='text_minhash',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='CubetaLSH',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.BigIntegerField()),
+                ('cita', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cubetas_lsh', to='citas.cita')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Cubeta LSH',
+                'verbose_name_plural': 'Cubetas LSH',
+                'indexes': [models.Index(fields=['owner', 'key'], name='cubeta_owner_key_idx')],
+            },
+        ),
+    ]
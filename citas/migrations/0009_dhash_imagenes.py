@@ -0,0 +1,35 @@
+# Generated by Django 6.0.2 on 2026-10-17 15:30
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('citas', '0008_duplicados_minhash'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cita',
+            name='image_dhash',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='CubetaImagen',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.IntegerField()),
+                ('cita', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cubetas_imagen', to='citas.cita')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Cubeta de imagen',
+                'verbose_name_plural': 'Cubetas de imagen',
+                'indexes': [models.Index(fields=['owner', 'key'], name='cubeta_imagen_owner_key_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-17 16:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('citas', '0009_dhash_imagenes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cita',
+            name='text_vector',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 6.0.2 on 2026-10-17 18:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('citas', '0010_vector_texto'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShardUsuario',
+            fields=[
+                ('owner', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('shard', models.CharField(max_length=50)),
+                ('moved_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Shard de usuario',
+                'verbose_name_plural': 'Shards de usuario',
+            },
+        ),
+        migrations.AlterField(
+            model_name='cita',
+            name='owner',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='citas', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='clasificadortemas',
+            name='owner',
+            field=models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='clasificador_temas', serialize=False, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='contadorusuario',
+            name='owner',
+            field=models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='contador_citas', serialize=False, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='cubetaimagen',
+            name='owner',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='cubetalsh',
+            name='owner',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='tema',
+            name='owner',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='temas', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
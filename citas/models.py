@@ -4,6 +4,15 @@ Modelos de la app citas.
 Aquí defino las "tablas" de la BD:
 - Tema: para organizar las citas (Motivación, Filosofía, etc.)
 - Cita: la cita en sí, con texto y/o imagen
+- Imagen: cuántas citas usan cada fichero de imagen
+- ContadorUsuario y ContadorTema: cuántas citas hay (para no hacer COUNT)
+- ClasificadorTemas: lo aprendido de las citas con tema, para sugerir temas
+- CubetaLSH: índice para encontrar citas casi repetidas (ver duplicates.py)
+- CubetaImagen: lo mismo para imágenes casi iguales (ver perceptual.py)
+- ShardUsuario: los usuarios movidos de shard a mano (ver sharding.py)
+
+OJO: los owner no tienen FOREIGN KEY en la BD (db_constraint=False):
+con CITAS_SHARDS las citas y auth_user están en BD distintas.
 
 Cada vez que cambio algo aquí tengo que hacer:
 python manage.py makemigrations
@@ -13,6 +22,7 @@ python manage.py migrate
 from django.db import models
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
+from .storage import get_image_storage
 
 
 class Tema(models.Model):
@@ -29,10 +39,12 @@ class Tema(models.Model):
     # ForeignKey = muchos temas pertenecen a un usuario
     # on_delete=CASCADE: si borro el usuario, se borran sus temas
     # related_name='temas': para hacer user.temas.all()
+    # db_constraint=False: con CITAS_SHARDS el usuario está en otra BD
     owner = models.ForeignKey(
         User, 
         on_delete=models.CASCADE, 
-        related_name='temas'
+        related_name='temas',
+        db_constraint=False
     )
     
     # Nombre del tema
@@ -78,7 +90,8 @@ class Cita(models.Model):
     owner = models.ForeignKey(
         User, 
         on_delete=models.CASCADE, 
-        related_name='citas'
+        related_name='citas',
+        db_constraint=False
     )
     
     # El texto de la cita
@@ -89,15 +102,45 @@ class Cita(models.Model):
     # Imagen de la cita
     # ImageField = para subir imágenes
     # upload_to='quotes/': las guarda en media/quotes/
+    # storage: se guardan por contenido (hash), así una imagen repetida
+    # solo ocupa disco una vez (ver storage.py)
     # blank=True, null=True: es opcional
     # OJO: Necesita Pillow instalado
     image = models.ImageField(
         upload_to='quotes/', 
+        storage=get_image_storage,
         blank=True, 
         null=True, 
         verbose_name='Imagen'
     )
     
+    # Tamaño de la imagen y miniatura borrosa para el grid
+    # Se rellenan al validar la subida en QuoteForm (ver placeholders.py)
+    # null=True: las citas sin imagen (o antiguas sin procesar) no tienen
+    image_width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    image_height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    image_placeholder = models.TextField(blank=True, editable=False)
+    
+    # Versiones redimensionadas de la imagen (WebP y JPEG)
+    # Las genera thumbnails.py en segundo plano después de guardar
+    # Ejemplo: {'grid': {'width': 400, 'webp': 'quotes/variants/x_grid.webp', 'jpeg': ...}}
+    # Vacío mientras no se han generado (los templates usan la original)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
+    
+    # Hash "perceptual" de la imagen (dHash, 64 bits): dos imágenes que se
+    # ven igual (aunque una esté recomprimida o reescalada) tienen hashes
+    # que se diferencian en muy pocos bits (ver perceptual.py)
+    image_dhash = models.BigIntegerField(null=True, blank=True, editable=False)
+    
+    # "Huella" del texto para encontrar citas casi iguales (MinHash, 128
+    # bytes). La calculan las señales al guardar (ver duplicates.py)
+    # null=True: las citas sin texto (o importadas y sin procesar) no tienen
+    text_minhash = models.BinaryField(null=True, blank=True, editable=False)
+    
+    # Vector del texto para "citas parecidas" (256 float32 = 1 KB, ver
+    # related.py). Lo calculan las señales; vacío (b'') si no tiene letras
+    text_vector = models.BinaryField(null=True, blank=True, editable=False)
+    
     # De dónde viene la cita (autor, libro, etc.)
     # Es opcional
     source = models.CharField(
@@ -139,6 +182,44 @@ class Cita(models.Model):
         # Las más recientes primero
         # '-created_at' = orden descendente
         ordering = ['-created_at']
+        
+        # Índices para las consultas que más se repiten
+        # Todas las vistas filtran por owner y ordenan por fecha, así que
+        # los índices empiezan por owner y terminan por (created_at, id),
+        # que es el orden de la paginación por cursor.
+        # Los que llevan condition son índices parciales: solo guardan las
+        # filas que cumplen la condición (más pequeños y más rápidos).
+        # Si añado una vista nueva: python manage.py check_query_plans
+        indexes = [
+            # Lista principal y citas aleatorias
+            models.Index(
+                fields=['owner', '-created_at', '-id'],
+                name='cita_owner_created_idx',
+            ),
+            # Filtro por tema
+            models.Index(
+                fields=['owner', 'tag', '-created_at', '-id'],
+                name='cita_owner_tag_created_idx',
+            ),
+            # Inbox (sin tema)
+            models.Index(
+                fields=['owner', '-created_at', '-id'],
+                name='cita_inbox_idx',
+                condition=models.Q(tag__isnull=True),
+            ),
+            # Solo favoritas
+            models.Index(
+                fields=['owner', '-created_at', '-id'],
+                name='cita_favorite_idx',
+                condition=models.Q(is_favorite=True),
+            ),
+            # Solo con imagen
+            models.Index(
+                fields=['owner', '-created_at', '-id'],
+                name='cita_with_image_idx',
+                condition=~models.Q(image=''),
+            ),
+        ]
     
     
     def __str__(self):
@@ -168,4 +249,241 @@ class Cita(models.Model):
         if not self.text and not self.image:
             raise ValidationError(
                 'La cita debe tener al menos texto o una imagen.'
-            )
\ No newline at end of file
+            )
+
+
+class Imagen(models.Model):
+    """
+    Un fichero de imagen guardado por contenido (ver storage.py).
+    
+    Como varias citas pueden apuntar al mismo fichero, aquí llevo la
+    cuenta de cuántas lo usan (refcount). Cuando llega a 0 se borran el
+    fichero y sus miniaturas. Lo mantienen las señales de signals.py.
+    
+    También guardo aquí las miniaturas: son del fichero, no de la cita,
+    así que si se vuelve a subir la misma imagen no hay que generarlas.
+    """
+    
+    # Ruta del fichero en el storage (quotes/ab/cd/abcd....jpg)
+    name = models.CharField(max_length=255, unique=True)
+    
+    # Cuántas citas usan este fichero
+    refcount = models.PositiveIntegerField(default=0)
+    
+    # Las mismas variantes que Cita.image_variants (ver thumbnails.py)
+    variants = models.JSONField(default=dict, blank=True)
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    
+    class Meta:
+        verbose_name = 'Imagen'
+        verbose_name_plural = 'Imágenes'
+    
+    
+    def __str__(self):
+        return f'{self.name} ({self.refcount})'
+
+
+class ContadorUsuario(models.Model):
+    """
+    Cuántas citas tiene cada usuario (total, inbox, favoritas, con imagen).
+    
+    Antes cada número era un COUNT(*) sobre citas_cita. Ahora lo llevo
+    apuntado aquí y lo actualizan las señales cada vez que se guarda o
+    se borra una cita (ver counters.py), así leerlo es una sola fila.
+    
+    Si algún número se desincroniza (cambios a mano en la BD, bulk_create
+    sin señal...): python manage.py recount
+    """
+    
+    # primary_key: una fila por usuario, y se busca directamente por su id
+    owner = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='contador_citas',
+        db_constraint=False
+    )
+    
+    total = models.PositiveIntegerField(default=0)
+    inbox = models.PositiveIntegerField(default=0)
+    favorites = models.PositiveIntegerField(default=0)
+    with_image = models.PositiveIntegerField(default=0)
+    
+    
+    class Meta:
+        verbose_name = 'Contador de usuario'
+        verbose_name_plural = 'Contadores de usuario'
+    
+    
+    def __str__(self):
+        return f'{self.owner}: {self.total} citas'
+
+
+class ContadorTema(models.Model):
+    """
+    Cuántas citas tiene cada tema. Igual que ContadorUsuario.
+    
+    No hace falta guardar el usuario: cada tema ya es de un solo usuario.
+    """
+    
+    tema = models.OneToOneField(
+        Tema,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='contador'
+    )
+    
+    total = models.PositiveIntegerField(default=0)
+    
+    
+    class Meta:
+        verbose_name = 'Contador de tema'
+        verbose_name_plural = 'Contadores de tema'
+    
+    
+    def __str__(self):
+        return f'{self.tema}: {self.total} citas'
+
+
+
+class ClasificadorTemas(models.Model):
+    """
+    El modelo de sugerencias de temas de cada usuario (ver suggestions.py).
+    
+    Es lo aprendido de sus citas ya clasificadas (qué palabras salen en
+    cada tema), comprimido en un solo campo binario. Se actualiza un poco
+    cada vez que una cita cambia de tema, sin volver a leer todas.
+    
+    Si se pierde o se desajusta: python manage.py train_suggestions
+    """
+    
+    owner = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='clasificador_temas',
+        db_constraint=False
+    )
+    
+    # Arrays de NumPy en un .npz comprimido (ver Classifier.to_bytes)
+    data = models.BinaryField()
+    
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    
+    class Meta:
+        verbose_name = 'Clasificador de temas'
+        verbose_name_plural = 'Clasificadores de temas'
+    
+    
+    def __str__(self):
+        return f'{self.owner}: {len(self.data) / 1024:.1f} KB'
+
+
+
+class CubetaLSH(models.Model):
+    """
+    Índice para encontrar citas con el texto casi igual (ver duplicates.py).
+    
+    La huella MinHash de cada cita se parte en 16 trozos ("bandas") y cada
+    trozo va a una cubeta (key). Dos citas muy parecidas caen casi seguro
+    en la misma cubeta en alguna banda, así que para buscar las parecidas
+    a un texto nuevo solo miro sus 16 cubetas, no todas las citas.
+    
+    Una fila por banda y cita. El owner está repetido (ya va en la cita)
+    para que el índice (owner, key) sea solo de las citas de ese usuario.
+    """
+    
+    owner = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='+',
+        db_constraint=False
+    )
+    
+    cita = models.ForeignKey(
+        Cita,
+        on_delete=models.CASCADE,
+        related_name='cubetas_lsh'
+    )
+    
+    # La banda y sus valores, en un número de 64 bits
+    key = models.BigIntegerField()
+    
+    
+    class Meta:
+        verbose_name = 'Cubeta LSH'
+        verbose_name_plural = 'Cubetas LSH'
+        indexes = [
+            models.Index(fields=['owner', 'key'], name='cubeta_owner_key_idx'),
+        ]
+
+
+
+class CubetaImagen(models.Model):
+    """
+    Índice para encontrar imágenes casi iguales (ver perceptual.py).
+    
+    El dHash de 64 bits se parte en 4 trozos de 16 bits y cada trozo es
+    una cubeta. Si dos hashes se diferencian en 3 bits o menos, al menos
+    uno de los 4 trozos es idéntico, así que basta con mirar 4 cubetas.
+    Igual que CubetaLSH pero para las imágenes.
+    """
+    
+    owner = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='+',
+        db_constraint=False
+    )
+    
+    cita = models.ForeignKey(
+        Cita,
+        on_delete=models.CASCADE,
+        related_name='cubetas_imagen'
+    )
+    
+    # El número de trozo (0-3) y su valor, juntos: trozo * 65536 + valor
+    key = models.IntegerField()
+    
+    
+    class Meta:
+        verbose_name = 'Cubeta de imagen'
+        verbose_name_plural = 'Cubetas de imagen'
+        indexes = [
+            models.Index(fields=['owner', 'key'], name='cubeta_imagen_owner_key_idx'),
+        ]
+
+
+
+class ShardUsuario(models.Model):
+    """
+    En qué shard están las citas de un usuario, si no es el que le toca
+    por el hash de su id (ver sharding.py).
+    
+    Solo hay fila para los usuarios movidos con move_user. Está siempre
+    en default, como auth_user.
+    """
+    
+    owner = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='+'
+    )
+    
+    # Alias de la BD en settings.DATABASES (shard_0, shard_1...)
+    shard = models.CharField(max_length=50)
+    
+    moved_at = models.DateTimeField(auto_now=True)
+    
+    
+    class Meta:
+        verbose_name = 'Shard de usuario'
+        verbose_name_plural = 'Shards de usuario'
+    
+    
+    def __str__(self):
+        return f'{self.owner_id}: {self.shard}'
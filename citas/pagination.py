@@ -0,0 +1,125 @@
+"""
+Paginación por cursor (keyset) para las listas de citas.
+
+Con OFFSET la base de datos tiene que recorrer y tirar todas las filas
+anteriores a la página que pides, así que la página 500 es lentísima.
+Con un cursor guardo dónde me quedé, (created_at, id) de la última cita
+de la página, y la siguiente página empieza justo ahí:
+
+    WHERE created_at < X OR (created_at = X AND id < Y)
+    ORDER BY created_at DESC, id DESC
+
+Uso el id para desempatar porque dos citas pueden tener el mismo
+created_at (por ejemplo si se importan de golpe).
+
+El cursor viaja en la URL (?cursor=...) codificado en base64 para que
+no se vea raro. Si alguien lo manipula y no se puede leer, simplemente
+empiezo desde la primera página.
+"""
+
+import base64
+import binascii
+from datetime import datetime
+
+from django.db.models import Q
+
+
+# Cuántas citas muestro en cada página
+PAGE_SIZE = 30
+
+# Orden estable de las listas (el mismo que Meta.ordering + id para desempatar)
+ORDERING = ('-created_at', '-id')
+
+# Los ids son BigAutoField (entero con signo de 64 bits): un cursor con un
+# id más grande se lee bien pero la consulta falla (OverflowError, un 500)
+MIN_ID = -2 ** 63
+MAX_ID = 2 ** 63 - 1
+
+
+def encode_cursor(cita):
+    """
+    Convierte la última cita de una página en un cursor para la URL.
+
+    Ejemplo: "2026-02-22T17:13:00.123456+00:00|42" -> "MjAyNi0wMi0y..."
+    """
+    raw = f'{cita.created_at.isoformat()}|{cita.pk}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Lee un cursor de la URL.
+
+    Devuelve una tupla (created_at, id) o None si el cursor está vacío
+    o no es válido (también si el id no cabe en un BigAutoField).
+    """
+    if not cursor:
+        return None
+
+    # base64 necesita el relleno '=' que quité al codificar
+    padding = '=' * (-len(cursor) % 4)
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor + padding).decode()
+        created_at, pk = raw.rsplit('|', 1)
+        created_at, pk = datetime.fromisoformat(created_at), int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+    if not MIN_ID <= pk <= MAX_ID:
+        return None
+    return created_at, pk
+
+
+def after_cursor(queryset, cursor):
+    """
+    Filtra el queryset para quedarme con lo que va DESPUÉS del cursor.
+
+    Si el cursor no es válido devuelvo el queryset sin tocar.
+    """
+    position = decode_cursor(cursor)
+    if not position:
+        return queryset
+
+    created_at, pk = position
+    return queryset.filter(
+        Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk)
+    )
+
+
+def keyset_page(queryset, cursor=None, page_size=PAGE_SIZE):
+    """
+    Devuelve una página de resultados a partir de un cursor.
+
+    Parámetros:
+    - queryset: las citas ya filtradas (owner, búsqueda, tema...)
+    - cursor: el valor de ?cursor= (o None para la primera página)
+    - page_size: cuántas citas por página
+
+    Devuelve (citas, next_cursor). next_cursor es None si ya no hay más.
+
+    Truco: pido page_size + 1 filas. Si llega la fila extra es que hay
+    página siguiente, y así no necesito hacer un COUNT.
+    """
+    queryset = after_cursor(queryset.order_by(*ORDERING), cursor)
+
+    citas = list(queryset[:page_size + 1])
+    return _split_page(citas, page_size)
+
+
+async def akeyset_page(queryset, cursor=None, page_size=PAGE_SIZE):
+    """Lo mismo que keyset_page con el ORM async (para async_views.py)"""
+    queryset = after_cursor(queryset.order_by(*ORDERING), cursor)
+
+    citas = [cita async for cita in queryset[:page_size + 1]]
+    return _split_page(citas, page_size)
+
+
+def _split_page(citas, page_size):
+    """Quita la fila de más (si ha llegado) y saca el cursor de la siguiente"""
+    next_cursor = None
+    if len(citas) > page_size:
+        citas = citas[:page_size]
+        next_cursor = encode_cursor(citas[-1])
+
+    return citas, next_cursor
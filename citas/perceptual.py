@@ -0,0 +1,236 @@
+"""
+Imágenes casi iguales: hash perceptual (dHash) + índice por trozos.
+
+Las citas que más se repiten son memes (solo imagen). El almacenamiento
+por contenido (storage.py) ya junta los ficheros idénticos byte a byte,
+pero la misma imagen descargada de otro sitio, recomprimida o reescalada
+tiene otros bytes y otro SHA-256.
+
+dHash: reduzco la imagen a 9x8 píxeles en gris y, para cada fila, apunto
+si cada píxel es más claro que el de su derecha: 8 x 8 = 64 bits. Dos
+imágenes que se ven igual dan hashes que se diferencian en muy pocos bits
+(distancia de Hamming). Se guarda en Cita.image_dhash.
+
+Para buscar sin comparar con todas las imágenes del usuario (multi-index
+hashing): parto el hash en 4 trozos de 16 bits y cada trozo es una cubeta
+(CubetaImagen). Si dos hashes se diferencian en MAX_DISTANCE = 3 bits o
+menos, por fuerza uno de los 4 trozos es idéntico. Miro esas 4 cubetas y
+compruebo la distancia de verdad solo en las que salgan.
+
+- Al subir una imagen, QuoteForm calcula el hash (el fichero ya está
+  abierto) y avisa si ya tienes una igual.
+- Las señales guardan las cubetas cuando cambia la imagen (y calculan el
+  hash si la imagen no vino del formulario, por ejemplo desde el admin).
+- Las que faltan: python manage.py find_duplicate_images --backfill
+  (en varios procesos, ver backfill()).
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from django.db import connections, transaction
+from PIL import Image, ImageOps
+
+from . import sharding
+from .duplicates import bucket_clusters
+from .models import Cita, CubetaImagen
+
+
+HASH_SIZE = 8
+CHUNKS = 4
+CHUNK_BITS = 64 // CHUNKS
+
+# Bits distintos como máximo para decir que dos imágenes son "la misma".
+# Con 4 trozos, hasta 3 está garantizado que se encuentran
+MAX_DISTANCE = CHUNKS - 1
+
+# Vecinos de la misma cubeta con los que comparo en clusters()
+WINDOW = 8
+
+# Citas por tanda en el backfill
+BATCH_SIZE = 500
+
+
+def dhash_image(image):
+    """El dHash de una imagen de Pillow ya abierta, como entero con signo de 64 bits"""
+    # draft() hace que Pillow decodifique los JPEG ya reducidos (mucho más rápido)
+    image.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+    image = ImageOps.exif_transpose(image).convert('L')
+    small = image.resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.LANCZOS)
+    pixels = np.asarray(small, dtype=np.int16)
+
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    value = int(np.packbits(bits).view('>u8')[0])
+    return to_signed(value)
+
+
+def dhash(fileobj):
+    """
+    El dHash de un fichero (subido o abierto desde el storage).
+
+    Como placeholders.image_metadata, lo deja otra vez al principio para
+    que Django lo pueda guardar.
+    """
+    fileobj.seek(0)
+    with Image.open(fileobj) as image:
+        value = dhash_image(image)
+    fileobj.seek(0)
+    return value
+
+
+def dhash_path(path):
+    """
+    dHash de un fichero por su ruta, o None si no se puede abrir.
+
+    Es la que ejecutan los procesos del backfill: no toca Django ni la BD.
+    """
+    try:
+        with Image.open(path) as image:
+            return dhash_image(image)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+def to_signed(value):
+    """La BD guarda enteros con signo: 0..2^64-1 -> -2^63..2^63-1"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def distance(a, b):
+    """Bits distintos entre dos hashes"""
+    return ((a ^ b) & ((1 << 64) - 1)).bit_count()
+
+
+def chunk_keys(value):
+    """Las 4 cubetas de un hash: trozo * 65536 + los 16 bits de ese trozo"""
+    value &= (1 << 64) - 1
+    mask = (1 << CHUNK_BITS) - 1
+    return [(chunk << CHUNK_BITS) | ((value >> (chunk * CHUNK_BITS)) & mask) for chunk in range(CHUNKS)]
+
+
+# --- Índice en la BD ---
+
+def index_citas(owner_id, rows):
+    """
+    Guarda el hash y las cubetas de citas de un usuario: rows = [(id, dhash)].
+
+    dhash None = la cita ya no tiene imagen (o no se pudo leer): se quedan
+    sin cubetas. Con executemany, como duplicates.index_citas.
+    """
+    if not rows:
+        return
+    ids = [pk for pk, _ in rows]
+    db = sharding.db_for_owner(owner_id)
+    quote = connections[db].ops.quote_name
+
+    with transaction.atomic(using=db):
+        CubetaImagen.objects.using(db).filter(cita_id__in=ids).delete()
+        with connections[db].cursor() as cursor:
+            cursor.executemany(
+                f'UPDATE {quote(Cita._meta.db_table)} SET image_dhash = %s WHERE id = %s',
+                [(value, pk) for pk, value in rows],
+            )
+            cursor.executemany(
+                f'INSERT INTO {quote(CubetaImagen._meta.db_table)} (owner_id, cita_id, {quote("key")}) '
+                f'VALUES (%s, %s, %s)',
+                [(owner_id, pk, key) for pk, value in rows if value is not None for key in chunk_keys(value)],
+            )
+
+
+def index_cita(cita):
+    """Las cubetas de una cita después de cambiar su imagen (ver signals.py)"""
+    index_citas(cita.owner_id, [(cita.pk, cita.image_dhash)])
+
+
+def find_similar(owner_id, value, exclude_pk=None, max_distance=MAX_DISTANCE, limit=5):
+    """
+    Las citas del usuario con una imagen casi igual al hash value:
+    [(Cita, bits distintos)] de más a menos parecida.
+
+    Una consulta por el índice de cubetas y otra para los hashes de las
+    candidatas.
+    """
+    if value is None:
+        return []
+
+    candidates = (CubetaImagen.objects.filter(owner_id=owner_id, key__in=chunk_keys(value))
+                  .values_list('cita_id', flat=True).distinct())
+    citas = Cita.objects.filter(owner_id=owner_id, pk__in=candidates, image_dhash__isnull=False)
+    if exclude_pk:
+        citas = citas.exclude(pk=exclude_pk)
+
+    found = []
+    for cita in citas.only('text', 'image', 'image_dhash'):
+        bits = distance(value, cita.image_dhash)
+        if bits <= max_distance:
+            found.append((cita, bits))
+    found.sort(key=lambda item: item[1])
+    return found[:limit]
+
+
+# --- En bloque (find_duplicate_images) ---
+
+def clusters(ids, hashes, max_distance=MAX_DISTANCE):
+    """
+    Agrupa imágenes casi iguales: ids (n,) y sus dHash (n,) como int64.
+
+    Las cubetas son los 4 trozos de 16 bits (ver duplicates.bucket_clusters).
+    En cada cubeta comparo con los WINDOW anteriores, no solo con el primero:
+    en 16 bits caen bastantes imágenes que no se parecen en nada.
+    """
+    hashes = np.asarray(hashes, dtype=np.int64).view(np.uint64)
+    shifts = np.arange(CHUNKS, dtype=np.uint64) * np.uint64(CHUNK_BITS)
+    keys = ((hashes[:, None] >> shifts) & np.uint64(0xFFFF)).astype(np.int64)
+
+    def matches(a, b):
+        different = np.unpackbits((hashes[a] ^ hashes[b]).view(np.uint8).reshape(-1, 8), axis=1)
+        return different.sum(axis=1) <= max_distance
+
+    return bucket_clusters(ids, keys, matches, window=WINDOW)
+
+
+def backfill(owner_ids=None, workers=None, stdout=None):
+    """
+    Calcula el dHash de las citas con imagen que aún no lo tienen.
+
+    Abrir y decodificar imágenes es lo lento (CPU), así que lo reparto
+    entre varios procesos (ProcessPoolExecutor): cada proceso solo recibe
+    rutas de ficheros y devuelve números; la BD solo la toca este proceso.
+
+    Las que no se pueden abrir se quedan sin hash (y sin cubetas). Voy por
+    tandas de pk creciente (pk__gt), así no se vuelven a intentar en la
+    misma ejecución. Devuelve cuántas se han calculado.
+    """
+    storage = Cita._meta.get_field('image').storage
+
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        # Shard por shard (ver sharding.py): las pk de cada uno van aparte
+        for shard_owner_ids in sharding.by_shard(owner_ids):
+            citas = Cita.objects.filter(image_dhash__isnull=True).exclude(image='').exclude(image__isnull=True)
+            if shard_owner_ids is not None:
+                citas = citas.filter(owner_id__in=shard_owner_ids)
+
+            last_pk = 0
+            while True:
+                batch = list(citas.filter(pk__gt=last_pk).order_by('pk')
+                             .values_list('pk', 'owner_id', 'image')[:BATCH_SIZE])
+                if not batch:
+                    break
+                last_pk = batch[-1][0]
+
+                paths = [storage.path(name) for _, _, name in batch]
+                values = pool.map(dhash_path, paths, chunksize=16)
+
+                by_owner = {}
+                for (pk, owner_id, _), value in zip(batch, values):
+                    if value is not None:
+                        by_owner.setdefault(owner_id, []).append((pk, value))
+                for owner_id, rows in by_owner.items():
+                    index_citas(owner_id, rows)
+                    done += len(rows)
+
+                if stdout:
+                    stdout.write(f'{last_pk}: {done} hashes calculados')
+    return done
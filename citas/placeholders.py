@@ -0,0 +1,57 @@
+"""
+Dimensiones y "placeholder" borroso de las imágenes de las citas.
+
+El grid tipo masonry no sabe cuánto mide una tarjeta hasta que se descarga
+su imagen, así que las tarjetas van saltando mientras cargan (layout shift).
+
+Para evitarlo guardo en la cita, UNA sola vez al subir la imagen:
+- image_width / image_height: el tamaño real (ya girado según EXIF)
+- image_placeholder: una miniatura de 16 px en WebP metida en un data URI
+  (unos pocos cientos de bytes). El template la pinta de fondo, borrosa,
+  mientras llega la imagen de verdad. Sin peticiones extra.
+
+Así el template reserva el hueco exacto (aspect-ratio) y pinta algo al
+momento, sin tener que abrir el fichero de la imagen al renderizar.
+"""
+
+import base64
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+
+# Ancho del placeholder en píxeles (el navegador lo estira y lo difumina)
+PLACEHOLDER_SIZE = 16
+
+# Orientaciones EXIF en las que la foto está girada 90º (ancho y alto cambiados)
+ROTATED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def image_metadata(fileobj):
+    """
+    Lee una imagen y devuelve (width, height, placeholder).
+
+    fileobj puede ser el fichero subido o uno abierto desde el storage.
+    Al terminar lo dejo otra vez al principio para que Django lo pueda
+    guardar normalmente.
+    """
+    fileobj.seek(0)
+    
+    with Image.open(fileobj) as image:
+        width, height = image.size
+        if image.getexif().get(ImageOps.ExifTags.Base.Orientation) in ROTATED_ORIENTATIONS:
+            width, height = height, width
+        
+        # draft() hace que Pillow decodifique el JPEG ya reducido
+        # (mucho más rápido que cargar una foto de 12 megapíxeles entera)
+        image.draft('RGB', (PLACEHOLDER_SIZE * 4, PLACEHOLDER_SIZE * 4))
+        tiny = ImageOps.exif_transpose(image).convert('RGB')
+        tiny.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+        
+        buffer = BytesIO()
+        tiny.save(buffer, format='WEBP', quality=40)
+    
+    fileobj.seek(0)
+    
+    encoded = base64.b64encode(buffer.getvalue()).decode()
+    return width, height, f'data:image/webp;base64,{encoded}'
@@ -0,0 +1,89 @@
+"""
+Comprobación de los planes de consulta (EXPLAIN QUERY PLAN) de las vistas.
+
+La idea: tener apuntadas aquí las consultas que hacen las vistas de citas
+y pedirle a SQLite cómo las va a ejecutar. Si alguna vuelve a:
+- recorrer la tabla entera ("SCAN citas_cita"), o
+- ordenar con una tabla temporal ("USE TEMP B-TREE FOR ORDER BY"),
+es que falta un índice (o alguien cambió una vista y ya no encaja con
+los de Cita.Meta.indexes).
+
+Lo usan el comando check_query_plans y los tests.
+"""
+
+from datetime import datetime, timezone
+
+from .forms import QuoteFilterForm
+from .models import Cita
+from .pagination import ORDERING, after_cursor, encode_cursor
+from . import random_draw
+
+
+# Frases del plan de SQLite que indican un problema
+BAD_PLAN_PATTERNS = (
+    'SCAN citas_',
+    'USE TEMP B-TREE FOR ORDER BY',
+)
+
+
+def _list_queryset(user, data):
+    """El queryset de quote_list con los filtros data (como request.GET)"""
+    from .views import filter_citas
+
+    citas = Cita.objects.filter(owner=user).select_related('tag')
+    form = QuoteFilterForm(data, user=user)
+    return filter_citas(citas, form).order_by(*ORDERING)
+
+
+def view_querysets(user, tema):
+    """
+    Devuelve una lista (nombre, queryset) con las consultas de las vistas.
+
+    Necesita un usuario y un tema suyo de verdad porque el formulario de
+    filtros valida que el tema exista.
+    """
+    # Una cita de mentira solo para construir un cursor de página 2
+    fake = Cita(pk=1, created_at=datetime(2026, 1, 1, tzinfo=timezone.utc))
+    cursor = encode_cursor(fake)
+
+    def page(queryset):
+        return after_cursor(queryset, cursor)
+
+    checks = [
+        ('quote_list', _list_queryset(user, {})),
+        ('quote_list (favoritas)', _list_queryset(user, {'favorite_only': 'on'})),
+        ('quote_list (con imagen)', _list_queryset(user, {'with_image_only': 'on'})),
+        ('quote_list (tema)', _list_queryset(user, {'tag': tema.pk})),
+        ('quote_list (búsqueda)', _list_queryset(user, {'q': 'hola'})),
+        ('quote_list (página 2)', page(_list_queryset(user, {}))),
+        ('quote_list (tema, página 2)', page(_list_queryset(user, {'tag': tema.pk}))),
+        ('quote_inbox', Cita.objects.filter(owner=user, tag__isnull=True)),
+    ]
+
+    scopes = [
+        random_draw.SCOPE_ALL,
+        random_draw.SCOPE_FAVORITES,
+        random_draw.SCOPE_INBOX,
+        random_draw.tema_scope(tema.pk),
+    ]
+    for scope in scopes:
+        checks.append((
+            f'quote_random ids ({scope})',
+            random_draw.scope_queryset(user.pk, scope).order_by().values_list('pk', flat=True),
+        ))
+
+    return checks
+
+
+def plan_problems(queryset):
+    """
+    Ejecuta EXPLAIN QUERY PLAN y devuelve las líneas problemáticas
+    (lista vacía si el plan está bien).
+    """
+    plan = queryset.explain()
+    return [
+        line.strip() for line in plan.splitlines()
+        if any(pattern in line for pattern in BAD_PLAN_PATTERNS)
+        # El índice FTS5 es una tabla virtual: su "SCAN" es su propio índice
+        and 'VIRTUAL TABLE' not in line
+    ]
@@ -0,0 +1,251 @@
+"""
+Motor para sacar citas aleatorias sin cargar toda la colección.
+
+Antes quote_random hacía list(Cita.objects.filter(owner=...)): traía TODAS
+las citas (con su texto entero) a memoria solo para elegir una.
+
+Ahora:
+1. Guardo en caché la lista de ids de las citas del usuario (solo ids,
+   empaquetados en un array de enteros de 8 bytes, muy compacto).
+2. Elijo un id al azar de esa lista: O(1).
+3. Cargo solo esa cita de la BD (una consulta por clave primaria).
+
+La lista de ids se guarda por "ámbito":
+- 'all': todas las citas
+- 'favorites': solo favoritas
+- 'inbox': solo las que no tienen tema
+- 'tema:<id>': las de un tema concreto
+
+Para invalidar la caché no borro claves una a una: las claves llevan
+dentro la versión de la caché del usuario, que sube cuando cambia alguna
+de sus citas o temas (ver caching.py y signals.py). Al subirla las
+antiguas dejan de usarse y la caché las acaba tirando sola.
+
+Modo "mazo" (sin repetir): barajo los ids y voy sacando uno cada vez,
+como cartas de una baraja. Cuando se acaba, vuelvo a barajar.
+El mazo va en la caché shared (la misma para todos los procesos): con la
+de cada proceso, cada worker tendría su mazo y se repetirían citas.
+"""
+
+import random
+import uuid
+from array import array
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache, caches
+
+from .caching import VERSIONS_CACHE, bump, get_version
+from .models import Cita
+
+
+# Cuánto tiempo guardo la lista de ids (segundos)
+IDS_TIMEOUT = 60 * 60
+
+# El mazo dura más: es el "progreso" del usuario
+DECK_TIMEOUT = 60 * 60 * 24 * 7
+
+# Dónde va el mazo (ver arriba)
+DECK_CACHE = VERSIONS_CACHE
+
+SCOPE_ALL = 'all'
+SCOPE_FAVORITES = 'favorites'
+SCOPE_INBOX = 'inbox'
+
+
+def tema_scope(tema_id):
+    """Nombre del ámbito para un tema concreto"""
+    return f'tema:{tema_id}'
+
+
+def scope_queryset(owner_id, scope):
+    """Queryset de las citas de un usuario dentro de un ámbito"""
+    citas = Cita.objects.filter(owner_id=owner_id)
+    
+    if scope == SCOPE_FAVORITES:
+        return citas.filter(is_favorite=True)
+    if scope == SCOPE_INBOX:
+        return citas.filter(tag__isnull=True)
+    if scope.startswith('tema:'):
+        return citas.filter(tag_id=int(scope.split(':', 1)[1]))
+    return citas
+
+
+def get_ids(owner_id, scope=SCOPE_ALL):
+    """
+    Devuelve los ids del ámbito como array('q').
+
+    Si no están en caché los saco de la BD con values_list (solo la
+    columna id, sin instanciar modelos) y los guardo.
+    """
+    key = _ids_key(owner_id, scope)
+    packed = cache.get(key)
+    
+    if packed is None:
+        ids = array('q', scope_queryset(owner_id, scope)
+                    .order_by().values_list('pk', flat=True))
+        cache.set(key, ids.tobytes(), IDS_TIMEOUT)
+        return ids
+    
+    ids = array('q')
+    ids.frombytes(packed)
+    return ids
+
+
+async def aget_ids(owner_id, scope=SCOPE_ALL):
+    """Lo mismo que get_ids con el ORM async (para async_views.py)"""
+    key = _ids_key(owner_id, scope)
+    packed = cache.get(key)
+    
+    if packed is None:
+        ids = array('q', [pk async for pk in scope_queryset(owner_id, scope)
+                          .order_by().values_list('pk', flat=True)])
+        cache.set(key, ids.tobytes(), IDS_TIMEOUT)
+        return ids
+    
+    ids = array('q')
+    ids.frombytes(packed)
+    return ids
+
+
+def _ids_key(owner_id, scope):
+    return f'citas:random:ids:{owner_id}:{scope}:{get_version(owner_id)}'
+
+
+def _deck_key(owner_id, scope):
+    return f'citas:random:deck:{owner_id}:{scope}'
+
+
+def _new_deck(version, order):
+    """
+    Un mazo: los ids en el orden en que van a salir (array('q') en bytes,
+    se guarda una vez) y la versión con la que se hizo. token es para la
+    clave de la posición: cada mazo nuevo empieza en 0.
+    """
+    return {'version': version, 'order': order.tobytes(), 'token': uuid.uuid4().hex}
+
+
+def _position_key(owner_id, scope, deck):
+    return f'{_deck_key(owner_id, scope)}:{deck["token"]}'
+
+
+def _draw_from_deck(owner_id, scope, ids):
+    """
+    Saca el siguiente id del mazo barajado del usuario.
+
+    En la caché shared guardo el mazo (ver _new_deck), y aparte la
+    posición por la que va: sacar una cita es leer el mazo y sumar 1 a
+    la posición (incr), sin volver a guardar todos los ids.
+
+    Si desde que se barajó han cambiado las citas (otra versión), no tiro
+    el mazo: quito las que ya no están de las que quedan y meto al azar
+    las nuevas. Así marcar una favorita no hace que vuelvan a salir las
+    que ya viste.
+
+    OJO: si dos peticiones rehacen el mazo a la vez, se queda uno de los
+    dos y alguna cita puede repetirse. No pasa nada grave.
+    """
+    decks = caches[DECK_CACHE]
+    key = _deck_key(owner_id, scope)
+    version = get_version(owner_id)
+    deck = decks.get(key)
+
+    if deck and deck['version'] != version:
+        order = array('q')
+        order.frombytes(deck['order'])
+        position = decks.get(_position_key(owner_id, scope, deck), 0)
+        current = set(ids)
+        new_ids = list(current.difference(order))
+        random.shuffle(new_ids)
+        remaining = array('q', [pk for pk in order[position:] if pk in current] + new_ids)
+        deck = _new_deck(version, remaining) if remaining else None
+        if deck:
+            decks.set(key, deck, DECK_TIMEOUT)
+
+    order = array('q')
+    if deck:
+        order.frombytes(deck['order'])
+        position_key = _position_key(owner_id, scope, deck)
+        decks.add(position_key, 0, DECK_TIMEOUT)
+        position = decks.incr(position_key) - 1
+        if position < len(order):
+            return order[position]
+
+    # Mazo nuevo (o terminado): barajo todos otra vez
+    order = array('q', ids)
+    random.shuffle(order)
+    deck = _new_deck(version, order)
+    decks.set(key, deck, DECK_TIMEOUT)
+    decks.set(_position_key(owner_id, scope, deck), 1, DECK_TIMEOUT)
+    return order[0]
+
+
+def draw_id(owner_id, scope=SCOPE_ALL, deck=False):
+    """
+    Como draw() pero solo devuelve el id, sin cargar la cita.
+
+    Lo uso en quote_random, que saca la tarjeta ya renderizada de la caché
+    (ver caching.py). Puede devolver el id de una cita que se acaba de
+    borrar: en ese caso hay que usar draw().
+    """
+    ids = get_ids(owner_id, scope)
+    if not ids:
+        return None
+    
+    if deck:
+        return _draw_from_deck(owner_id, scope, ids)
+    return random.choice(ids)
+
+
+async def adraw_id(owner_id, scope=SCOPE_ALL, deck=False):
+    """Lo mismo que draw_id para las vistas async"""
+    ids = await aget_ids(owner_id, scope)
+    if not ids:
+        return None
+    
+    if deck:
+        # La caché shared puede ser de ficheros o Redis (bloquean)
+        return await sync_to_async(_draw_from_deck)(owner_id, scope, ids)
+    return random.choice(ids)
+
+
+def draw(owner_id, scope=SCOPE_ALL, deck=False):
+    """
+    Devuelve una cita aleatoria del ámbito, o None si no hay ninguna.
+
+    Parámetros:
+    - owner_id: id del usuario
+    - scope: SCOPE_ALL, SCOPE_FAVORITES, SCOPE_INBOX o tema_scope(id)
+    - deck: True para el modo "sin repetir hasta agotar"
+    """
+    # Si el id elegido ya no existe (la caché iba con retraso),
+    # lo intento un par de veces más antes de rendirme
+    for _ in range(3):
+        pk = draw_id(owner_id, scope, deck)
+        if pk is None:
+            return None
+        
+        cita = (scope_queryset(owner_id, scope)
+                .select_related('tag').filter(pk=pk).first())
+        if cita:
+            return cita
+        
+        bump(owner_id)
+    
+    return None
+
+
+async def adraw(owner_id, scope=SCOPE_ALL, deck=False):
+    """Lo mismo que draw con el ORM async"""
+    for _ in range(3):
+        pk = await adraw_id(owner_id, scope, deck)
+        if pk is None:
+            return None
+        
+        cita = await (scope_queryset(owner_id, scope)
+                      .select_related('tag').filter(pk=pk).afirst())
+        if cita:
+            return cita
+        
+        bump(owner_id)
+    
+    return None
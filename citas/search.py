@@ -0,0 +1,205 @@
+"""
+Búsqueda de texto completo (FTS5 de SQLite) para las citas.
+
+Antes el buscador hacía text__icontains / source__icontains, que en SQL es
+un LIKE '%...%' y obliga a leer TODAS las filas de citas_cita en cada
+búsqueda. Ahora mantengo un índice invertido en una tabla virtual FTS5:
+
+    citas_cita_fts(text, source)  -> apunta a citas_cita por rowid = id
+
+Detalles:
+- Es una tabla "external content": no duplica el texto, solo el índice.
+- Se mantiene sola con triggers de SQLite (insert, update y delete), así
+  que funciona igual con save(), delete(), update() o bulk_create().
+- El tokenizador unicode61 con remove_diacritics quita las tildes, así que
+  "corazon" encuentra "corazón" y al revés.
+- Cada palabra se busca como prefijo: "filos" encuentra "filosofía".
+
+Si la base de datos no es SQLite (o no tiene FTS5) todo vuelve a la
+búsqueda de siempre con icontains, para no romper nada.
+
+La tabla y los triggers se crean en post_migrate (ver apps.py) y no en una
+migración normal porque, al añadir columnas, Django reconstruye la tabla
+citas_cita en SQLite y los triggers se pierden. Así se vuelven a crear
+después de cada migrate.
+"""
+
+import re
+
+from django.db import connection as default_connection, connections
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+from .models import Cita
+
+
+FTS_TABLE = 'citas_cita_fts'
+
+# Palabras de la búsqueda: letras y números (incluye tildes y ñ)
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# SQL para crear la tabla virtual y los triggers que la mantienen
+# (todo con IF NOT EXISTS para poder ejecutarlo varias veces)
+INSTALL_SQL = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        text, source,
+        content='citas_cita', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON citas_cita BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, text, source) VALUES (new.id, new.text, new.source);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON citas_cita BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text, source)
+        VALUES ('delete', old.id, old.text, old.source);
+    END
+    """,
+    # Solo cuando cambia el texto o la fuente (marcar favorita no toca el índice)
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF text, source ON citas_cita BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text, source)
+        VALUES ('delete', old.id, old.text, old.source);
+        INSERT INTO {FTS_TABLE}(rowid, text, source) VALUES (new.id, new.text, new.source);
+    END
+    """,
+]
+
+
+def is_available(connection=default_connection):
+    """
+    True si puedo usar el índice FTS5 en esta conexión.
+
+    Lo compruebo mirando sqlite_master, y guardo el resultado en la
+    conexión para no repetir la consulta en cada búsqueda.
+    """
+    if connection.vendor != 'sqlite':
+        return False
+
+    if not hasattr(connection, '_citas_fts_available'):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s",
+                [FTS_TABLE],
+            )
+            connection._citas_fts_available = cursor.fetchone() is not None
+
+    return connection._citas_fts_available
+
+
+def install(connection=default_connection):
+    """
+    Crea la tabla FTS5 y los triggers si no existen.
+
+    Si la tabla es nueva la relleno con las citas que ya había.
+    Devuelve True si el índice quedó disponible.
+    """
+    if connection.vendor != 'sqlite':
+        return False
+
+    existed = is_available(connection)
+
+    try:
+        with connection.cursor() as cursor:
+            for sql in INSTALL_SQL:
+                cursor.execute(sql)
+    except Exception:
+        # SQLite compilado sin FTS5: me quedo con icontains
+        connection._citas_fts_available = False
+        return False
+
+    connection._citas_fts_available = True
+
+    if not existed:
+        rebuild(connection)
+
+    return True
+
+
+def rebuild(connection=default_connection):
+    """
+    Reconstruye el índice entero a partir de citas_cita.
+
+    Es lo que hace el comando rebuild_search_index. Solo hace falta si
+    alguien tocó la base de datos a mano saltándose los triggers.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def match_expression(q):
+    """
+    Convierte lo que escribe el usuario en una expresión MATCH de FTS5.
+
+    "el  Corazón de" -> '"el"* "corazón"* "de"*'
+
+    - Cada palabra va entre comillas para que los caracteres especiales
+      de FTS5 (comillas, asteriscos, AND/OR...) no den error de sintaxis.
+    - El * final hace que sea búsqueda por prefijo.
+    - Varias palabras seguidas = tienen que aparecer todas (AND).
+
+    Devuelve '' si no hay ninguna palabra buscable.
+    """
+    words = WORD_RE.findall(q.lower())
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def _match_sql():
+    return f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s'
+
+
+def filter_queryset(queryset, q):
+    """
+    Filtra un queryset de citas por el texto q (en text o source).
+
+    Con FTS5: WHERE id IN (SELECT rowid FROM citas_cita_fts WHERE ... MATCH ...)
+    Sin FTS5: el icontains de siempre.
+
+    No cambia el orden del queryset, así que la paginación por cursor
+    de la lista sigue funcionando igual.
+    """
+    expression = match_expression(q)
+
+    # En la BD del queryset: con CITAS_SHARDS cada shard tiene su índice
+    if not expression or not is_available(connections[queryset.db]):
+        return queryset.filter(Q(text__icontains=q) | Q(source__icontains=q))
+
+    return queryset.filter(pk__in=RawSQL(_match_sql(), [expression]))
+
+
+def annotate_rank(queryset, q):
+    """
+    Añade search_rank a cada cita (bm25: cuanto MÁS BAJO, más relevante).
+
+    Uso una subconsulta por fila con MATCH + rowid, que FTS5 resuelve
+    directamente sin recorrer el índice entero.
+    Si no hay FTS5 pongo 0 para todas (no se puede ordenar por relevancia).
+    """
+    expression = match_expression(q)
+
+    # En la BD del queryset: con CITAS_SHARDS cada shard tiene su índice
+    if not expression or not is_available(connections[queryset.db]):
+        return queryset.annotate(search_rank=RawSQL('0', []))
+
+    # COALESCE a 0 para las filas que no casan con el texto (por ejemplo,
+    # las que encuentra el admin buscando por usuario): van al final
+    return queryset.annotate(search_rank=RawSQL(
+        f'COALESCE((SELECT rank FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s '
+        f'AND rowid = {Cita._meta.db_table}.id), 0)',
+        [expression],
+    ))
+
+
+def search(queryset, q):
+    """
+    Búsqueda completa: filtra y ordena por relevancia (las mejores primero).
+
+    Empata por -created_at para que, a igual relevancia, salgan antes las
+    más recientes.
+    """
+    queryset = filter_queryset(queryset, q)
+    return annotate_rank(queryset, q).order_by('search_rank', '-created_at')
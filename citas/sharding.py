@@ -0,0 +1,439 @@
+"""
+Reparto (sharding) de las citas entre varias bases de datos SQLite.
+
+Con una sola BD SQLite todos los usuarios escriben en el mismo fichero, y
+SQLite solo deja escribir a uno a la vez (ver el perfil de producción en
+settings.py). Con CITAS_SHARDS=N los datos de citas de cada usuario van a
+una de N bases de datos (shard_0, shard_1...), cada una con su fichero:
+
+    default   -> usuarios, sesiones, admin, Imagen y ShardUsuario
+    shard_<i> -> Tema, Cita, contadores, clasificador y cubetas
+
+Así dos usuarios en shards distintos no se esperan nunca entre ellos.
+
+Dónde va cada usuario:
+- Por defecto, por un hash de su id (jump consistent hash, ver
+  jump_hash): siempre sale lo mismo y no hace falta guardarlo.
+- Si se ha movido con `python manage.py move_user`, lo dice su fila de
+  ShardUsuario (en default). Se guarda en la caché 'shared' (la de todos
+  los procesos, ver PLACEMENT_CACHE) para no consultarla en cada petición.
+
+Cómo sabe Django a qué BD mandar cada consulta (ShardRouter):
+- Lo que no es de citas (auth, sesiones...) y Imagen: siempre default.
+- Un objeto ya cargado: a la BD de donde salió (cita.tag, tema.citas...).
+- Un objeto nuevo con owner (Cita(owner=...).save()): a la del owner.
+- user.citas.all(): a la de ese usuario.
+- Lo demás (Cita.objects.filter(...)): al shard "actual", que pone
+  ShardMiddleware en cada petición con el del usuario logueado. Fuera de
+  una petición (comandos, hilos) hay que decirlo con for_owner(owner_id)
+  o each_shard(). Si no, salta NoShardSelected (mejor eso que buscar en
+  la BD equivocada y no encontrar nada).
+
+Con CITAS_SHARDS=0 (lo normal) el router no hace nada: todo en default,
+como siempre.
+
+OJO: cada vista de citas solo ve el shard de quien la usa. En el admin
+se elige el shard con el filtro "Shard" o filtrando por usuario (ver
+ShardedAdmin en admin.py); sin nada, el del admin.
+
+OJO: Cita.owner, Tema.owner... apuntan a auth_user, que no está en los
+shards, así que no tienen FOREIGN KEY en la BD (db_constraint=False).
+Al borrar un usuario, sus datos de los shards los borra
+signals.delete_owner_data.
+"""
+
+import hashlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+
+SHARD_PREFIX = 'shard_'
+
+# Modelos de citas que NO se reparten: se quedan en default
+# (Imagen cuenta ficheros que comparten usuarios de distintos shards)
+DEFAULT_MODELS = {'imagen', 'shardusuario'}
+
+# Dónde está cada usuario se guarda PLACEMENT_TIMEOUT segundos en la caché
+# de todos los procesos (como las versiones de caching.py): move_user la
+# cambia al terminar y los workers se enteran en la siguiente petición.
+# Con la caché de cada proceso ('default') seguirían mandando al usuario
+# al shard de antes hasta que caducara
+PLACEMENT_CACHE = 'shared'
+PLACEMENT_TIMEOUT = 60
+
+# Filas que copio de cada vez al mover un usuario (menos de 999: con cada
+# trozo miro qué ids están libres con un IN, ver _copy_rows)
+COPY_BATCH = 900
+
+# El shard de la petición (o del comando) que se está ejecutando.
+# ContextVar y no threading.local: con ASGI varias peticiones comparten
+# hilo, y sync_to_async copia el contexto al hilo que ejecuta el ORM
+_current = ContextVar('citas_shard', default=None)
+
+
+class NoShardSelected(RuntimeError):
+    """Una consulta de citas sin saber a qué shard va"""
+
+
+def enabled():
+    return bool(getattr(settings, 'CITAS_SHARDS', 0))
+
+
+def shard_alias(number):
+    return f'{SHARD_PREFIX}{number}'
+
+
+def databases():
+    """Las BD donde están las citas: los shards, o solo default"""
+    if not enabled():
+        return [DEFAULT_DB_ALIAS]
+    return [shard_alias(number) for number in range(settings.CITAS_SHARDS)]
+
+
+def is_sharded(model):
+    """True si las filas de este modelo van repartidas por usuario"""
+    return model._meta.app_label == 'citas' and model._meta.model_name not in DEFAULT_MODELS
+
+
+# --- Dónde está cada usuario ---
+
+def jump_hash(key, buckets):
+    """
+    Jump consistent hash (Lamping y Veach, 2014): un número de 0 a
+    buckets - 1 para key.
+
+    Al pasar de N a N+1 shards solo cambia de sitio 1 de cada N+1
+    usuarios (los que tienen que ir al nuevo), no casi todos como con
+    key % buckets.
+    """
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def hashed_shard(owner_id, shards=None):
+    """El shard que le toca a un usuario por su id (sin mirar ShardUsuario)"""
+    # Los ids son seguidos (1, 2, 3...): los mezclo antes con blake2b
+    digest = hashlib.blake2b(str(owner_id).encode(), digest_size=8).digest()
+    return shard_alias(jump_hash(int.from_bytes(digest, 'big'), shards or settings.CITAS_SHARDS))
+
+
+def _placement_key(owner_id):
+    return f'citas:shard:{owner_id}'
+
+
+def db_for_owner(owner_id):
+    """La BD con los datos de citas de un usuario"""
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+
+    placements = caches[PLACEMENT_CACHE]
+    alias = placements.get(_placement_key(owner_id))
+    if alias is None:
+        from .models import ShardUsuario
+
+        alias = (ShardUsuario.objects.filter(owner_id=owner_id).values_list('shard', flat=True).first()
+                 or hashed_shard(owner_id))
+        placements.set(_placement_key(owner_id), alias, PLACEMENT_TIMEOUT)
+    return alias
+
+
+async def adb_for_owner(owner_id):
+    """db_for_owner desde código async (ShardMiddleware con ASGI)"""
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    # La caché shared (ficheros o Redis) también bloquea: todo a un hilo
+    return await sync_to_async(db_for_owner)(owner_id)
+
+
+# --- El shard actual ---
+
+def db():
+    """La BD de citas de lo que se está ejecutando ahora"""
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    alias = _current.get()
+    if alias is None:
+        raise NoShardSelected(
+            'Consulta de citas sin shard: usa sharding.for_owner(owner_id) '
+            'o sharding.each_shard() (o pásala por ShardMiddleware)'
+        )
+    return alias
+
+
+@contextmanager
+def using(alias):
+    """Las consultas de citas de dentro del with van a alias"""
+    token = _current.set(alias)
+    try:
+        yield alias
+    finally:
+        _current.reset(token)
+
+
+def for_owner(owner_id):
+    """Las consultas de citas de dentro del with van al shard del usuario"""
+    return using(db_for_owner(owner_id))
+
+
+def each_shard():
+    """Recorre las BD de citas con cada una como shard actual"""
+    for alias in databases():
+        with using(alias):
+            yield alias
+
+
+def by_shard(owner_ids=None):
+    """
+    Reparte owner_ids por shards: recorre los shards (cada uno como shard
+    actual) y da los ids de los usuarios que están en él.
+
+    Con owner_ids=None (todos los usuarios) da None en cada shard.
+    """
+    if owner_ids is None:
+        for _ in each_shard():
+            yield None
+        return
+
+    groups = {}
+    for owner_id in owner_ids:
+        groups.setdefault(db_for_owner(owner_id), []).append(owner_id)
+    for alias, ids in groups.items():
+        with using(alias):
+            yield ids
+
+
+class ShardRouter:
+    """Manda cada consulta a su BD (ver arriba). DATABASE_ROUTERS en settings.py"""
+
+    def _db(self, model, **hints):
+        if not enabled():
+            return None
+        if not is_sharded(model):
+            return DEFAULT_DB_ALIAS
+
+        instance = hints.get('instance')
+        if instance is not None:
+            # __class__ y no type(): request.user es un SimpleLazyObject
+            if is_sharded(instance.__class__):
+                if instance._state.db:
+                    return instance._state.db
+                owner_id = getattr(instance, 'owner_id', None)
+                if owner_id is not None:
+                    return db_for_owner(owner_id)
+            elif instance._meta.label == settings.AUTH_USER_MODEL:
+                # user.citas.all(), Cita(owner=user)
+                return db_for_owner(instance.pk)
+        return db()
+
+    db_for_read = _db
+    db_for_write = _db
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Una cita (en su shard) apunta a un usuario (en default)
+        return True if enabled() else None
+
+    def allow_migrate(self, alias, app_label, model_name=None, **hints):
+        # default tiene todas las tablas (con CITAS_SHARDS=0 es la única).
+        # Los shards, solo las de citas que se reparten
+        if not alias.startswith(SHARD_PREFIX):
+            return None
+        return app_label == 'citas' and model_name not in DEFAULT_MODELS
+
+
+class ShardMiddleware:
+    """
+    Pone como shard actual el del usuario logueado mientras dura la
+    petición (también el renderizado de la plantilla). Va después de
+    AuthenticationMiddleware.
+
+    Funciona con WSGI y con ASGI (sin pasar a un hilo, como los
+    middlewares de Django).
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not request.user.is_authenticated:
+            return self.get_response(request)
+        with for_owner(request.user.pk):
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        user = await request.auser()
+        if not user.is_authenticated:
+            return await self.get_response(request)
+        with using(await adb_for_owner(user.pk)):
+            return await self.get_response(request)
+
+
+# --- Mover usuarios de shard (move_user) ---
+
+def _owner_tables():
+    """(modelo, filas del usuario) en el orden en que se copian"""
+    from .models import ContadorTema, ContadorUsuario, Cita, CubetaImagen, CubetaLSH, Tema
+
+    return [
+        (Tema, 'owner_id = %s'),
+        (ContadorTema, f'tema_id IN (SELECT id FROM {Tema._meta.db_table} WHERE owner_id = %s)'),
+        (Cita, 'owner_id = %s'),
+        (ContadorUsuario, 'owner_id = %s'),
+        (CubetaLSH, 'owner_id = %s'),
+        (CubetaImagen, 'owner_id = %s'),
+    ]
+
+
+def delete_rows(alias, owner_id):
+    """Borra todo lo del usuario en alias (SQL directo: sin señales)"""
+    from .models import ClasificadorTemas
+
+    tables = [*_owner_tables(), (ClasificadorTemas, 'owner_id = %s')]
+    with connections[alias].cursor() as cursor:
+        for model, where in reversed(tables):
+            cursor.execute(f'DELETE FROM {model._meta.db_table} WHERE {where}', [owner_id])
+
+
+def _copy_rows(source, target, model, where, owner_id, remap):
+    """
+    Copia las filas de model del usuario de source a target, con SQL
+    directo (sin señales, y sin que auto_now_add pise created_at).
+
+    Las ForeignKey de remap ({columna: {id antiguo: id nuevo}}) se
+    cambian por los ids nuevos.
+
+    Si la clave primaria es un id autoincremental, cada fila se queda con
+    su id si en target está libre (así no cambian los enlaces a
+    /citas/edit/<id>/). Pero los ids de cada shard van por separado y el
+    de antes puede ser de otro usuario de target: esas filas se insertan
+    sin id y target pone uno nuevo. Devuelve {id antiguo: id nuevo} de
+    las que han cambiado.
+
+    OJO: meter ids a mano solo vale porque Django crea las tablas de
+    SQLite con AUTOINCREMENT: los ids que ponga después target siempre
+    son mayores que el mayor que haya habido, así que no chocan con
+    estos. (Con PostgreSQL habría que mover la secuencia.)
+    """
+    pk = model._meta.pk
+    auto_id = pk.column == 'id'
+    columns = [field.column for field in model._meta.concrete_fields if not (auto_id and field.primary_key)]
+    quote = connections[target].ops.quote_name
+    table = quote(model._meta.db_table)
+
+    def insert(columns):
+        return (f'INSERT INTO {table} ({", ".join(map(quote, columns))}) '
+                f'VALUES ({", ".join(["%s"] * len(columns))})')
+
+    renumbered = {}
+    with connections[source].cursor() as read, connections[target].cursor() as write:
+        read.execute(
+            f'SELECT {quote(pk.column)}, {", ".join(map(quote, columns))} FROM {table} '
+            f'WHERE {where} ORDER BY {quote(pk.column)}',
+            [owner_id],
+        )
+        while rows := read.fetchmany(COPY_BATCH):
+            values = [list(row[1:]) for row in rows]
+            for i, column in enumerate(columns):
+                if column in remap:
+                    for row in values:
+                        row[i] = remap[column].get(row[i], row[i])
+
+            if not auto_id:
+                write.executemany(insert(columns), values)
+                continue
+
+            old_ids = [row[0] for row in rows]
+            write.execute(
+                f'SELECT id FROM {table} WHERE id IN ({", ".join(["%s"] * len(old_ids))})', old_ids
+            )
+            taken = {row[0] for row in write.fetchall()}
+            write.executemany(insert(['id', *columns]), [
+                [old_id, *row] for old_id, row in zip(old_ids, values) if old_id not in taken
+            ])
+            # Las que chocan, de una en una para saber el id que les toca
+            for old_id, row in zip(old_ids, values):
+                if old_id in taken:
+                    write.execute(insert(columns), row)
+                    renumbered[old_id] = write.lastrowid
+    return renumbered
+
+
+def move_owner(owner_id, target, source=None):
+    """
+    Mueve los datos de citas de un usuario a otro shard. Devuelve
+    (citas movidas, citas que han cambiado de id).
+
+    source es donde están ahora (por defecto, donde dice db_for_owner).
+    Hace falta al cambiar CITAS_SHARDS: el hash ya da el shard nuevo pero
+    los datos siguen en el de antes.
+
+    1. Copia sus filas a target en una transacción (con los mismos ids
+       si están libres, ver _copy_rows)
+    2. Apunta en ShardUsuario que ahora está en target
+    3. Borra sus filas del shard de antes
+
+    Si se corta a mitad, se vuelve a ejecutar y ya está: lo que hubiera
+    quedado copiado en target se borra antes de copiar.
+
+    OJO: las citas cuyo id ya es de otra cita en target cambian de id
+    (sus enlaces a /citas/edit/<id>/ dejan de valer; move_user dice
+    cuántas) y el clasificador de temas se vuelve a entrenar. Lo que el
+    usuario guarde MIENTRAS se mueve puede quedarse en el shard de antes:
+    mejor hacerlo con la web parada o el usuario sin sesión.
+    """
+    from . import caching, related
+    from .models import Cita, ShardUsuario, Tema
+
+    source = source or db_for_owner(owner_id)
+    if source == target:
+        return 0, 0
+
+    # Si en source no hay nada (ya se movió, p. ej. al repetir --rebalance)
+    # solo apunto dónde está. Si no, ¡borraría lo que ya hay en target!
+    moved = renumbered = 0
+    if (Tema.objects.using(source).filter(owner_id=owner_id).exists()
+            or Cita.objects.using(source).filter(owner_id=owner_id).exists()):
+        with transaction.atomic(using=target):
+            delete_rows(target, owner_id)
+            remap = {}
+            for model, where in _owner_tables():
+                ids = _copy_rows(source, target, model, where, owner_id, remap)
+                if model is Tema:
+                    remap['tag_id'] = remap['tema_id'] = ids
+                elif model is Cita:
+                    remap['cita_id'] = ids
+            moved = Cita.objects.using(target).filter(owner_id=owner_id).count()
+            renumbered = len(remap.get('cita_id', {}))
+
+    # Desde aquí las peticiones del usuario ya van a target
+    if target == hashed_shard(owner_id):
+        ShardUsuario.objects.filter(owner_id=owner_id).delete()
+    else:
+        ShardUsuario.objects.update_or_create(owner_id=owner_id, defaults={'shard': target})
+    caches[PLACEMENT_CACHE].set(_placement_key(owner_id), target, PLACEMENT_TIMEOUT)
+
+    with transaction.atomic(using=source):
+        delete_rows(source, owner_id)
+
+    # Algunos ids pueden haber cambiado: fuera lo que los tenga guardados
+    caching.bump(owner_id)
+    related.invalidate([owner_id])
+    return moved, renumbered
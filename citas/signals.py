@@ -0,0 +1,389 @@
+"""
+Señales de la app citas.
+
+Aquí reacciono a los cambios en Cita y Tema (guardar, borrar) para
+mantener al día las cosas que dependen de ellos:
+- la caché del usuario (tarjetas, listas de ids, citas aleatorias)
+- la cuenta de referencias de los ficheros de imagen
+- los contadores de citas (ver counters.py)
+- el clasificador que sugiere temas (ver suggestions.py)
+- las huellas para encontrar citas casi repetidas (ver duplicates.py)
+- el hash de la imagen para encontrar imágenes repetidas (ver perceptual.py)
+- los vectores de "citas parecidas" (ver related.py)
+- las otras pestañas abiertas del usuario (ver events.py)
+
+Y a los usuarios borrados: con CITAS_SHARDS sus citas están en otra BD
+(ver sharding.py).
+
+bulk_create() y update() no lanzan post_save, así que el código que
+cambia muchas citas de golpe (por ejemplo import_citas) envía al terminar
+la señal citas_bulk_changed con los usuarios afectados.
+
+Se conectan al arrancar la app (ver CitasConfig.ready en apps.py).
+"""
+
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_init, post_save, pre_delete
+from django.dispatch import Signal, receiver
+
+from . import bulk, caching, counters, duplicates, events, image_refs, perceptual, related, sharding, suggestions
+from .models import Cita, ContadorTema, Tema
+
+
+# Se envía después de crear/cambiar/borrar citas en bloque
+# Argumentos: owner_ids (los usuarios cuyas citas han cambiado)
+citas_bulk_changed = Signal()
+
+
+@receiver(citas_bulk_changed)
+def recount_bulk(sender, owner_ids, **kwargs):
+    """
+    Después de un cambio en bloque no sé qué ha cambiado en cada cita:
+    recalculo los contadores de esos usuarios (un aggregate por usuario)
+    """
+    for owner_id in owner_ids:
+        with sharding.for_owner(owner_id):
+            counters.recount(owner_id)
+
+
+@receiver(citas_bulk_changed)
+def invalidate_suggestions_bulk(sender, owner_ids, **kwargs):
+    """Y el clasificador de temas se vuelve a entrenar cuando haga falta"""
+    suggestions.invalidate(owner_ids)
+
+
+@receiver(citas_bulk_changed)
+def index_minhash_bulk(sender, owner_ids, **kwargs):
+    """Huellas de las citas nuevas (bulk_create no las calcula)"""
+    duplicates.index_missing(owner_ids)
+
+
+@receiver(citas_bulk_changed)
+def index_vectors_bulk(sender, owner_ids, **kwargs):
+    """Y sus vectores de citas parecidas"""
+    related.index_missing(owner_ids)
+
+
+@receiver(citas_bulk_changed)
+def publish_resync_bulk(sender, owner_ids, **kwargs):
+    """Las pestañas abiertas no saben qué ha cambiado: que recarguen"""
+    for owner_id in owner_ids:
+        events.publish(owner_id, events.RESYNC)
+
+
+@receiver(post_save, sender=Cita)
+def publish_cita_change(sender, instance, created, **kwargs):
+    """
+    Las otras pestañas del usuario se enteran del cambio (ver events.py).
+    Con el tema: el inbox quita la tarjeta si ya tiene.
+    """
+    events.publish(instance.owner_id, events.CREATED if created else events.UPDATED,
+                   id=instance.pk, tag=instance.tag_id)
+
+
+@receiver(post_delete, sender=Cita)
+def publish_cita_deleted(sender, instance, **kwargs):
+    events.publish(instance.owner_id, events.DELETED, id=instance.pk)
+
+
+@receiver(post_save, sender=Tema)
+@receiver(post_delete, sender=Tema)
+def publish_tema_change(sender, instance, created=False, **kwargs):
+    """
+    Renombrar o borrar un tema cambia muchas tarjetas: resync.
+    (Un tema nuevo todavía no sale en ninguna)
+    """
+    if not created:
+        events.publish(instance.owner_id, events.RESYNC)
+
+
+def _image_name(value):
+    """El nombre del fichero, venga como texto o como FieldFile"""
+    return getattr(value, 'name', value) or ''
+
+
+@receiver(post_init, sender=Cita)
+def remember_image(sender, instance, **kwargs):
+    """
+    Apunto qué imagen tenía la cita al cargarla, para saber en post_save
+    si ha cambiado.
+
+    Miro __dict__ directamente para no provocar una consulta si el campo
+    es diferido (.only(...)); en ese caso lo dejo en None = "no lo sé".
+    """
+    if 'image' in instance.__dict__:
+        instance._original_image = _image_name(instance.__dict__['image'])
+    else:
+        instance._original_image = None
+    
+    # Y lo que cuenta para los contadores (si no se ha cargado, None)
+    # Las citas nuevas (sin pk) todavía no cuentan para nada
+    instance._counted = counters.snapshot(instance) if instance.pk else None
+    
+    # Y lo que ve el clasificador de temas: (tema, texto, fuente)
+    instance._classified = suggestions.snapshot(instance) if instance.pk else None
+    
+    # Y el texto, para saber si hay que recalcular su huella MinHash
+    instance._original_text = instance.__dict__.get('text') if instance.pk else None
+    
+    # Y el hash de la imagen, para saber si alguien (el formulario) ya lo ha calculado
+    instance._original_dhash = instance.__dict__.get('image_dhash') if instance.pk else None
+
+
+@receiver(post_save, sender=Cita)
+def update_image_dhash(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Si la cita estrena imagen, guarda su hash perceptual y sus cubetas
+    (ver perceptual.py).
+    
+    QuoteForm ya lo calcula al validar (tiene el fichero abierto). Si la
+    imagen viene de otro sitio (el admin, el shell...) y nadie ha tocado
+    image_dhash, lo calculo aquí abriendo el fichero.
+    
+    OJO: tiene que ir ANTES que update_image_refs, que cambia
+    _original_image al terminar.
+    """
+    if update_fields is not None and 'image' not in update_fields:
+        return
+    
+    old = '' if created else instance._original_image
+    new = _image_name(instance.image)
+    
+    if old is None or old == new:
+        return
+    
+    if not new:
+        instance.image_dhash = None
+    elif instance.image_dhash is None or (not created and instance.image_dhash == instance._original_dhash):
+        try:
+            with instance.image.storage.open(new) as fileobj:
+                instance.image_dhash = perceptual.dhash(fileobj)
+        except (OSError, ValueError):
+            instance.image_dhash = None
+    
+    perceptual.index_cita(instance)
+    instance._original_dhash = instance.image_dhash
+
+
+@receiver(post_save, sender=Cita)
+def update_image_refs(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Si la cita estrena imagen, suma una referencia a la nueva y resta
+    una a la anterior (que se borra si ya no la usa nadie).
+    """
+    if update_fields is not None and 'image' not in update_fields:
+        return
+    
+    old = '' if created else instance._original_image
+    new = _image_name(instance.image)
+    
+    if old == new:
+        # Se ha vuelto a subir la misma imagen: la referencia que ha
+        # tomado storage.py (image_refs.hold) sobra
+        image_refs.drop_hold(new)
+        return
+    if old is None:
+        return
+    
+    image_refs.acquire(new)
+    image_refs.release(old)
+    instance._original_image = new
+
+
+@receiver(post_delete, sender=Cita)
+def release_image_ref(sender, instance, **kwargs):
+    """Al borrar una cita, su imagen tiene una referencia menos"""
+    image_refs.release(_image_name(instance.image))
+
+
+@receiver(post_save, sender=Cita)
+def update_counters(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Suma/resta en los contadores la diferencia entre lo que contaba la
+    cita antes y lo que cuenta ahora.
+    """
+    new = counters.snapshot(instance)
+    old = None if created else instance._counted
+    
+    if new is None or (old is None and not created):
+        # No sé cómo estaba (o cómo está): recalculo el usuario entero
+        counters.recount(instance.owner_id)
+    else:
+        if update_fields is not None and old is not None:
+            # Con update_fields solo se guardan esos campos: el resto sigue
+            # en la BD como estaba aunque en memoria sea distinto
+            new = tuple(
+                new[i] if field in update_fields else old[i]
+                for i, field in enumerate(('owner', 'tag', 'is_favorite', 'image'))
+            )
+        counters.apply_change(old, new)
+    
+    instance._counted = counters.snapshot(instance)
+
+
+@receiver(post_delete, sender=Cita)
+def discount_cita(sender, instance, **kwargs):
+    """Al borrar una cita, resto lo que contaba"""
+    old = getattr(instance, '_counted', None) or counters.snapshot(instance)
+    if old is not None:
+        counters.apply_change(old, None)
+
+
+@receiver(post_save, sender=Cita)
+def update_suggestions(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Si la cita cambia de tema (o de texto y tiene tema), el clasificador
+    lo aprende: resta lo de antes y suma lo de ahora.
+    
+    Marcar favorita, cambiar la imagen... no le importan, y las citas que
+    siguen en el inbox tampoco (ver suggestions.record_changes).
+    
+    OJO: una cita cargada con .only(...) se guarda solo con sus campos
+    cargados (update_fields). Si entre ellos no está ni el tema ni el
+    texto ni la fuente, no hay nada que aprender.
+    """
+    if update_fields is not None and not {'tag', 'tag_id', 'text', 'source'} & set(update_fields):
+        return
+    
+    new = suggestions.snapshot(instance)
+    old = None if created else instance._classified
+    
+    if new is None or (old is None and not created):
+        # No sé qué había antes. Entrenarlo entero aquí sería leer todas
+        # sus citas en medio de la petición: lo tiro y se vuelve a
+        # entrenar cuando haga falta (como después de import_citas)
+        suggestions.invalidate([instance.owner_id])
+    else:
+        if update_fields is not None and old is not None:
+            new = tuple(
+                new[i] if field in update_fields else old[i]
+                for i, field in enumerate(('tag', 'text', 'source'))
+            )
+        suggestions.record_changes(instance.owner_id, [(old, new)])
+    
+    instance._classified = suggestions.snapshot(instance)
+
+
+@receiver(post_delete, sender=Cita)
+def unlearn_cita(sender, instance, **kwargs):
+    """Al borrar una cita con tema, el clasificador la olvida"""
+    old = getattr(instance, '_classified', None) or suggestions.snapshot(instance)
+    if old is not None:
+        suggestions.record_changes(instance.owner_id, [(old, None)])
+
+
+@receiver(post_save, sender=Cita)
+def update_text_vector(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Si el texto ha cambiado, recalculo su vector de citas parecidas.
+    
+    OJO: tiene que ir ANTES que update_text_minhash, que cambia
+    _original_text al terminar.
+    """
+    if update_fields is not None and 'text' not in update_fields:
+        return
+    if 'text' not in instance.__dict__:
+        return
+    if created and not instance.text:
+        return
+    if not created and instance._original_text == instance.text:
+        return
+    
+    related.index_cita(instance)
+
+
+@receiver(post_delete, sender=Cita)
+def forget_text_vector(sender, instance, **kwargs):
+    """Una cita borrada ya no sale como parecida"""
+    related.forget(instance.owner_id, [instance.pk])
+
+
+@receiver(post_save, sender=Cita)
+def update_text_minhash(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Si el texto ha cambiado, recalculo su huella y sus cubetas LSH.
+    (Al borrar la cita las cubetas se borran solas, por el CASCADE)
+    """
+    if update_fields is not None and 'text' not in update_fields:
+        return
+    if 'text' not in instance.__dict__:
+        return
+    if created and not instance.text:
+        return
+    if not created and instance._original_text == instance.text:
+        return
+    
+    duplicates.index_cita(instance)
+    instance._original_text = instance.text
+
+
+@receiver(post_delete, sender=Tema)
+def forget_tema_suggestions(sender, instance, **kwargs):
+    """Un tema borrado no se puede sugerir"""
+    suggestions.forget_tema(instance.owner_id, instance.pk)
+
+
+@receiver(post_save, sender=Tema)
+def create_tema_counter(sender, instance, created, **kwargs):
+    """Los temas nuevos empiezan con 0 citas"""
+    if created:
+        ContadorTema.objects.get_or_create(tema=instance)
+
+
+@receiver(pre_delete, sender=Tema)
+def move_tema_citas_to_inbox(sender, instance, **kwargs):
+    """
+    Al borrar un tema sus citas se quedan sin tema (SET_NULL), pero Django
+    lo hace con un UPDATE, sin save(): las sumo yo al inbox.
+    (El ContadorTema se borra solo, por el CASCADE)
+    """
+    counters.add_to_inbox(instance.owner_id, instance.citas.count())
+
+
+@receiver(pre_delete, sender=User)
+def delete_owner_data(sender, instance, **kwargs):
+    """
+    Con CITAS_SHARDS las citas del usuario están en su shard y el CASCADE
+    de Django no las ve (las busca en default, donde está el usuario):
+    las borro yo. Las citas con bulk.delete (imágenes, contadores...) y
+    el resto (temas, contadores, clasificador) con SQL directo.
+    
+    Sin shards no hace falta: lo hace el CASCADE.
+    """
+    if not sharding.enabled():
+        return
+    
+    with sharding.for_owner(instance.pk):
+        ids = list(Cita.objects.filter(owner_id=instance.pk).values_list('pk', flat=True))
+        bulk.delete(instance.pk, ids)
+        sharding.delete_rows(sharding.db(), instance.pk)
+
+
+# --- La versión de la caché: lo ÚLTIMO ---
+# Los receivers se ejecutan en el orden en que se conectan. Si la versión
+# sube antes de cambiar los contadores, otra petición puede leer el
+# contador viejo entre medias y guardarlo en caché con la versión nueva
+# (y ahí se queda hasta el siguiente cambio). Por eso van al final del
+# módulo, y bump() la vuelve a subir al confirmar la transacción.
+
+@receiver(post_save, sender=Cita)
+@receiver(post_delete, sender=Cita)
+@receiver(post_save, sender=Tema)
+@receiver(post_delete, sender=Tema)
+def bump_cache_version(sender, instance, using=None, **kwargs):
+    """
+    Cualquier cambio en las citas o temas de un usuario invalida todo lo
+    que tiene en caché: tarjetas, listas de ids, ids de las aleatorias,
+    contadores...
+
+    (Al borrar o renombrar un tema cambian sus citas: el inbox, el nombre
+    en la tarjeta... por eso también escucho a Tema)
+    """
+    caching.bump(instance.owner_id, using=using)
+
+
+@receiver(citas_bulk_changed)
+def bump_cache_version_bulk(sender, owner_ids, **kwargs):
+    """Lo mismo para los cambios en bloque (después de recount_bulk)"""
+    for owner_id in owner_ids:
+        caching.bump(owner_id)
@@ -0,0 +1,142 @@
+"""
+Almacenamiento de imágenes por contenido (deduplicado).
+
+Antes cada subida se guardaba con su nombre en media/quotes/, así que el
+mismo meme subido diez veces eran diez ficheros iguales (foto.jpg,
+foto_AbC123.jpg, foto_XyZ789.jpg...).
+
+Ahora el nombre del fichero es el hash SHA-256 de su contenido:
+
+    quotes/3f/a2/3fa2c1...e9.jpg
+
+- Si se sube una imagen que ya existe, el hash sale igual y no escribo
+  nada: la cita apunta al fichero que ya había. (Antes de mirar si existe
+  tomo la referencia de la cita, ver image_refs.hold: si no, otra
+  petición podría borrarlo justo después)
+- Las dos primeras parejas del hash hacen de subcarpetas para que no
+  acaben cientos de miles de ficheros en la misma carpeta.
+- El hash se calcula leyendo la subida por trozos (chunks), sin cargarla
+  entera en memoria.
+
+Cuántas citas usan cada fichero lo lleva el modelo Imagen (ver signals.py):
+el fichero solo se borra cuando ya no lo usa ninguna.
+
+Para pasar las imágenes antiguas a este formato: python manage.py dedupe_images
+"""
+
+import hashlib
+import os
+import posixpath
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+def content_hash(content):
+    """SHA-256 (en hexadecimal) de un fichero, leyéndolo por trozos"""
+    digest = hashlib.sha256()
+
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    for chunk in content.chunks():
+        digest.update(chunk)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+
+    return digest.hexdigest()
+
+
+def hashed_name(directory, digest, original_name):
+    """
+    Ruta por contenido: <directory>/ab/cd/abcd....<ext>
+
+    Mantengo la extensión original (en minúsculas) para que el servidor
+    web sirva el Content-Type correcto.
+    """
+    extension = posixpath.splitext(original_name)[1].lower()
+    return posixpath.join(directory, digest[:2], digest[2:4], f'{digest}{extension}')
+
+
+def is_hashed_name(name):
+    """True si name ya tiene el formato quotes/ab/cd/<sha256>.ext"""
+    parts = name.split('/')
+    if len(parts) < 3:
+        return False
+
+    digest = posixpath.splitext(parts[-1])[0]
+    return (
+        len(digest) == 64
+        and parts[-3] == digest[:2]
+        and parts[-2] == digest[2:4]
+        and all(c in '0123456789abcdef' for c in digest)
+    )
+
+
+@deconstructible
+class HashedImageStorage(FileSystemStorage):
+    """
+    FileSystemStorage que guarda cada fichero con el nombre de su hash.
+    """
+
+    def save(self, name, content, max_length=None):
+        """
+        Guarda content y devuelve la ruta por contenido.
+
+        name solo se usa para saber la carpeta (la del upload_to) y la
+        extensión. Si el fichero ya existe no se vuelve a escribir.
+
+        Solo lo llama FileField al guardar una cita, así que aquí se toma
+        ya su referencia (ver image_refs.hold).
+        """
+        # Aquí y no arriba: image_refs importa models, que importa este módulo
+        from .image_refs import hold
+
+        if name is None:
+            name = content.name
+
+        digest = content_hash(content)
+        name = hashed_name(posixpath.dirname(name), digest, name)
+
+        hold(name)
+        if self.exists(name):
+            return name
+
+        return self._save(name, content)
+
+    def _save(self, name, content):
+        """
+        Escribo en un fichero temporal y lo muevo al final con os.replace.
+
+        Así, si dos peticiones suben la misma imagen a la vez, nadie ve
+        nunca un fichero a medio escribir (y como el contenido es el mismo,
+        da igual cuál de las dos gane).
+        """
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.upload')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                for chunk in content.chunks():
+                    temp_file.write(chunk)
+
+            if self.file_permissions_mode is not None:
+                os.chmod(temp_path, self.file_permissions_mode)
+
+            os.replace(temp_path, full_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        return name
+
+
+def get_image_storage():
+    """
+    Storage de Cita.image (la uso como callable para que la migración no
+    dependa de MEDIA_ROOT)
+    """
+    return HashedImageStorage()
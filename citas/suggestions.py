@@ -0,0 +1,428 @@
+"""
+Sugerencias de tema para las citas del inbox.
+
+Cada usuario tiene su propio "clasificador", aprendido de sus citas que ya
+tienen tema: qué palabras (del texto y de la fuente) suelen salir en cada
+tema. Para una cita del inbox busco los temas que más se le parecen y los
+enseño como botones en la tarjeta.
+
+Cómo funciona (TF-IDF + centroide más cercano):
+- Cada cita es un vector de palabras: 1 + log(veces que sale), dividido
+  por su longitud para que las citas largas no pesen más.
+  Las palabras de la fuente van aparte ("@nietzsche"): el autor dice mucho.
+- Cada tema guarda la SUMA de los vectores de sus citas (su centroide) y
+  en cuántas de sus citas sale cada palabra.
+- Al sugerir, cada palabra pesa según lo rara que es (IDF: las que salen
+  en todas las citas no ayudan a distinguir) y comparo la cita con cada
+  tema con el coseno. Los temas con más puntuación son las sugerencias.
+
+Como solo guardo sumas, aprender es sumar y olvidar es restar: cuando una
+cita cambia de tema resto su vector del tema viejo y lo sumo al nuevo, sin
+volver a leer todas las citas (ver las señales en signals.py y bulk.py).
+
+Todo son arrays de NumPy (una matriz dispersa en formato "coordenadas":
+fila = tema, columna = palabra) guardados comprimidos en
+ClasificadorTemas.data. Puntuar una página entera del inbox son unas pocas
+operaciones con arrays: milisegundos.
+
+Si falta el de un usuario (o algo lo ha dejado inservible), se entrena la
+primera vez que se necesita. Para rehacerlos: python manage.py train_suggestions
+"""
+
+import io
+import re
+import unicodedata
+from collections import Counter
+
+import numpy as np
+from django.db import transaction
+
+from . import sharding
+from .models import Cita, ClasificadorTemas, Tema
+
+
+# Cuántos temas sugiero por cita, y la puntuación mínima (coseno, 0 a 1)
+# para sugerir uno: por debajo es más ruido que otra cosa
+SUGGESTIONS = 3
+MIN_SCORE = 0.05
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Palabras tan comunes que no dicen nada del tema (ya sin tildes)
+STOPWORDS = frozenset('''
+    las los una uno unos unas del por para con sin sobre entre hasta desde
+    que como cuando donde quien cual cuyo pero porque aunque sino mas
+    este esta esto estos estas ese esa eso esos esas aquel aquella
+    mas muy tan tanto todo toda todos todas nada algo alguien nadie
+    ser estar haber tener hacer son era fue sea hay han has habia tiene
+    mis tus sus nos les ella ellos ellas usted ustedes nuestro vuestro
+    the and for with that this from are was you your not but have all
+'''.split())
+
+
+def _normalize(value):
+    """En minúsculas y sin tildes ("Corazón" -> "corazon")"""
+    value = unicodedata.normalize('NFKD', (value or '').lower())
+    return ''.join(char for char in value if not unicodedata.combining(char))
+
+
+def features(text, source):
+    """Las palabras de una cita: {palabra: veces}"""
+    terms = Counter(
+        word for word in WORD_RE.findall(_normalize(text))
+        if len(word) > 2 and not word.isdigit() and word not in STOPWORDS
+    )
+    for word in WORD_RE.findall(_normalize(source)):
+        terms['@' + word] += 1
+    return terms
+
+
+def doc_vector(text, source):
+    """{palabra: peso} de una cita, con longitud 1 (vacío si no hay palabras)"""
+    weights = {term: 1 + np.log(count) for term, count in features(text, source).items()}
+    length = np.sqrt(sum(weight * weight for weight in weights.values()))
+    return {term: weight / length for term, weight in weights.items()}
+
+
+def snapshot(cita):
+    """
+    Lo que le importa al clasificador de una cita: (tag_id, text, source).
+
+    Como counters.snapshot: None si alguno no está cargado, para no hacer
+    una consulta por cita.
+    """
+    values = cita.__dict__
+    if not all(field in values for field in ('tag_id', 'text', 'source')):
+        return None
+    return (values['tag_id'], values['text'] or '', values['source'] or '')
+
+
+class Classifier:
+    """
+    El clasificador de un usuario.
+
+    - terms: las palabras (la columna de cada una es su posición)
+    - tema_ids: los temas (la fila de cada uno es su posición)
+    - tema_docs: cuántas citas tiene cada tema
+    - rows, cols, weights, counts: la matriz dispersa. Para cada par
+      (tema, palabra) que existe: la suma de los pesos de la palabra en las
+      citas del tema y en cuántas de esas citas sale.
+    """
+
+    def __init__(self, terms=(), tema_ids=(), tema_docs=(), rows=(), cols=(), weights=(), counts=()):
+        self.terms = list(terms)
+        self.term_index = {term: col for col, term in enumerate(self.terms)}
+        self.tema_ids = [int(pk) for pk in tema_ids]
+        self.tema_index = {pk: row for row, pk in enumerate(self.tema_ids)}
+        self.tema_docs = np.asarray(tema_docs, dtype=np.int32)
+        self.rows = np.asarray(rows, dtype=np.int32)
+        self.cols = np.asarray(cols, dtype=np.int32)
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.counts = np.asarray(counts, dtype=np.int32)
+
+    # --- Guardar y cargar ---
+
+    def to_bytes(self):
+        """
+        Todo en un .npz comprimido. Las palabras que ya no salen en ningún
+        tema (citas borradas o cambiadas) no se guardan.
+        """
+        used = np.unique(self.cols)
+        new_col = np.zeros(len(self.terms), dtype=np.int32)
+        new_col[used] = np.arange(len(used), dtype=np.int32)
+
+        terms = '\n'.join(self.terms[col] for col in used).encode()
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            terms=np.frombuffer(terms, dtype=np.uint8),
+            tema_ids=np.asarray(self.tema_ids, dtype=np.int64),
+            tema_docs=self.tema_docs,
+            rows=self.rows,
+            cols=new_col[self.cols],
+            weights=self.weights,
+            counts=self.counts,
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        arrays = np.load(io.BytesIO(data))
+        terms = arrays['terms'].tobytes().decode()
+        return cls(
+            terms=terms.split('\n') if terms else [],
+            tema_ids=arrays['tema_ids'].tolist(),
+            tema_docs=arrays['tema_docs'],
+            rows=arrays['rows'],
+            cols=arrays['cols'],
+            weights=arrays['weights'],
+            counts=arrays['counts'],
+        )
+
+    # --- Aprender ---
+
+    def _row(self, tema_id):
+        if tema_id not in self.tema_index:
+            self.tema_index[tema_id] = len(self.tema_ids)
+            self.tema_ids.append(tema_id)
+        return self.tema_index[tema_id]
+
+    def _col(self, term):
+        if term not in self.term_index:
+            self.term_index[term] = len(self.terms)
+            self.terms.append(term)
+        return self.term_index[term]
+
+    def update(self, changes):
+        """
+        Aprende de citas que han cambiado. changes son pares (old, new) de
+        snapshots (None = la cita no existía / ya no existe): lo de old se
+        resta de su tema y lo de new se suma al suyo.
+
+        Devuelve True si ha cambiado algo.
+        """
+        rows, cols, weights, counts = [], [], [], []
+        docs = Counter()
+
+        for old, new in changes:
+            for doc, sign in ((old, -1), (new, 1)):
+                if doc is None or doc[0] is None:
+                    continue
+                tag_id, text, source = doc
+                vector = doc_vector(text, source)
+                if not vector:
+                    continue
+
+                row = self._row(tag_id)
+                docs[row] += sign
+                for term, weight in vector.items():
+                    rows.append(row)
+                    cols.append(self._col(term))
+                    weights.append(sign * weight)
+                    counts.append(sign)
+
+        if not rows:
+            return False
+
+        tema_docs = np.zeros(len(self.tema_ids), dtype=np.int32)
+        tema_docs[:len(self.tema_docs)] = self.tema_docs
+        for row, delta in docs.items():
+            tema_docs[row] = max(tema_docs[row] + delta, 0)
+        self.tema_docs = tema_docs
+
+        self._merge(
+            np.concatenate([self.rows, np.asarray(rows, dtype=np.int32)]),
+            np.concatenate([self.cols, np.asarray(cols, dtype=np.int32)]),
+            np.concatenate([self.weights, np.asarray(weights, dtype=np.float32)]),
+            np.concatenate([self.counts, np.asarray(counts, dtype=np.int32)]),
+        )
+        return True
+
+    def _merge(self, rows, cols, weights, counts):
+        """
+        Junta las entradas repetidas (mismo tema y palabra) sumándolas, y
+        quita las que se quedan a 0 (ninguna cita del tema tiene la palabra).
+        """
+        width = max(len(self.terms), 1)
+        keys = rows.astype(np.int64) * width + cols
+        keys, position = np.unique(keys, return_inverse=True)
+
+        counts = np.bincount(position, weights=counts, minlength=len(keys)).round().astype(np.int32)
+        weights = np.bincount(position, weights=weights, minlength=len(keys)).astype(np.float32)
+        keep = counts > 0
+
+        self.rows = (keys[keep] // width).astype(np.int32)
+        self.cols = (keys[keep] % width).astype(np.int32)
+        self.weights = np.maximum(weights[keep], 0)
+        self.counts = counts[keep]
+
+    def forget_tema(self, tema_id):
+        """Olvida un tema borrado (sus citas pasan al inbox)"""
+        row = self.tema_index.get(tema_id)
+        if row is None or row >= len(self.tema_docs):
+            return False
+        keep = self.rows != row
+        self.rows, self.cols = self.rows[keep], self.cols[keep]
+        self.weights, self.counts = self.weights[keep], self.counts[keep]
+        self.tema_docs[row] = 0
+        return True
+
+    # --- Sugerir ---
+
+    def suggest(self, docs, k=SUGGESTIONS, min_score=MIN_SCORE):
+        """
+        Los k temas que más se parecen a cada cita.
+
+        docs es una lista de (text, source). Devuelve, para cada una, una
+        lista de (tema_id, puntuación) de mayor a menor.
+        """
+        results = [[] for _ in docs]
+        n_temas = len(self.tema_ids)
+        if not docs or not len(self.rows):
+            return results
+
+        # IDF de cada palabra con las citas clasificadas
+        n_docs = int(self.tema_docs.sum())
+        df = np.bincount(self.cols, weights=self.counts, minlength=len(self.terms))
+        idf = np.log((1 + n_docs) / (1 + df)) + 1
+
+        # Los centroides con IDF, y su longitud (con todas sus palabras)
+        weights = self.weights * idf[self.cols]
+        norms = np.sqrt(np.bincount(self.rows, weights=weights * weights, minlength=n_temas))
+
+        # Las citas a puntuar, también como matriz dispersa (cita, palabra).
+        # Las palabras que el clasificador no conoce no suman nada
+        query_rows, query_cols, query_weights = [], [], []
+        for i, (text, source) in enumerate(docs):
+            for term, weight in doc_vector(text, source).items():
+                col = self.term_index.get(term)
+                if col is not None:
+                    query_rows.append(i)
+                    query_cols.append(col)
+                    query_weights.append(weight)
+        if not query_rows:
+            return results
+
+        query_rows = np.asarray(query_rows)
+        query_cols = np.asarray(query_cols)
+        query_weights = np.asarray(query_weights) * idf[query_cols]
+        query_norms = np.sqrt(np.bincount(query_rows, weights=query_weights ** 2, minlength=len(docs)))
+
+        # Solo necesito las columnas de los centroides que salen en las citas:
+        # una matriz densa temas x (esas palabras), pequeña
+        needed, position = np.unique(query_cols, return_inverse=True)
+        mask = np.isin(self.cols, needed)
+        centroids = np.zeros((n_temas, len(needed)))
+        centroids[self.rows[mask], np.searchsorted(needed, self.cols[mask])] = weights[mask]
+
+        # Producto escalar de cada cita con cada tema: una suma por tema
+        scores = np.empty((len(docs), n_temas))
+        for row in range(n_temas):
+            scores[:, row] = np.bincount(
+                query_rows, weights=query_weights * centroids[row, position], minlength=len(docs)
+            )
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores /= query_norms[:, None] * norms[None, :]
+        scores = np.nan_to_num(scores, nan=0.0, posinf=0.0)
+
+        top = np.argsort(-scores, axis=1)[:, :k]
+        for i, rows in enumerate(top):
+            results[i] = [
+                (self.tema_ids[row], float(scores[i, row]))
+                for row in rows if scores[i, row] >= min_score
+            ]
+        return results
+
+    def __len__(self):
+        """Cuántas citas clasificadas ha visto"""
+        return int(self.tema_docs.sum())
+
+
+# --- El clasificador de cada usuario (en la BD) ---
+
+def train(owner_id):
+    """Un clasificador nuevo con todas las citas con tema del usuario"""
+    classifier = Classifier()
+    docs = (Cita.objects.filter(owner_id=owner_id, tag__isnull=False)
+            .values_list('tag_id', 'text', 'source')
+            .iterator(chunk_size=2000))
+    classifier.update((None, doc) for doc in docs)
+    return classifier
+
+
+def save(owner_id, classifier):
+    ClasificadorTemas.objects.update_or_create(
+        owner_id=owner_id, defaults={'data': classifier.to_bytes()}
+    )
+
+
+def retrain(owner_id):
+    classifier = train(owner_id)
+    save(owner_id, classifier)
+    return classifier
+
+
+def load(owner_id):
+    """El clasificador del usuario (lo entreno si todavía no tiene)"""
+    data = ClasificadorTemas.objects.filter(owner_id=owner_id).values_list('data', flat=True).first()
+    if data is None:
+        return retrain(owner_id)
+    return Classifier.from_bytes(bytes(data))
+
+
+def _tagged(change):
+    old, new = change
+    return (old is not None and old[0] is not None) or (new is not None and new[0] is not None)
+
+
+def record_changes(owner_id, changes):
+    """
+    Aprende de las citas que han cambiado: lista de (old, new) de snapshot().
+
+    Los cambios entre citas del inbox (sin tema) no tocan el clasificador,
+    así que ni lo cargo.
+
+    Si el usuario aún no tiene clasificador no hago nada: cuando se
+    entrene ya leerá las citas como estén.
+    """
+    changes = [change for change in changes if _tagged(change) and change[0] != change[1]]
+    if not changes:
+        return
+
+    with transaction.atomic(using=sharding.db_for_owner(owner_id)):
+        # select_for_update: que dos peticiones a la vez no se pisen
+        # (en PostgreSQL; en SQLite las escrituras ya van de una en una)
+        data = (ClasificadorTemas.objects.select_for_update()
+                .filter(owner_id=owner_id).values_list('data', flat=True).first())
+        if data is None:
+            return
+
+        classifier = Classifier.from_bytes(bytes(data))
+        if classifier.update(changes):
+            save(owner_id, classifier)
+
+
+def forget_tema(owner_id, tema_id):
+    """Al borrar un tema, lo quito del clasificador"""
+    with transaction.atomic(using=sharding.db_for_owner(owner_id)):
+        data = (ClasificadorTemas.objects.select_for_update()
+                .filter(owner_id=owner_id).values_list('data', flat=True).first())
+        if data is None:
+            return
+
+        classifier = Classifier.from_bytes(bytes(data))
+        if classifier.forget_tema(tema_id):
+            save(owner_id, classifier)
+
+
+def invalidate(owner_ids):
+    """
+    Tira los clasificadores de estos usuarios (después de cambios en bloque
+    como import_citas). Se vuelven a entrenar cuando hagan falta.
+    """
+    for shard_owner_ids in sharding.by_shard(owner_ids):
+        ClasificadorTemas.objects.filter(owner_id__in=shard_owner_ids).delete()
+
+
+def suggest(owner_id, citas, k=SUGGESTIONS):
+    """
+    {cita.pk: [(Tema, puntuación), ...]} para unas citas del usuario.
+
+    Un solo cálculo para todas (no uno por cita) y una consulta para
+    sacar los temas sugeridos.
+    """
+    citas = list(citas)
+    if not citas:
+        return {}
+
+    classifier = load(owner_id)
+    results = classifier.suggest([(cita.text, cita.source) for cita in citas], k)
+
+    tema_ids = {tema_id for result in results for tema_id, _ in result}
+    temas = Tema.objects.filter(owner_id=owner_id).in_bulk(tema_ids)
+
+    return {
+        cita.pk: [(temas[tema_id], score) for tema_id, score in result if tema_id in temas]
+        for cita, result in zip(citas, results)
+    }
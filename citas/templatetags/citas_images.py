@@ -0,0 +1,95 @@
+"""
+Template tags para las imágenes de las citas.
+
+Uso en un template:
+
+    {% load citas_images %}
+    {% cita_picture cita %}                     -> tarjeta del grid
+    {% cita_picture cita 'detail' 'mi-clase' %} -> imagen grande
+
+Pinta un <picture> con las variantes de thumbnails.py (WebP con JPEG de
+reserva) y srcset, para que el navegador elija el tamaño que necesita.
+Si las variantes todavía no existen, usa la imagen original.
+
+Si la cita tiene guardado el tamaño de la imagen, pongo width/height y
+aspect-ratio (el hueco queda reservado antes de descargarla) y pinto de
+fondo el placeholder borroso de placeholders.py. Nada de esto abre el
+fichero de la imagen.
+"""
+
+from django import template
+from django.core.files.storage import default_storage
+
+
+register = template.Library()
+
+
+# Qué variantes uso en cada sitio y qué ancho ocupa la imagen en pantalla
+# (el grid tiene 3 columnas, 2 en tablet y 1 en móvil, ver styles.css)
+LAYOUTS = {
+    'grid': {
+        'variants': ['grid', 'grid2x'],
+        'sizes': '(max-width: 576px) 100vw, (max-width: 992px) 50vw, 400px',
+        'loading': 'lazy',
+    },
+    'detail': {
+        'variants': ['grid2x', 'detail'],
+        'sizes': '(max-width: 600px) 100vw, 600px',
+        # Es la imagen principal de la página: no la retraso
+        'loading': 'eager',
+    },
+}
+
+
+def _srcset(storage, variants, names, fmt):
+    """
+    'url1 400w, url2 800w' con las variantes que existan.
+
+    Si dos variantes son el mismo fichero (imagen original pequeña)
+    solo lo pongo una vez.
+    """
+    candidates = {}
+    for name in names:
+        info = variants.get(name, {})
+        if info.get(fmt):
+            candidates[info[fmt]] = info['width']
+    
+    return ', '.join(f'{storage.url(path)} {width}w' for path, width in candidates.items())
+
+
+@register.inclusion_tag('citas/partials/cita_picture.html')
+def cita_picture(cita, layout='grid', css_class='card-img-top', style=''):
+    config = LAYOUTS[layout]
+    variants = cita.image_variants or {}
+    # Las variantes están en default_storage (ver thumbnails.py)
+    storage = default_storage
+    
+    context = {
+        'src': cita.image.url,
+        'webp_srcset': '',
+        'jpeg_srcset': '',
+        'sizes': config['sizes'],
+        'loading': config['loading'],
+        'css_class': css_class,
+        'width': cita.image_width,
+        'height': cita.image_height,
+        'placeholder': bool(cita.image_placeholder),
+    }
+    
+    # Estilos en línea: el que me pasen + hueco reservado + placeholder
+    styles = [style.strip().rstrip(';')] if style.strip() else []
+    if cita.image_width and cita.image_height:
+        styles.append(f'aspect-ratio: {cita.image_width} / {cita.image_height}')
+    if cita.image_placeholder:
+        styles.append(f'background: center / cover no-repeat url({cita.image_placeholder})')
+    context['style'] = '; '.join(styles)
+    
+    if variants:
+        # La primera variante del layout en JPEG hace de src por defecto
+        first = variants.get(config['variants'][0], {})
+        if first.get('jpeg'):
+            context['src'] = storage.url(first['jpeg'])
+        context['webp_srcset'] = _srcset(storage, variants, config['variants'], 'webp')
+        context['jpeg_srcset'] = _srcset(storage, variants, config['variants'], 'jpeg')
+    
+    return context
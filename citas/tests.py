@@ -1,3 +1,1964 @@
-from django.test import TestCase
+import asyncio
+import base64
+import json
+import os
+import tempfile
+import zipfile
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth import authenticate
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.messages import get_messages
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.contrib.sessions.backends.cached_db import SessionStore
+from django.core.cache import cache, caches
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connections, transaction
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.http import Http404, HttpResponse
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from accounts import backends
+
+from .forms import QuoteFilterForm
+from .models import Cita, ClasificadorTemas, ContadorTema, ContadorUsuario, Imagen, ShardUsuario, Tema
+from .pagination import ORDERING, decode_cursor, encode_cursor, keyset_page
+from .views import filter_citas, set_favorite
+from . import (
+    async_views, autocomplete, bulk, caching, counters, duplicates, events, export, image_refs,
+    metrics, pagination, perceptual, placeholders, query_plans, random_draw, related, search,
+    sharding, suggestions, thumbnails, timing, views,
+)
+
+
+def clear_caches():
+    """
+    Vacía todas las cachés: la de cada proceso y la shared (versiones...),
+    que entre tests no se vacía sola y los ids de los usuarios se repiten
+    """
+    for alias in settings.CACHES:
+        caches[alias].clear()
+
+
+class QueryPlanTests(TestCase):
+    """
+    Las consultas de las vistas tienen que usar los índices de Cita.Meta.
+    (Si falla, mira la salida: dice qué consulta hace SCAN o TEMP B-TREE)
+    """
+    
+    databases = '__all__'
+    
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user('ana', password='x')
+        # Las citas van al shard de ana (ver sharding.py)
+        self.enterContext(sharding.for_owner(self.user.pk))
+        self.tema = Tema.objects.create(owner=self.user, name='Filosofía')
+        Cita.objects.create(owner=self.user, text='Solo sé que no sé nada', tag=self.tema)
+    
+    def test_view_querysets_use_indexes(self):
+        for name, queryset in query_plans.view_querysets(self.user, self.tema):
+            with self.subTest(name):
+                self.assertEqual(query_plans.plan_problems(queryset), [])
+    
+    def test_full_scan_is_detected(self):
+        # Buscar por updated_at no tiene índice: tiene que detectarlo
+        queryset = Cita.objects.filter(updated_at__isnull=False).order_by('updated_at')
+        self.assertNotEqual(query_plans.plan_problems(queryset), [])
+    
+    def test_check_query_plans_command(self):
+        out = StringIO()
+        call_command('check_query_plans', stdout=out)
+        self.assertIn('Todas las consultas usan índices', out.getvalue())
+
+
+class PaginationTests(TestCase):
+    """
+    Paginación por cursor (pagination.py): recorriendo las páginas salen
+    todas las citas una vez, en el orden de ORDERING, con y sin filtros.
+    """
+    
+    databases = '__all__'
+    
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user('ana', password='x')
+        self.enterContext(sharding.for_owner(self.user.pk))
+        self.tema = Tema.objects.create(owner=self.user, name='Filosofía')
+        
+        # De dos en dos con el mismo created_at (como al importar): el id desempata
+        now = timezone.now()
+        for number in range(11):
+            cita = Cita.objects.create(
+                owner=self.user, text=f'Cita {number}',
+                is_favorite=number % 3 == 0, tag=self.tema if number % 2 else None,
+            )
+            Cita.objects.filter(pk=cita.pk).update(created_at=now - timedelta(minutes=number // 2))
+    
+    def _walk(self, queryset, page_size=3):
+        """Todas las páginas seguidas, como el scroll infinito"""
+        seen, cursor = [], None
+        while True:
+            page, cursor = keyset_page(queryset, cursor, page_size)
+            self.assertLessEqual(len(page), page_size)
+            seen += [cita.pk for cita in page]
+            if not cursor:
+                return seen
+    
+    def test_pages_cover_every_cita_once_in_order(self):
+        citas = Cita.objects.filter(owner=self.user)
+        expected = list(citas.order_by(*ORDERING).values_list('pk', flat=True))
+        self.assertEqual(len(expected), 11)
+        for page_size in (1, 2, 3, 11, 30):
+            with self.subTest(page_size=page_size):
+                self.assertEqual(self._walk(citas, page_size), expected)
+    
+    def test_pages_with_filters(self):
+        filters = {
+            'favoritas': {'favorite_only': 'on'},
+            'tema': {'tag': self.tema.pk},
+            'favoritas del tema': {'favorite_only': 'on', 'tag': self.tema.pk},
+            'búsqueda': {'q': 'cita'},
+        }
+        for name, data in filters.items():
+            with self.subTest(name):
+                form = QuoteFilterForm(data, user=self.user)
+                citas = filter_citas(Cita.objects.filter(owner=self.user), form)
+                expected = list(citas.order_by(*ORDERING).values_list('pk', flat=True))
+                self.assertTrue(expected)
+                self.assertEqual(self._walk(citas, 2), expected)
+    
+    def test_cursor_round_trip(self):
+        cita = Cita.objects.filter(owner=self.user).first()
+        self.assertEqual(decode_cursor(encode_cursor(cita)), (cita.created_at, cita.pk))
+    
+    def test_invalid_cursors_start_from_the_beginning(self):
+        created_at = timezone.now().isoformat()
+        for pk in (pagination.MAX_ID + 1, pagination.MIN_ID - 1, 10 ** 30):
+            cursor = base64.urlsafe_b64encode(f'{created_at}|{pk}'.encode()).decode()
+            with self.subTest(pk=pk):
+                self.assertIsNone(decode_cursor(cursor))
+        for cursor in ('', 'no-es-base64!', base64.urlsafe_b64encode(b'sin separador').decode()):
+            with self.subTest(cursor=cursor):
+                self.assertIsNone(decode_cursor(cursor))
+    
+    def test_views_ignore_an_overflowing_cursor(self):
+        self.client.force_login(self.user)
+        raw = f'{timezone.now().isoformat()}|{2 ** 63}'
+        cursor = base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+        for name in ('citas:quote_list', 'citas:quote_list_page'):
+            with self.subTest(name):
+                response = self.client.get(reverse(name), {'cursor': cursor})
+                self.assertContains(response, 'Cita 0')
+
+
+class SearchTests(TestCase):
+    """
+    Búsqueda con FTS5 (search.py): los triggers mantienen el índice, se
+    busca por prefijo y sin tildes, y sin FTS5 se usa icontains.
+    """
+    
+    databases = '__all__'
+    
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user('ana', password='x')
+        self.enterContext(sharding.for_owner(self.user.pk))
+        self.connection = connections[Cita.objects.all().db]
+        if not search.is_available(self.connection):
+            self.skipTest('SQLite sin FTS5')
+        self.cita = Cita.objects.create(owner=self.user, text='El corazón tiene razones', source='Pascal')
+    
+    def _found(self, q):
+        return set(search.filter_queryset(Cita.objects.filter(owner=self.user), q).values_list('pk', flat=True))
+    
+    def test_triggers_follow_insert_update_and_delete(self):
+        self.assertEqual(self._found('razones'), {self.cita.pk})
+        
+        self.cita.text = 'Conócete a ti mismo'
+        self.cita.save()
+        self.assertEqual(self._found('razones'), set())
+        self.assertEqual(self._found('conocete'), {self.cita.pk})
+        
+        # update() no lanza señales, pero el trigger sí salta
+        Cita.objects.filter(pk=self.cita.pk).update(source='Sócrates')
+        self.assertEqual(self._found('pascal'), set())
+        self.assertEqual(self._found('socrates'), {self.cita.pk})
+        
+        self.cita.delete()
+        self.assertEqual(self._found('conocete'), set())
+        # Mirando el índice directamente (sin pasar por citas_cita)
+        with self.connection.cursor() as cursor:
+            cursor.execute(search._match_sql(), [search.match_expression('socrates')])
+            self.assertEqual(cursor.fetchall(), [])
+    
+    def test_prefix_search(self):
+        filosofia = Cita.objects.create(owner=self.user, text='La filosofía empieza en el asombro')
+        self.assertEqual(self._found('filos'), {filosofia.pk})
+        self.assertEqual(self._found('cora raz'), {self.cita.pk})
+        # Todas las palabras tienen que estar
+        self.assertEqual(self._found('corazón filos'), set())
+    
+    def test_accents_and_case_are_folded(self):
+        for q in ('corazon', 'CORAZÓN', 'Corazón', 'pascal'):
+            with self.subTest(q):
+                self.assertEqual(self._found(q), {self.cita.pk})
+    
+    def test_fts_syntax_is_escaped(self):
+        for q in ('"', 'cora*', 'OR', 'NEAR(', '-'):
+            with self.subTest(q):
+                self._found(q)
+        self.assertEqual(self._found('"cora"'), {self.cita.pk})
+    
+    def test_icontains_fallback_without_fts(self):
+        self.connection._citas_fts_available = False
+        try:
+            queryset = search.filter_queryset(Cita.objects.filter(owner=self.user), 'razon')
+            self.assertNotIn(search.FTS_TABLE, str(queryset.query))
+            self.assertEqual(list(queryset), [self.cita])
+            # icontains no quita tildes
+            self.assertEqual(self._found('corazon'), set())
+            self.assertEqual(self._found('corazón'), {self.cita.pk})
+            # Y search() sigue funcionando (sin relevancia)
+            self.assertEqual(list(search.search(Cita.objects.filter(owner=self.user), 'pascal')), [self.cita])
+        finally:
+            del self.connection._citas_fts_available
+        self.assertTrue(search.is_available(self.connection))
+
+
+class RandomDrawTests(TestCase):
+    """La cita aleatoria (random_draw.py): ámbitos, el mazo y las borradas"""
+    
+    databases = '__all__'
+    
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user('ana', password='x')
+        self.enterContext(sharding.for_owner(self.user.pk))
+        self.tema = Tema.objects.create(owner=self.user, name='Filosofía')
+        self.inbox = Cita.objects.create(owner=self.user, text='Sin tema')
+        self.favorita = Cita.objects.create(owner=self.user, text='Favorita', tag=self.tema, is_favorite=True)
+        self.con_tema = Cita.objects.create(owner=self.user, text='Con tema', tag=self.tema)
+        self.all_ids = {self.inbox.pk, self.favorita.pk, self.con_tema.pk}
+    
+    def _deck(self, draws, scope=random_draw.SCOPE_ALL):
+        return [random_draw.draw_id(self.user.pk, scope, deck=True) for _ in range(draws)]
+    
+    def test_scopes(self):
+        for scope, expected in (
+            (random_draw.SCOPE_ALL, self.all_ids),
+            (random_draw.SCOPE_FAVORITES, {self.favorita.pk}),
+            (random_draw.SCOPE_INBOX, {self.inbox.pk}),
+            (random_draw.tema_scope(self.tema.pk), {self.favorita.pk, self.con_tema.pk}),
+            (random_draw.tema_scope(self.tema.pk + 1000), set()),
+        ):
+            with self.subTest(scope=scope):
+                self.assertEqual(set(random_draw.get_ids(self.user.pk, scope)), expected)
+                drawn = random_draw.draw(self.user.pk, scope)
+                if expected:
+                    self.assertIn(drawn.pk, expected)
+                else:
+                    self.assertIsNone(drawn)
+    
+    def test_scope_from_url(self):
+        tema = f'tema-{self.tema.pk}'
+        for ambito, scope in (
+            ('', random_draw.SCOPE_ALL),
+            ('favoritas', random_draw.SCOPE_FAVORITES),
+            ('inbox', random_draw.SCOPE_INBOX),
+            (tema, random_draw.tema_scope(self.tema.pk)),
+            # Lo que no vale: todas (antes algunos daban un 500)
+            ('tema-\u00b2', random_draw.SCOPE_ALL),
+            ('tema-99999999999999999999', random_draw.SCOPE_ALL),
+            ('tema--1', random_draw.SCOPE_ALL),
+            ('tema-', random_draw.SCOPE_ALL),
+        ):
+            with self.subTest(ambito=ambito):
+                request = RequestFactory().get('/citas/random/', {'ambito': ambito})
+                self.assertEqual(views._random_scope(request), scope)
+        
+        self.client.force_login(self.user)
+        for ambito in ('tema-\u00b2', 'tema-99999999999999999999'):
+            with self.subTest(ambito=ambito):
+                response = self.client.get(reverse('citas:quote_random'), {'ambito': ambito})
+                self.assertEqual(response.status_code, 200)
+    
+    def test_deck_does_not_repeat_until_it_runs_out(self):
+        first = self._deck(3)
+        self.assertEqual(set(first), self.all_ids)
+        # Otra vuelta: barajado otra vez, y tampoco repite
+        self.assertEqual(set(self._deck(3)), self.all_ids)
+    
+    def test_deck_is_shared_by_every_process(self):
+        # Otro worker no tiene nada en su caché: tiene que seguir el mismo mazo
+        drawn = []
+        for _ in range(3):
+            cache.clear()
+            drawn += self._deck(1)
+        self.assertEqual(set(drawn), self.all_ids)
+    
+    def test_deck_follows_changes(self):
+        first = self._deck(1)[0]
+        # Borro una de las que quedan y añado otra: la borrada no sale y la nueva sí
+        gone = next(pk for pk in self.all_ids if pk != first)
+        Cita.objects.filter(pk=gone).delete()
+        nueva = Cita.objects.create(owner=self.user, text='Nueva')
+        rest = self._deck(2)
+        self.assertEqual(set(rest), self.all_ids - {first, gone} | {nueva.pk})
+    
+    def test_stale_ids_are_retried(self):
+        # La lista de ids en caché tiene una que ya no existe
+        key = random_draw._ids_key(self.user.pk, random_draw.SCOPE_INBOX)
+        cache.set(key, array('q', [self.inbox.pk + 1000]).tobytes())
+        self.assertEqual(random_draw.draw(self.user.pk, random_draw.SCOPE_INBOX), self.inbox)
+        
+        Cita.objects.filter(pk=self.inbox.pk).delete()
+        self.assertIsNone(random_draw.draw(self.user.pk, random_draw.SCOPE_INBOX))
+        self.assertIsNone(random_draw.draw(self.user.pk, random_draw.SCOPE_INBOX, deck=True))
+
+
+def png(color='red', name='foto.png', size=(8, 8)):
+    """Una imagen PNG pequeña para ImageField"""
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'PNG')
+    return ContentFile(buffer.getvalue(), name=name)
+
+
+class ImageRefTests(TestCase):
+    """
+    Referencias de los ficheros de imagen (image_refs.py): cada cita
+    cuenta una vez y un fichero que se usa nunca se borra.
+    """
+    
+    databases = '__all__'
+    
+    def setUp(self):
+        clear_caches()
+        media = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(MEDIA_ROOT=media))
+        self.user = User.objects.create_user('ana', password='x')
+        self.enterContext(sharding.for_owner(self.user.pk))
+        self.storage = Cita._meta.get_field('image').storage
+    
+    def _refcount(self, name):
+        imagen = Imagen.objects.filter(name=name).first()
+        return imagen.refcount if imagen else 0
+    
+    def test_shared_file_counts_each_cita_once(self):
+        first = Cita.objects.create(owner=self.user, text='Una', image=png())
+        second = Cita.objects.create(owner=self.user, text='Otra', image=png(name='copia.png'))
+        name = first.image.name
+        self.assertEqual(second.image.name, name)
+        self.assertEqual(self._refcount(name), 2)
+        self.assertEqual(image_refs._held.get(), ())
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(self._refcount(name), 1)
+        self.assertTrue(self.storage.exists(name))
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(Imagen.objects.filter(name=name).exists())
+        self.assertFalse(self.storage.exists(name))
+    
+    def test_uploading_the_same_image_again_keeps_the_count(self):
+        cita = Cita.objects.create(owner=self.user, text='Una', image=png())
+        cita.image = png(name='otra-vez.png')
+        cita.save()
+        self.assertEqual(self._refcount(cita.image.name), 1)
+        self.assertEqual(image_refs._held.get(), ())
+    
+    def test_file_survives_a_concurrent_release(self):
+        old = Cita.objects.create(owner=self.user, text='Una', image=png())
+        name = old.image.name
+        
+        # Otra petición borra la última cita con el fichero: su on_commit
+        # (borrar el fichero) todavía no ha llegado...
+        with self.captureOnCommitCallbacks() as callbacks:
+            old.delete()
+        self.assertTrue(self.storage.exists(name))
+        
+        # ...y entretanto se sube la misma imagen: el fichero ya existe
+        new = Cita.objects.create(owner=self.user, text='Otra', image=png())
+        self.assertEqual(new.image.name, name)
+        
+        for callback in callbacks:
+            callback()
+        self.assertTrue(self.storage.exists(name))
+        self.assertEqual(self._refcount(name), 1)
+
+
+class ImageVariantTests(TestCase):
+    """
+    Miniaturas (thumbnails.py) y tamaño + placeholder (placeholders.py)
+    de las imágenes de las citas
+    """
+    
+    databases = '__all__'
+    
+    def setUp(self):
+        clear_caches()
+        media = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(MEDIA_ROOT=media))
+        self.user = User.objects.create_user('ana', password='x')
+        self.enterContext(sharding.for_owner(self.user.pk))
+        self.storage = Cita._meta.get_field('image').storage
+    
+    def test_image_metadata(self):
+        image = png(size=(300, 100))
+        width, height, placeholder = placeholders.image_metadata(image)
+        self.assertEqual((width, height), (300, 100))
+        self.assertEqual(image.tell(), 0)
+        
+        prefix = 'data:image/webp;base64,'
+        self.assertTrue(placeholder.startswith(prefix))
+        with Image.open(BytesIO(base64.b64decode(placeholder[len(prefix):]))) as tiny:
+            self.assertEqual(tiny.format, 'WEBP')
+            self.assertEqual(tiny.size[0], placeholders.PLACEHOLDER_SIZE)
+    
+    def test_image_metadata_follows_exif_rotation(self):
+        # Una foto del móvil en vertical: guardada tumbada, con Orientation=6
+        buffer = BytesIO()
+        exif = Image.Exif()
+        exif[ImageOps.ExifTags.Base.Orientation] = 6
+        Image.new('RGB', (300, 100), 'blue').save(buffer, 'JPEG', exif=exif)
+        width, height, _ = placeholders.image_metadata(ContentFile(buffer.getvalue(), name='movil.jpg'))
+        self.assertEqual((width, height), (100, 300))
+    
+    def test_generate_variants(self):
+        name = self.storage.save('quotes/grande.png', png(size=(1000, 500)))
+        variants = thumbnails.generate_variants(name)
+        
+        # Nunca agranda: detail se queda con los 1000 px de la original
+        self.assertEqual({variant: info['width'] for variant, info in variants.items()},
+                         {'grid': 400, 'grid2x': 800, 'detail': 1000})
+        for info in variants.values():
+            for fmt, expected in (('webp', 'WEBP'), ('jpeg', 'JPEG')):
+                with self.storage.open(info[fmt]) as f, Image.open(f) as image:
+                    self.assertEqual((image.format, image.width), (expected, info['width']))
+    
+    def test_small_image_reuses_the_same_files(self):
+        name = self.storage.save('quotes/pequena.png', png(size=(300, 200)))
+        variants = thumbnails.generate_variants(name)
+        self.assertEqual(variants['grid'], variants['detail'])
+        self.assertEqual(variants['grid']['width'], 300)
+    
+    @override_settings(CITAS_THUMBNAILS_SYNC=True)
+    def test_create_fills_size_placeholder_and_variants(self):
+        self.client.force_login(self.user)
+        upload = png(size=(600, 300), name='subida.png')
+        # El on_commit va en la transacción del shard del usuario
+        with self.captureOnCommitCallbacks(using=sharding.db_for_owner(self.user.pk), execute=True):
+            response = self.client.post(reverse('citas:quote_create'), {
+                'text': 'Con imagen', 'image': SimpleUploadedFile('subida.png', upload.read(), 'image/png'),
+            })
+        self.assertEqual(response.status_code, 302)
+        
+        cita = Cita.objects.get(owner=self.user)
+        self.assertEqual((cita.image_width, cita.image_height), (600, 300))
+        self.assertTrue(cita.image_placeholder.startswith('data:image/webp;base64,'))
+        self.assertEqual(cita.image_variants['grid']['width'], 400)
+        self.assertEqual(Imagen.objects.get(name=cita.image.name).variants, cita.image_variants)
+    
+    def test_process_cita_reuses_variants_of_the_same_file(self):
+        first = Cita.objects.create(owner=self.user, text='Una', image=png(size=(500, 500)))
+        thumbnails.process_cita(first.pk, first.image.name, self.user.pk)
+        first.refresh_from_db()
+        self.assertEqual(first.image_variants['grid']['width'], 400)
+        
+        second = Cita.objects.create(owner=self.user, text='Otra', image=png(size=(500, 500), name='copia.png'))
+        with mock.patch.object(thumbnails, 'generate_variants') as generate:
+            thumbnails.process_cita(second.pk, second.image.name, self.user.pk)
+        generate.assert_not_called()
+        second.refresh_from_db()
+        self.assertEqual(second.image_variants, first.image_variants)
+    
+    def test_process_cita_does_not_touch_a_changed_image(self):
+        # El usuario cambia la imagen antes de que el hilo llegue con la de antes
+        cita = Cita.objects.create(owner=self.user, text='Una', image=png(size=(500, 500)))
+        old = cita.image.name
+        cita.image = png('blue', size=(500, 500))
+        cita.save()
+        
+        thumbnails.process_cita(cita.pk, old, self.user.pk)
+        cita.refresh_from_db()
+        self.assertEqual(cita.image_variants, {})
+        # Y como nadie usa la de antes, sus variantes no se quedan en disco
+        self.assertFalse(self.storage.exists(thumbnails.variant_name(old, 'grid', 'webp')))
+
+
+class ExportTests(TestCase):
+    """El ZIP de export.py lleva cada imagen con su ruta entera"""
+    
+    databases = '__all__'
+    
+    def setUp(self):
+        clear_caches()
+        media = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(MEDIA_ROOT=media))
+        self.user = User.objects.create_user('ana', password='x')
+        self.enterContext(sharding.for_owner(self.user.pk))
+    
+    def test_legacy_images_with_the_same_name_do_not_collide(self):
+        # Imágenes de antes del almacenamiento por hash, con el mismo nombre
+        storage = Cita._meta.get_field('image').storage
+        for folder, color in (('a', 'red'), ('b', 'blue')):
+            name = f'quotes/{folder}/foto.png'
+            os.makedirs(os.path.dirname(storage.path(name)))
+            with open(storage.path(name), 'wb') as f:
+                f.write(png(color).read())
+            Cita.objects.create(owner=self.user, text=f'Cita {folder}', image=name)
+        
+        data = b''.join(export.zip_chunks(Cita.objects.filter(owner=self.user)))
+        with zipfile.ZipFile(BytesIO(data)) as archive:
+            images = sorted(name for name in archive.namelist() if name.startswith('images/'))
+            self.assertEqual(images, ['images/quotes/a/foto.png', 'images/quotes/b/foto.png'])
+            self.assertNotEqual(archive.read(images[0]), archive.read(images[1]))
+            lines = [json.loads(line) for line in archive.read('citas.jsonl').decode().splitlines()]
+        self.assertEqual(sorted(line['image'] for line in lines), images)
+    
+    def test_image_path_stays_inside_images(self):
+        self.assertEqual(export._image_path('../../etc/passwd'), 'images/etc/passwd')
+        self.assertEqual(export._image_path('/quotes/x.jpg'), 'images/quotes/x.jpg')
+        self.assertEqual(export._image_path(''), '')
+
+
+class ImportTests(TestCase):
+    """El comando import_citas con un fichero pequeño"""
+    
+    databases = '__all__'
+    
+    def setUp(self):
+        clear_caches()
+        self.dir = self.enterContext(tempfile.TemporaryDirectory())
+        self.user = User.objects.create_user('bea', password='x')
+        self.enterContext(sharding.for_owner(self.user.pk))
+        Tema.objects.create(owner=self.user, name='Filosofía')
+    
+    def write(self, name, lines):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        return path
+    
+    def jsonl(self, count, **extra):
+        return self.write('citas.jsonl', [
+            json.dumps({'text': f'Cita {n}', 'tema': 'Filosofía' if n % 2 else 'Poesía', **extra})
+            for n in range(1, count + 1)
+        ])
+    
+    def test_import_in_batches(self):
+        path = self.jsonl(5, created_at='2024-01-31T10:00:00+01:00', is_favorite=True)
+        out = StringIO()
+        with mock.patch.object(Cita.objects, 'bulk_create', wraps=Cita.objects.bulk_create) as bulk_create:
+            call_command('import_citas', path, '--owner', 'bea', '--batch-size', '2', stdout=out)
+        
+        # 5 citas de 2 en 2: tres lotes
+        self.assertEqual([len(call.args[0]) for call in bulk_create.call_args_list], [2, 2, 1])
+        self.assertIn('Terminado: 5 citas importadas, 0 con error', out.getvalue())
+        self.assertFalse(os.path.exists(f'{path}.progress'))
+        
+        citas = Cita.objects.filter(owner=self.user)
+        self.assertEqual(citas.count(), 5)
+        # Conserva la fecha del fichero (y no "ahora")
+        self.assertEqual(set(citas.values_list('created_at', flat=True)),
+                         {datetime.fromisoformat('2024-01-31T10:00:00+01:00')})
+        self.assertEqual(citas.filter(is_favorite=True).count(), 5)
+    
+    def test_creates_missing_temas_once(self):
+        path = self.jsonl(6)
+        call_command('import_citas', path, '--owner', 'bea', '--batch-size', '2', stdout=StringIO())
+        
+        # Filosofía ya existía y Poesía se crea una sola vez aunque salga en tres lotes
+        self.assertEqual(sorted(Tema.objects.filter(owner=self.user).values_list('name', flat=True)),
+                         ['Filosofía', 'Poesía'])
+        self.assertEqual(Cita.objects.filter(tag__name='Poesía').count(), 3)
+        self.assertEqual(Cita.objects.filter(tag__name='Filosofía').count(), 3)
+    
+    def test_bad_rows_are_skipped(self):
+        path = self.write('citas.jsonl', [
+            '{"text": "Buena"}', '{roto', '{"text": ""}', '{"text": "Otra", "owner": "nadie"}',
+        ])
+        err = StringIO()
+        call_command('import_citas', path, '--owner', 'bea', stdout=StringIO(), stderr=err)
+        self.assertEqual(list(Cita.objects.values_list('text', flat=True)), ['Buena'])
+        for number in (2, 3, 4):
+            self.assertIn(f'Cita {number}:', err.getvalue())
+    
+    def test_csv(self):
+        path = self.write('citas.csv', [
+            'text,source,tema,is_favorite', '"Una, con coma",Séneca,Poesía,sí', 'Dos,,,',
+        ])
+        call_command('import_citas', path, '--owner', 'bea', stdout=StringIO())
+        una = Cita.objects.get(text='Una, con coma')
+        self.assertEqual((una.source, una.tag.name, una.is_favorite), ('Séneca', 'Poesía', True))
+        self.assertIsNone(Cita.objects.get(text='Dos').tag)
+    
+    def test_resume(self):
+        # Una importación anterior se cortó después de guardar las 3 primeras
+        call_command('import_citas', self.jsonl(3), '--owner', 'bea', stdout=StringIO())
+        path = self.jsonl(5)
+        with open(f'{path}.progress', 'w') as f:
+            json.dump({'records': 3}, f)
+        
+        # Sin --resume no empieza de cero por su cuenta
+        with self.assertRaisesMessage(CommandError, '--resume'):
+            call_command('import_citas', path, '--owner', 'bea', stdout=StringIO())
+        
+        out = StringIO()
+        call_command('import_citas', path, '--owner', 'bea', '--batch-size', '2', '--resume', stdout=out)
+        self.assertIn('me salto las 3 primeras', out.getvalue())
+        self.assertEqual(sorted(Cita.objects.values_list('text', flat=True)),
+                         [f'Cita {n}' for n in range(1, 6)])
+        self.assertFalse(os.path.exists(f'{path}.progress'))
+
+
+class CounterTests(TestCase):
+    """
+    Los contadores que van sumando las señales (counters.py) tienen que
+    dar lo mismo que recount(), y el de la caché (for_owner) también.
+    """
+    
+    databases = '__all__'
+    
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user('ana', password='x')
+        self.enterContext(sharding.for_owner(self.user.pk))
+        self.filosofia = Tema.objects.create(owner=self.user, name='Filosofía')
+        self.poesia = Tema.objects.create(owner=self.user, name='Poesía')
+        # La primera lectura crea la fila y la deja en caché
+        counters.for_owner(self.user.pk)
+    
+    def _counts(self):
+        contador = ContadorUsuario.objects.get(owner=self.user)
+        temas = dict(ContadorTema.objects.filter(tema__owner=self.user).values_list('tema_id', 'total'))
+        return {field: getattr(contador, field) for field in counters.FIELDS}, temas
+    
+    def assertCountersMatchRecount(self):
+        counted = self._counts()
+        cached = counters.for_owner(self.user.pk)
+        self.assertEqual({field: getattr(cached, field) for field in counters.FIELDS}, counted[0])
+        counters.recount(self.user.pk)
+        self.assertEqual(counted, self._counts())
+    
+    def test_create(self):
+        Cita.objects.create(owner=self.user, text='Una')
+        Cita.objects.create(owner=self.user, text='Otra', tag=self.filosofia, is_favorite=True)
+        Cita.objects.create(owner=self.user, text='Con imagen', image='quotes/vieja.jpg')
+        self.assertCountersMatchRecount()
+        self.assertEqual(counters.for_owner(self.user.pk).total, 3)
+    
+    def test_tag_change(self):
+        cita = Cita.objects.create(owner=self.user, text='Una')
+        cita.tag = self.filosofia
+        cita.save()
+        self.assertCountersMatchRecount()
+        cita.tag = self.poesia
+        cita.save(update_fields=['tag'])
+        self.assertCountersMatchRecount()
+        cita.tag = None
+        cita.save()
+        self.assertCountersMatchRecount()
+    
+    def test_favorite(self):
+        cita = Cita.objects.create(owner=self.user, text='Una', tag=self.filosofia)
+        cita.is_favorite = True
+        cita.save()
+        self.assertCountersMatchRecount()
+        # La vista lo hace con update(), sin señales
+        set_favorite(self.user, cita.pk, False)
+        self.assertCountersMatchRecount()
+        set_favorite(self.user, cita.pk, True)
+        set_favorite(self.user, cita.pk, True)
+        self.assertCountersMatchRecount()
+        self.assertEqual(counters.for_owner(self.user.pk).favorites, 1)
+    
+    def test_delete(self):
+        cita = Cita.objects.create(owner=self.user, text='Una', tag=self.filosofia, is_favorite=True)
+        Cita.objects.create(owner=self.user, text='Otra')
+        cita.delete()
+        self.assertCountersMatchRecount()
+        self.assertEqual(counters.for_owner(self.user.pk).total, 1)
+    
+    def test_tema_delete(self):
+        Cita.objects.create(owner=self.user, text='Una', tag=self.filosofia)
+        Cita.objects.create(owner=self.user, text='Otra', tag=self.filosofia)
+        Cita.objects.create(owner=self.user, text='Y otra', tag=self.poesia)
+        self.filosofia.delete()
+        self.assertCountersMatchRecount()
+        self.assertEqual(counters.for_owner(self.user.pk).inbox, 2)
+    
+    def test_bulk(self):
+        ids = [Cita.objects.create(owner=self.user, text=f'Cita {n}').pk for n in range(6)]
+        bulk.run(self.user.pk, bulk.CLASSIFY, ids[:4], self.filosofia)
+        self.assertCountersMatchRecount()
+        bulk.run(self.user.pk, bulk.FAVORITE, ids[2:])
+        self.assertCountersMatchRecount()
+        bulk.run(self.user.pk, bulk.DELETE, ids[3:5])
+        self.assertCountersMatchRecount()
+        self.assertEqual(counters.for_owner(self.user.pk).total, 4)
+    
+    def test_version_is_bumped_again_on_commit(self):
+        # Dentro de una transacción, lo que otros guarden en caché antes
+        # del COMMIT (con los contadores viejos) tiene que dejar de valer
+        alias = sharding.db_for_owner(self.user.pk)
+        with self.captureOnCommitCallbacks(using=alias, execute=True):
+            with transaction.atomic(using=alias):
+                Cita.objects.create(owner=self.user, text='Una')
+                before_commit = caching.get_version(self.user.pk)
+        self.assertNotEqual(caching.get_version(self.user.pk), before_commit)
+        self.assertCountersMatchRecount()
+
+
+class CacheVersionTests(TestCase):
+    """
+    Las versiones de caching.py van en la caché shared (todos los procesos
+    ven la misma) y nunca se repite una, aunque la caché la pierda.
+    """
+    
+    def setUp(self):
+        clear_caches()
+        self.versions = caches[caching.VERSIONS_CACHE]
+        self.key = caching._version_key(42)
+    
+    def test_versions_live_in_the_shared_cache(self):
+        version = caching.get_version(42)
+        self.assertEqual(self.versions.get(self.key), version)
+        self.assertIsNone(cache.get(self.key))
+        caching.bump(42)
+        self.assertGreater(self.versions.get(self.key), version)
+    
+    def test_a_lost_version_does_not_start_again(self):
+        first = caching.get_version(42)
+        self.assertGreater(first, 1)
+        self.versions.delete(self.key)
+        self.assertGreater(caching.get_version(42), first)
+        
+        # bump() sin la clave también pone una versión nueva (antes no hacía nada)
+        second = caching.get_version(42)
+        self.versions.delete(self.key)
+        caching.bump(42)
+        self.assertGreater(self.versions.get(self.key), second)
+    
+    def test_user_cache_keys_change_with_the_version(self):
+        before = caching.UserCache(42).key('card', 1)
+        caching.bump(42)
+        self.assertNotEqual(caching.UserCache(42).key('card', 1), before)
+
+
+def learned(classifier):
+    """Lo que ha aprendido un clasificador, sin depender del orden de filas y columnas"""
+    docs = {tema_id: int(n) for tema_id, n in zip(classifier.tema_ids, classifier.tema_docs) if n}
+    cells = {
+        (classifier.tema_ids[row], classifier.terms[col]): (round(float(weight), 4), int(count))
+        for row, col, weight, count in zip(classifier.rows, classifier.cols, classifier.weights, classifier.counts)
+    }
+    return docs, cells
+
+
+class BulkTests(TestCase):
+    """
+    Las acciones en bloque (bulk.py) hacen a mano lo de las señales:
+    contadores, clasificador de temas y versión de la caché.
+    """
+    
+    databases = '__all__'
+    
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user('ana', password='x')
+        self.other = User.objects.create_user('bea', password='x')
+        with sharding.for_owner(self.other.pk):
+            self.ajena = Cita.objects.create(owner=self.other, text='De otra persona')
+        self.enterContext(sharding.for_owner(self.user.pk))
+        self.filosofia = Tema.objects.create(owner=self.user, name='Filosofía')
+        self.poesia = Tema.objects.create(owner=self.user, name='Poesía')
+        self.citas = [
+            Cita.objects.create(owner=self.user, text=text, source=source, tag=self.poesia)
+            for text, source in [
+                ('El ser humano es una cuerda tendida entre el animal y el superhombre', 'Nietzsche'),
+                ('Dios ha muerto y nosotros lo hemos matado', 'Nietzsche'),
+                ('Caminante no hay camino, se hace camino al andar', 'Machado'),
+                ('Verde que te quiero verde, verde viento, verdes ramas', 'Lorca'),
+                ('Pienso, luego existo', 'Descartes'),
+            ]
+        ]
+        self.ids = [cita.pk for cita in self.citas]
+        # Que ya tenga clasificador, si no record_changes no hace nada
+        suggestions.retrain(self.user.pk)
+    
+    def assertEverythingAdjusted(self):
+        counted = {field: getattr(counters.for_owner(self.user.pk), field) for field in counters.FIELDS}
+        temas = dict(ContadorTema.objects.filter(tema__owner=self.user).values_list('tema_id', 'total'))
+        counters.recount(self.user.pk)
+        contador = ContadorUsuario.objects.get(owner=self.user)
+        self.assertEqual(counted, {field: getattr(contador, field) for field in counters.FIELDS})
+        self.assertEqual(temas, dict(ContadorTema.objects.filter(tema__owner=self.user).values_list('tema_id', 'total')))
+        self.assertEqual(learned(suggestions.load(self.user.pk)),
+                         learned(suggestions.train(self.user.pk)))
+    
+    def test_other_owner_ids_are_ignored(self):
+        version = caching.get_version(self.user.pk)
+        self.assertEqual(bulk.run(self.user.pk, bulk.DELETE, [max(self.ids) + 1000]), 0)
+        self.assertEqual(caching.get_version(self.user.pk), version)
+        
+        # Mis citas no las toca otra persona aunque mande sus ids
+        # (y con shards los ids se pueden repetir: cada BD tiene los suyos)
+        mine = [pk for pk in self.ids if pk != self.ajena.pk]
+        for action in (bulk.CLASSIFY, bulk.FAVORITE, bulk.DELETE):
+            self.assertEqual(bulk.run(self.other.pk, action, mine, self.filosofia), 0)
+        with sharding.for_owner(self.other.pk):
+            ajena = Cita.objects.get(pk=self.ajena.pk)
+            self.assertEqual(counters.for_owner(self.other.pk).total, 1)
+        self.assertEqual((ajena.tag_id, ajena.is_favorite), (None, False))
+        self.assertEqual(Cita.objects.filter(owner=self.user).count(), 5)
+        self.assertEverythingAdjusted()
+    
+    def test_classify(self):
+        version = caching.get_version(self.user.pk)
+        self.assertEqual(bulk.run(self.user.pk, bulk.CLASSIFY, self.ids[:2], self.filosofia), 2)
+        self.assertNotEqual(caching.get_version(self.user.pk), version)
+        self.assertEverythingAdjusted()
+        self.assertEqual(counters.for_owner(self.user.pk).inbox, 0)
+        
+        # Las que ya están en ese tema no cuentan
+        self.assertEqual(bulk.run(self.user.pk, bulk.CLASSIFY, self.ids, self.filosofia), 3)
+        self.assertEqual(bulk.run(self.user.pk, bulk.CLASSIFY, self.ids[3:], None), 2)
+        self.assertEverythingAdjusted()
+        self.assertEqual(counters.for_owner(self.user.pk).inbox, 2)
+    
+    def test_favorite_and_delete(self):
+        self.assertEqual(bulk.run(self.user.pk, bulk.FAVORITE, self.ids[:3]), 3)
+        self.assertEqual(bulk.run(self.user.pk, bulk.UNFAVORITE, self.ids[2:]), 1)
+        self.assertEverythingAdjusted()
+        self.assertEqual(counters.for_owner(self.user.pk).favorites, 2)
+        
+        version = caching.get_version(self.user.pk)
+        self.assertEqual(bulk.run(self.user.pk, bulk.DELETE, self.ids[1:4]), 3)
+        self.assertNotEqual(caching.get_version(self.user.pk), version)
+        self.assertEverythingAdjusted()
+        self.assertEqual(counters.for_owner(self.user.pk).total, 2)
+    
+    def test_more_ids_than_batch_size(self):
+        # Con trozos de 2, las 5 citas (y una repetida) van en 3 trozos
+        with mock.patch.object(bulk, 'BATCH_SIZE', 2):
+            self.assertEqual(len(list(bulk._batches(self.ids + self.ids[:1]))), 3)
+            self.assertEqual(bulk.run(self.user.pk, bulk.CLASSIFY, self.ids + self.ids[:1], self.filosofia), 5)
+            self.assertEverythingAdjusted()
+            self.assertEqual(bulk.run(self.user.pk, bulk.FAVORITE, self.ids), 5)
+            self.assertEqual(bulk.run(self.user.pk, bulk.DELETE, self.ids[1:]), 4)
+        self.assertEverythingAdjusted()
+        self.assertEqual(list(Cita.objects.filter(owner=self.user).values_list('pk', 'tag', 'is_favorite')),
+                         [(self.ids[0], self.filosofia.pk, True)])
+    
+    def test_ids_out_of_range(self):
+        # Un id que no cabe en un BigAutoField: error del formulario y no un 500
+        self.client.force_login(self.user)
+        for ids in (['99999999999999999999'], [self.ids[0], str(-2 ** 63 - 1)]):
+            with self.subTest(ids=ids):
+                response = self.client.post(reverse('citas:quote_bulk_action'),
+                                            {'action': bulk.FAVORITE, 'ids': ids})
+                self.assertEqual(response.status_code, 302)
+                self.assertIn('Selección de citas no válida.',
+                              [str(m) for m in get_messages(response.wsgi_request)])
+        self.assertFalse(Cita.objects.filter(owner=self.user, is_favorite=True).exists())
+
+
+class SuggestionTests(TestCase):
+    """
+    El clasificador de temas (suggestions.py): lo que aprenden las señales
+    poco a poco tiene que ser lo mismo que entrenarlo de cero.
+    """
+    
+    databases = '__all__'
+    
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user('ana', password='x')
+        self.enterContext(sharding.for_owner(self.user.pk))
+        self.filosofia = Tema.objects.create(owner=self.user, name='Filosofía')
+        self.poesia = Tema.objects.create(owner=self.user, name='Poesía')
+        for text, source, tema in [
+            ('El ser humano es una cuerda tendida entre el animal y el superhombre', 'Nietzsche', self.filosofia),
+            ('Dios ha muerto y nosotros lo hemos matado', 'Nietzsche', self.filosofia),
+            ('Pienso, luego existo', 'Descartes', self.filosofia),
+            ('Caminante no hay camino, se hace camino al andar', 'Machado', self.poesia),
+            ('Verde que te quiero verde, verde viento, verdes ramas', 'Lorca', self.poesia),
+        ]:
+            Cita.objects.create(owner=self.user, text=text, source=source, tag=tema)
+        suggestions.retrain(self.user.pk)
+    
+    def assertSameAsRetrain(self):
+        self.assertEqual(learned(suggestions.load(self.user.pk)),
+                         learned(suggestions.train(self.user.pk)))
+    
+    def test_incremental_updates_match_a_full_retrain(self):
+        cita = Cita.objects.create(owner=self.user, text='Caminante, son tus huellas el camino', source='Machado')
+        self.assertSameAsRetrain()
+        
+        # Del inbox a un tema, de un tema a otro, cambio de texto y de fuente
+        cita.tag = self.poesia
+        cita.save()
+        self.assertSameAsRetrain()
+        cita.tag = self.filosofia
+        cita.save()
+        self.assertSameAsRetrain()
+        cita.text = 'Nada más que el camino'
+        cita.source = 'Antonio Machado'
+        cita.save(update_fields=['text', 'source'])
+        self.assertSameAsRetrain()
+        
+        cita.delete()
+        self.assertSameAsRetrain()
+        self.poesia.delete()
+        self.assertSameAsRetrain()
+    
+    def test_suggest(self):
+        inbox = [
+            Cita.objects.create(owner=self.user, text='Dios ha muerto', source='Nietzsche'),
+            Cita.objects.create(owner=self.user, text='Verde viento, verdes ramas', source='Lorca'),
+            Cita.objects.create(owner=self.user, text='Xyz qwerty'),
+        ]
+        result = suggestions.suggest(self.user.pk, inbox)
+        
+        self.assertEqual(result[inbox[0].pk][0][0], self.filosofia)
+        self.assertEqual(result[inbox[1].pk][0][0], self.poesia)
+        # Palabras que no ha visto nunca: ninguna sugerencia
+        self.assertEqual(result[inbox[2].pk], [])
+        # De mayor a menor y con la puntuación mínima
+        for found in result.values():
+            scores = [score for _, score in found]
+            self.assertEqual(scores, sorted(scores, reverse=True))
+            self.assertTrue(all(score >= suggestions.MIN_SCORE for score in scores))
+        
+        self.assertEqual(len(suggestions.suggest(self.user.pk, inbox[:1], k=1)[inbox[0].pk]), 1)
+        self.assertEqual(suggestions.suggest(self.user.pk, []), {})
+    
+    def test_partial_instance_does_not_retrain_in_the_request(self):
+        pk = Cita.objects.filter(tag=self.poesia).values_list('pk', flat=True).first()
+        
+        # Cargada con .only(): Django la guarda solo con ese campo
+        cita = Cita.objects.only('is_favorite').get(pk=pk)
+        cita.is_favorite = True
+        with mock.patch.object(suggestions, 'train') as train:
+            cita.save()
+        train.assert_not_called()
+        self.assertTrue(ClasificadorTemas.objects.filter(owner=self.user).exists())
+        
+        # Si cambia el tema sin saber cuál tenía, lo tira (y no lo entrena aquí)
+        cita = Cita.objects.only('tag').get(pk=pk)
+        cita.tag = self.filosofia
+        with mock.patch.object(suggestions, 'train') as train:
+            cita.save()
+        train.assert_not_called()
+        self.assertFalse(ClasificadorTemas.objects.filter(owner=self.user).exists())
+        
+        # La próxima vez que haga falta se entrena con las citas como estén
+        self.assertEqual(learned(suggestions.load(self.user.pk))[0], {self.filosofia.pk: 4, self.poesia.pk: 1})
+
+
+class DuplicateTextTests(TestCase):
+    """Citas casi repetidas por el texto (duplicates.py: MinHash + LSH)"""
+    
+    databases = '__all__'
+    
+    ORIGINAL = 'El ser humano es una cuerda tendida entre el animal y el superhombre, una cuerda sobre un abismo'
+    # La misma con otra puntuación, minúsculas y el autor al final
+    NEAR = 'el ser humano es una cuerda tendida entre el animal y el superhombre: una cuerda sobre un abismo. —Nietzsche'
+    # Empieza igual: comparte alguna cubeta pero no se parece tanto
+    HALF = 'El ser humano es una cuerda tendida entre la bestia y el superhombre'
+    OTHER = 'Caminante no hay camino, se hace camino al andar'
+    
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user('ana', password='x')
+        self.other = User.objects.create_user('bea', password='x')
+        with sharding.for_owner(self.other.pk):
+            Cita.objects.create(owner=self.other, text=self.ORIGINAL)
+        self.enterContext(sharding.for_owner(self.user.pk))
+        self.cita = Cita.objects.create(owner=self.user, text=self.ORIGINAL)
+        Cita.objects.create(owner=self.user, text=self.OTHER)
+    
+    def keys(self, text):
+        return duplicates.band_keys([duplicates.from_bytes(duplicates.signature(text))])[0]
+    
+    def test_near_duplicate_is_found(self):
+        found = duplicates.find_similar(self.user.pk, self.NEAR)
+        # Solo la mía, no la de la otra persona ni la que no se parece
+        self.assertEqual([cita.pk for cita, _ in found], [self.cita.pk])
+        self.assertGreaterEqual(found[0][1], duplicates.THRESHOLD)
+        
+        self.assertEqual(duplicates.find_similar(self.user.pk, self.NEAR, exclude_pk=self.cita.pk), [])
+        self.assertEqual(duplicates.find_similar(self.user.pk, self.OTHER)[0][1], 1.0)
+    
+    def test_buckets_and_threshold(self):
+        # Sin ninguna cubeta en común ni siquiera es candidata
+        self.assertFalse((self.keys(self.ORIGINAL) == self.keys('Pienso, luego existo')).any())
+        
+        # Con alguna cubeta en común es candidata, pero por debajo del umbral no sale
+        self.assertTrue((self.keys(self.ORIGINAL) == self.keys(self.HALF)).any())
+        score = duplicates.similarity(duplicates.signature(self.ORIGINAL), duplicates.signature(self.HALF))
+        self.assertLess(score, duplicates.THRESHOLD)
+        self.assertEqual(duplicates.find_similar(self.user.pk, self.HALF), [])
+        self.assertEqual(len(duplicates.find_similar(self.user.pk, self.HALF, threshold=score)), 1)
+        
+        # Cambiar un solo número de la huella solo cambia la cubeta de su banda
+        self.cita.refresh_from_db()
+        sig = duplicates.from_bytes(self.cita.text_minhash).copy()
+        sig[duplicates.ROWS * 5] += 1
+        changed = duplicates.band_keys([sig])[0] != self.keys(self.ORIGINAL)
+        self.assertEqual(changed.nonzero()[0].tolist(), [5])
+    
+    def test_index_follows_text_changes(self):
+        self.cita.text = self.HALF
+        self.cita.save()
+        self.assertEqual(duplicates.find_similar(self.user.pk, self.NEAR), [])
+        
+        # Las de bulk_create no tienen huella hasta index_missing
+        Cita.objects.bulk_create([Cita(owner=self.user, text=self.NEAR)])
+        self.assertEqual(duplicates.find_similar(self.user.pk, self.ORIGINAL), [])
+        self.assertEqual(duplicates.index_missing([self.user.pk]), 1)
+        self.assertEqual(len(duplicates.find_similar(self.user.pk, self.ORIGINAL)), 1)
+    
+    def test_clusters(self):
+        texts = [self.ORIGINAL, self.OTHER, self.NEAR, self.HALF, self.OTHER.upper()]
+        sigs, _ = duplicates.signatures(texts)
+        groups = duplicates.clusters([10, 11, 12, 13, 14], sigs)
+        self.assertEqual(sorted(sorted(group) for group in groups), [[10, 12], [11, 14]])
+
+
+def pattern(seed, size=(180, 160)):
+    """Una imagen con manchas (8x9 grises al azar, ampliados y suavizados)"""
+    pixels = np.random.default_rng(seed).integers(0, 256, (8, 9), dtype=np.uint8)
+    return Image.fromarray(pixels).resize(size, Image.Resampling.BILINEAR).convert('RGB')
+
+
+def image_file(image, name='foto.png', fmt='PNG', **options):
+    buffer = BytesIO()
+    image.save(buffer, fmt, **options)
+    return ContentFile(buffer.getvalue(), name=name)
+
+
+class DuplicateImageTests(TestCase):
+    """Imágenes casi iguales (perceptual.py: dHash + cubetas de 16 bits)"""
+    
+    databases = '__all__'
+    
+    def setUp(self):
+        clear_caches()
+        media = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(MEDIA_ROOT=media))
+        self.user = User.objects.create_user('ana', password='x')
+        self.enterContext(sharding.for_owner(self.user.pk))
+        # Las señales calculan el hash abriendo el fichero
+        self.cita = Cita.objects.create(owner=self.user, text='Meme', image=image_file(pattern(1)))
+        Cita.objects.create(owner=self.user, text='Otro', image=image_file(pattern(2), name='otro.png'))
+        self.cita.refresh_from_db()
+    
+    def test_recompressed_copy_is_found(self):
+        # Más pequeña y en JPEG: otros bytes, el mismo hash (o casi)
+        copy = image_file(pattern(1).resize((120, 107)), name='copia.jpg', fmt='JPEG', quality=60)
+        value = perceptual.dhash(copy)
+        self.assertEqual(copy.tell(), 0)
+        self.assertLessEqual(perceptual.distance(value, self.cita.image_dhash), perceptual.MAX_DISTANCE)
+        
+        found = perceptual.find_similar(self.user.pk, value)
+        self.assertEqual([cita.pk for cita, _ in found], [self.cita.pk])
+        self.assertEqual(perceptual.find_similar(self.user.pk, value, exclude_pk=self.cita.pk), [])
+    
+    def test_unrelated_image_is_not_found(self):
+        value = perceptual.dhash(image_file(pattern(3)))
+        self.assertGreater(perceptual.distance(value, self.cita.image_dhash), perceptual.MAX_DISTANCE)
+        self.assertEqual(perceptual.find_similar(self.user.pk, value), [])
+    
+    def test_hamming_threshold_and_chunks(self):
+        # (Con XOR de bits por debajo del 63 sigue siendo un entero con signo de 64 bits)
+        value = self.cita.image_dhash
+        # Un bit distinto en 3 de los 4 trozos: el cuarto trozo es igual y la encuentra
+        near = value ^ (1 | 1 << 16 | 1 << 32)
+        self.assertEqual(perceptual.distance(value, near), perceptual.MAX_DISTANCE)
+        self.assertEqual(len(set(perceptual.chunk_keys(value)) & set(perceptual.chunk_keys(near))), 1)
+        self.assertEqual(len(perceptual.find_similar(self.user.pk, near)), 1)
+        
+        # Uno más en el otro trozo: ya no comparten cubeta (y son 4 bits, por encima del máximo)
+        far = near ^ (1 << 48)
+        self.assertEqual(set(perceptual.chunk_keys(value)) & set(perceptual.chunk_keys(far)), set())
+        self.assertEqual(perceptual.find_similar(self.user.pk, far), [])
+        
+        # Con los 4 bits en el mismo trozo sí es candidata, pero la distancia manda
+        same_chunk = value ^ 0b1111
+        self.assertEqual(perceptual.find_similar(self.user.pk, same_chunk), [])
+        self.assertEqual(len(perceptual.find_similar(self.user.pk, same_chunk, max_distance=4)), 1)
+    
+    def test_clusters(self):
+        hashes = [perceptual.dhash_image(image) for image in (
+            pattern(1), pattern(2), pattern(1, size=(90, 80)), pattern(3), pattern(2, size=(360, 320)),
+        )]
+        groups = perceptual.clusters([10, 11, 12, 13, 14], hashes)
+        self.assertEqual(sorted(sorted(group) for group in groups), [[10, 12], [11, 14]])
+
+
+class RelatedTests(TestCase):
+    """Las citas parecidas (related.py)"""
+    
+    databases = '__all__'
+    
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user('ana', password='x')
+        self.other = User.objects.create_user('bea', password='x')
+        with sharding.for_owner(self.other.pk):
+            Cita.objects.create(owner=self.other, text='El amor es un fuego que arde sin verse')
+        self.enterContext(sharding.for_owner(self.user.pk))
+        self.citas = [Cita.objects.create(owner=self.user, text=text) for text in [
+            'El amor es un fuego que arde sin verse',
+            'El amor es fuego que arde sin que se vea',
+            'Amor es un fuego que arde sin verse, es herida que duele y no se siente',
+            'El amor es una herida que duele y no se siente',
+            'Caminante no hay camino, se hace camino al andar',
+            'Pienso, luego existo',
+        ]]
+    
+    def test_top_k_without_the_cita_itself(self):
+        cita = self.citas[0]
+        found = related.similar(self.user.pk, cita.pk, k=2)
+        self.assertEqual([other.pk for other, _ in found], [self.citas[1].pk, self.citas[2].pk])
+        self.assertGreater(found[0][1], found[1][1])
+        
+        found = related.similar(self.user.pk, cita.pk)
+        ids = [other.pk for other, _ in found]
+        self.assertNotIn(cita.pk, ids)
+        # Las que no se parecen no llegan al mínimo (y la de la otra persona no está)
+        self.assertEqual(set(ids), {c.pk for c in self.citas[1:4]})
+        self.assertTrue(all(score >= related.MIN_SCORE for _, score in found))
+    
+    def test_follows_changes(self):
+        self.citas[1].delete()
+        self.citas[4].text = 'El amor es un fuego que arde sin verse y camina'
+        self.citas[4].save()
+        ids = [other.pk for other, _ in related.similar(self.user.pk, self.citas[0].pk, k=1)]
+        self.assertEqual(ids, [self.citas[4].pk])
+    
+    def test_approximate_index_excludes_the_cita_too(self):
+        index = related.build(self.user.pk)
+        vec = index.vector(self.citas[0].pk)
+        exact = index.search(vec, k=3, exclude=self.citas[0].pk)
+        
+        # Con el índice aproximado: con tan pocas citas hay menos grupos
+        # que PROBES y se miran todos, así que sale lo mismo que sin él
+        with mock.patch.object(related, 'APPROX_MIN', 1):
+            approximate = related.build(self.user.pk)
+        self.assertIsNotNone(approximate.groups)
+        self.assertLess(len(approximate.centroids), related.PROBES)
+        self.assertEqual(approximate.search(vec, k=3, exclude=self.citas[0].pk), exact)
+        self.assertEqual(approximate.search(vec, k=3, exclude=self.citas[0].pk, exact=True), exact)
+
+
+class AutocompleteTests(TestCase):
+    """Sugerencias para la fuente y el tema (autocomplete.py)"""
+    
+    databases = '__all__'
+    
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user('ana', password='x')
+        self.enterContext(sharding.for_owner(self.user.pk))
+        self.enterContext(mock.patch.object(autocomplete, '_indexes', OrderedDict()))
+        for source, count in [('Friedrich Nietzsche', 3), ('Nicolás Maquiavelo', 1), ('Antonio Machado', 2),
+                              ('antonio machado', 1), ('ANTONIO MACHADO ', 1)]:
+            for n in range(count):
+                Cita.objects.create(owner=self.user, text=f'{source} {n}', source=source)
+    
+    def values(self, prefix, **kwargs):
+        results = autocomplete.suggest(self.user.pk, autocomplete.SOURCE, prefix, **kwargs)
+        return [(result['value'], result['count']) for result in results]
+    
+    def test_prefix_of_any_word(self):
+        self.assertEqual(self.values('nietz'), [('Friedrich Nietzsche', 3)])
+        self.assertEqual(self.values('friedrich n'), [('Friedrich Nietzsche', 3)])
+        # Solo al principio de una palabra
+        self.assertEqual(self.values('ietz'), [])
+    
+    def test_accents_and_case(self):
+        # Las tres formas de escribir a Machado son una, con la más usada
+        self.assertEqual(self.values('MACH'), [('Antonio Machado', 4)])
+        self.assertEqual(self.values('nicolas'), self.values('NICOLÁS'))
+        self.assertEqual(self.values('nicolas'), [('Nicolás Maquiavelo', 1)])
+    
+    def test_ordered_by_count(self):
+        self.assertEqual(self.values(''), [('Antonio Machado', 4), ('Friedrich Nietzsche', 3),
+                                           ('Nicolás Maquiavelo', 1)])
+        self.assertEqual(self.values('n'), [('Friedrich Nietzsche', 3), ('Nicolás Maquiavelo', 1)])
+    
+    def test_limit(self):
+        self.assertEqual(len(self.values('', limit=2)), 2)
+        for limit in (0, -1):
+            with self.subTest(limit=limit):
+                self.assertEqual(self.values('', limit=limit), [('Antonio Machado', 4)])
+        with mock.patch.object(autocomplete, 'MAX_LIMIT', 2):
+            self.assertEqual(len(self.values('', limit=100)), 2)
+    
+    def test_temas_have_their_id(self):
+        tema = Tema.objects.create(owner=self.user, name='Filosofía')
+        Cita.objects.create(owner=self.user, text='Una', tag=tema)
+        self.assertEqual(autocomplete.suggest(self.user.pk, autocomplete.TEMA, 'filo'),
+                         [{'value': 'Filosofía', 'count': 1, 'id': tema.pk}])
+    
+    def test_rebuilt_after_changes(self):
+        self.assertEqual(self.values('sen'), [])
+        Cita.objects.create(owner=self.user, text='Otra', source='Séneca')
+        self.assertEqual(self.values('sen'), [('Séneca', 1)])
+    
+    def test_lru(self):
+        with mock.patch.object(autocomplete, 'MAX_INDEXES', 2):
+            autocomplete.load(self.user.pk, autocomplete.SOURCE)
+            autocomplete.load(self.user.pk, autocomplete.TEMA)
+            # Usar el de las fuentes lo pone el último: se va el de temas
+            autocomplete.load(self.user.pk, autocomplete.SOURCE)
+            autocomplete.load(self.user.pk + 1, autocomplete.SOURCE)
+            self.assertEqual(list(autocomplete._indexes),
+                             [(self.user.pk, autocomplete.SOURCE), (self.user.pk + 1, autocomplete.SOURCE)])
+    
+    def test_view(self):
+        self.client.force_login(self.user)
+        url = reverse('citas:quote_autocomplete')
+        response = self.client.get(url, {'field': 'source', 'q': 'nie', 'limit': 'x'})
+        self.assertEqual(response.json(), {'results': [{'value': 'Friedrich Nietzsche', 'count': 3}]})
+        self.assertEqual(self.client.get(url, {'field': 'text', 'q': 'a'}).status_code, 400)
+
+
+class FavoriteApiTests(TestCase):
+    """quote_favorite_api (la de main.js) y set_favorite, que es la que hace el UPDATE"""
+    
+    databases = '__all__'
+    
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user('ana', password='x')
+        self.other = User.objects.create_user('bea', password='x')
+        with sharding.for_owner(self.user.pk):
+            self.cita = Cita.objects.create(owner=self.user, text='Mía')
+        # Con shards los ids se repiten (cada BD tiene los suyos): uno que no sea el de la mía
+        with sharding.for_owner(self.other.pk):
+            self.ajena = Cita.objects.create(pk=self.cita.pk + 1000, owner=self.other, text='De otra persona')
+        self.client.force_login(self.user)
+    
+    def _post(self, pk, favorite):
+        return self.client.post(reverse('citas:quote_favorite_api', args=[pk]), {'favorite': favorite})
+    
+    def _favorites(self):
+        with sharding.for_owner(self.user.pk):
+            return counters.for_owner(self.user.pk).favorites
+    
+    def test_mark_and_unmark(self):
+        version = caching.get_version(self.user.pk)
+        response = self._post(self.cita.pk, '1')
+        self.assertEqual(response.json(), {'id': self.cita.pk, 'is_favorite': True, 'changed': True})
+        self.assertEqual(self._favorites(), 1)
+        self.assertNotEqual(caching.get_version(self.user.pk), version)
+        
+        response = self._post(self.cita.pk, '0')
+        self.assertEqual(response.json()['changed'], True)
+        self.assertEqual(self._favorites(), 0)
+    
+    def test_same_value_changes_nothing(self):
+        self._post(self.cita.pk, '1')
+        version = caching.get_version(self.user.pk)
+        
+        # Dos clics seguidos (o dos pestañas): el segundo no suma
+        response = self._post(self.cita.pk, '1')
+        self.assertEqual(response.json()['changed'], False)
+        self.assertEqual(self._favorites(), 1)
+        self.assertEqual(caching.get_version(self.user.pk), version)
+        
+        with sharding.for_owner(self.user.pk):
+            self.assertFalse(set_favorite(self.user, self.cita.pk, True))
+        self.assertEqual(self._favorites(), 1)
+    
+    def test_other_users_cita_is_404(self):
+        for favorite in ('1', '0'):
+            with self.subTest(favorite=favorite):
+                self.assertEqual(self._post(self.ajena.pk, favorite).status_code, 404)
+        with sharding.for_owner(self.user.pk), self.assertRaises(Http404):
+            set_favorite(self.user, self.ajena.pk, True)
+        
+        with sharding.for_owner(self.other.pk):
+            self.assertFalse(Cita.objects.get(pk=self.ajena.pk).is_favorite)
+            self.assertEqual(counters.for_owner(self.other.pk).favorites, 0)
+        self.assertEqual(self._favorites(), 0)
+    
+    def test_missing_favorite_is_400(self):
+        response = self.client.post(reverse('citas:quote_favorite_api', args=[self.cita.pk]))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self._favorites(), 0)
+
+
+class AsyncFavoriteTests(TestCase):
+    """
+    async_views.quote_toggle_favorite (la que usa urls.py con ASGI). Como
+    urls.py elige las vistas al arrancar, la llamo directamente.
+    """
+    
+    databases = '__all__'
+    
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user('ana', password='x')
+        self.other = User.objects.create_user('bea', password='x')
+        with sharding.for_owner(self.user.pk):
+            self.cita = Cita.objects.create(owner=self.user, text='Mía')
+        # Con shards los ids se repiten (cada BD tiene los suyos): uno que no sea el de la mía
+        with sharding.for_owner(self.other.pk):
+            self.ajena = Cita.objects.create(pk=self.cita.pk + 1000, owner=self.other, text='De otra persona')
+    
+    def _toggle(self, user, pk, data=None):
+        request = AsyncRequestFactory().post(f'/citas/toggle-favorite/{pk}/', data or {})
+        request.user = user
+        request.auser = sync_to_async(lambda: user)
+        request._messages = CookieStorage(request)
+        
+        async def view(request):
+            return await async_views.quote_toggle_favorite(request, pk=pk)
+        
+        # Como en una petición de verdad: ShardMiddleware alrededor de la vista
+        if sharding.enabled():
+            view = sharding.ShardMiddleware(view)
+        return async_to_sync(view)(request)
+    
+    def test_toggle(self):
+        response = self._toggle(self.user, self.cita.pk)
+        self.assertEqual(response.status_code, 302)
+        with sharding.for_owner(self.user.pk):
+            self.assertTrue(Cita.objects.get(pk=self.cita.pk).is_favorite)
+            self.assertEqual(counters.for_owner(self.user.pk).favorites, 1)
+        
+        self._toggle(self.user, self.cita.pk, {'favorite': '0'})
+        with sharding.for_owner(self.user.pk):
+            self.assertFalse(Cita.objects.get(pk=self.cita.pk).is_favorite)
+            self.assertEqual(counters.for_owner(self.user.pk).favorites, 0)
+    
+    def test_other_users_cita_is_404(self):
+        # Con y sin 'favorite' (sin él la vista lee la cita para darle la vuelta)
+        for data in ({}, {'favorite': '1'}):
+            with self.subTest(data=data), self.assertRaises(Http404):
+                self._toggle(self.user, self.ajena.pk, data)
+        with sharding.for_owner(self.other.pk):
+            self.assertFalse(Cita.objects.get(pk=self.ajena.pk).is_favorite)
+    
+    def test_login_required(self):
+        response = self._toggle(AnonymousUser(), self.cita.pk)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.url.startswith(settings.LOGIN_URL))
+        with sharding.for_owner(self.user.pk):
+            self.assertFalse(Cita.objects.get(pk=self.cita.pk).is_favorite)
+
+
+class EventHubTests(TestCase):
+    """El reparto de los cambios en directo (events.Hub)"""
+    
+    def setUp(self):
+        # Uno nuevo con colas e historial pequeños (no el del proceso)
+        self.hub = events.Hub(queue_size=2, history=3)
+    
+    def _pending(self, subscriber):
+        pending = []
+        while not subscriber.queue.empty():
+            pending.append(subscriber.queue.get_nowait())
+        return [(event.kind, event.data) for event in pending]
+    
+    def test_full_queue_is_replaced_by_resync(self):
+        async def run():
+            subscriber = self.hub.subscribe(1)
+            self.hub.publish(1, events.TOGGLED, id=5, is_favorite=True)
+            self.hub.publish(2, events.DELETED, id=6)
+            # publish() entrega con call_soon_threadsafe: que corra el bucle
+            await asyncio.sleep(0)
+            self.assertEqual(self._pending(subscriber), [(events.TOGGLED, {'id': 5, 'is_favorite': True})])
+            
+            for pk in range(3):
+                self.hub.publish(1, events.DELETED, id=pk)
+            await asyncio.sleep(0)
+            self.assertEqual(self._pending(subscriber), [(events.RESYNC, {})])
+        async_to_sync(run)()
+    
+    def test_last_event_id_replays_missed_events(self):
+        async def run():
+            first = self.hub.publish(1, events.CREATED, id=1, tag=None)
+            self.hub.publish(1, events.UPDATED, id=1, tag=2)
+            self.hub.publish(1, events.DELETED, id=1)
+            subscriber = self.hub.subscribe(1, first.id)
+            self.assertEqual(self._pending(subscriber), [
+                (events.UPDATED, {'id': 1, 'tag': 2}), (events.DELETED, {'id': 1}),
+            ])
+            
+            # Del historial ya se ha caído (solo guarda 3), de otro proceso o basura: resync
+            self.hub.publish(1, events.CREATED, id=2, tag=None)
+            for last_event_id in (first.id, 'abcdef12-1', 'basura'):
+                with self.subTest(last_event_id=last_event_id):
+                    subscriber = self.hub.subscribe(1, last_event_id)
+                    self.assertEqual(self._pending(subscriber), [(events.RESYNC, {})])
+        async_to_sync(run)()
+    
+    def test_disconnect_unsubscribes(self):
+        async def run():
+            subscriber = self.hub.subscribe(1)
+            body = events.stream(subscriber)
+            self.assertEqual(await anext(body), 'retry: 5000\n\n')
+            event = self.hub.publish(1, events.DELETED, id=5)
+            self.assertEqual(await anext(body), event.encode())
+            self.assertEqual(self.hub.connections(), 1)
+            # Es lo que hace Django cuando el navegador cierra la conexión
+            await body.aclose()
+            self.assertEqual(self.hub.connections(), 0)
+        with mock.patch.object(events, 'hub', self.hub):
+            async_to_sync(run)()
+    
+    def test_check_warns_with_several_workers(self):
+        for workers, warnings in (('', []), ('1', []), ('4', ['citas.W001'])):
+            with self.subTest(workers=workers), mock.patch.dict(os.environ, {'WEB_CONCURRENCY': workers}):
+                self.assertEqual([warning.id for warning in events.check_single_process()], warnings)
+
+
+@skipUnless(sharding.enabled(), 'CITAS_SHARDS=0')
+class ShardingTests(TestCase):
+    """
+    Con CITAS_SHARDS (los tests se ejecutan con 2, ver settings.py) cada
+    vista de citas solo tiene que consultar el shard del usuario.
+    """
+    
+    databases = '__all__'
+    
+    def setUp(self):
+        clear_caches()
+        # Usuarios hasta tener uno en cada shard
+        self.users = {}
+        number = 0
+        while len(self.users) < len(sharding.databases()):
+            user = User.objects.create_user(f'usuario{number}', password='x')
+            self.users.setdefault(sharding.db_for_owner(user.pk), user)
+            number += 1
+        
+        for user in self.users.values():
+            with sharding.for_owner(user.pk):
+                tema = Tema.objects.create(owner=user, name='Filosofía')
+                Cita.objects.create(owner=user, text='Solo sé que no sé nada', source='Sócrates', tag=tema)
+                Cita.objects.create(owner=user, text='Pienso, luego existo', source='Descartes')
+    
+    def _shards_used(self, request):
+        """Los shards que consulta request() (default aparte: ahí están las sesiones)"""
+        shards = [alias for alias in settings.DATABASES if alias.startswith(sharding.SHARD_PREFIX)]
+        contexts = {alias: CaptureQueriesContext(connections[alias]) for alias in shards}
+        for context in contexts.values():
+            context.__enter__()
+        # Sin caché: que cada vista tenga que ir a la BD
+        clear_caches()
+        try:
+            response = request()
+            if response.streaming:
+                b''.join(response.streaming_content)
+        finally:
+            for context in contexts.values():
+                context.__exit__(None, None, None)
+        self.assertLess(response.status_code, 400)
+        return {alias for alias, context in contexts.items() if len(context)}
+    
+    def test_users_are_spread_across_shards(self):
+        self.assertEqual(set(self.users), set(sharding.databases()))
+        for alias, user in self.users.items():
+            self.assertEqual(Cita.objects.using(alias).filter(owner=user).count(), 2)
+            self.assertFalse(Cita.objects.using(alias).exclude(owner=user).exists())
+    
+    def test_hash_is_stable(self):
+        self.assertEqual(sharding.hashed_shard(42), sharding.hashed_shard(42))
+        # Al pasar de 2 a 3 shards solo se mueven los que van al nuevo
+        for owner_id in range(200):
+            new = sharding.hashed_shard(owner_id, 3)
+            if new != sharding.shard_alias(2):
+                self.assertEqual(new, sharding.hashed_shard(owner_id, 2))
+    
+    def test_query_without_shard_fails(self):
+        with self.assertRaises(sharding.NoShardSelected):
+            list(Cita.objects.all())
+    
+    def test_views_hit_only_the_users_shard(self):
+        for alias, user in self.users.items():
+            self.client.force_login(user)
+            with sharding.for_owner(user.pk):
+                cita = Cita.objects.filter(owner=user).first()
+                tema = Tema.objects.get(owner=user)
+            
+            requests = {
+                'lista': lambda: self.client.get(reverse('citas:quote_list')),
+                'lista filtrada': lambda: self.client.get(reverse('citas:quote_list'), {'q': 'sé', 'tag': tema.pk}),
+                'página': lambda: self.client.get(reverse('citas:quote_list_page')),
+                'exportar': lambda: self.client.get(reverse('citas:quote_export')),
+                'inbox': lambda: self.client.get(reverse('citas:quote_inbox')),
+                'aleatoria': lambda: self.client.get(reverse('citas:quote_random')),
+                'crear (GET)': lambda: self.client.get(reverse('citas:quote_create')),
+                'crear (POST)': lambda: self.client.post(reverse('citas:quote_create'), {'text': 'Nueva', 'source': 'Yo'}),
+                'editar (GET)': lambda: self.client.get(reverse('citas:quote_edit', args=[cita.pk])),
+                'editar (POST)': lambda: self.client.post(
+                    reverse('citas:quote_edit', args=[cita.pk]), {'text': 'Cambiada', 'source': 'Yo'}
+                ),
+                'favorita': lambda: self.client.post(reverse('citas:quote_toggle_favorite', args=[cita.pk])),
+                'favorita (JSON)': lambda: self.client.post(
+                    reverse('citas:quote_favorite_api', args=[cita.pk]), {'favorite': '1'}
+                ),
+                'autocompletar': lambda: self.client.get(reverse('citas:quote_autocomplete'), {'field': 'source', 'q': 'S'}),
+                'tarjeta': lambda: self.client.get(reverse('citas:quote_card', args=[cita.pk])),
+                'en bloque': lambda: self.client.post(
+                    reverse('citas:quote_bulk_action'), {'action': bulk.UNFAVORITE, 'ids': [cita.pk]}
+                ),
+                'tema (GET)': lambda: self.client.get(reverse('citas:tema_create')),
+                'tema (POST)': lambda: self.client.post(reverse('citas:tema_create'), {'nombre': 'Ética'}),
+            }
+            for name, request in requests.items():
+                with self.subTest(shard=alias, vista=name):
+                    self.assertEqual(self._shards_used(request), {alias})
+    
+    def test_async_views_hit_only_the_users_shard(self):
+        factory = AsyncRequestFactory()
+        for alias, user in self.users.items():
+            for view in (async_views.quote_list, async_views.quote_inbox, async_views.quote_random):
+                request = factory.get('/citas/')
+                request.user = user
+                request.auser = sync_to_async(lambda user=user: user)
+                
+                # Como en una petición de verdad: ShardMiddleware alrededor de la vista
+                middleware = sharding.ShardMiddleware(view)
+                with self.subTest(shard=alias, vista=view.__name__):
+                    self.assertEqual(self._shards_used(lambda: async_to_sync(middleware)(request)), {alias})
+    
+    def test_move_user(self):
+        source, user = next(iter(self.users.items()))
+        target = next(alias for alias in sharding.databases() if alias != source)
+        # Sus dos primeras tienen los mismos ids que las del usuario de
+        # target (cada shard cuenta por su lado); esta no
+        with sharding.for_owner(user.pk):
+            Cita.objects.create(pk=50, owner=user, text='Con un id libre en el otro shard')
+        theirs = set(Cita.objects.using(target).values_list('pk', flat=True))
+        
+        out = StringIO()
+        call_command('move_user', user.username, '--to', target, stdout=out)
+        self.assertIn(f'{source} -> {target}, 3 citas', out.getvalue())
+        self.assertIn('2 cita(s) con id nuevo', out.getvalue())
+        
+        self.assertEqual(sharding.db_for_owner(user.pk), target)
+        self.assertEqual(ShardUsuario.objects.get(owner=user).shard, target)
+        self.assertFalse(Cita.objects.using(source).filter(owner=user).exists())
+        
+        # La del id libre lo conserva; las otras tienen uno nuevo y las de
+        # target siguen siendo de su usuario
+        moved = Cita.objects.using(target).filter(owner=user).select_related('tag')
+        self.assertIn(50, {cita.pk for cita in moved})
+        self.assertFalse({cita.pk for cita in moved} & theirs)
+        self.assertFalse(Cita.objects.using(target).filter(pk__in=theirs, owner=user).exists())
+        # Las citas conservan su tema (aunque el tema también cambie de id)
+        self.assertEqual(sorted(cita.tag.name if cita.tag else '' for cita in moved), ['', '', 'Filosofía'])
+        with sharding.for_owner(user.pk):
+            self.assertEqual(counters.for_owner(user.pk).total, 3)
+        
+        # Repetirlo (p. ej. un --rebalance que se corta) no borra nada
+        self.assertEqual(sharding.move_owner(user.pk, target, source=source), (0, 0))
+        self.assertEqual(Cita.objects.using(target).filter(owner=user).count(), 3)
+        
+        self.client.force_login(user)
+        self.assertEqual(self._shards_used(lambda: self.client.get(reverse('citas:quote_list'))), {target})
+        self.assertContains(self.client.get(reverse('citas:quote_list')), 'Pienso, luego existo')
+    
+    def test_placement_is_shared_between_processes(self):
+        source, user = next(iter(self.users.items()))
+        target = next(alias for alias in sharding.databases() if alias != source)
+        self.assertEqual(sharding.db_for_owner(user.pk), source)
+        
+        # Otro worker (con su propia caché 'default', vacía) ya lo sabe sin
+        # consultar ShardUsuario, y se entera de que move_user lo ha movido
+        cache.clear()
+        with self.assertNumQueries(0, using='default'):
+            self.assertEqual(sharding.db_for_owner(user.pk), source)
+        sharding.move_owner(user.pk, target)
+        cache.clear()
+        with self.assertNumQueries(0, using='default'):
+            self.assertEqual(sharding.db_for_owner(user.pk), target)
+            self.assertEqual(async_to_sync(sharding.adb_for_owner)(user.pk), target)
+    
+    def test_move_keeps_ids_when_free(self):
+        source, user = next(iter(self.users.items()))
+        target, other = next((alias, other) for alias, other in self.users.items() if alias != source)
+        with sharding.for_owner(other.pk):
+            Cita.objects.filter(owner=other).delete()
+        ids = set(Cita.objects.using(source).filter(owner=user).values_list('pk', flat=True))
+        
+        self.assertEqual(sharding.move_owner(user.pk, target), (2, 0))
+        self.assertEqual(set(Cita.objects.using(target).filter(owner=user).values_list('pk', flat=True)), ids)
+        # Y lo siguiente que se cree en target no choca con ellos
+        with sharding.for_owner(other.pk):
+            self.assertNotIn(Cita.objects.create(owner=other, text='Nueva').pk, ids)
+    
+    def test_admin_goes_to_the_shard_in_the_url(self):
+        admin_user = User.objects.create_superuser('jefa', password='x')
+        self.client.force_login(admin_user)
+        mine = {}
+        for alias, user in self.users.items():
+            with sharding.for_owner(user.pk):
+                mine[alias] = Cita.objects.create(owner=user, text=f'Cita de {user.username}')
+        
+        changelist = reverse('admin:citas_cita_changelist')
+        for alias, user in self.users.items():
+            cita = mine[alias]
+            with self.subTest(shard=alias):
+                for params in ({'owner__id__exact': user.pk}, {'shard': alias}):
+                    response = self.client.get(changelist, params)
+                    shown = {(cita.pk, cita.owner_id) for cita in response.context['cl'].result_list}
+                    self.assertIn((cita.pk, user.pk), shown)
+                    self.assertEqual({owner_id for _, owner_id in shown}, {user.pk})
+                
+                # La ficha (y borrar) van con los filtros de la lista
+                filters = {'_changelist_filters': f'shard={alias}'}
+                change = reverse('admin:citas_cita_change', args=[cita.pk])
+                self.assertContains(self.client.get(change, filters), cita.text)
+                delete = reverse('admin:citas_cita_delete', args=[cita.pk])
+                response = self.client.post(f'{delete}?_changelist_filters=shard%3D{alias}', {'post': 'yes'})
+                self.assertEqual(response.status_code, 302)
+                self.assertFalse(Cita.objects.using(alias).filter(pk=cita.pk, owner=user).exists())
+        
+        # Todos los temas están en la lista de algún shard
+        for alias in sharding.databases():
+            response = self.client.get(reverse('admin:citas_tema_changelist'), {'shard': alias})
+            self.assertContains(response, 'Filosofía')
+    
+    def test_deleting_a_user_deletes_their_citas(self):
+        alias, user = next(iter(self.users.items()))
+        user.delete()
+        self.assertFalse(Cita.objects.using(alias).filter(owner_id=user.pk).exists())
+        self.assertFalse(Tema.objects.using(alias).filter(owner_id=user.pk).exists())
+
+
+class WarmRequestTests(TestCase):
+    """
+    Con la caché llena, una página de alguien logueado no toca la BD:
+    sesión cached_db, usuario en caché (accounts/backends.py), mensajes en
+    cookie y contadores en caché (ver settings.py).
+    """
+    
+    databases = '__all__'
+    
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user('ana', password='una-clave-larga')
+        with sharding.for_owner(self.user.pk):
+            self.cita = Cita.objects.create(owner=self.user, text='Solo sé que no sé nada')
+        self.client.login(username='ana', password='una-clave-larga')
+    
+    def _queries(self, request):
+        """Las consultas de request() en todas las BD"""
+        contexts = [CaptureQueriesContext(connections[alias]) for alias in settings.DATABASES]
+        for context in contexts:
+            context.__enter__()
+        try:
+            response = request()
+        finally:
+            for context in contexts:
+                context.__exit__(None, None, None)
+        return response, [query['sql'] for context in contexts for query in context.captured_queries]
+    
+    def test_warm_quote_list_does_no_queries(self):
+        url = reverse('citas:quote_list')
+        self.client.get(url)  # la primera llena la caché
+        response, queries = self._queries(lambda: self.client.get(url))
+        self.assertContains(response, 'Solo sé que no sé nada')
+        self.assertEqual(queries, [])
+    
+    def test_messages_do_not_write_the_session(self):
+        url = reverse('citas:quote_toggle_favorite', args=[self.cita.pk])
+        response, queries = self._queries(lambda: self.client.post(url, {'favorite': '1'}))
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse([sql for sql in queries if 'django_session' in sql])
+        self.assertIn('messages', response.cookies)
+    
+    def test_counters_follow_changes(self):
+        url = reverse('citas:quote_list')
+        self.client.get(url)
+        with sharding.for_owner(self.user.pk):
+            Cita.objects.create(owner=self.user, text='Pienso, luego existo')
+            self.assertEqual(counters.for_owner(self.user.pk).total, 2)
+    
+    def test_password_change_invalidates_cached_user(self):
+        url = reverse('citas:quote_list')
+        self.client.get(url)
+        
+        self.user.set_password('otra-clave-larga')
+        self.user.save()
+        # La sesión era de la contraseña de antes: fuera
+        self.assertRedirects(self.client.get(url), f'{settings.LOGIN_URL}?next={url}')
+    
+    def test_session_and_user_live_in_the_shared_cache(self):
+        # Los tiene que ver igual cada proceso: si uno cierra la sesión o
+        # cambia la contraseña, los demás no pueden seguir con lo de antes
+        self.client.get(reverse('citas:quote_list'))
+        session = SessionStore(self.client.session.session_key)
+        for key in (session.cache_key, backends._key(self.user.pk)):
+            self.assertIsNotNone(caches['shared'].get(key))
+            self.assertIsNone(cache.get(key))
+        
+        cookie = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        self.client.logout()
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = cookie
+        self.assertEqual(self.client.get(reverse('citas:quote_list')).status_code, 302)
+    
+    def test_user_is_not_cached_in_a_per_process_cache(self):
+        local = {**settings.CACHES, 'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        with override_settings(CACHES=local):
+            self.assertEqual(backends.CachedModelBackend().get_user(self.user.pk), self.user)
+            self.assertIsNone(caches['shared'].get(backends._key(self.user.pk)))
+    
+    def test_old_sessions_with_model_backend_still_work(self):
+        self.client.force_login(self.user, backend='django.contrib.auth.backends.ModelBackend')
+        self.assertEqual(self.client.get(reverse('citas:quote_list')).status_code, 200)
+    
+    def test_failed_login_checks_the_password_once(self):
+        with mock.patch.object(User, 'check_password', autospec=True, return_value=False) as check:
+            self.assertIsNone(authenticate(username='ana', password='mal'))
+        self.assertEqual(check.call_count, 1)
+
+
+@skipUnless(settings.CITAS_DB_PROFILE == 'production', 'CITAS_DB_PROFILE=default')
+class SqliteTests(TestCase):
+    """
+    Los PRAGMA de SQLITE_PRAGMAS y el comando sqlite_maintenance.
+    
+    La BD de los tests está en memoria (sin -wal): para lo que depende del
+    fichero abro otra conexión con la misma configuración a uno temporal.
+    """
+    
+    def setUp(self):
+        directory = self.enterContext(tempfile.TemporaryDirectory())
+        self.connection = DatabaseWrapper({
+            **connections['default'].settings_dict, 'NAME': os.path.join(directory, 'db.sqlite3'),
+        }, alias='temporal')
+        self.addCleanup(self.connection.close)
+    
+    def pragma(self, name):
+        with self.connection.cursor() as cursor:
+            return cursor.execute(f'PRAGMA {name}').fetchone()[0]
+    
+    def test_pragmas_on_a_new_connection(self):
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        self.assertEqual(self.pragma('busy_timeout'), settings.SQLITE_PRAGMAS['busy_timeout'])
+        self.assertEqual(self.pragma('cache_size'), settings.SQLITE_PRAGMAS['cache_size'])
+        # NORMAL = 1, INCREMENTAL = 2, MEMORY = 2
+        self.assertEqual(self.pragma('synchronous'), 1)
+        self.assertEqual(self.pragma('auto_vacuum'), 2)
+        self.assertEqual(self.pragma('temp_store'), 2)
+    
+    def test_maintenance_returns_free_pages(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute('CREATE TABLE notas (texto TEXT)')
+            cursor.executemany('INSERT INTO notas VALUES (%s)', [('x' * 1000,) for _ in range(500)])
+            cursor.execute('DELETE FROM notas')
+        free = self.pragma('freelist_count')
+        self.assertGreater(free, 10)
+        
+        out = StringIO()
+        with mock.patch('citas.management.commands.sqlite_maintenance.connections', {'temporal': self.connection}):
+            call_command('sqlite_maintenance', '--pages', '10', stdout=StringIO())
+            self.assertEqual(self.pragma('freelist_count'), free - 10)
+            call_command('sqlite_maintenance', '--check', stdout=out)
+        self.assertIn('quick_check: ok', out.getvalue())
+        self.assertIn('PRAGMA optimize hecho', out.getvalue())
+        self.assertIn('-wal: ', out.getvalue())
+        # Todas, no una (ver el comando)
+        self.assertEqual(self.pragma('freelist_count'), 0)
+        self.assertEqual(os.path.getsize(f'{self.connection.settings_dict["NAME"]}-wal'), 0)
+
+
+class TimingTests(TestCase):
+    """ServerTimingMiddleware (timing.py): la cabecera y los avisos del log"""
+    
+    databases = '__all__'
+    
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user('ana', password='x')
+        with sharding.for_owner(self.user.pk):
+            for name in ('Filosofía', 'Poesía', 'Ciencia'):
+                Cita.objects.create(owner=self.user, text=f'Una de {name}',
+                                    tag=Tema.objects.create(owner=self.user, name=name))
+        self.client.force_login(self.user)
+    
+    def _n_plus_one(self, request):
+        """Una vista con el N+1 de siempre: el tema de cada cita sin select_related"""
+        with sharding.for_owner(self.user.pk):
+            names = [cita.tag.name for cita in Cita.objects.filter(owner=self.user)]
+        return HttpResponse(', '.join(names))
+    
+    @override_settings(CITAS_SERVER_TIMING=True)
+    def test_server_timing_header(self):
+        response = self.client.get(reverse('citas:quote_list'))
+        timings = [part.strip().split(';')[0] for part in response['Server-Timing'].split(',')]
+        self.assertEqual(timings, ['db', 'tpl', 'view'])
+        self.assertIn('consultas"', response['Server-Timing'])
+    
+    @override_settings(CITAS_SERVER_TIMING=False)
+    def test_no_header_when_off(self):
+        self.assertFalse(self.client.get(reverse('citas:quote_list')).has_header('Server-Timing'))
+    
+    @override_settings(CITAS_REQUEST_BUDGETS={'citas:quote_list': {'queries': 1, 'ms': 60000}})
+    def test_over_budget_is_logged(self):
+        with self.assertLogs('citas.timing', 'WARNING') as logs:
+            self.client.get(reverse('citas:quote_list'))
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn('citas:quote_list', logs.output[0])
+        self.assertIn('(máx. 1)', logs.output[0])
+    
+    @override_settings(CITAS_REQUEST_BUDGETS={'*': {'queries': 100, 'ms': 60000, 'repeats': 2}})
+    def test_repeated_query_is_logged(self):
+        middleware = timing.ServerTimingMiddleware(self._n_plus_one)
+        with self.assertLogs('citas.timing', 'WARNING') as logs:
+            middleware(RequestFactory().get('/citas/'))
+        self.assertIn('la misma consulta 3 veces, ¿N+1?', logs.output[0])
+        self.assertIn('citas_tema', logs.output[0])
+        
+        # Con margen para 3 no avisa
+        with override_settings(CITAS_REQUEST_BUDGETS={'*': {'queries': 100, 'ms': 60000, 'repeats': 3}}):
+            with self.assertNoLogs('citas.timing', 'WARNING'):
+                middleware(RequestFactory().get('/citas/'))
+
+
+class MetricsTests(TestCase):
+    """Las métricas de /metrics/ (metrics.py): sumar los procesos y quién las ve"""
+    
+    def setUp(self):
+        clear_caches()
+        self.dir = self.enterContext(tempfile.TemporaryDirectory())
+    
+    def test_exposition_adds_up_every_process(self):
+        # Dos procesos (dos pids) escribiendo cada uno en su fichero. Al
+        # terminar, patch deja el fichero de este proceso como estaba
+        with override_settings(CITAS_METRICS_DIR=self.dir), \
+                mock.patch.object(metrics, '_values', None), mock.patch.object(metrics, '_values_pid', None):
+            for pid, elapsed in ((111, 0.05), (222, 0.2)):
+                with mock.patch('os.getpid', return_value=pid):
+                    metrics.requests_total.inc(view='citas:quote_list', method='GET', status=200)
+                    metrics.request_duration.observe(elapsed, view='citas:quote_list')
+                    metrics.cache_hits_total.inc(3, cache='default')
+                    metrics.cache_misses_total.inc(1, cache='default')
+                    metrics._values.close()
+            self.assertEqual(sorted(os.listdir(self.dir)), ['111.bin', '222.bin'])
+            text = metrics.exposition()
+        
+        duration = 'citas_http_request_duration_seconds'
+        for line in (
+            'citas_http_requests_total{view="citas:quote_list",method="GET",status="200"} 2',
+            # Las cubetas se acumulan: la de 0.25 incluye la de 0.05
+            f'{duration}_bucket{{view="citas:quote_list",le="0.05"}} 1',
+            f'{duration}_bucket{{view="citas:quote_list",le="0.25"}} 2',
+            f'{duration}_bucket{{view="citas:quote_list",le="+Inf"}} 2',
+            f'{duration}_sum{{view="citas:quote_list"}} 0.25',
+            f'{duration}_count{{view="citas:quote_list"}} 2',
+            'citas_cache_hits_total{cache="default"} 6',
+            'citas_cache_hit_ratio{cache="default"} 0.75',
+        ):
+            self.assertIn(line, text.splitlines())
+    
+    def test_page_is_only_for_staff_or_with_token(self):
+        url = reverse('core:metrics')
+        self.assertRedirects(self.client.get(url), f'{settings.LOGIN_URL}?next={url}', fetch_redirect_response=False)
+        
+        user = User.objects.create_user('ana', password='x')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(url).status_code, 403)
+        user.is_staff = True
+        user.save()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE citas_http_requests_total counter', response.content.decode())
+        
+        # El que las recoge no tiene sesión: le vale el token
+        self.client.logout()
+        with override_settings(CITAS_METRICS_TOKEN='un-token-largo'):
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer un-token-largo').status_code, 200)
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer otro').status_code, 302)
+        # Sin token en settings no vale ninguno (tampoco uno vacío)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer ').status_code, 302)
+
+
+# Los tests van con 2 shards (ver settings.py), pero lo normal es
+# CITAS_SHARDS=0. Estas repiten algunas clases con todo en default (la
+# suite entera también se puede pasar así: CITAS_SHARDS=0 python manage.py test)
+
+@override_settings(CITAS_SHARDS=0)
+class UnshardedTests(TestCase):
+    """Sin shards todo va a default, sin elegir shard en ningún sitio"""
+    
+    databases = '__all__'
+    
+    def test_everything_in_default(self):
+        clear_caches()
+        user = User.objects.create_user('ana', password='x')
+        self.assertEqual(sharding.db_for_owner(user.pk), 'default')
+        self.assertEqual(sharding.databases(), ['default'])
+        
+        # Sin for_owner y sin ShardMiddleware (MiddlewareNotUsed)
+        cita = Cita.objects.create(owner=user, text='Pienso, luego existo')
+        self.assertEqual(cita._state.db, 'default')
+        self.client.force_login(user)
+        self.assertContains(self.client.get(reverse('citas:quote_list')), 'Pienso, luego existo')
+        for alias in settings.DATABASES:
+            if alias != 'default':
+                self.assertFalse(Cita.objects.using(alias).exists())
+
+
+@override_settings(CITAS_SHARDS=0)
+class UnshardedPaginationTests(PaginationTests):
+    pass
+
+
+@override_settings(CITAS_SHARDS=0)
+class UnshardedSearchTests(SearchTests):
+    pass
+
+
+@override_settings(CITAS_SHARDS=0)
+class UnshardedRandomDrawTests(RandomDrawTests):
+    pass
+
+
+@override_settings(CITAS_SHARDS=0)
+class UnshardedImportTests(ImportTests):
+    pass
+
+
+@override_settings(CITAS_SHARDS=0)
+class UnshardedCounterTests(CounterTests):
+    pass
+
+
+@override_settings(CITAS_SHARDS=0)
+class UnshardedBulkTests(BulkTests):
+    pass
+
+
+@override_settings(CITAS_SHARDS=0)
+class UnshardedFavoriteApiTests(FavoriteApiTests):
+    pass
+
+
+@override_settings(CITAS_SHARDS=0)
+class UnshardedAsyncFavoriteTests(AsyncFavoriteTests):
+    pass
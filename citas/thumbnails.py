@@ -0,0 +1,210 @@
+"""
+Miniaturas (variantes redimensionadas) de las imágenes de las citas.
+
+Antes el grid ponía la imagen ORIGINAL en cada tarjeta: una foto del móvil
+puede pesar 5 MB, así que una página con 30 fotos eran cientos de MB.
+
+Ahora, cuando se guarda una cita con imagen, genero varias versiones más
+pequeñas en WebP y en JPEG (para navegadores sin WebP):
+
+    grid    -> 400 px de ancho  (tarjetas del grid)
+    grid2x  -> 800 px           (tarjetas en pantallas retina)
+    detail  -> 1200 px          (vista aleatoria)
+
+Las rutas se guardan en Cita.image_variants (un JSON) y los templates las
+usan con <picture>, srcset y loading="lazy" (ver templatetags/citas_images.py).
+
+Generar las variantes tarda (abrir la foto, redimensionar, comprimir...),
+así que no lo hago dentro de la petición: lo mando a un pool de hilos
+cuando termina la transacción y la vista responde enseguida. Mientras
+tanto los templates usan la imagen original.
+
+Para las imágenes que ya existían: python manage.py generate_thumbnails
+
+OJO: las variantes se guardan con default_storage y no con el storage de
+Cita.image, porque ese renombra cada fichero con su hash (storage.py).
+Como el nombre de la variante sale del de la imagen, que ya es su hash,
+dos citas con la misma imagen comparten también las miniaturas.
+"""
+
+import logging
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps
+
+from . import caching, sharding
+from .models import Cita, Imagen
+
+
+logger = logging.getLogger(__name__)
+
+# Nombre de la variante -> ancho máximo en píxeles
+VARIANTS = {
+    'grid': 400,
+    'grid2x': 800,
+    'detail': 1200,
+}
+
+# Formato -> (extensión, opciones de Pillow)
+FORMATS = {
+    'webp': ('webp', {'format': 'WEBP', 'quality': 80, 'method': 4}),
+    'jpeg': ('jpg', {'format': 'JPEG', 'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+# El pool se crea la primera vez que hace falta
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        workers = getattr(settings, 'CITAS_THUMBNAIL_WORKERS', 2)
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnails')
+    return _executor
+
+
+def variant_name(name, variant, extension):
+    """
+    Ruta de una variante a partir de la ruta de la imagen original.
+
+    quotes/foto.jpg -> quotes/variants/foto_grid.webp
+    """
+    directory, filename = posixpath.split(name)
+    stem = posixpath.splitext(filename)[0]
+    return posixpath.join(directory, 'variants', f'{stem}_{variant}.{extension}')
+
+
+def generate_variants(name, storage=None):
+    """
+    Genera todas las variantes de una imagen y las guarda en el storage.
+
+    No toca la base de datos (por eso se puede usar desde otros procesos
+    en el comando generate_thumbnails). Devuelve el dict para
+    Cita.image_variants:
+
+        {'grid': {'width': 400, 'webp': 'quotes/variants/..', 'jpeg': '..'}, ...}
+    """
+    storage = storage or default_storage
+
+    with Cita._meta.get_field('image').storage.open(name, 'rb') as original:
+        image = Image.open(original)
+        # Las fotos del móvil vienen giradas con EXIF: las pongo derechas
+        image = ImageOps.exif_transpose(image)
+        # WebP y JPEG no tienen paleta ni (JPEG) transparencia
+        image = image.convert('RGB')
+
+    variants = {}
+    previous = None
+    for variant, max_width in VARIANTS.items():
+        resized = image.copy()
+        # thumbnail() mantiene la proporción y nunca agranda
+        resized.thumbnail((max_width, max_width * 4), Image.LANCZOS)
+
+        # Si la original es pequeña, las variantes grandes saldrían iguales
+        # que la anterior: reutilizo los mismos ficheros
+        if previous and resized.width == previous['width']:
+            variants[variant] = previous
+            continue
+
+        variants[variant] = previous = {'width': resized.width}
+        for fmt, (extension, options) in FORMATS.items():
+            buffer = BytesIO()
+            resized.save(buffer, **options)
+
+            path = variant_name(name, variant, extension)
+            # Si ya existía (por ejemplo al regenerar) lo sustituyo
+            if storage.exists(path):
+                storage.delete(path)
+            variants[variant][fmt] = storage.save(path, ContentFile(buffer.getvalue()))
+
+    return variants
+
+
+def delete_variants(variants, storage=None):
+    """Borra del storage los ficheros de unas variantes"""
+    storage = storage or default_storage
+
+    paths = {
+        info[fmt]
+        for info in (variants or {}).values()
+        for fmt in FORMATS
+        if info.get(fmt)
+    }
+    for path in paths:
+        storage.delete(path)
+
+
+def delete_all_variants(name, storage=None):
+    """
+    Borra todas las variantes posibles de la imagen name.
+
+    No necesito saber cuáles se generaron: las rutas salen del nombre.
+    (Borrar un fichero que no existe no da error)
+    """
+    storage = storage or default_storage
+
+    for variant in VARIANTS:
+        for extension, _ in FORMATS.values():
+            storage.delete(variant_name(name, variant, extension))
+
+
+def process_cita(pk, name, owner_id):
+    """
+    Genera las variantes de una cita y guarda las rutas.
+
+    Se ejecuta en un hilo del pool. El UPDATE lleva image=name en el WHERE:
+    si mientras tanto el usuario cambió la imagen, no piso nada.
+
+    Si el mismo fichero ya tenía variantes (otra cita con la misma imagen)
+    las reutilizo sin escribir nada en disco.
+    """
+    close_old_connections()
+    try:
+        # Los hilos no heredan el shard de la petición (ver sharding.py)
+        with sharding.for_owner(owner_id):
+            imagen = Imagen.objects.filter(name=name).exclude(variants={}).first()
+            if imagen:
+                variants = imagen.variants
+            else:
+                variants = generate_variants(name)
+                Imagen.objects.filter(name=name).update(variants=variants)
+
+            updated = Cita.objects.filter(pk=pk, image=name).update(image_variants=variants)
+            if updated:
+                # update() no lanza señales: la tarjeta en caché tiene que
+                # cambiar a las miniaturas
+                caching.bump(owner_id)
+            elif not Imagen.objects.filter(name=name).exists():
+                # La imagen cambió y ya no la usa nadie: estas variantes sobran
+                delete_variants(variants)
+    except Exception:
+        logger.exception('No se pudieron generar las miniaturas de la cita %s', pk)
+    finally:
+        close_old_connections()
+
+
+def schedule(cita):
+    """
+    Programa la generación de variantes de una cita recién guardada.
+
+    Espera a que termine la transacción (on_commit): si no, el hilo podría
+    buscar una cita que todavía no existe para él. Con
+    CITAS_THUMBNAILS_SYNC = True se hace en el momento (útil en tests).
+    """
+    if not cita.image:
+        return
+
+    pk, name, owner_id = cita.pk, cita.image.name, cita.owner_id
+
+    # La transacción de la BD donde se ha guardado (ver sharding.py)
+    using = cita._state.db
+    if getattr(settings, 'CITAS_THUMBNAILS_SYNC', False):
+        transaction.on_commit(lambda: process_cita(pk, name, owner_id), using=using)
+    else:
+        transaction.on_commit(lambda: _get_executor().submit(process_cita, pk, name, owner_id), using=using)
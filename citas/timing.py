@@ -0,0 +1,212 @@
+"""
+Dónde se va el tiempo de cada petición (BD, plantillas, total) y aviso
+de las que se pasan de su presupuesto.
+
+ServerTimingMiddleware mide tres cosas:
+- db: cuántas consultas y cuánto tardan. Cada conexión a la BD lleva un
+  execute_wrapper (install_wrapper, se pone al crearse la conexión, ver
+  apps.py) que suma en el Timer de la petición.
+- tpl: lo que se tarda en renderizar plantillas (TimedTemplates, el
+  BACKEND de TEMPLATES en settings.py). Incluye las tarjetas que no
+  estaban en caché (caching.render_cards).
+- view: todo lo que pasa desde el middleware hasta que vuelve la
+  respuesta (la vista y los middlewares de después).
+
+OJO: db y tpl se solapan (una consulta mientras se renderiza cuenta en
+las dos). Y en las respuestas en streaming (export, eventos) solo se mide
+hasta que empieza a mandarse.
+
+Con CITAS_SERVER_TIMING (por defecto, con DEBUG) van en la cabecera
+Server-Timing, y las herramientas del navegador (pestaña Red -> Tiempos)
+las enseñan:
+
+    Server-Timing: db;dur=3.1;desc="4 consultas", tpl;dur=12.0, view;dur=18.4
+
+Y siempre, si una petición se pasa de su presupuesto
+(CITAS_REQUEST_BUDGETS, por nombre de la URL: 'citas:quote_list'...) lo
+apunta en el log 'citas.timing'. También si la misma consulta se repite
+muchas veces: lo típico de un N+1 (por ejemplo {{ cita.tag.name }} en
+cada tarjeta sin select_related('tag')).
+
+Lo que mide también va a las métricas de /metrics/ (ver metrics.py).
+
+El Timer va en un ContextVar y no en la conexión: con ASGI las consultas
+de las vistas async se ejecutan en otro hilo (sync_to_async), con otra
+conexión, pero el contexto se copia y llega el mismo Timer.
+"""
+
+import logging
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.template.backends.django import DjangoTemplates
+
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Presupuesto si no hay uno para la URL ni en '*'
+DEFAULT_BUDGET = {'queries': 50, 'ms': 1000, 'repeats': 10}
+
+_current = ContextVar('citas_timer', default=None)
+
+
+class Timer:
+    """Lo que se va sumando durante una petición"""
+
+    __slots__ = ('queries', 'db', 'template', 'rendering', 'statements')
+
+    def __init__(self):
+        self.queries = 0
+        self.db = 0.0
+        self.template = 0.0
+        # Para no contar dos veces una plantilla que se renderiza dentro de otra
+        self.rendering = False
+        # SQL (sin parámetros) -> veces, para ver los N+1
+        self.statements = Counter()
+
+
+# --- La BD ---
+
+def record_query(execute, sql, params, many, context):
+    """El execute_wrapper: mide la consulta si hay una petición midiéndose"""
+    timer = _current.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timer.db += time.perf_counter() - start
+        timer.queries += 1
+        timer.statements[sql] += 1
+
+
+def install_wrapper(sender, connection, **kwargs):
+    """
+    Para la señal connection_created: cada conexión nueva lleva
+    record_query para siempre (si no hay Timer no hace nada)
+    """
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+# --- Las plantillas ---
+
+class TimedTemplate:
+    """Una plantilla del backend de Django que suma lo que tarda en el Timer"""
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        timer = _current.get()
+        if timer is None or timer.rendering:
+            return self.template.render(context, request)
+        timer.rendering = True
+        start = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            timer.template += time.perf_counter() - start
+            timer.rendering = False
+
+
+class TimedTemplates(DjangoTemplates):
+    """El backend de siempre (DjangoTemplates) con TimedTemplate"""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+# --- El middleware ---
+
+def budget_for(view_name):
+    """El presupuesto de una URL: el suyo por encima del de '*'"""
+    budgets = getattr(settings, 'CITAS_REQUEST_BUDGETS', {})
+    return {**DEFAULT_BUDGET, **budgets.get('*', {}), **budgets.get(view_name, {})}
+
+
+class ServerTimingMiddleware:
+    """
+    Mide cada petición (ver arriba). Va el primero de MIDDLEWARE después
+    de SecurityMiddleware, para contar también la sesión y el usuario.
+
+    Funciona con WSGI y con ASGI (sin pasar a un hilo).
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timer = Timer()
+        token = _current.set(timer)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.finish(request, response, timer, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        timer = Timer()
+        token = _current.set(timer)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.finish(request, response, timer, time.perf_counter() - start)
+        return response
+
+    def finish(self, request, response, timer, elapsed):
+        if getattr(settings, 'CITAS_SERVER_TIMING', False):
+            timings = [
+                f'db;dur={timer.db * 1000:.1f};desc="{timer.queries} consultas"',
+                f'tpl;dur={timer.template * 1000:.1f}',
+                f'view;dur={elapsed * 1000:.1f}',
+            ]
+            if response.has_header('Server-Timing'):
+                timings.insert(0, response['Server-Timing'])
+            response['Server-Timing'] = ', '.join(timings)
+
+        match = request.resolver_match
+        view_name = match.view_name if match else None
+        metrics.observe_request(
+            view_name, request.method, response.status_code, elapsed, timer.queries, timer.db,
+        )
+        budget = budget_for(view_name)
+
+        problems = []
+        if timer.queries > budget['queries']:
+            problems.append(f'{timer.queries} consultas (máx. {budget["queries"]})')
+        if elapsed * 1000 > budget['ms']:
+            problems.append(f'{elapsed * 1000:.0f} ms (máx. {budget["ms"]})')
+        if timer.statements:
+            sql, repeats = timer.statements.most_common(1)[0]
+            if repeats > budget['repeats']:
+                problems.append(f'la misma consulta {repeats} veces, ¿N+1?: {sql[:200]}')
+
+        if problems:
+            logger.warning(
+                '%s %s (%s): %s', request.method, request.path, view_name or '-', '; '.join(problems),
+                extra={'view_name': view_name, 'queries': timer.queries, 'ms': elapsed * 1000},
+            )
@@ -3,16 +3,25 @@ URLs de la app citas.
 
 Aquí defino todas las rutas relacionadas con el contenido:
 - Ver lista de contenido con filtros
+- Fragmentos de la lista para el scroll infinito
 - Inbox (contenido sin clasificar)
+- Exportar todo el contenido
 - Vista aleatoria
 - Crear nuevo contenido
 - Editar contenido existente
-- Marcar/desmarcar favoritos
+- Marcar/desmarcar favoritos (con formulario o con JSON desde main.js)
+- Autocompletar la fuente y el tema (JSON)
+- Cambios en directo entre pestañas (Server-Sent Events) y tarjetas sueltas
 - Gestión de temas
 """
 
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import async_views, views
+
+# Con ASGI la lista, el inbox, la aleatoria y marcar favorita sin JS usan
+# las vistas async (ver async_views.py y CITAS_ASYNC_VIEWS en settings.py)
+pages = async_views if settings.CITAS_ASYNC_VIEWS else views
 
 # app_name me permite hacer referencia a estas URLs como 'citas:nombre'
 # Por ejemplo: {% url 'citas:quote_list' %}
@@ -22,17 +31,27 @@ urlpatterns = [
     # Lista principal de contenido (con filtros)
     # URL: /citas/
     # Vista: muestra todo el contenido del usuario con opciones de filtrado
-    path('', views.quote_list, name='quote_list'),
+    path('', pages.quote_list, name='quote_list'),
+    
+    # Siguiente página de la lista (solo las tarjetas, sin base.html)
+    # URL: /citas/page/?cursor=...
+    # Vista: la pide main.js al llegar al final del grid (scroll infinito)
+    path('page/', views.quote_list_page, name='quote_list_page'),
+    
+    # Exportar todo el contenido (JSONL, CSV o ZIP con imágenes)
+    # URL: /citas/export/?formato=zip
+    # Vista: descarga el fichero en streaming
+    path('export/', views.quote_export, name='quote_export'),
     
     # Inbox (contenido sin tema asignado)
     # URL: /citas/inbox/
     # Vista: solo muestra contenido que no tiene tema
-    path('inbox/', views.quote_inbox, name='quote_inbox'),
+    path('inbox/', pages.quote_inbox, name='quote_inbox'),
     
     # Vista aleatoria
     # URL: /citas/random/
     # Vista: muestra un contenido aleatorio del usuario
-    path('random/', views.quote_random, name='quote_random'),
+    path('random/', pages.quote_random, name='quote_random'),
     
     # Crear nuevo contenido
     # URL: /citas/create/
@@ -49,7 +68,32 @@ urlpatterns = [
     # URL: /citas/toggle-favorite/5/
     # Vista: botón que alterna el estado de favorito
     # Solo acepta POST (no GET) por seguridad
-    path('toggle-favorite/<int:pk>/', views.quote_toggle_favorite, name='quote_toggle_favorite'),
+    path('toggle-favorite/<int:pk>/', pages.quote_toggle_favorite, name='quote_toggle_favorite'),
+    
+    # Marcar/desmarcar favorito sin recargar la página (JSON)
+    # URL: /citas/api/favorite/5/ con favorite=1 o favorite=0
+    # Vista: la llama main.js y cambia la tarjeta en el sitio
+    path('api/favorite/<int:pk>/', views.quote_favorite_api, name='quote_favorite_api'),
+    
+    # Sugerencias mientras escribes la fuente o el tema (JSON)
+    # URL: /citas/api/autocomplete/?field=source&q=nie
+    # Vista: la llama main.js para rellenar las sugerencias del campo
+    path('api/autocomplete/', views.quote_autocomplete, name='quote_autocomplete'),
+    
+    # Cambios de mis citas en directo (Server-Sent Events, solo con ASGI)
+    # URL: /citas/api/events/
+    # Vista: main.js la deja abierta y cambia las tarjetas al llegar eventos
+    path('api/events/', async_views.quote_events, name='quote_events'),
+    
+    # Una tarjeta suelta (HTML)
+    # URL: /citas/api/card/5/?tipo=inbox
+    # Vista: la pide main.js para cambiar una tarjeta que ha cambiado en otra pestaña
+    path('api/card/<int:pk>/', views.quote_card, name='quote_card'),
+    
+    # Acciones en bloque sobre las citas marcadas (solo POST)
+    # URL: /citas/bulk/
+    # Vista: clasifica, marca favoritas o borra varias citas a la vez
+    path('bulk/', views.quote_bulk_action, name='quote_bulk_action'),
     
     # Crear nuevo tema
     # URL: /citas/tema/nuevo/
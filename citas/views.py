@@ -3,11 +3,16 @@ Vistas de la app citas.
 
 Aquí están todas las funciones que manejan las páginas de citas:
 - Ver lista de citas con filtros
+- Siguiente página de la lista (fragmento para el scroll infinito)
+- Exportar todas las citas (JSONL, CSV o ZIP)
 - Inbox (citas sin clasificar)
 - Cita aleatoria
 - Crear nueva cita
 - Editar cita existente
-- Marcar/desmarcar favorito
+- Marcar/desmarcar favorito (también en JSON, sin recargar)
+- Autocompletar la fuente y el tema (JSON)
+- Una tarjeta suelta (para los cambios en directo de main.js)
+- Acciones en bloque (clasificar, favoritas o borrar varias a la vez)
 
 Todas estas vistas están protegidas con @login_required, así que solo 
 los usuarios logueados pueden acceder.
@@ -15,13 +20,192 @@ los usuarios logueados pueden acceder.
 También filtro por owner (request.user) para que cada usuario vea solo sus cosas.
 """
 
+import re
+
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.db.models import Q
-import random
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import url_has_allowed_host_and_scheme
+from django.views.decorators.http import require_GET, require_POST
 from .models import Cita, Tema
-from .forms import QuoteForm, QuoteFilterForm
+from .forms import BulkActionForm, QuoteForm, QuoteFilterForm
+from .pagination import ORDERING, keyset_page
+from . import autocomplete, bulk, caching, counters, events, export, random_draw, related, search, sharding, suggestions, thumbnails
+
+
+# Plantilla de las tarjetas de la lista (y del scroll infinito)
+CARD_TEMPLATE = 'citas/partials/cita_card.html'
+INBOX_TEMPLATE = 'citas/partials/inbox_card.html'
+RANDOM_TEMPLATE = 'citas/partials/random_card.html'
+
+# Las tarjetas que main.js puede pedir sueltas (quote_card): plantilla y csrf
+LIVE_CARDS = {
+    'lista': (CARD_TEMPLATE, True),
+    'inbox': (INBOX_TEMPLATE, True),
+    'aleatoria': (RANDOM_TEMPLATE, False),
+}
+
+
+def filter_citas(citas, form):
+    """
+    Aplica los filtros de QuoteFilterForm a un queryset de citas.
+
+    La saco a una función aparte porque la usan dos vistas:
+    la lista completa (quote_list) y los fragmentos del scroll
+    infinito (quote_list_page). Así los filtros son siempre los mismos.
+
+    Si el formulario no es válido devuelvo el queryset tal cual.
+    """
+    # Compruebo si el formulario es válido
+    # Aunque los filtros son opcionales, necesito validar por si hay algo raro
+    if not form.is_valid():
+        return citas
+    
+    # === FILTRO DE BÚSQUEDA POR TEXTO ===
+    # Obtengo el valor del campo 'q' (el buscador)
+    q = form.cleaned_data.get('q')
+    
+    # Si el usuario escribió algo en el buscador
+    if q:
+        # Filtro las citas que contengan 'q' en text O en source
+        # Uso el índice de texto completo (FTS5) de search.py:
+        # no distingue mayúsculas ni tildes y busca por prefijo.
+        # Si no hay FTS5, search.py usa icontains como antes.
+        citas = search.filter_queryset(citas, q)
+    
+    # === FILTRO SOLO FAVORITAS ===
+    # Si marcó el checkbox de "solo favoritas"
+    if form.cleaned_data.get('favorite_only'):
+        # Me quedo solo con las que is_favorite=True
+        citas = citas.filter(is_favorite=True)
+    
+    # === FILTRO SOLO CON IMAGEN ===
+    # Si marcó el checkbox de "solo con imagen"
+    if form.cleaned_data.get('with_image_only'):
+        # exclude(image='') quita las que NO tienen imagen
+        # También podría hacer: filter(image__isnull=False)
+        # Pero exclude me parece más claro
+        citas = citas.exclude(image='')
+    
+    # === FILTRO POR TEMA ===
+    # Obtengo el tema seleccionado (si seleccionó alguno)
+    tag = form.cleaned_data.get('tag')
+    
+    # Si eligió un tema específico
+    if tag:
+        # Filtro solo las citas de ese tema
+        citas = citas.filter(tag=tag)
+    
+    return citas
+
+
+def _filter_params(request):
+    """
+    Devuelve los parámetros GET de los filtros sin el cursor.
+
+    Los uso para construir el enlace a la página siguiente
+    (mismos filtros + cursor nuevo) y como clave de la caché del contador.
+    """
+    params = request.GET.copy()
+    params.pop('cursor', None)
+    return params
+
+
+def _next_page_urls(request, next_cursor):
+    """
+    Construye las dos URLs de la página siguiente:
+    - la de la página completa (para quien no tiene JavaScript)
+    - la del fragmento HTML que pide main.js para el scroll infinito
+    """
+    if not next_cursor:
+        return None, None
+    
+    params = _filter_params(request)
+    params['cursor'] = next_cursor
+    query = params.urlencode()
+    
+    return (
+        f"{reverse('citas:quote_list')}?{query}",
+        f"{reverse('citas:quote_list_page')}?{query}",
+    )
+
+
+def _counted_total(user, form):
+    """
+    Si los filtros son de los que llevo contados (ninguno, solo favoritas,
+    solo con imagen o solo un tema), devuelvo el número de los contadores.
+    Si no (hay búsqueda o varios filtros a la vez) devuelvo None.
+    """
+    filters = {}
+    if form.is_bound:
+        if not form.is_valid():
+            return None
+        filters = {name: value for name, value in form.cleaned_data.items() if value}
+    
+    if not filters:
+        return counters.for_owner(user.pk).total
+    if filters.keys() == {'favorite_only'}:
+        return counters.for_owner(user.pk).favorites
+    if filters.keys() == {'with_image_only'}:
+        return counters.for_owner(user.pk).with_image
+    if filters.keys() == {'tag'}:
+        return counters.tema_counts(user.pk).get(filters['tag'].pk)
+    return None
+
+
+def _cached_count(request, user_cache, citas, form):
+    """
+    Cuenta las citas filtradas, pero guardando el resultado en caché.
+
+    Un COUNT(*) sobre decenas de miles de citas no es gratis, y antes
+    se hacía en cada visita ({{ citas.count }} en el template).
+    Ahora lo cuento una vez y lo reutilizo para el mismo usuario y los
+    mismos filtros hasta que cambie alguna de sus citas (la clave lleva
+    la versión de su caché, ver caching.py).
+
+    Si los filtros son sencillos ni siquiera cuento: uso los contadores.
+    
+    Si CITAS_SHOW_COUNT es False en settings no cuento nada (devuelve None).
+    """
+    if not getattr(settings, 'CITAS_SHOW_COUNT', True):
+        return None
+    
+    # Los filtros sencillos ya los tengo contados (ver counters.py)
+    total = _counted_total(request.user, form)
+    if total is not None:
+        return total
+    
+    # La clave depende de los filtros (ordenados para que ?a=1&b=2 y
+    # ?b=2&a=1 compartan entrada)
+    params = sorted(_filter_params(request).lists())
+    return user_cache.get_or_set(('count', caching.digest(params)), citas.count)
+
+
+def _page_ids(request, user_cache, citas):
+    """
+    Ids de la página pedida y el cursor de la siguiente.
+
+    La lista de ids se guarda en caché por filtros + cursor, así que
+    volver a la misma página no consulta la tabla de citas.
+
+    Devuelve (ids, next_cursor, citas_por_id). citas_por_id solo viene si
+    he tenido que ir a la BD (para no volver a cargarlas al renderizar).
+    """
+    key = user_cache.key('page', caching.digest(sorted(request.GET.lists())))
+    cached = cache.get(key)
+    if cached is not None:
+        ids, next_cursor = cached
+        return ids, next_cursor, None
+    
+    page, next_cursor = keyset_page(citas, request.GET.get('cursor'))
+    ids = [cita.pk for cita in page]
+    cache.set(key, (ids, next_cursor), caching.IDS_TIMEOUT)
+    return ids, next_cursor, {cita.pk: cita for cita in page}
 
 
 @login_required
@@ -36,71 +220,104 @@ def quote_list(request):
        - Solo favoritas
        - Solo las que tienen imagen
        - Por tema específico
+    3. Pagino con cursor: solo cargo PAGE_SIZE citas por visita
+    4. Las tarjetas salen ya renderizadas de la caché (ver caching.py)
     
     Los filtros vienen en la URL como parámetros GET, por eso uso request.GET
     Ejemplo: /citas/?q=motivacion&favorite_only=on
     
-    OJO: Uso Q() para hacer búsquedas OR (buscar en text O en source)
+    OJO: La búsqueda por texto usa el índice FTS5 (ver search.py)
     """
     # Empiezo con todas las citas del usuario actual
     # .filter(owner=request.user) es súper importante
     # Sin esto, verías las citas de TODOS los usuarios
-    citas = Cita.objects.filter(owner=request.user)
+    # select_related('tag') trae el tema en la misma consulta
+    # (si no, cada {{ cita.tag.name }} del template haría otra consulta)
+    citas = Cita.objects.filter(owner=request.user).select_related('tag')
     
     # Creo el formulario de filtros
     # Le paso request.GET (los parámetros de la URL)
     # Y le paso user=request.user para que solo muestre temas del usuario
     # Si request.GET está vacío, pongo None para que el form esté vacío
     form = QuoteFilterForm(request.GET or None, user=request.user)
+    citas = filter_citas(citas, form)
     
-    # Compruebo si el formulario es válido
-    # Aunque los filtros son opcionales, necesito validar por si hay algo raro
-    if form.is_valid():
-        # === FILTRO DE BÚSQUEDA POR TEXTO ===
-        # Obtengo el valor del campo 'q' (el buscador)
-        q = form.cleaned_data.get('q')
-        
-        # Si el usuario escribió algo en el buscador
-        if q:
-            # Filtro las citas que contengan 'q' en text O en source
-            # icontains = busca sin importar mayúsculas/minúsculas
-            # Q() permite hacer OR (|)
-            # Sin Q() solo podría hacer AND (&)
-            citas = citas.filter(
-                Q(text__icontains=q) | Q(source__icontains=q)
-            )
-        
-        # === FILTRO SOLO FAVORITAS ===
-        # Si marcó el checkbox de "solo favoritas"
-        if form.cleaned_data.get('favorite_only'):
-            # Me quedo solo con las que is_favorite=True
-            citas = citas.filter(is_favorite=True)
-        
-        # === FILTRO SOLO CON IMAGEN ===
-        # Si marcó el checkbox de "solo con imagen"
-        if form.cleaned_data.get('with_image_only'):
-            # exclude(image='') quita las que NO tienen imagen
-            # También podría hacer: filter(image__isnull=False)
-            # Pero exclude me parece más claro
-            citas = citas.exclude(image='')
-        
-        # === FILTRO POR TEMA ===
-        # Obtengo el tema seleccionado (si seleccionó alguno)
-        tag = form.cleaned_data.get('tag')
-        
-        # Si eligió un tema específico
-        if tag:
-            # Filtro solo las citas de ese tema
-            citas = citas.filter(tag=tag)
+    # Solo cargo una página, no todas las citas
+    # (y si ya la había pedido, solo sus ids y las tarjetas de la caché)
+    user_cache = caching.UserCache(request.user.pk)
+    ids, next_cursor, page = _page_ids(request, user_cache, citas)
+    cards = caching.render_cards(request, user_cache, ids, CARD_TEMPLATE, page, csrf=True)
+    next_url, next_fragment_url = _next_page_urls(request, next_cursor)
     
     # Renderizo la plantilla
-    # Le paso las citas (ya filtradas) y el formulario
+    # Le paso las tarjetas de la página (ya filtradas) y el formulario
     return render(request, 'citas/quote_list.html', {
-        'citas': citas,
+        'cards': cards,
+        'total': _cached_count(request, user_cache, citas, form),
         'form': form,
+        'bulk_form': BulkActionForm(user=request.user),
+        'next_url': next_url,
+        'next_fragment_url': next_fragment_url,
     })
 
 
+@login_required
+def quote_list_page(request):
+    """
+    Fragmento HTML con la siguiente página de la lista.
+
+    Es lo que pide main.js cuando llegas al final del grid (scroll infinito).
+    Devuelve solo las tarjetas, sin base.html, para añadirlas al grid.
+
+    Acepta los mismos filtros que quote_list más el ?cursor=
+    """
+    citas = Cita.objects.filter(owner=request.user).select_related('tag')
+    form = QuoteFilterForm(request.GET or None, user=request.user)
+    citas = filter_citas(citas, form)
+    
+    user_cache = caching.UserCache(request.user.pk)
+    ids, next_cursor, page = _page_ids(request, user_cache, citas)
+    cards = caching.render_cards(request, user_cache, ids, CARD_TEMPLATE, page, csrf=True)
+    next_url, next_fragment_url = _next_page_urls(request, next_cursor)
+    
+    return render(request, 'citas/partials/quote_list_page.html', {
+        'cards': cards,
+        'next_url': next_url,
+        'next_fragment_url': next_fragment_url,
+    })
+
+
+@login_required
+def quote_export(request):
+    """
+    Descarga de todas mis citas: ?formato=jsonl (por defecto), csv o zip.
+
+    El zip lleva citas.jsonl y las imágenes. Todo se manda en streaming
+    (ver export.py): aunque tenga 100.000 citas, la memoria no crece.
+    """
+    formato = request.GET.get('formato')
+    if formato not in export.FORMATS:
+        formato = 'jsonl'
+    content_type, extension = export.FORMATS[formato]
+    
+    # using(): el fichero se genera cuando la vista ya ha terminado, fuera
+    # del shard de la petición (ver sharding.py)
+    citas = Cita.objects.using(sharding.db()).filter(owner=request.user)
+    filename = f'cuaderno-{request.user.username}-{timezone.localdate():%Y%m%d}.{extension}'
+    
+    response = StreamingHttpResponse(export.generate(citas, formato), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+def _suggested_temas(owner_id):
+    """El context de render_cards para las tarjetas del inbox: sus temas sugeridos"""
+    def suggested_temas(citas):
+        found = suggestions.suggest(owner_id, citas)
+        return {pk: {'suggestions': temas} for pk, temas in found.items()}
+    return suggested_temas
+
+
 @login_required
 def quote_inbox(request):
     """
@@ -114,49 +331,115 @@ def quote_inbox(request):
     - Luego vienes aquí y les asignas tema
     
     Filtro por tag__isnull=True (que el tag sea NULL en la BD)
+    
+    La lista de ids y las tarjetas se guardan en caché (ver caching.py)
+    
+    Cada tarjeta lleva botones con los temas que le sugiere el
+    clasificador (ver suggestions.py): un clic y queda clasificada.
+    Se calculan todas juntas, y solo las de las tarjetas que no estaban
+    en caché.
     """
     # Obtengo las citas del usuario que NO tienen tema
     # tag__isnull=True significa "donde tag es NULL"
     # Podría hacer filter(tag=None) pero isnull es más explícito
     citas = Cita.objects.filter(owner=request.user, tag__isnull=True)
     
+    user_cache = caching.UserCache(request.user.pk)
+    ids = user_cache.get_or_set(
+        ('inbox',),
+        lambda: list(citas.order_by(*ORDERING).values_list('pk', flat=True)),
+    )
+    # csrf=True: los botones de las sugerencias son formularios POST
+    cards = caching.render_cards(
+        request, user_cache, ids, INBOX_TEMPLATE,
+        csrf=True, context=_suggested_temas(request.user.pk),
+    )
+    
     # Renderizo la plantilla del inbox
     return render(request, 'citas/quote_inbox.html', {
-        'citas': citas,
+        'cards': cards,
+        'bulk_form': BulkActionForm(user=request.user),
     })
 
 
+# ?ambito=tema-<id>: hasta 18 cifras, siempre cabe en un entero de 64 bits
+TEMA_SCOPE_RE = re.compile(r'tema-([0-9]{1,18})')
+
+
+def _random_scope(request):
+    """
+    Lee de la URL de qué citas hay que sacar la aleatoria.
+
+    ?ambito=             -> todas
+    ?ambito=favoritas    -> solo favoritas
+    ?ambito=inbox        -> solo sin clasificar
+    ?ambito=tema-5       -> solo las del tema 5
+
+    Si el valor no es válido uso todas.
+
+    OJO: isdigit() no vale para el id del tema: también da True con
+    dígitos que no son 0-9 ('²', y luego int() falla) y con números que
+    no caben en 64 bits (falla la consulta). Por eso la regex.
+    """
+    ambito = request.GET.get('ambito', '')
+    
+    if ambito == 'favoritas':
+        return random_draw.SCOPE_FAVORITES
+    if ambito == 'inbox':
+        return random_draw.SCOPE_INBOX
+    match = TEMA_SCOPE_RE.fullmatch(ambito)
+    if match:
+        return random_draw.tema_scope(int(match.group(1)))
+    return random_draw.SCOPE_ALL
+
+
 @login_required
 def quote_random(request):
     """
     Muestra una cita aleatoria del usuario.
     
     Me costó un poco esto al principio porque .order_by('?') no me convencía
-    (es lento si tienes muchas citas), así que uso random.choice().
-    
-    Pasos:
-    1. Convierto las citas a lista con list()
-    2. Uso random.choice() de Python para elegir una
-    3. Si no hay citas, pongo None y lo manejo en el template
-    """
-    # Obtengo todas las citas del usuario y las convierto a lista
-    # Convertir a lista es necesario para usar random.choice()
-    # Si uso .order_by('?')[0] sería más "Django" pero más lento
-    citas = list(Cita.objects.filter(owner=request.user))
-    
-    # Si hay al menos una cita
-    if citas:
-        # Elijo una aleatoria
-        # random.choice(lista) devuelve un elemento random de la lista
-        cita = random.choice(citas)
-    else:
-        # Si no hay citas, pongo None
-        # En el template verifico: {% if cita %}
-        cita = None
+    (es lento si tienes muchas citas). Luego lo hice con list() + random.choice(),
+    pero eso cargaba TODAS las citas en memoria para elegir una.
+    
+    Ahora uso random_draw.py, que guarda en caché solo los ids, y la
+    tarjeta de la elegida sale ya renderizada de la caché (caching.py).
+    
+    Opciones (parámetros GET):
+    - ambito: todas, favoritas, inbox o un tema (ver _random_scope)
+    - mazo=1: modo "sin repetir" hasta que salgan todas
+    
+    Debajo van las citas más parecidas a la elegida (ver related.py).
+    
+    Si no hay citas, pongo None y lo manejo en el template.
+    """
+    scope = _random_scope(request)
+    deck = request.GET.get('mazo') == '1'
+    
+    # Elijo una aleatoria (o None si no hay ninguna en ese ámbito)
+    # Solo el id: si su tarjeta está en caché no hace falta cargarla
+    user_cache = caching.UserCache(request.user.pk)
+    template = RANDOM_TEMPLATE
+    cita_id = random_draw.draw_id(request.user.pk, scope, deck=deck)
+    cards = caching.render_cards(request, user_cache, [cita_id], template) if cita_id else []
+    
+    if cita_id and not cards:
+        # La cita se acaba de borrar: draw() lo vuelve a intentar
+        cita = random_draw.draw(request.user.pk, scope, deck=deck)
+        cita_id = cita.pk if cita else None
+        cards = caching.render_cards(request, user_cache, [cita_id], template, {cita_id: cita}) if cita else []
     
     # Renderizo la plantilla
+    # Le paso también los temas para el selector de ámbito
     return render(request, 'citas/quote_random.html', {
-        'cita': cita,
+        'cita_id': cita_id,
+        'card': cards[0] if cards else None,
+        'related': related.similar(request.user.pk, cita_id) if cards else [],
+        'temas': Tema.objects.filter(owner=request.user),
+        'ambito': request.GET.get('ambito', ''),
+        'tema_actual': int(scope[5:]) if scope.startswith('tema:') else None,
+        'mazo': deck,
+        'query': request.GET.urlencode(),
     })
 
 
@@ -196,6 +479,9 @@ def quote_create(request):
             # AHORA sí guardo en la BD
             cita.save()
             
+            # Las miniaturas se generan en segundo plano (ver thumbnails.py)
+            thumbnails.schedule(cita)
+            
             # Mensaje de éxito (se muestra en el siguiente request)
             # success = mensaje verde en Bootstrap
             messages.success(request, 'Contenido añadido correctamente')
@@ -248,9 +534,20 @@ def quote_edit(request, pk):
         
         # Valido
         if form.is_valid():
+            # Si ha cambiado la imagen, las miniaturas viejas ya no valen:
+            # genero las nuevas después de guardar
+            # (los ficheros viejos los borran las señales si ya no los usa
+            # ninguna otra cita, ver image_refs.py)
+            image_changed = 'image' in form.changed_data
+            if image_changed:
+                cita.image_variants = {}
+            
             # Guardo (actualiza el contenido existente)
             # Como ya tiene instance, no necesito asignar owner
-            form.save()
+            cita = form.save()
+            
+            if image_changed:
+                thumbnails.schedule(cita)
             
             # Mensaje de éxito
             messages.success(request, 'Contenido actualizado correctamente')
@@ -269,6 +566,7 @@ def quote_edit(request, pk):
         'form': form,
         'titulo': 'Editar Contenido',
         'cita': cita,  # Por si quiero mostrar algo más en el template
+        'related': related.similar(request.user.pk, cita.pk),
     })
 
 @login_required
@@ -300,6 +598,47 @@ def tema_create(request):
     
     return render(request, 'citas/tema_create.html', {'temas': temas})
 
+def set_favorite(user, pk, favorite):
+    """
+    Marca (favorite=True) o desmarca una cita del usuario.
+
+    Un solo UPDATE con condición, sin cargar la cita:
+
+        UPDATE citas_cita SET is_favorite = 1
+        WHERE id = 5 AND owner_id = 1 AND NOT is_favorite
+
+    Si ya estaba así no cambia ninguna fila y no hago nada más. Así, dos
+    clics seguidos (o dos pestañas) no suman dos veces al contador.
+
+    Como update() no manda señales, actualizo yo el contador de favoritas
+    y la versión de la caché (ver counters.py y caching.py).
+
+    Devuelve True si ha cambiado algo. Http404 si la cita no es suya.
+    """
+    changed = (Cita.objects.filter(pk=pk, owner=user)
+               .exclude(is_favorite=favorite)
+               .update(is_favorite=favorite))
+
+    if changed:
+        counters.add_to_favorites(user.pk, 1 if favorite else -1)
+        caching.bump(user.pk)
+        events.publish(user.pk, events.TOGGLED, id=pk, is_favorite=favorite)
+    elif not Cita.objects.filter(pk=pk, owner=user).exists():
+        raise Http404('Cita no encontrada')
+
+    return bool(changed)
+
+
+def _favorite_from_post(request):
+    """El valor de 'favorite' del POST ('1' o '0'), o None si no viene"""
+    value = request.POST.get('favorite')
+    if value in ('1', 'true', 'on'):
+        return True
+    if value in ('0', 'false', 'off'):
+        return False
+    return None
+
+
 @login_required
 def quote_toggle_favorite(request, pk):
     """
@@ -312,6 +651,9 @@ def quote_toggle_favorite(request, pk):
     - Si is_favorite=False, lo pone a True
     
     Después redirige de vuelta a la página donde estabas.
+
+    Con JavaScript el botón de la tarjeta usa quote_favorite_api (abajo) y
+    no recarga la página. Esta se queda para cuando no hay JS.
     
     OJO: Solo POST porque cambiar el estado de algo debe ser POST, no GET.
     Si fuera GET, un bot podría marcar/desmarcar tus favoritos solo visitando URLs.
@@ -319,20 +661,17 @@ def quote_toggle_favorite(request, pk):
     # Solo permito POST
     # Si alguien intenta con GET (escribiendo la URL en el navegador), no pasa nada
     if request.method == 'POST':
-        # Obtengo la cita (verifico que sea del usuario)
-        cita = get_object_or_404(Cita, pk=pk, owner=request.user)
-        
-        # Cambio el valor de is_favorite
-        # not True = False
-        # not False = True
-        # Es como un switch on/off
-        cita.is_favorite = not cita.is_favorite
-        
-        # Guardo los cambios en la BD
-        cita.save()
+        # El formulario de la tarjeta manda el estado que quiere (favorite=1/0).
+        # Si no lo manda (formularios antiguos), le doy la vuelta al actual
+        favorite = _favorite_from_post(request)
+        if favorite is None:
+            cita = get_object_or_404(Cita.objects.only('is_favorite'), pk=pk, owner=request.user)
+            favorite = not cita.is_favorite
+
+        set_favorite(request.user, pk, favorite)
         
         # Mensaje según el nuevo estado
-        if cita.is_favorite:
+        if favorite:
             messages.success(request, 'Cita marcada como favorita ⭐')
         else:
             messages.info(request, 'Cita desmarcada de favoritas')
@@ -341,4 +680,126 @@ def quote_toggle_favorite(request, pk):
     # request.META.get('HTTP_REFERER') = la URL de donde vino
     # Si no existe, redirijo a la lista por defecto
     # Esto es útil porque puedes marcar favorito desde la lista, inbox o random
-    return redirect(request.META.get('HTTP_REFERER', 'citas:quote_list'))
\ No newline at end of file
+    return redirect(request.META.get('HTTP_REFERER', 'citas:quote_list'))
+
+
+@login_required
+@require_POST
+def quote_favorite_api(request, pk):
+    """
+    Lo mismo que quote_toggle_favorite pero en JSON, para main.js.
+
+    Recibe favorite=1 (marcar) o favorite=0 (desmarcar) y devuelve:
+
+        {"id": 5, "is_favorite": true, "changed": true}
+
+    changed=false si ya estaba así. No uso messages aquí: el mensaje se
+    quedaría guardado y saldría en la siguiente página que cargues.
+    """
+    favorite = _favorite_from_post(request)
+    if favorite is None:
+        return JsonResponse({'error': 'Falta favorite (1 o 0)'}, status=400)
+
+    changed = set_favorite(request.user, pk, favorite)
+    return JsonResponse({'id': pk, 'is_favorite': favorite, 'changed': changed})
+
+
+@login_required
+@require_GET
+def quote_autocomplete(request):
+    """
+    Sugerencias para los campos de fuente y tema, en JSON (para main.js).
+
+    Parámetros: field=source|tema, q=lo que lleva escrito, limit (opcional)
+
+        {"results": [{"value": "Nietzsche", "count": 12}, ...]}
+
+    Los temas llevan además "id". Sale del índice en memoria de
+    autocomplete.py: normalmente sin tocar la BD.
+    """
+    field = request.GET.get('field')
+    if field not in autocomplete.FIELDS:
+        return JsonResponse({'error': 'field tiene que ser source o tema'}, status=400)
+
+    try:
+        limit = int(request.GET.get('limit', autocomplete.LIMIT))
+    except ValueError:
+        limit = autocomplete.LIMIT
+
+    results = autocomplete.suggest(request.user.pk, field, request.GET.get('q', ''), max(limit, 1))
+    return JsonResponse({'results': results})
+
+
+@login_required
+@require_GET
+def quote_card(request, pk):
+    """
+    El HTML de una sola tarjeta, para cambiarla en el grid sin recargar.
+
+    La pide main.js cuando llega un cambio de otra pestaña (ver events.py).
+    ?tipo=lista (por defecto), inbox o aleatoria: la misma plantilla que
+    en esa página, así que normalmente sale de la caché.
+
+    404 si no es tuya (o ya no existe). Con tipo=inbox, 204 si ya tiene
+    tema: ya no va en el inbox y main.js la quita.
+    """
+    template, csrf = LIVE_CARDS.get(request.GET.get('tipo'), LIVE_CARDS['lista'])
+    cita = Cita.objects.filter(pk=pk, owner=request.user).values('tag_id').first()
+    if cita is None:
+        raise Http404('Cita no encontrada')
+    if template == INBOX_TEMPLATE and cita['tag_id'] is not None:
+        return HttpResponse(status=204)
+
+    user_cache = caching.UserCache(request.user.pk)
+    context = _suggested_temas(request.user.pk) if template == INBOX_TEMPLATE else None
+    cards = caching.render_cards(request, user_cache, [pk], template, csrf=csrf, context=context)
+    if not cards:
+        raise Http404('Cita no encontrada')
+    return HttpResponse(cards[0])
+
+
+# Mensajes de quote_bulk_action según la acción
+BULK_MESSAGES = {
+    bulk.CLASSIFY: '{n} cita(s) movida(s) {destino}',
+    bulk.FAVORITE: '{n} cita(s) marcada(s) como favoritas ⭐',
+    bulk.UNFAVORITE: '{n} cita(s) desmarcada(s) de favoritas',
+    bulk.DELETE: '{n} cita(s) borrada(s)',
+}
+
+
+@login_required
+@require_POST
+def quote_bulk_action(request):
+    """
+    Acciones en bloque: la barra de arriba de la lista y del inbox.
+    
+    Recibe la acción, el tema (si es "Mover al tema") y los ids de las
+    citas marcadas, y lo hace todo con unas pocas consultas (ver bulk.py).
+    Clasificar 500 citas del inbox pasa de 1500 peticiones a una.
+    
+    Las citas que no son del usuario se ignoran (todas las consultas
+    llevan owner=request.user).
+    
+    Después vuelve a la página donde estaba (el campo oculto next).
+    """
+    form = BulkActionForm(request.POST, user=request.user)
+    
+    if form.is_valid():
+        action = form.cleaned_data['action']
+        tema = form.cleaned_data['tema']
+        affected = bulk.run(request.user.pk, action, form.cleaned_data['ids'], tema)
+        
+        messages.success(request, BULK_MESSAGES[action].format(
+            n=affected,
+            destino=f'al tema "{tema.name}"' if tema else 'al Inbox',
+        ))
+    else:
+        for errors in form.errors.values():
+            for error in errors:
+                messages.error(request, error)
+    
+    # Solo redirijo a URLs de esta web (que no me usen para mandar a otra)
+    next_url = request.POST.get('next', '')
+    if not url_has_allowed_host_and_scheme(next_url, allowed_hosts={request.get_host()}):
+        next_url = 'citas:quote_list'
+    return redirect(next_url)
@@ -14,4 +14,7 @@ urlpatterns = [
     
     # Página about
     path('about/', views.about, name='about'),
+
+    # Métricas para Prometheus (solo staff)
+    path('metrics/', views.metrics, name='metrics'),
 ]
\ No newline at end of file
@@ -3,10 +3,19 @@ Vistas de la app core.
 
 Son las páginas públicas del sitio (home y about).
 Súper simples, solo renderean templates sin más lógica.
+
+Y /metrics/, que no es pública: las métricas para Prometheus.
 """
 
+import hmac
+
+from django.conf import settings
+from django.contrib.auth.views import redirect_to_login
+from django.http import HttpResponse, HttpResponseForbidden
 from django.shortcuts import render
 
+from citas import metrics as citas_metrics
+
 
 def home(request):
     """
@@ -27,4 +36,25 @@ def about(request):
     Explico qué es esto, qué tecnologías usé, etc.
     También pública, cualquiera puede verla.
     """
-    return render(request, 'core/about.html')
\ No newline at end of file
+    return render(request, 'core/about.html')
+
+
+def metrics(request):
+    """
+    Las métricas de todos los procesos en el formato de texto de
+    Prometheus (ver citas/metrics.py).
+
+    Solo para staff: dicen qué páginas se usan y cuánto tardan. Para el
+    que las recoge (que no tiene sesión) vale también la cabecera
+    "Authorization: Bearer <CITAS_METRICS_TOKEN>", si hay token.
+    """
+    token = getattr(settings, 'CITAS_METRICS_TOKEN', '')
+    sent = request.headers.get('Authorization', '')
+    with_token = token and hmac.compare_digest(sent.encode(), f'Bearer {token}'.encode())
+    if not with_token:
+        if not request.user.is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        if not request.user.is_staff:
+            return HttpResponseForbidden()
+
+    return HttpResponse(citas_metrics.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -13,4 +13,7 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cuaderno_citas.settings')
 
+# Con ASGI uso las vistas async de citas (ver CITAS_ASYNC_VIEWS en settings.py)
+os.environ.setdefault('CITAS_ASYNC_VIEWS', '1')
+
 application = get_asgi_application()
@@ -10,6 +10,10 @@ CREDENCIALES PARA PROBAR:
 
 """
 
+import copy
+import os
+import sys
+import tempfile
 from pathlib import Path
 
 # Esta es la ruta base del proyecto
@@ -55,10 +59,12 @@ INSTALLED_APPS = [
 # Van en orden, es importante no cambiarlos de sitio
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'citas.timing.ServerTimingMiddleware',  # Tiempos de BD/plantillas y presupuestos (ver abajo)
     'django.contrib.sessions.middleware.SessionMiddleware',  # Necesario para login
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',  # Protección contra CSRF
     'django.contrib.auth.middleware.AuthenticationMiddleware',  # Para que funcione request.user
+    'citas.sharding.ShardMiddleware',  # El shard del usuario (solo con CITAS_SHARDS)
     'django.contrib.messages.middleware.MessageMiddleware',  # Para messages.success(), etc.
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -70,7 +76,9 @@ ROOT_URLCONF = 'cuaderno_citas.urls'
 # Configuración de templates (los HTML)
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # El de Django (DjangoTemplates) midiendo lo que tarda cada plantilla
+        # (ver citas/timing.py)
+        'BACKEND': 'citas.timing.TimedTemplates',
         
         # DIRS es para templates globales (como base.html)
         # Los puse en /templates/ en la raíz del proyecto
@@ -86,6 +94,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',  # Añade 'request'
                 'django.contrib.auth.context_processors.auth',  # Añade 'user' y 'perms'
                 'django.contrib.messages.context_processors.messages',  # Añade 'messages'
+                'citas.context_processors.contadores',  # Añade 'contador_citas'
             ],
         },
     },
@@ -96,14 +105,86 @@ WSGI_APPLICATION = 'cuaderno_citas.wsgi.application'
 
 # Base de datos
 # Uso SQLite porque es lo más fácil para desarrollo
-# El archivo se crea en la raíz: db.sqlite3
+# El archivo se crea en la raíz: db.sqlite3 (CITAS_DB_NAME para usar otro,
+# lo usa bench_sqlite)
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.environ.get('CITAS_DB_NAME') or BASE_DIR / 'db.sqlite3',
     }
 }
 
+# Perfil de producción de SQLite. Con la configuración de siempre, al
+# guardar citas desde varias peticiones a la vez salía "database is
+# locked" y las lecturas esperaban a las escrituras. Ahora cada conexión
+# nueva ejecuta estos PRAGMA:
+# - journal_mode=WAL: los que leen no bloquean al que escribe ni al revés
+#   (se queda guardado en el fichero)
+# - busy_timeout: si otro está escribiendo, espera hasta 20 s en vez de
+#   fallar enseguida
+# - synchronous=NORMAL: con WAL no se pierde la BD si se va la luz (como
+#   mucho las últimas transacciones) y cada COMMIT no espera al disco
+# - mmap_size: lee el fichero mapeado en memoria (256 MB)
+# - cache_size: 64 MB de caché de páginas por conexión (negativo = KB)
+# - auto_vacuum=INCREMENTAL: el espacio de lo borrado se puede devolver
+#   al disco poco a poco (sqlite_maintenance). Solo cuenta en una BD
+#   nueva; en las que ya hay lo activa `sqlite_maintenance --enable-incremental`
+# - temp_store: las tablas temporales (ORDER BY sin índice...) en memoria
+# Y además:
+# - transaction_mode IMMEDIATE: las transacciones piden el candado de
+#   escritura al empezar. Con DEFERRED, dos que leen y luego escriben se
+#   bloquean entre ellas y SQLite falla sin esperar al busy_timeout
+# - CONN_MAX_AGE: las conexiones se reutilizan entre peticiones (10 min),
+#   así no se repiten los PRAGMA en cada una
+# CITAS_DB_PROFILE=default deja SQLite como viene (para comparar con
+# `python manage.py bench_sqlite`)
+CITAS_DB_PROFILE = os.environ.get('CITAS_DB_PROFILE', 'production')
+
+SQLITE_PRAGMAS = {
+    # El primero: después de crear el fichero (WAL lo crea) ya no cambia
+    'auto_vacuum': 'INCREMENTAL',
+    'journal_mode': 'WAL',
+    'busy_timeout': 20000,
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64000,
+    'temp_store': 'MEMORY',
+}
+
+if CITAS_DB_PROFILE == 'production':
+    DATABASES['default'].update({
+        'OPTIONS': {
+            'init_command': ';'.join(f'PRAGMA {name} = {value}' for name, value in SQLITE_PRAGMAS.items()),
+            'transaction_mode': 'IMMEDIATE',
+        },
+        'CONN_MAX_AGE': 600,
+        # Si la conexión guardada ha dejado de funcionar, abre otra
+        'CONN_HEALTH_CHECKS': True,
+    })
+
+# Reparto de las citas entre varias BD (ver citas/sharding.py)
+# Con CITAS_SHARDS=N los temas y las citas de cada usuario van a una de N
+# BD más (shard_0, shard_1... en db_shard_0.sqlite3, db_shard_1.sqlite3...,
+# con el mismo perfil que default). Usuarios y sesiones siguen en default.
+# 0 = todo en default, como siempre. Al crear los shards:
+#     python manage.py migrate --database shard_0   (y los demás)
+# Los tests se ejecutan siempre con 2, para probar el reparto
+TESTING = sys.argv[1:2] == ['test']
+CITAS_SHARDS = int(os.environ.get('CITAS_SHARDS', 2 if TESTING else 0))
+
+# Los tests ponen en un directorio temporal lo que va a ficheros (la caché
+# shared...) y lo borran al terminar
+TEST_RUNNER = 'cuaderno_citas.test_runner.TestRunner'
+
+for number in range(CITAS_SHARDS):
+    _name = Path(DATABASES['default']['NAME'])
+    DATABASES[f'shard_{number}'] = {
+        **copy.deepcopy(DATABASES['default']),
+        'NAME': _name.with_name(f'{_name.stem}_shard_{number}{_name.suffix}'),
+    }
+
+DATABASE_ROUTERS = ['citas.sharding.ShardRouter']
+
 
 # Validación de contraseñas
 # Django comprueba que las contraseñas no sean tontas
@@ -160,6 +241,30 @@ LOGIN_REDIRECT_URL = '/citas/'
 # Después de logout, te manda aquí
 LOGOUT_REDIRECT_URL = '/'
 
+# Peticiones de alguien logueado sin tocar la BD. Antes cada página hacía
+# (antes de llegar a la vista) un SELECT de la sesión y otro del usuario,
+# y cada messages.success() volvía a guardar la sesión:
+# - Sesiones cached_db: se leen de la caché shared (ver CACHES) y solo se
+#   guardan en la BD al cambiar. Si se vacía la caché se vuelven a leer de
+#   la BD, no se pierde nadie. Tiene que ser la shared: con la de cada
+#   proceso, al cerrar sesión en un worker los otros seguirían teniendo
+#   la sesión en su caché.
+#   Otra opción sin BD ninguna: 'django.contrib.sessions.backends.signed_cookies'
+#   (la sesión va firmada en la cookie; no se puede cerrar desde el servidor)
+# - El usuario en caché: accounts/backends.py, también en la shared (se
+#   borra al guardarlo, por ejemplo al cambiar la contraseña, y todos los
+#   procesos tienen que enterarse). Si la shared es LocMem no lo guarda.
+#   ModelBackend va detrás para las sesiones de antes, que lo tienen
+#   apuntado (si no se quitara de la lista, habría que volver a entrar)
+# - Los mensajes van en una cookie firmada, no en la sesión
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+SESSION_CACHE_ALIAS = 'shared'
+AUTHENTICATION_BACKENDS = [
+    'accounts.backends.CachedModelBackend',
+    'django.contrib.auth.backends.ModelBackend',
+]
+MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
+
 
 # === CRISPY FORMS ===
 # Para que los formularios se vean bonitos con Bootstrap
@@ -168,4 +273,104 @@ CRISPY_TEMPLATE_PACK = "bootstrap5"
 
 
 # Tipo de campo para las IDs automáticas
-DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
\ No newline at end of file
+DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# === APP CITAS ===
+
+# Mostrar "N elemento(s) encontrado(s)" en la lista (el número se guarda en caché)
+CITAS_SHOW_COUNT = True
+
+# Campos máximos por petición (Django pone 1000 para frenar peticiones
+# enormes). Las acciones en bloque mandan un campo por cita marcada
+# (ids=1&ids=2...), y en el inbox se pueden marcar todas
+DATA_UPLOAD_MAX_NUMBER_FIELDS = 10000
+
+# Vistas async (citas/async_views.py) para la lista, el inbox, la
+# aleatoria y marcar favoritas. asgi.py las activa (CITAS_ASYNC_VIEWS=1);
+# con WSGI (runserver, gunicorn...) van las normales de views.py
+CITAS_ASYNC_VIEWS = os.environ.get('CITAS_ASYNC_VIEWS') == '1'
+
+# Hilos que generan las miniaturas de las imágenes en segundo plano
+CITAS_THUMBNAIL_WORKERS = 2
+
+# Cachés:
+# - default: tarjetas renderizadas, listas de ids, citas aleatorias...
+#   En memoria del proceso, con límite de tamaño: cuando se llena tira lo
+#   que lleva más tiempo sin usarse (ver citas/cache_backends.py). Cada
+#   worker tiene la suya, y no pasa nada: todo va con la versión del
+#   usuario en la clave.
+#   Para compartirla entre varios procesos se puede usar la de ficheros:
+#       'BACKEND': 'citas.cache_backends.LRUFileBasedCache',
+#       'LOCATION': BASE_DIR / 'cache' / 'default',
+# - shared: lo que TIENEN que ver todos los procesos igual: las versiones
+#   de la caché de cada usuario (citas/caching.py), las sesiones y los
+#   usuarios (ver arriba). Si un worker sube la versión y los demás no se
+#   enteran, siguen enseñando lo de antes.
+#   Ficheros en CITAS_SHARED_CACHE_DIR, o Redis con CITAS_REDIS_URL
+#   (mejor con muchos procesos; necesita el paquete redis)
+CITAS_SHARED_CACHE_DIR = os.environ.get('CITAS_SHARED_CACHE_DIR', BASE_DIR / 'cache' / 'shared')
+CITAS_REDIS_URL = os.environ.get('CITAS_REDIS_URL', '')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'citas.cache_backends.LRULocMemCache',
+        'LOCATION': 'cuaderno-citas',
+        'OPTIONS': {
+            'MAX_ENTRIES': 50000,
+            'MAX_BYTES': 64 * 1024 * 1024,  # 64 MB
+        },
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': CITAS_SHARED_CACHE_DIR,
+        # Por defecto son 300 y al pasarse tira un tercio al azar
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
+
+if CITAS_REDIS_URL:
+    CACHES['shared'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': CITAS_REDIS_URL,
+    }
+
+# Tiempos de cada petición (ver citas/timing.py): consultas y tiempo de
+# BD, plantillas y total. Con CITAS_SERVER_TIMING van en la cabecera
+# Server-Timing (el navegador los enseña en la pestaña Red); mejor no en
+# producción, dice cuánto tarda cada cosa a cualquiera
+CITAS_SERVER_TIMING = DEBUG
+
+# Presupuesto de cada URL (por su nombre; '*' para las demás): si una
+# petición hace más consultas o tarda más, se apunta en el log
+# 'citas.timing'. repeats: veces que se puede repetir la misma consulta
+# antes de avisar de un posible N+1
+# Las páginas con la caché llena no hacen ninguna; los números son para la
+# caché vacía (sesión, usuario, contadores...), que ronda las 5-15
+CITAS_REQUEST_BUDGETS = {
+    '*': {'queries': 30, 'ms': 500, 'repeats': 5},
+    'citas:quote_list': {'queries': 20, 'ms': 300},
+    'citas:quote_list_page': {'queries': 20, 'ms': 300},
+    'citas:quote_inbox': {'queries': 25, 'ms': 300},
+    'citas:quote_random': {'queries': 20, 'ms': 300},
+    'citas:quote_card': {'queries': 8, 'ms': 100},
+    'citas:quote_autocomplete': {'queries': 6, 'ms': 100},
+    'citas:quote_favorite_api': {'queries': 10, 'ms': 200},
+    # Guardar una cita pone al día contadores, huellas, vectores... y el
+    # export y las acciones en bloque dependen de cuántas citas haya
+    'citas:quote_create': {'queries': 40, 'ms': 1000},
+    'citas:quote_edit': {'queries': 40, 'ms': 1000},
+    'citas:quote_bulk_action': {'queries': 60, 'ms': 3000},
+    'citas:quote_export': {'ms': 5000},
+}
+
+# Métricas en /metrics/ (formato de Prometheus, ver citas/metrics.py):
+# peticiones, tiempos y errores por URL, consultas y aciertos de la caché.
+# Cada proceso escribe en un fichero suyo de CITAS_METRICS_DIR y la página
+# los suma, así salen bien con varios workers. Al desplegar se puede vaciar
+# el directorio (si no, se siguen sumando los de los procesos de antes)
+# Solo la ven los usuarios staff, o quien mande
+# "Authorization: Bearer <CITAS_METRICS_TOKEN>" (para el que las recoge)
+CITAS_METRICS = True
+# (los tests usan uno temporal suyo, ver cuaderno_citas/test_runner.py)
+CITAS_METRICS_DIR = os.environ.get('CITAS_METRICS_DIR', Path(tempfile.gettempdir()) / 'cuaderno-citas-metrics')
+CITAS_METRICS_TOKEN = os.environ.get('CITAS_METRICS_TOKEN', '')
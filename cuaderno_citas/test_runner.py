@@ -0,0 +1,32 @@
+"""
+El test runner de Django con un directorio temporal para los tests.
+
+Lo que en desarrollo va a ficheros (la caché shared, ver CACHES en
+settings.py, y las métricas de cada proceso, CITAS_METRICS_DIR) en los
+tests va a un directorio temporal que se borra al terminar. Así no se
+mezcla con lo de runserver ni quedan ficheros de cada ejecución.
+"""
+
+import shutil
+import tempfile
+from pathlib import Path
+
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+
+
+class TestRunner(DiscoverRunner):
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.temp_dir = Path(tempfile.mkdtemp(prefix='cuaderno-citas-tests-'))
+        # La caché todavía no se ha abierto: basta con cambiar la ruta
+        if settings.CACHES['shared']['BACKEND'].endswith('FileBasedCache'):
+            settings.CACHES['shared']['LOCATION'] = str(self.temp_dir / 'cache')
+        # Las métricas tampoco: el fichero del proceso se abre al apuntar la
+        # primera petición (ver metrics._process_values)
+        settings.CITAS_METRICS_DIR = self.temp_dir / 'metrics'
+
+    def teardown_test_environment(self, **kwargs):
+        super().teardown_test_environment(**kwargs)
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
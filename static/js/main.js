@@ -1,21 +1,390 @@
 /*
  * JavaScript del proyecto
- * Por ahora solo confirmación al desmarcar favoritos
+ * - Confirmación al desmarcar favoritos
+ * - Marcar/desmarcar favoritos sin recargar la página
+ * - Acciones en bloque: marcar todas, contador y confirmar al borrar
+ * - Sugerencias al escribir la fuente y el tema
+ * - Scroll infinito en la lista de citas
+ * - Cambios en directo de las otras pestañas (Server-Sent Events)
+ * - Quitar el placeholder borroso cuando carga la imagen
  */
 
-document.addEventListener('DOMContentLoaded', function() {
-    // Confirmar antes de quitar de favoritos
-    const favoriteButtons = document.querySelectorAll('form[action*="toggle-favorite"] button');
-    
-    favoriteButtons.forEach(button => {
-        button.addEventListener('click', function(e) {
-            // Si tiene la estrella llena (es favorita)
-            if (this.textContent.includes('★')) {
-                // Pregunto antes de quitar
-                if (!confirm('¿Quitar de favoritas?')) {
-                    e.preventDefault();
+// Confirmar antes de quitar de favoritos
+// Lo hago con delegación (en document) para que también funcione
+// en las tarjetas que llegan después con el scroll infinito
+document.addEventListener('click', function(e) {
+    const button = e.target.closest('form[action*="toggle-favorite"] button');
+    
+    // Si tiene la estrella llena (es favorita)
+    if (button && button.textContent.includes('★')) {
+        // Pregunto antes de quitar
+        if (!confirm('¿Quitar de favoritas?')) {
+            e.preventDefault();
+        }
+    }
+});
+
+
+/*
+ * Favoritos sin recargar
+ *
+ * El formulario de la estrella lleva data-api-url: en vez de enviarlo
+ * (POST + redirección + volver a cargar toda la lista) mando los mismos
+ * datos a la API en JSON y cambio la tarjeta aquí: la estrella, el valor
+ * que se mandará la próxima vez y la etiqueta "Favorita".
+ *
+ * Si la confirmación de arriba se cancela, el submit ni llega.
+ * Si la petición falla, envío el formulario normal.
+ */
+function updateFavoriteCard(form, isFavorite) {
+    const button = form.querySelector('button');
+    button.textContent = isFavorite ? '★' : '☆';
+    form.querySelector('input[name="favorite"]').value = isFavorite ? '0' : '1';
+    
+    const badge = form.closest('.card').querySelector('[data-favorite-badge]');
+    if (badge) {
+        badge.classList.toggle('d-none', !isFavorite);
+    }
+}
+
+document.addEventListener('submit', function(e) {
+    const form = e.target.closest('form[data-api-url]');
+    if (!form || !window.fetch) {
+        return;
+    }
+    e.preventDefault();
+    
+    const button = form.querySelector('button');
+    button.disabled = true;
+    
+    fetch(form.dataset.apiUrl, {
+        method: 'POST',
+        body: new FormData(form),  // lleva el csrfmiddlewaretoken
+        headers: {'X-Requested-With': 'XMLHttpRequest'},
+        credentials: 'same-origin',
+    })
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(response.status);
+            }
+            return response.json();
+        })
+        .then(data => updateFavoriteCard(form, data.is_favorite))
+        .catch(() => form.submit())
+        .finally(() => { button.disabled = false; });
+});
+
+
+/*
+ * Acciones en bloque (bulk_actions.html)
+ *
+ * Sin JavaScript ya funcionan (los checkboxes van con form="bulk-form").
+ * Esto solo añade "Marcar todas", el número de marcadas y una
+ * confirmación antes de borrar.
+ */
+function bulkCheckboxes() {
+    return document.querySelectorAll('input[name="ids"][form="bulk-form"]');
+}
+
+function updateBulkCount() {
+    const count = document.querySelector('[data-bulk-count]');
+    if (count) {
+        const checked = Array.from(bulkCheckboxes()).filter(box => box.checked).length;
+        count.textContent = checked ? checked + ' marcada(s)' : '';
+    }
+}
+
+document.addEventListener('change', function(e) {
+    if (e.target.matches('[data-bulk-select-all]')) {
+        bulkCheckboxes().forEach(box => { box.checked = e.target.checked; });
+    }
+    if (e.target.matches('[data-bulk-select-all], input[name="ids"][form="bulk-form"]')) {
+        updateBulkCount();
+    }
+});
+
+document.addEventListener('submit', function(e) {
+    if (e.target.id !== 'bulk-form') {
+        return;
+    }
+    const action = e.target.querySelector('select[name="action"]').value;
+    const checked = Array.from(bulkCheckboxes()).filter(box => box.checked).length;
+    
+    if (action === 'delete' && !confirm('¿Borrar ' + checked + ' cita(s)? No se puede deshacer.')) {
+        e.preventDefault();
+    }
+});
+
+
+/*
+ * Autocompletar (AutocompleteInput y TemaAutocomplete en forms.py)
+ *
+ * Los inputs con data-autocomplete piden sugerencias a la API mientras
+ * escribes (esperando un poco entre teclas) y las meten en su <datalist>.
+ *
+ * El del tema lleva además data-autocomplete-target: el input oculto
+ * donde va el id del tema. Si lo escrito es el nombre de una sugerencia
+ * pongo su id; si no, lo dejo vacío (sin tema / todos los temas).
+ */
+let autocompleteTimer = null;
+
+function autocompleteTarget(input) {
+    return input.dataset.autocompleteTarget && document.getElementById(input.dataset.autocompleteTarget);
+}
+
+function updateAutocompleteTarget(input) {
+    const target = autocompleteTarget(input);
+    if (!target) {
+        return;
+    }
+    const list = document.getElementById(input.getAttribute('list'));
+    const match = Array.from(list.options).find(option => option.value === input.value);
+    if (match) {
+        target.value = match.dataset.id;
+    } else if (!input.value) {
+        target.value = '';
+    }
+}
+
+function fetchSuggestions(input) {
+    const url = new URL(input.dataset.autocompleteUrl, window.location.href);
+    url.searchParams.set('field', input.dataset.autocomplete);
+    url.searchParams.set('q', input.value);
+    
+    fetch(url, {headers: {'X-Requested-With': 'XMLHttpRequest'}, credentials: 'same-origin'})
+        .then(response => response.json())
+        .then(data => {
+            const list = document.getElementById(input.getAttribute('list'));
+            list.replaceChildren(...data.results.map(result => {
+                const option = document.createElement('option');
+                option.value = result.value;
+                option.label = result.count + ' cita(s)';
+                if (result.id !== undefined) {
+                    option.dataset.id = result.id;
                 }
+                return option;
+            }));
+            updateAutocompleteTarget(input);
+        })
+        .catch(() => {});
+}
+
+document.addEventListener('input', function(e) {
+    const input = e.target.closest('input[data-autocomplete]');
+    if (!input || !window.fetch) {
+        return;
+    }
+    // Si se ha elegido una sugerencia, el id ya está en el datalist
+    const target = autocompleteTarget(input);
+    if (target) {
+        target.value = '';
+        updateAutocompleteTarget(input);
+    }
+    clearTimeout(autocompleteTimer);
+    autocompleteTimer = setTimeout(() => fetchSuggestions(input), 150);
+});
+
+// Al entrar en el campo vacío enseño las más usadas
+document.addEventListener('focusin', function(e) {
+    const input = e.target.closest('input[data-autocomplete]');
+    if (input && window.fetch && !input.value) {
+        fetchSuggestions(input);
+    }
+});
+
+
+// Cuando una imagen termina de cargar, quito el placeholder de fondo
+// (si no, se vería detrás de las imágenes con transparencia)
+// 'load' no burbujea, por eso lo escucho en fase de captura (true)
+document.addEventListener('load', function(e) {
+    if (e.target.tagName === 'IMG' && e.target.hasAttribute('data-placeholder')) {
+        e.target.style.backgroundImage = 'none';
+    }
+}, true);
+
+
+/*
+ * Scroll infinito
+ *
+ * Al final del grid hay un <div class="next-page" data-fragment-url="...">
+ * con un enlace "Cargar más". Cuando ese div entra en pantalla pido el
+ * fragmento HTML de la página siguiente, meto las tarjetas en el grid
+ * y cambio el div por el nuevo (que apunta a la página de después).
+ *
+ * Sin JavaScript el enlace "Cargar más" sigue funcionando normal.
+ */
+function loadNextPage(observer, sentinel) {
+    observer.unobserve(sentinel);
+    
+    fetch(sentinel.dataset.fragmentUrl, {headers: {'X-Requested-With': 'XMLHttpRequest'}})
+        .then(response => response.text())
+        .then(html => {
+            const template = document.createElement('template');
+            template.innerHTML = html;
+            
+            // Las tarjetas van al grid
+            const grid = document.querySelector('.masonry-grid');
+            template.content.querySelectorAll('.masonry-item').forEach(item => grid.appendChild(item));
+            
+            // El nuevo "Cargar más" sustituye al anterior (o desaparece si era la última página)
+            const next = template.content.querySelector('.next-page');
+            if (next) {
+                sentinel.replaceWith(next);
+                observer.observe(next);
+            } else {
+                sentinel.remove();
+            }
+        })
+        .catch(() => {
+            // Si falla la petición dejo el enlace para que pueda hacer clic
+            observer.observe(sentinel);
+        });
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+    const sentinel = document.querySelector('.next-page[data-fragment-url]');
+    
+    if (!sentinel || !('IntersectionObserver' in window)) {
+        return;
+    }
+    
+    // rootMargin: empiezo a cargar un poco antes de llegar al final
+    const observer = new IntersectionObserver(entries => {
+        entries.forEach(entry => {
+            if (entry.isIntersecting) {
+                loadNextPage(observer, entry.target);
             }
         });
+    }, {rootMargin: '600px'});
+    
+    observer.observe(sentinel);
+});
+
+
+/*
+ * Cambios en directo (citas/events.py)
+ *
+ * Si la página tiene tarjetas (un contenedor con data-live) abro un
+ * EventSource a /citas/api/events/. Cada evento dice qué cita ha
+ * cambiado en otra pestaña y aquí cambio solo esa tarjeta:
+ * - toggled: la estrella y la etiqueta "Favorita"
+ * - updated: pido la tarjeta nueva a /citas/api/card/<id>/ y la cambio
+ *   (en el inbox, si ya tiene tema, la quito)
+ * - created: la añado al principio (solo donde hay data-live-new)
+ * - deleted: la quito
+ * - resync: demasiados cambios; aviso para recargar
+ *
+ * Si se corta, el navegador reconecta solo (y manda Last-Event-ID para
+ * recibir lo que se ha perdido). Con WSGI el servidor contesta 204 y el
+ * EventSource se cierra sin más.
+ */
+function liveCard(container, id) {
+    return container.querySelector('[data-cita-id="' + id + '"]');
+}
+
+function fetchCard(container, id) {
+    const url = new URL(document.body.dataset.cardUrl.replace('/0/', '/' + id + '/'), window.location.href);
+    url.searchParams.set('tipo', container.dataset.live);
+    
+    return fetch(url, {headers: {'X-Requested-With': 'XMLHttpRequest'}, credentials: 'same-origin'})
+        .then(response => {
+            // 204: ya no va en esta página; 404: ya no existe
+            if (response.status === 204 || response.status === 404) {
+                return null;
+            }
+            if (!response.ok) {
+                throw new Error(response.status);
+            }
+            return response.text().then(html => {
+                const template = document.createElement('template');
+                template.innerHTML = html.trim();
+                return template.content.firstElementChild;
+            });
+        });
+}
+
+function refreshCard(container, id, insert) {
+    fetchCard(container, id)
+        .then(card => {
+            const old = liveCard(container, id);
+            if (!card) {
+                if (old) {
+                    old.remove();
+                }
+                return;
+            }
+            if (old) {
+                // Si estaba marcada para una acción en bloque, lo sigue estando
+                const box = old.querySelector('input[name="ids"]');
+                const newBox = card.querySelector('input[name="ids"]');
+                if (box && newBox) {
+                    newBox.checked = box.checked;
+                }
+                old.replaceWith(card);
+            } else if (insert) {
+                container.prepend(card);
+            }
+        })
+        .catch(() => {});
+}
+
+function showResync() {
+    if (document.querySelector('[data-live-resync]')) {
+        return;
+    }
+    const alert = document.createElement('div');
+    alert.className = 'alert alert-info';
+    alert.dataset.liveResync = '';
+    alert.textContent = 'Hay cambios hechos en otra pestaña. ';
+    
+    const link = document.createElement('a');
+    link.href = window.location.href;
+    link.textContent = 'Recargar';
+    alert.appendChild(link);
+    document.querySelector('main').prepend(alert);
+}
+
+function handleLiveEvent(container, kind, data) {
+    const card = liveCard(container, data.id);
+    const canInsert = container.dataset.liveNew !== undefined
+        && (container.dataset.live !== 'inbox' || data.tag === null);
+    
+    if (kind === 'toggled' && card) {
+        const form = card.querySelector('form[data-api-url]');
+        if (form) {
+            updateFavoriteCard(form, data.is_favorite);
+        } else {
+            refreshCard(container, data.id, false);
+        }
+    } else if (kind === 'updated') {
+        const inbox = container.dataset.live === 'inbox';
+        if (inbox && data.tag !== null) {
+            // Ya tiene tema: fuera del inbox
+            if (card) {
+                card.remove();
+            }
+        } else if (card || (inbox && canInsert)) {
+            // En el inbox puede aparecer una que no estaba (le han quitado el tema)
+            refreshCard(container, data.id, inbox);
+        }
+    } else if (kind === 'created' && !card && canInsert) {
+        refreshCard(container, data.id, true);
+    } else if (kind === 'deleted' && card) {
+        card.remove();
+    }
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+    const container = document.querySelector('[data-live]');
+    const url = document.body.dataset.eventsUrl;
+    
+    if (!container || !url || !('EventSource' in window)) {
+        return;
+    }
+    
+    const source = new EventSource(url);
+    ['created', 'updated', 'toggled', 'deleted'].forEach(kind => {
+        source.addEventListener(kind, e => handleLiveEvent(container, kind, JSON.parse(e.data)));
     });
-});
\ No newline at end of file
+    source.addEventListener('resync', showResync);
+});